@@ -0,0 +1,276 @@
+"""
+Circuit Breakers
+
+This module stops sending work to a model that is failing. Each (model, task) pair has a
+breaker that watches the outcome of recent calls:
+
+- closed: calls flow normally. When enough recent calls failed (5xx, 429, dropped streams)
+  or were slow to produce their first chunk, the breaker opens.
+- open: calls are refused immediately (ComponentService fails over to the fallback model or
+  raises CircuitOpenError, rendered as 503 + Retry-After) until the cool-down elapses.
+- half-open: a few probe calls are let through; success closes the breaker, a failure
+  reopens it with a longer cool-down.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .errors import CircuitOpenError
+from .retry_policy import INVALID, classify_error
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Error-rate and latency driven breaker for one (model, task) pair.
+
+    Args:
+        name: Label used in logs and metrics.
+        window_s: Outcomes older than this are forgotten.
+        min_calls: Calls in the window needed before the breaker may open.
+        failure_threshold: Failure ratio in the window that opens the breaker.
+        slow_call_s: Time to first chunk above which a successful call counts as slow.
+        slow_threshold: Slow-call ratio in the window that opens the breaker.
+        open_s: Initial cool-down; doubled (up to `max_open_s`) each time a probe fails.
+        half_open_probes: Concurrent probe calls allowed while half-open.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window_s: float = 60.0,
+        min_calls: int = 10,
+        failure_threshold: float = 0.5,
+        slow_call_s: float = 20.0,
+        slow_threshold: float = 0.8,
+        open_s: float = 15.0,
+        max_open_s: float = 120.0,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.window_s = window_s
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call_s = slow_call_s
+        self.slow_threshold = slow_threshold
+        self.base_open_s = open_s
+        self.max_open_s = max_open_s
+        self.half_open_probes = half_open_probes
+
+        self.state = CLOSED
+        self._open_s = open_s
+        self._opened_at = 0.0
+        self._probes = 0
+        self._outcomes: Deque[Tuple[float, bool, bool]] = deque()  # (time, failed, slow)
+        self._lock = threading.Lock()
+
+        self.rejected = 0
+        self.times_opened = 0
+
+    # --- Admission ---
+
+    def allow(self) -> bool:
+        """True if a call may be made now (a half-open breaker admits a limited number of probes)."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self._open_s:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+                logger.info(f"Circuit {self.name} half-open: probing the model again.")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def refusing(self) -> bool:
+        """True while open and still cooling down (does not consume a probe)."""
+        return self.state == OPEN and time.monotonic() - self._opened_at < self._open_s
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker will admit a probe."""
+        if self.state != OPEN:
+            return 1.0
+        return max(self._open_s - (time.monotonic() - self._opened_at), 1.0)
+
+    # --- Outcomes ---
+
+    def record_success(self, latency_s: float = 0.0) -> None:
+        """A call completed (or started streaming) after `latency_s` to first chunk."""
+        self._record(failed=False, slow=latency_s > self.slow_call_s)
+
+    def record_failure(self) -> None:
+        """A call failed for a reason attributable to the model (5xx, 429, dropped stream)."""
+        self._record(failed=True, slow=False)
+
+    def record_outcome(self, error: Optional[BaseException], latency_s: Optional[float]) -> None:
+        """
+        Records how a call ended.
+
+        Args:
+            error: The exception the call failed with, if any. Invalid requests (4xx other
+                than 429) say nothing about the model's health and are not counted.
+            latency_s: Time to first chunk, or None if the call was abandoned before any output.
+        """
+        if error is not None:
+            if classify_error(error) == INVALID:
+                self.release()
+            else:
+                self.record_failure()
+        elif latency_s is None:
+            self.release()
+        else:
+            self.record_success(latency_s)
+
+    def release(self) -> None:
+        """A call ended without an outcome (cancelled, or rejected as invalid); frees a probe slot."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._open(now, escalate=True)
+                else:
+                    logger.info(f"Circuit {self.name} closed: probe call succeeded.")
+                    self.state = CLOSED
+                    self._open_s = self.base_open_s
+                    self._outcomes.clear()
+                return
+            if self.state == OPEN:
+                return  # Late outcome of a call admitted before the breaker opened
+            self._outcomes.append((now, failed, slow))
+            self._trim(now)
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, _, s in self._outcomes if s)
+            if failures / calls >= self.failure_threshold or slow_calls / calls >= self.slow_threshold:
+                logger.warning(f"Circuit {self.name} opened: {failures}/{calls} failed, {slow_calls}/{calls} slow in the last {self.window_s:.0f}s.")
+                self._open(now, escalate=False)
+
+    def _open(self, now: float, escalate: bool) -> None:
+        if escalate:
+            self._open_s = min(self._open_s * 2, self.max_open_s)
+            logger.warning(f"Circuit {self.name} re-opened for {self._open_s:.0f}s: probe call failed.")
+        self.state = OPEN
+        self._opened_at = now
+        self._probes = 0
+        self._outcomes.clear()
+        self.times_opened += 1
+
+    def _trim(self, now: float) -> None:
+        while self._outcomes and now - self._outcomes[0][0] > self.window_s:
+            self._outcomes.popleft()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._trim(time.monotonic())
+            calls = len(self._outcomes)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failure_rate": round(sum(1 for _, f, _ in self._outcomes if f) / calls, 3) if calls else 0.0,
+                "retry_after_s": round(self.retry_after(), 1) if self.state == OPEN else None,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class CircuitBreakers:
+    """
+    Breakers keyed by (model, task), created on first use with shared settings.
+
+    Args:
+        fallback_model: Model used while a breaker for the primary model is open (None disables failover).
+        **settings: CircuitBreaker keyword arguments applied to every breaker.
+    """
+
+    def __init__(self, fallback_model: Optional[str] = None, **settings: Any):
+        self.fallback_model = fallback_model
+        self._settings = settings
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self.failovers = 0
+
+    def get(self, model: str, task: Optional[str]) -> CircuitBreaker:
+        key = (model, task or "default")
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(f"{key[0]}/{key[1]}", **self._settings)
+        return breaker
+
+    def select(self, model: str, task: Optional[str]) -> Tuple[str, CircuitBreaker]:
+        """
+        Picks the model for a call: `model` if its breaker admits the call, else the fallback.
+
+        Raises:
+            CircuitOpenError: Neither the model nor the fallback is accepting calls.
+        """
+        breaker = self.get(model, task)
+        if breaker.allow():
+            return model, breaker
+        if self.fallback_model and self.fallback_model != model:
+            fallback = self.get(self.fallback_model, task)
+            if fallback.allow():
+                self.failovers += 1
+                logger.warning(f"Circuit {breaker.name} is open; routing {task or 'call'} to fallback model {self.fallback_model}.")
+                return self.fallback_model, fallback
+        raise CircuitOpenError(f"Model {model} is temporarily unavailable for {task or 'requests'} (circuit open).", breaker.retry_after())
+
+    def check(self, model: str, task: Optional[str]) -> None:
+        """
+        Endpoint pre-check that does not consume a half-open probe.
+
+        Raises:
+            CircuitOpenError: The model's breaker is open (and still cooling down) with no usable fallback.
+        """
+        breaker = self.get(model, task)
+        if not breaker.refusing():
+            return
+        if self.fallback_model and self.fallback_model != model and not self.get(self.fallback_model, task).refusing():
+            return
+        raise CircuitOpenError(f"Model {model} is temporarily unavailable for {task or 'requests'} (circuit open).", breaker.retry_after())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Breaker states for /api/metrics."""
+        return {
+            "fallback_model": self.fallback_model,
+            "failovers": self.failovers,
+            "breakers": {breaker.name: breaker.snapshot() for breaker in self._breakers.values()},
+        }
+
+
+def create_circuit_breakers() -> CircuitBreakers:
+    """
+    Builds the breaker registry from the environment: MORPHEO_FALLBACK_MODEL,
+    MORPHEO_BREAKER_FAILURE_THRESHOLD, MORPHEO_BREAKER_MIN_CALLS, MORPHEO_BREAKER_SLOW_CALL_SECONDS,
+    MORPHEO_BREAKER_OPEN_SECONDS.
+    """
+    fallback_model = os.getenv("MORPHEO_FALLBACK_MODEL") or None
+    try:
+        return CircuitBreakers(
+            fallback_model=fallback_model,
+            failure_threshold=float(os.getenv("MORPHEO_BREAKER_FAILURE_THRESHOLD", 0.5)),
+            min_calls=int(os.getenv("MORPHEO_BREAKER_MIN_CALLS", 10)),
+            slow_call_s=float(os.getenv("MORPHEO_BREAKER_SLOW_CALL_SECONDS", 20)),
+            open_s=float(os.getenv("MORPHEO_BREAKER_OPEN_SECONDS", 15)),
+        )
+    except ValueError:
+        logger.warning("Invalid MORPHEO_BREAKER_* setting; using defaults.")
+        return CircuitBreakers(fallback_model=fallback_model)
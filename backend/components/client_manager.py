@@ -0,0 +1,185 @@
+"""
+Shared Model Client
+
+This module owns the one model client the process uses. Building a google-genai client and
+opening its first connection (DNS, TCP, TLS) costs tens to hundreds of milliseconds, so it is
+done once at startup instead of on the request path:
+
+- The client is created once and handed to ComponentService and to the endpoints that use
+  the Files API.
+- Its HTTP connections come from pools owned here (httpx, for both the sync and async
+  surfaces) with explicit limits and keep-alive, so connections are reused across requests.
+- `warm()` opens a connection at startup with a cheap authenticated call.
+- `aclose()` closes the pools on shutdown, after in-flight streams have finished.
+
+The synthetic, record and replay backends (see model_backend) are built through the same
+manager, so they are shared the same way.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+import google.genai as genai
+from google.genai import types as genai_types
+
+from .model_backend import MODEL_BACKEND_ENV, create_model_client
+
+logger = logging.getLogger(__name__)
+
+
+class ClientManager:
+    """
+    Process-wide model client with a tuned HTTP connection pool.
+
+    Args:
+        backend: Model backend ("gemini", "synthetic", "record", "replay"); MORPHEO_MODEL_BACKEND when omitted.
+        max_connections: Upper bound on open connections per pool.
+        max_keepalive_connections: Idle connections kept open for reuse.
+        keepalive_expiry_s: How long an idle connection is kept.
+        connect_timeout_s: Timeout for opening a connection (reads are left to the streaming deadline).
+        warm_model: Model looked up by `warm()` to open the first connection.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[str] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry_s: float = 120.0,
+        connect_timeout_s: float = 10.0,
+        warm_model: str = "gemini-2.0-flash",
+    ):
+        self.backend = (backend or os.getenv(MODEL_BACKEND_ENV, "gemini")).strip().lower()
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_s,
+        )
+        self.timeout = httpx.Timeout(None, connect=connect_timeout_s)
+        self.warm_model = warm_model
+        self._client: Any = None
+        self._http: Optional[httpx.Client] = None
+        self._async_http: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+        self.build_s: Optional[float] = None
+        self.warm_s: Optional[float] = None
+        self.warm_error: Optional[str] = None
+        self.closed = False
+
+    @property
+    def uses_http_pool(self) -> bool:
+        return self.backend in ("gemini", "record")
+
+    def _gemini_client(self) -> genai.Client:
+        self._http = httpx.Client(limits=self.limits, timeout=self.timeout)
+        self._async_http = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return genai.Client(http_options=genai_types.HttpOptions(httpx_client=self._http, httpx_async_client=self._async_http))
+
+    def get(self) -> Any:
+        """The shared client, built on first use. Raises if it cannot be built (e.g. no API key)."""
+        if self._client is not None:
+            return self._client
+        with self._lock:
+            if self._client is None:
+                if self.closed:
+                    raise RuntimeError("The model client manager has been shut down.")
+                start = time.perf_counter()
+                self._client = create_model_client(self.backend, gemini_factory=self._gemini_client if self.uses_http_pool else None)
+                self.build_s = time.perf_counter() - start
+                logger.info(f"Shared model client ({type(self._client).__name__}) built in {self.build_s * 1000:.0f} ms.")
+        return self._client
+
+    async def warm(self, model: Optional[str] = None) -> bool:
+        """
+        Builds the client and opens its first upstream connection, off the request path.
+
+        Never raises: a failed warm-up is logged and the first request connects instead.
+
+        Args:
+            model: Model to look up for the warm-up call (default: `warm_model`).
+
+        Returns:
+            True if the client is ready and (for the real API) a connection was opened.
+        """
+        start = time.perf_counter()
+        try:
+            client = await asyncio.to_thread(self.get)
+            if self.uses_http_pool:
+                await client.aio.models.get(model=model or self.warm_model)
+        except Exception as e:
+            self.warm_error = str(e)
+            logger.warning(f"Model client warm-up failed; the first request will connect instead: {e}")
+            return False
+        self.warm_s = time.perf_counter() - start
+        self.warm_error = None
+        logger.info(f"Model client warmed in {self.warm_s * 1000:.0f} ms.")
+        return True
+
+    async def aclose(self) -> None:
+        """Closes the connection pools. Safe to call more than once."""
+        with self._lock:
+            self.closed = True
+            http, async_http = self._http, self._async_http
+            self._http = self._async_http = None
+        if async_http is not None:
+            await async_http.aclose()
+        if http is not None:
+            await asyncio.to_thread(http.close)
+        if http is not None or async_http is not None:
+            logger.info("Model client connection pools closed.")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Client and connection pool settings and warm-up timing, for /api/metrics."""
+        return {
+            "backend": self.backend,
+            "built": self._client is not None,
+            "closed": self.closed,
+            "build_ms": round(self.build_s * 1000, 1) if self.build_s is not None else None,
+            "warm_ms": round(self.warm_s * 1000, 1) if self.warm_s is not None else None,
+            "warm_error": self.warm_error,
+            "pool": {
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+                "keepalive_expiry_s": self.limits.keepalive_expiry,
+            } if self.uses_http_pool else None,
+        }
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}; using default {default}.")
+        return default
+
+
+def create_client_manager() -> ClientManager:
+    """
+    Builds the manager from the environment: MORPHEO_HTTP_MAX_CONNECTIONS,
+    MORPHEO_HTTP_MAX_KEEPALIVE, MORPHEO_HTTP_KEEPALIVE_SECONDS, MORPHEO_HTTP_CONNECT_TIMEOUT_SECONDS.
+    """
+    return ClientManager(
+        max_connections=int(_env_number("MORPHEO_HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(_env_number("MORPHEO_HTTP_MAX_KEEPALIVE", 20)),
+        keepalive_expiry_s=_env_number("MORPHEO_HTTP_KEEPALIVE_SECONDS", 120),
+        connect_timeout_s=_env_number("MORPHEO_HTTP_CONNECT_TIMEOUT_SECONDS", 10),
+    )
+
+
+_manager: Optional[ClientManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_client_manager() -> ClientManager:
+    """The process-wide client manager (created on first use)."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = create_client_manager()
+    return _manager
@@ -0,0 +1,434 @@
+"""
+Adaptive Concurrency Limiter
+
+This module bounds the number of concurrent upstream model calls. The limit adapts AIMD-style:
+it grows additively while calls succeed at normal latency and shrinks multiplicatively when
+the model answers 429 / RESOURCE_EXHAUSTED or time-to-first-token degrades well beyond its
+observed baseline.
+
+Callers over the limit wait in a bounded queue with a deadline. When the queue is full the
+limiter refuses immediately with OverloadedError (HTTP 503 + Retry-After), so a burst sheds
+load at the edge instead of piling up streams that the model will reject anyway.
+
+The wait queue is a FairQueue: freed slots go to the highest priority class first
+(interactive tool calls, then generations, then suggestions) and, within a class, to users in
+deficit round-robin order, so one user with many queued requests cannot starve the others.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+from .errors import OverloadedError
+
+logger = logging.getLogger(__name__)
+
+
+class Permit:
+    """One admitted upstream call. Release it exactly once when the call ends."""
+
+    def __init__(self, limiter: "AdaptiveLimiter"):
+        self._limiter = limiter
+        self.started_at = time.monotonic()
+        self.first_chunk_at: Optional[float] = None
+        self._released = False
+
+    def mark_first_chunk(self) -> None:
+        """Records time-to-first-chunk, the latency signal used to adapt the limit."""
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.monotonic()
+
+    def time_to_first_chunk(self) -> Optional[float]:
+        """Seconds from admission to the first chunk, or None if no chunk arrived."""
+        return None if self.first_chunk_at is None else self.first_chunk_at - self.started_at
+
+    def release(self, rate_limited: bool = False, failed: bool = False) -> None:
+        """
+        Frees the slot and feeds the outcome back into the limit.
+
+        Args:
+            rate_limited: The upstream answered 429 / RESOURCE_EXHAUSTED.
+            failed: The call failed for another reason (no latency sample is taken).
+        """
+        if self._released:
+            return
+        self._released = True
+        self._limiter._on_release(self, rate_limited, failed)
+
+
+# Scheduling classes in priority order, and the class each service task belongs to
+PRIORITY_CLASSES = ("interactive", "generation", "suggestion")
+
+TASK_CLASSES: Dict[str, str] = {
+    "chat": "interactive",
+    "image_analysis": "interactive",
+    "video_analysis": "interactive",
+    "audio_analysis": "interactive",
+    "generation": "generation",
+    "modification": "generation",
+    "correction": "generation",
+    "image_generation": "generation",
+    "suggestion": "suggestion",
+}
+
+
+def task_class(task: Optional[str]) -> str:
+    """Scheduling class for a service task name (unknown tasks are scheduled as generations)."""
+    return TASK_CLASSES.get(task or "", "generation")
+
+
+class _QueueEntry:
+    __slots__ = ("future", "user", "priority", "cost", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, user: str, priority: int, cost: float):
+        self.future = future
+        self.user = user
+        self.priority = priority
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+
+
+class _ClassQueue:
+    """Per-user FIFO queues of one priority class, served in deficit round-robin order."""
+
+    def __init__(self, quantum: float):
+        self.quantum = quantum
+        self.users: "collections.OrderedDict[str, Deque[_QueueEntry]]" = collections.OrderedDict()
+        self.deficits: Dict[str, float] = {}
+        self.size = 0
+
+    def push(self, entry: _QueueEntry) -> None:
+        if entry.user not in self.users:
+            self.users[entry.user] = collections.deque()
+            self.deficits[entry.user] = 0.0
+        self.users[entry.user].append(entry)
+        self.size += 1
+
+    def oldest(self) -> Optional[float]:
+        return min((queue[0].enqueued_at for queue in self.users.values() if queue), default=None)
+
+    def pop(self) -> Optional[_QueueEntry]:
+        while self.users:
+            user, queue = next(iter(self.users.items()))
+            if self.deficits[user] >= queue[0].cost:
+                entry = queue.popleft()
+                self.deficits[user] -= entry.cost
+                self.size -= 1
+                if not queue:
+                    del self.users[user]
+                    del self.deficits[user]
+                return entry
+            # Not enough credit for this user's next request: top up and move to the back
+            self.deficits[user] += self.quantum
+            self.users.move_to_end(user)
+        return None
+
+    def remove(self, entry: _QueueEntry) -> bool:
+        queue = self.users.get(entry.user)
+        if queue is None or entry not in queue:
+            return False
+        queue.remove(entry)
+        self.size -= 1
+        if not queue:
+            del self.users[entry.user]
+            del self.deficits[entry.user]
+        return True
+
+
+class FairQueue:
+    """
+    Wait queue with strict priority across classes and deficit round-robin across users.
+
+    Args:
+        quantum: Credit a user receives per round; a request costs `cost` credits (default 1).
+        max_starvation_s: A lower-priority request that has waited this long is served ahead of
+            higher classes, so background work still makes progress under sustained load.
+    """
+
+    def __init__(self, quantum: float = 1.0, max_starvation_s: float = 5.0):
+        self.max_starvation_s = max_starvation_s
+        self._classes: List[_ClassQueue] = [_ClassQueue(quantum) for _ in PRIORITY_CLASSES]
+        self._entries: Dict[asyncio.Future, _QueueEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def push(self, future: asyncio.Future, user: str, priority_class: str, cost: float = 1.0) -> None:
+        entry = _QueueEntry(future, user, PRIORITY_CLASSES.index(priority_class), cost)
+        self._entries[future] = entry
+        self._classes[entry.priority].push(entry)
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """Removes and returns the next waiter to admit (None when empty)."""
+        now = time.monotonic()
+        order = list(range(len(self._classes)))
+        for index in reversed(order[1:]):
+            oldest = self._classes[index].oldest()
+            if oldest is not None and now - oldest >= self.max_starvation_s:
+                order.remove(index)
+                order.insert(0, index)
+                break
+        for index in order:
+            entry = self._classes[index].pop()
+            if entry is not None:
+                del self._entries[entry.future]
+                return entry.future
+        return None
+
+    def remove(self, future: asyncio.Future) -> None:
+        entry = self._entries.pop(future, None)
+        if entry is not None:
+            self._classes[entry.priority].remove(entry)
+
+    def lowest_below(self, priority_class: str) -> Optional[asyncio.Future]:
+        """Newest waiter of the lowest class strictly below `priority_class` (the first to shed)."""
+        threshold = PRIORITY_CLASSES.index(priority_class)
+        for index in range(len(self._classes) - 1, threshold, -1):
+            entries = [entry for queue in self._classes[index].users.values() for entry in queue]
+            if entries:
+                return max(entries, key=lambda entry: entry.enqueued_at).future
+        return None
+
+    def depths(self) -> Dict[str, int]:
+        return {name: self._classes[index].size for index, name in enumerate(PRIORITY_CLASSES)}
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter with a bounded, deadline-aware wait queue.
+
+    Args:
+        initial_limit: Starting concurrency limit.
+        min_limit: The limit never drops below this.
+        max_limit: The limit never grows above this.
+        queue_size: Maximum callers waiting for a slot; further callers are rejected.
+        queue_timeout_s: Longest a caller waits for a slot before being rejected.
+        max_starvation_s: Wait after which a lower-priority request is served ahead of higher classes.
+        latency_tolerance: Time-to-first-chunk above baseline * tolerance counts as congestion.
+        latency_slack_s: Minimum excess over the baseline that counts as congestion (ignores jitter on fast calls).
+        backoff: Multiplicative decrease factor applied on a 429.
+        name: Label used in logs and metrics.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        queue_size: int = 32,
+        queue_timeout_s: float = 10.0,
+        max_starvation_s: float = 5.0,
+        latency_tolerance: float = 2.0,
+        latency_slack_s: float = 0.25,
+        backoff: float = 0.7,
+        name: str = "gemini",
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout_s = queue_timeout_s
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack_s = latency_slack_s
+        self.backoff = backoff
+        self.name = name
+
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._waiters = FairQueue(max_starvation_s=max_starvation_s)
+        self._baseline_latency: Optional[float] = None
+        self._avg_latency: Optional[float] = None
+        self._avg_duration: Optional[float] = None
+        self._last_decrease = float("-inf")
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.shed = 0
+        self.rate_limited = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    # --- Admission ---
+
+    def check_admission(self, task: Optional[str] = None) -> None:
+        """
+        Fast pre-check for endpoints, called before a response starts streaming.
+
+        Args:
+            task: Service task name; a full queue still admits a task that outranks a queued one.
+
+        Raises:
+            OverloadedError: Every slot is busy and the wait queue is full.
+        """
+        if self._in_flight >= self.limit and len(self._waiters) >= self.queue_size:
+            if self._waiters.lowest_below(task_class(task)) is not None:
+                return
+            self.rejected_full += 1
+            raise OverloadedError(f"Model capacity exhausted ({self._in_flight} running, {len(self._waiters)} queued).", self.retry_after())
+
+    async def acquire(self, timeout: Optional[float] = None, task: Optional[str] = None, user: Optional[str] = None, cost: float = 1.0) -> Permit:
+        """
+        Waits for a slot.
+
+        Args:
+            timeout: Maximum wait in seconds (defaults to `queue_timeout_s`).
+            task: Service task name, which selects the priority class (see TASK_CLASSES).
+            user: Caller identity for per-user fairness (anonymous callers share one queue).
+            cost: Relative cost of the request for deficit round-robin accounting.
+
+        Returns:
+            A Permit that must be released when the upstream call ends.
+
+        Raises:
+            OverloadedError: The queue is full, the request was shed in favour of a higher
+                priority one, or no slot freed up before the deadline.
+        """
+        if self._in_flight < self.limit and not self._waiters:
+            return self._admit()
+        priority_class = task_class(task)
+        self.check_admission(task)
+        if len(self._waiters) >= self.queue_size:
+            self._shed(self._waiters.lowest_below(priority_class))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.push(waiter, user or "anonymous", priority_class, cost)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout_s if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            self.rejected_timeout += 1
+            raise OverloadedError("Timed out waiting for model capacity.", self.retry_after()) from None
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the caller went away
+            if waiter.done() and not waiter.cancelled():
+                self._in_flight -= 1
+                self._wake()
+            self._discard(waiter)
+            raise
+        return Permit(self)
+
+    def retry_after(self) -> float:
+        """Estimated seconds until a new request would be admitted."""
+        service_time = self._avg_duration or 2.0
+        backlog = (len(self._waiters) + 1) / max(self._limit, 1.0)
+        return min(max(service_time * backlog, 1.0), 60.0)
+
+    # --- Internals ---
+
+    def _admit(self) -> Permit:
+        self._in_flight += 1
+        self.admitted += 1
+        return Permit(self)
+
+    def _discard(self, waiter: asyncio.Future) -> None:
+        self._waiters.remove(waiter)
+
+    def _shed(self, waiter: asyncio.Future) -> None:
+        """Rejects a queued lower-priority waiter to make room for a higher-priority request."""
+        self._waiters.remove(waiter)
+        if not waiter.done():
+            self.shed += 1
+            waiter.set_exception(OverloadedError("Request shed in favour of higher-priority work.", self.retry_after()))
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.pop()
+            if waiter is None or waiter.done():
+                continue
+            self._in_flight += 1
+            self.admitted += 1
+            waiter.set_result(True)
+
+    def _on_release(self, permit: Permit, rate_limited: bool, failed: bool) -> None:
+        now = time.monotonic()
+        saturated = self._in_flight >= self.limit or bool(self._waiters)
+        self._in_flight -= 1
+
+        if rate_limited:
+            self.rate_limited += 1
+            self._decrease(now, self.backoff, "upstream rate limit")
+        elif not failed:
+            duration = now - permit.started_at
+            latency = (permit.first_chunk_at or now) - permit.started_at
+            self._avg_duration = duration if self._avg_duration is None else 0.8 * self._avg_duration + 0.2 * duration
+            self._avg_latency = latency if self._avg_latency is None else 0.8 * self._avg_latency + 0.2 * latency
+            # Slowly drifting minimum, so the baseline follows genuine shifts in model latency
+            if self._baseline_latency is None or latency < self._baseline_latency:
+                self._baseline_latency = latency
+            else:
+                self._baseline_latency *= 1.01
+            congestion_threshold = max(self._baseline_latency * self.latency_tolerance, self._baseline_latency + self.latency_slack_s)
+            if self._avg_latency > congestion_threshold:
+                self._decrease(now, 0.9, f"time-to-first-chunk {self._avg_latency:.2f}s")
+            elif saturated and self._limit < self.max_limit:
+                self._limit = min(self._limit + 1.0 / self._limit, float(self.max_limit))
+        self._wake()
+
+    def _decrease(self, now: float, factor: float, reason: str) -> None:
+        # One decrease per observed latency window, so a burst of 429s counts as a single signal
+        if now - self._last_decrease < max(self._avg_latency or 0.0, 1.0):
+            return
+        self._last_decrease = now
+        previous = self._limit
+        self._limit = max(self._limit * factor, float(self.min_limit))
+        if int(previous) != int(self._limit):
+            logger.warning(f"Limiter '{self.name}': limit {int(previous)} -> {int(self._limit)} ({reason}).")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters for /api/metrics."""
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "queue_depth": len(self._waiters),
+            "queue_depth_by_class": self._waiters.depths(),
+            "queue_size": self.queue_size,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "shed_for_priority": self.shed,
+            "rate_limited": self.rate_limited,
+            "avg_first_chunk_s": round(self._avg_latency, 3) if self._avg_latency is not None else None,
+            "baseline_first_chunk_s": round(self._baseline_latency, 3) if self._baseline_latency is not None else None,
+        }
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_limiter() -> AdaptiveLimiter:
+    """
+    Builds the model-call limiter from the environment: MORPHEO_CONCURRENCY_INITIAL,
+    MORPHEO_CONCURRENCY_MIN, MORPHEO_CONCURRENCY_MAX, MORPHEO_QUEUE_SIZE, MORPHEO_QUEUE_TIMEOUT_SECONDS,
+    MORPHEO_QUEUE_MAX_STARVATION_SECONDS.
+    """
+    return AdaptiveLimiter(
+        initial_limit=int(_env_number("MORPHEO_CONCURRENCY_INITIAL", 8)),
+        min_limit=int(_env_number("MORPHEO_CONCURRENCY_MIN", 1)),
+        max_limit=int(_env_number("MORPHEO_CONCURRENCY_MAX", 64)),
+        queue_size=int(_env_number("MORPHEO_QUEUE_SIZE", 32)),
+        queue_timeout_s=_env_number("MORPHEO_QUEUE_TIMEOUT_SECONDS", 10.0),
+        max_starvation_s=_env_number("MORPHEO_QUEUE_MAX_STARVATION_SECONDS", 5.0),
+    )
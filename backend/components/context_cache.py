@@ -0,0 +1,289 @@
+"""
+Upstream Context Caching
+
+This module keeps the static part of a prompt (the WC prompt template) on the model side as
+cached content (`client.aio.caches`), so requests send only their per-request suffix and
+reference the cached prefix by name.
+
+- Handles are keyed by (model, template hash). The first request for a key creates the
+  handle (concurrent requests wait for that one creation); later requests reuse it.
+- Handles are created with a TTL. A request that finds its handle close to expiry extends
+  the TTL; an expired or rejected handle is dropped and recreated on the next request.
+- Prefixes below the minimum cacheable size, clients without a caches API and models that
+  refuse to cache fall back to sending the whole prompt inline. So do requests with tools
+  (grounding): the API does not accept `tools` together with `cached_content`.
+
+Whether explicit or implicit (upstream reuse of a prompt prefix shared with recent requests),
+the cached share of each prompt is reported in the response usage metadata; PromptUsage
+tallies it per task, with first-chunk latency split by cache hits and misses.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from .token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Cached input tokens are billed at a quarter of the regular input rate
+CACHED_TOKEN_DISCOUNT = 0.75
+
+
+def prefix_digest(text: str) -> str:
+    """Content hash of a static prefix (the cache key's template half)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def is_stale_handle_error(error: BaseException) -> bool:
+    """True if an upstream error says the referenced cached content no longer exists."""
+    code = getattr(error, "code", None)
+    message = str(getattr(error, "message", None) or error).lower()
+    return code in (403, 404) and "cachedcontent" in message.replace(" ", "").replace("_", "")
+
+
+@dataclass
+class CacheHandle:
+    name: str
+    model: str
+    digest: str
+    tokens: int
+    expires_at: float  # time.monotonic() deadline
+    created_at: float
+
+
+@dataclass
+class ContextCacheStats:
+    hits: int = 0          # Requests that referenced a live handle
+    inline: int = 0        # Requests that sent the prefix inline (no usable handle)
+    created: int = 0
+    refreshed: int = 0
+    expired: int = 0
+    invalidated: int = 0   # Handles dropped because upstream rejected them
+    failures: int = 0      # Failed create/refresh calls
+
+    def as_dict(self) -> Dict[str, Any]:
+        served = self.hits + self.inline
+        return {
+            "hits": self.hits,
+            "inline": self.inline,
+            "hit_rate": round(self.hits / served, 3) if served else 0.0,
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "failures": self.failures,
+        }
+
+
+class ContextCache:
+    """
+    Cached-content handles for static prompt prefixes.
+
+    Args:
+        enabled: When False every request sends its prefix inline.
+        ttl_s: Lifetime requested for new handles, and for refreshed ones.
+        refresh_margin_s: A handle used within this many seconds of expiry has its TTL extended.
+        min_tokens: Prefixes smaller than this are not cached (the upstream minimum for caching).
+        retry_after_failure_s: After a failed creation, the model is not tried again for this long.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        ttl_s: float = 3600.0,
+        refresh_margin_s: float = 300.0,
+        min_tokens: int = 4096,
+        retry_after_failure_s: float = 600.0,
+    ):
+        self.enabled = enabled
+        self.ttl_s = ttl_s
+        self.refresh_margin_s = refresh_margin_s
+        self.min_tokens = min_tokens
+        self.retry_after_failure_s = retry_after_failure_s
+        self.stats = ContextCacheStats()
+        self._handles: Dict[Tuple[str, str], CacheHandle] = {}
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._unavailable_until: Dict[str, float] = {}
+
+    @staticmethod
+    def _caches(client: Any) -> Any:
+        return getattr(getattr(client, "aio", None), "caches", None)
+
+    async def handle_for(self, client: Any, model: str, prefix: str) -> Optional[str]:
+        """
+        Name of a live cached-content handle holding `prefix` for `model`, or None to send it inline.
+
+        Never raises: any upstream failure falls back to inline.
+        """
+        caches = self._caches(client)
+        if not self.enabled or not prefix or caches is None or time.monotonic() < self._unavailable_until.get(model, 0.0):
+            self.stats.inline += 1
+            return None
+        key = (model, prefix_digest(prefix))
+        now = time.monotonic()
+        handle = self._handles.get(key)
+        if handle is not None and now >= handle.expires_at:
+            logger.info(f"Context cache {handle.name} for {model} expired.")
+            self._handles.pop(key, None)
+            self.stats.expired += 1
+            handle = None
+        if handle is not None and handle.expires_at - now < self.refresh_margin_s:
+            handle = await self._refresh(caches, key, handle)
+        if handle is None:
+            handle = await self._create_once(caches, key, prefix)
+        if handle is None:
+            self.stats.inline += 1
+            return None
+        self.stats.hits += 1
+        return handle.name
+
+    async def _create_once(self, caches: Any, key: Tuple[str, str], prefix: str) -> Optional[CacheHandle]:
+        """Creates the handle for `key`, sharing one in-flight creation between concurrent requests."""
+        task = self._pending.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._pending[key] = asyncio.ensure_future(self._create(caches, key, prefix))
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done() and self._pending.get(key) is task:
+                del self._pending[key]
+
+    async def _create(self, caches: Any, key: Tuple[str, str], prefix: str) -> Optional[CacheHandle]:
+        model, digest = key
+        tokens = count_tokens(prefix)
+        if tokens < self.min_tokens:
+            return None
+        try:
+            cached = await caches.create(model=model, config={
+                "contents": [{"role": "user", "parts": [{"text": prefix}]}],
+                "display_name": f"morpheo-{digest[:12]}",
+                "ttl": f"{int(self.ttl_s)}s",
+            })
+        except Exception as e:
+            self.stats.failures += 1
+            self._unavailable_until[model] = time.monotonic() + self.retry_after_failure_s
+            logger.warning(f"Context cache creation for {model} failed; sending the template inline for {self.retry_after_failure_s:.0f}s: {e}")
+            return None
+        now = time.monotonic()
+        usage = getattr(cached, "usage_metadata", None)
+        handle = CacheHandle(
+            name=cached.name,
+            model=model,
+            digest=digest,
+            tokens=getattr(usage, "total_token_count", None) or tokens,
+            expires_at=now + self.ttl_s,
+            created_at=now,
+        )
+        self._handles[key] = handle
+        self.stats.created += 1
+        logger.info(f"Context cache {handle.name} created for {model} (template {digest[:12]}, ~{handle.tokens:,} tokens, ttl {self.ttl_s:.0f}s).")
+        return handle
+
+    async def _refresh(self, caches: Any, key: Tuple[str, str], handle: CacheHandle) -> Optional[CacheHandle]:
+        try:
+            await caches.update(name=handle.name, config={"ttl": f"{int(self.ttl_s)}s"})
+        except Exception as e:
+            self.stats.failures += 1
+            logger.warning(f"Context cache {handle.name} TTL refresh failed; it will be recreated: {e}")
+            self._handles.pop(key, None)
+            return None
+        handle.expires_at = time.monotonic() + self.ttl_s
+        self.stats.refreshed += 1
+        return handle
+
+    def invalidate(self, name: str) -> None:
+        """Drops a handle that upstream reported as missing; the next request recreates it."""
+        for key, handle in list(self._handles.items()):
+            if handle.name == name:
+                del self._handles[key]
+                self.stats.invalidated += 1
+                logger.warning(f"Context cache {name} was rejected upstream; dropped.")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Handle and hit-rate figures for /api/metrics."""
+        now = time.monotonic()
+        return dict(
+            self.stats.as_dict(),
+            enabled=self.enabled,
+            handles=[
+                {"name": h.name, "model": h.model, "template": h.digest[:12], "tokens": h.tokens, "expires_in_s": round(h.expires_at - now, 1)}
+                for h in self._handles.values()
+            ],
+        )
+
+
+class PromptUsage:
+    """
+    Upstream-reported prompt and cached token counts per task, from response usage metadata.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, task: Optional[str], usage: Any, first_chunk_s: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Tallies one call's usage metadata.
+
+        Returns:
+            (prompt tokens, cached tokens); (0, 0) when the response carried no usage metadata.
+        """
+        prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", None) or 0
+        if not prompt_tokens:
+            return 0, 0
+        with self._lock:
+            t = self._tasks.setdefault(task or "default", {
+                "requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "cache_hits": 0,
+                "hit_first_chunk_s": 0.0, "hit_timed": 0, "miss_first_chunk_s": 0.0, "miss_timed": 0,
+            })
+            t["requests"] += 1
+            t["prompt_tokens"] += prompt_tokens
+            t["cached_tokens"] += cached_tokens
+            t["cache_hits"] += 1 if cached_tokens else 0
+            if first_chunk_s is not None:
+                side = "hit" if cached_tokens else "miss"
+                t[f"{side}_first_chunk_s"] += first_chunk_s
+                t[f"{side}_timed"] += 1
+        return prompt_tokens, cached_tokens
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cached-token share, estimated input cost saving and first-chunk latency per task, for /api/metrics."""
+        with self._lock:
+            tasks = {}
+            for task, t in self._tasks.items():
+                share = t["cached_tokens"] / t["prompt_tokens"] if t["prompt_tokens"] else 0.0
+                tasks[task] = {
+                    "requests": int(t["requests"]),
+                    "prompt_tokens": int(t["prompt_tokens"]),
+                    "cached_tokens": int(t["cached_tokens"]),
+                    "cached_share": round(share, 3),
+                    "cache_hit_rate": round(t["cache_hits"] / t["requests"], 3) if t["requests"] else 0.0,
+                    "est_input_cost_saving": round(share * CACHED_TOKEN_DISCOUNT, 3),
+                    "avg_first_chunk_s_cache_hit": round(t["hit_first_chunk_s"] / t["hit_timed"], 3) if t["hit_timed"] else None,
+                    "avg_first_chunk_s_cache_miss": round(t["miss_first_chunk_s"] / t["miss_timed"], 3) if t["miss_timed"] else None,
+                }
+            return {"tasks": tasks}
+
+
+def create_context_cache() -> ContextCache:
+    """
+    Builds the context cache from the environment: MORPHEO_CONTEXT_CACHE_ENABLED,
+    MORPHEO_CONTEXT_CACHE_TTL_SECONDS, MORPHEO_CONTEXT_CACHE_MIN_TOKENS.
+    """
+    enabled = os.getenv("MORPHEO_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+    try:
+        return ContextCache(
+            enabled=enabled,
+            ttl_s=float(os.getenv("MORPHEO_CONTEXT_CACHE_TTL_SECONDS", 3600)),
+            min_tokens=int(os.getenv("MORPHEO_CONTEXT_CACHE_MIN_TOKENS", 4096)),
+        )
+    except ValueError:
+        logger.warning("Invalid MORPHEO_CONTEXT_CACHE_* setting; using defaults.")
+        return ContextCache(enabled=enabled)
@@ -0,0 +1,235 @@
+"""
+Edit-Based Modifications
+
+A full-rewrite modification has the model output the entire modified file, even for a
+one-line change, so its latency grows with the document rather than with the change. In the
+edit mode the model answers with anchored search/replace blocks instead:
+
+    <<<<<<< SEARCH
+    <h1>Todo</h1>
+    =======
+    <h1>My Todo List</h1>
+    >>>>>>> REPLACE
+
+The server applies them to the current HTML in order. Each SEARCH text must match exactly one
+place in the document (exactly, or line by line ignoring indentation and trailing spaces).
+The patched document is then sent to the client like a rewritten one. When an edit does not
+apply, the caller falls back to a full rewrite; nothing has been sent to the client by then.
+
+The mode is switchable (MORPHEO_MODIFICATION_MODE=edits|full). The output tokens and the
+estimated latency saved against a full rewrite are tallied for /api/metrics.
+"""
+
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EDITS = "edits"
+FULL = "full"
+
+EDIT_INSTRUCTIONS = (
+    "Answer with search/replace edits to the **EXISTING HTML CODE**, NOT with the whole file. Each edit is:\n"
+    "<<<<<<< SEARCH\n"
+    "(lines copied exactly from the existing code)\n"
+    "=======\n"
+    "(the lines that replace them)\n"
+    ">>>>>>> REPLACE\n"
+    "- The SEARCH lines must be copied exactly (indentation included) and must match exactly one place in the existing code; "
+    "include a few neighbouring lines when needed to make them unique.\n"
+    "- Keep each edit small. Use several edits for changes in different places, in the order they appear in the file.\n"
+    "- To insert code, SEARCH for a nearby line and repeat it in the replacement together with the new lines. To delete code, leave the replacement empty.\n"
+    "- Output ONLY edit blocks: no explanations and no markdown fences.\n"
+)
+
+_EDIT_BLOCK = re.compile(
+    r"^<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*$",
+    re.DOTALL | re.MULTILINE,
+)
+_FULL_DOCUMENT = re.compile(r"^\s*(?:```\w*\s*)?(?:<!DOCTYPE html|<html)", re.IGNORECASE)
+_LEADING_FENCE = re.compile(r"^\s*```[\w-]*[ \t]*\n")
+_TRAILING_FENCE = re.compile(r"\n[ \t]*```[ \t]*\s*$")
+
+
+class EditError(ValueError):
+    """An edit reply cannot be applied to the document."""
+
+
+@dataclass(frozen=True)
+class Edit:
+    search: str
+    replace: str
+
+
+def _section(text: str) -> str:
+    return text[:-1] if text.endswith("\n") else text
+
+
+def parse_edits(reply: str) -> List[Edit]:
+    """The search/replace blocks of a model reply, in order."""
+    return [Edit(_section(m.group(1)), _section(m.group(2))) for m in _EDIT_BLOCK.finditer(reply)]
+
+
+def _loose_span(document: str, search: str) -> Optional[Tuple[int, int]]:
+    """Span of the only run of whole lines equal to `search` line by line, ignoring surrounding whitespace."""
+    wanted = [line.strip() for line in search.split("\n")]
+    while wanted and not wanted[0]:
+        wanted.pop(0)
+    while wanted and not wanted[-1]:
+        wanted.pop()
+    if not wanted:
+        return None
+    lines = document.split("\n")
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line) + 1)
+    stripped = [line.strip() for line in lines]
+    spans = [
+        (starts[i], starts[i + len(wanted)] - 1)
+        for i in range(len(lines) - len(wanted) + 1)
+        if stripped[i] == wanted[0] and stripped[i:i + len(wanted)] == wanted
+    ]
+    if len(spans) > 1:
+        raise EditError(f"SEARCH text matches {len(spans)} places: {wanted[0][:80]!r}")
+    return spans[0] if spans else None
+
+
+def apply_edits(document: str, edits: List[Edit]) -> str:
+    """
+    Applies `edits` to `document` in order.
+
+    Raises:
+        EditError: An edit has an empty SEARCH, matches nowhere, or matches more than one place.
+    """
+    for number, edit in enumerate(edits, 1):
+        if not edit.search.strip():
+            raise EditError(f"Edit {number} has an empty SEARCH block.")
+        count = document.count(edit.search)
+        if count > 1:
+            raise EditError(f"Edit {number}: SEARCH text matches {count} places.")
+        if count == 1:
+            start = document.index(edit.search)
+            document = document[:start] + edit.replace + document[start + len(edit.search):]
+            continue
+        try:
+            span = _loose_span(document, edit.search)
+        except EditError as e:
+            raise EditError(f"Edit {number}: {e}") from None
+        if span is None:
+            raise EditError(f"Edit {number}: SEARCH text not found: {edit.search.strip()[:80]!r}")
+        document = document[:span[0]] + edit.replace + document[span[1]:]
+    return document
+
+
+def apply_reply(document: str, reply: str) -> Tuple[str, int]:
+    """
+    The modified document for an edit-mode reply, and the number of edits applied.
+
+    A reply that is a whole document (the model rewrote the file anyway) is used without its
+    markdown fences, provided it is complete.
+
+    Raises:
+        EditError: The reply has no edits, or they do not apply, or they break the document,
+            or the whole document it contains is cut off before </html>.
+    """
+    edits = parse_edits(reply)
+    if not edits:
+        if _FULL_DOCUMENT.match(reply):
+            rewritten = _TRAILING_FENCE.sub("", _LEADING_FENCE.sub("", reply, count=1), count=1)
+            if "</html>" not in rewritten.lower():
+                raise EditError("The rewritten document ends before </html>.")
+            return rewritten, 0
+        raise EditError("The reply contains no search/replace edits.")
+    patched = apply_edits(document, edits)
+    if "</html>" in document.lower() and "</html>" not in patched.lower():
+        raise EditError("The edits removed the end of the document.")
+    return patched, len(edits)
+
+
+class EditProtocol:
+    """
+    Modification mode and its outcomes against full rewrites.
+
+    Args:
+        mode: "edits" asks for search/replace edits (falling back to a full rewrite when they
+            do not apply); "full" always asks for the whole modified file.
+    """
+
+    def __init__(self, mode: str = EDITS):
+        if mode not in (EDITS, FULL):
+            raise ValueError(f"Unknown modification mode '{mode}' (expected edits or full).")
+        self.mode = mode
+        self.applied = 0
+        self.edits = 0
+        self.full_replies = 0
+        self.fallbacks = 0
+        self.output_tokens_saved = 0
+        self.latency_saved_s = 0.0
+        self.latency_estimates = 0
+        self._rewrite_tokens = 0
+        self._rewrite_s = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == EDITS
+
+    def record_rewrite(self, output_tokens: int, duration_s: float) -> None:
+        """Observes a full rewrite, the baseline for the latency saved by edits."""
+        with self._lock:
+            self._rewrite_tokens += output_tokens
+            self._rewrite_s += duration_s
+
+    def estimate_rewrite_s(self, output_tokens: int) -> Optional[float]:
+        """Estimated time for a full rewrite producing `output_tokens`, from the rewrites observed so far."""
+        with self._lock:
+            if not self._rewrite_tokens or not self._rewrite_s:
+                return None
+            return output_tokens * self._rewrite_s / self._rewrite_tokens
+
+    def record_applied(self, edits: int, output_tokens_saved: int, latency_saved_s: Optional[float]) -> None:
+        """Tallies an edit reply that was applied (`edits` == 0: the model returned the whole file)."""
+        with self._lock:
+            if edits:
+                self.applied += 1
+                self.edits += edits
+                self.output_tokens_saved += output_tokens_saved
+                if latency_saved_s is not None:
+                    self.latency_saved_s += latency_saved_s
+                    self.latency_estimates += 1
+            else:
+                self.full_replies += 1
+
+    def record_fallback(self) -> None:
+        with self._lock:
+            self.fallbacks += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Edit outcomes and the output tokens and latency saved against full rewrites, for /api/metrics."""
+        with self._lock:
+            attempts = self.applied + self.full_replies + self.fallbacks
+            return {
+                "mode": self.mode,
+                "applied": self.applied,
+                "full_replies": self.full_replies,
+                "fallbacks": self.fallbacks,
+                "fallback_rate": round(self.fallbacks / attempts, 3) if attempts else 0.0,
+                "avg_edits": round(self.edits / self.applied, 2) if self.applied else None,
+                "output_tokens_saved": self.output_tokens_saved,
+                "avg_output_tokens_saved": round(self.output_tokens_saved / self.applied) if self.applied else None,
+                "avg_latency_saved_s": round(self.latency_saved_s / self.latency_estimates, 3) if self.latency_estimates else None,
+            }
+
+
+def create_edit_protocol() -> EditProtocol:
+    """Builds the modification mode from MORPHEO_MODIFICATION_MODE (edits | full)."""
+    mode = os.getenv("MORPHEO_MODIFICATION_MODE", EDITS).strip().lower()
+    try:
+        return EditProtocol(mode)
+    except ValueError as e:
+        logger.warning(f"{e} Using edits.")
+        return EditProtocol(EDITS)
@@ -0,0 +1,49 @@
+"""
+Service Errors
+
+Exceptions raised by ComponentService when it refuses work to protect the upstream model,
+plus helpers for recognising upstream rate-limit responses. main.py maps
+ServiceUnavailableError to HTTP 503 with a Retry-After header.
+"""
+
+import math
+
+
+class ServiceUnavailableError(Exception):
+    """
+    The request was refused for now and may be retried later.
+
+    Args:
+        message: Human-readable reason.
+        retry_after: Suggested delay in seconds before retrying.
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = max(float(retry_after), 0.0)
+
+    @property
+    def retry_after_header(self) -> str:
+        """Retry-After value (whole seconds, at least 1)."""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class OverloadedError(ServiceUnavailableError):
+    """The concurrency limiter's wait queue is full, or a queued request hit its deadline."""
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    """The model's circuit breaker is open and no fallback model is available."""
+
+
+class ModelCallError(Exception):
+    """A collected (non-streaming) model call failed after retries; the message is the error marker's text."""
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """True for upstream 429 / RESOURCE_EXHAUSTED responses (google-genai or google-api-core)."""
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    return "RESOURCE_EXHAUSTED" in str(error)
@@ -0,0 +1,360 @@
+"""
+Generation Cache
+
+This module provides a content-addressed cache for full-page generations. Entries are
+keyed on the normalized user request, a hash of the prompt template, the model name and
+the grounding flag, so "A calculator." and "a calculator" share one entry while a template
+edit or model switch naturally invalidates everything generated before it.
+
+Two tiers are kept: a small in-memory LRU for hot prompts and an on-disk tier (one JSON
+file per entry) with a TTL and a total-size cap. Disk access is done off the event loop.
+The disk tier's entries, sizes and write order are indexed in memory (one directory scan,
+on first use), so enforcing the size cap never rescans the directory.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.,;:!?\"'`"
+
+
+def normalize_request(user_request: str) -> str:
+    """Case-folds, collapses whitespace and strips surrounding punctuation/quotes."""
+    return _WHITESPACE.sub(" ", user_request.casefold()).strip(_EDGE_PUNCTUATION)
+
+
+def template_hash(template_text: str) -> str:
+    """Short content hash of a prompt template."""
+    return hashlib.sha256(template_text.encode("utf-8")).hexdigest()[:16]
+
+
+def make_cache_key(user_request: str, template_digest: str, model: str, grounding: bool) -> str:
+    """
+    Builds the cache key for a generation request.
+
+    Args:
+        user_request: The raw user prompt (normalized here).
+        template_digest: `template_hash()` of the prompt template used.
+        model: Model name the generation runs on.
+        grounding: Whether Google Search grounding is enabled.
+
+    Returns:
+        A hex SHA-256 digest.
+    """
+    material = json.dumps(
+        [normalize_request(user_request), template_digest, model, bool(grounding)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits_memory: int = 0
+    hits_disk: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class GenerationCache:
+    """
+    Two-tier (memory LRU + disk) cache of generated HTML.
+
+    Synchronous methods are thread-safe; the `fetch()`/`store()` coroutines run disk work in
+    a worker thread so callers on the event loop never block on file IO.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        memory_entries: int = 64,
+        disk_max_bytes: int = 256 * 1024 * 1024,
+        ttl_s: float = 7 * 24 * 3600,
+        grounded_ttl_s: float = 15 * 60,
+        enabled: bool = True,
+    ):
+        """
+        Args:
+            directory: Disk tier location (None disables the disk tier).
+            memory_entries: Maximum entries held in the memory LRU.
+            disk_max_bytes: Oldest disk entries are evicted once the tier grows past this.
+            ttl_s: Lifetime of an entry.
+            grounded_ttl_s: Lifetime of a grounded entry (search results go stale quickly).
+            enabled: When False every lookup misses and nothing is stored.
+        """
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl_s = ttl_s
+        self.grounded_ttl_s = grounded_ttl_s
+        self.enabled = enabled
+        self.stats = CacheStats()
+
+        self._memory: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None  # Computed with the index
+        # Disk entries oldest write first: key -> (written at, size); built lazily by one scan
+        self._disk_index: Optional["collections.OrderedDict[str, Tuple[float, int]]"] = None
+        # Called with the key of every entry that leaves the cache (evicted, expired or invalidated)
+        self.on_remove: Optional[Callable[[str], None]] = None
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    # --- Lookup ---
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached HTML for `key`, or None. Disk hits are promoted to memory."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry["expires_at"] > now:
+                    self._memory.move_to_end(key)
+                    self.stats.hits_memory += 1
+                    return entry["html"]
+                del self._memory[key]
+                self.stats.expirations += 1
+        if not self.directory and entry is not None:
+            self._removed(key)  # Expired, with no disk tier to fall back on
+
+        entry = self._read_disk(key)
+        if entry is not None and entry["expires_at"] <= now:
+            self._remove_disk(key)
+            self.stats.expirations += 1
+            entry = None
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits_disk += 1
+        self._remember(key, entry)
+        return entry["html"]
+
+    async def fetch(self, key: str) -> Optional[str]:
+        """`get()` without blocking the event loop on a disk read."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None and entry["expires_at"] > time.time():
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    # --- Store ---
+
+    def put(self, key: str, html: str, grounding: bool = False, **meta: Any) -> None:
+        """Stores generated HTML under `key` in both tiers."""
+        if not self.enabled or not html:
+            return
+        ttl = self.grounded_ttl_s if grounding else self.ttl_s
+        if ttl <= 0:
+            return
+        created_at = time.time()
+        entry = {"html": html, "created_at": created_at, "expires_at": created_at + ttl, "meta": meta}
+        self._remember(key, entry)
+        self._write_disk(key, entry)
+        self.stats.stores += 1
+
+    async def store(self, key: str, html: str, grounding: bool = False, **meta: Any) -> None:
+        """`put()` with the disk write done in a worker thread."""
+        await asyncio.to_thread(self.put, key, html, grounding, **meta)
+
+    # --- Invalidation ---
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        """
+        Drops one entry (`key`) or the whole cache (no key).
+
+        Returns:
+            The number of entries removed.
+        """
+        removed = 0
+        with self._lock:
+            if key is None:
+                dropped = list(self._memory)
+                self._memory.clear()
+            else:
+                dropped = [key] if self._memory.pop(key, None) is not None else []
+        removed = len(dropped)
+        if not self.directory:
+            for dropped_key in dropped:
+                self._removed(dropped_key)
+        if self.directory:
+            if key is None:
+                for name in os.listdir(self.directory):
+                    if name.endswith(".json"):
+                        removed += self._remove_disk(name[:-5])
+                with self._lock:
+                    self._disk_index = collections.OrderedDict()
+                    self._disk_bytes = 0
+            else:
+                removed += self._remove_disk(key)
+        self.stats.invalidations += removed
+        return removed
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters for /api/metrics."""
+        lookups = self.stats.hits_memory + self.stats.hits_disk + self.stats.misses
+        hits = self.stats.hits_memory + self.stats.hits_disk
+        return dict(
+            vars(self.stats),
+            enabled=self.enabled,
+            memory_entries=len(self._memory),
+            disk_bytes=self._disk_bytes,
+            hit_ratio=round(hits / lookups, 3) if lookups else 0.0,
+        )
+
+    # --- Internals ---
+
+    def _remember(self, key: str, entry: Dict[str, Any]) -> None:
+        evicted = []
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                evicted.append(self._memory.popitem(last=False)[0])
+        if not self.directory:
+            for evicted_key in evicted:
+                self._removed(evicted_key)  # Gone for good without a disk tier
+
+    def _removed(self, key: str) -> None:
+        if self.on_remove is not None:
+            try:
+                self.on_remove(key)
+            except Exception as e:
+                logger.warning(f"Generation cache removal callback failed for {key[:12]}: {e}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable generation cache entry {key[:12]}: {e}")
+            self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, entry: Dict[str, Any]) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write generation cache entry {key[:12]}: {e}")
+            return
+        with self._lock:
+            index = self._ensure_index()
+            previous = index.pop(key, (0.0, 0))[1]
+            index[key] = (time.time(), len(data))
+            self._disk_bytes += len(data) - previous
+            over_cap = self._disk_bytes > self.disk_max_bytes
+        if over_cap:
+            self._evict_disk()
+
+    def _remove_disk(self, key: str) -> int:
+        if not self.directory:
+            return 0
+        try:
+            os.remove(self._path(key))
+            removed = 1
+        except FileNotFoundError:
+            removed = 0
+        except OSError:
+            return 0
+        with self._lock:
+            if self._disk_index is not None:
+                _, size = self._disk_index.pop(key, (0.0, 0))
+                self._disk_bytes = max(self._disk_bytes - size, 0)
+        if removed:
+            self._removed(key)
+        return removed
+
+    def _ensure_index(self) -> "collections.OrderedDict[str, Tuple[float, int]]":
+        """The disk index, built from one directory scan on first use. Call with the lock held."""
+        if self._disk_index is None:
+            files = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, name[:-5]))
+            files.sort()
+            self._disk_index = collections.OrderedDict((key, (mtime, size)) for mtime, size, key in files)
+            self._disk_bytes = sum(size for _, size, _ in files)
+        return self._disk_index
+
+    def _evict_disk(self) -> None:
+        """Removes expired entries, then the least recently written ones, until under the size cap."""
+        oldest_allowed = time.time() - max(self.ttl_s, self.grounded_ttl_s)
+        victims = []
+        with self._lock:
+            total = self._disk_bytes
+            for key, (written_at, size) in self._ensure_index().items():
+                if total <= self.disk_max_bytes and written_at >= oldest_allowed:
+                    break
+                victims.append(key)
+                total -= size
+        for key in victims:
+            if self._remove_disk(key):
+                self.stats.evictions += 1
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_generation_cache() -> GenerationCache:
+    """
+    Builds the cache from the environment:
+    MORPHEO_GEN_CACHE_ENABLED, MORPHEO_GEN_CACHE_DIR (empty disables the disk tier),
+    MORPHEO_GEN_CACHE_MEMORY_ENTRIES, MORPHEO_GEN_CACHE_MAX_BYTES, MORPHEO_GEN_CACHE_TTL_SECONDS,
+    MORPHEO_GEN_CACHE_GROUNDED_TTL_SECONDS.
+    """
+    enabled = os.getenv("MORPHEO_GEN_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    directory = os.getenv("MORPHEO_GEN_CACHE_DIR", os.path.join(".morpheo_cache", "generations")) or None
+    try:
+        return GenerationCache(
+            directory if enabled else None,
+            memory_entries=int(_env_float("MORPHEO_GEN_CACHE_MEMORY_ENTRIES", 64)),
+            disk_max_bytes=int(_env_float("MORPHEO_GEN_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+            ttl_s=_env_float("MORPHEO_GEN_CACHE_TTL_SECONDS", 7 * 24 * 3600),
+            grounded_ttl_s=_env_float("MORPHEO_GEN_CACHE_GROUNDED_TTL_SECONDS", 15 * 60),
+            enabled=enabled,
+        )
+    except OSError as e:
+        logger.error(f"Generation cache directory unavailable ({e}); using the memory tier only.")
+        return GenerationCache(None, enabled=enabled)
@@ -0,0 +1,207 @@
+"""
+Hedged Requests
+
+This module cuts tail latency for short model calls whose whole response is collected
+before returning (chat replies, image analysis, modification suggestions). If a call has
+not finished within the recent p90 latency of its call class, an identical backup request
+is started and whichever finishes first wins; the other is cancelled.
+
+Backup requests are paid for out of a token-bucket budget (by default 5% of calls), so
+hedging cannot multiply upstream load when the model is slow across the board.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """
+    Sliding-window latency quantile for one call class.
+
+    Args:
+        window: Most recent successful calls considered.
+        quantile: Quantile used as the hedge delay.
+        min_samples: No delay is reported until this many calls were observed.
+        min_delay_s: Floor for the reported delay.
+    """
+
+    def __init__(self, window: int = 200, quantile: float = 0.9, min_samples: int = 20, min_delay_s: float = 0.05):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay_s = min_delay_s
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def threshold(self) -> Optional[float]:
+        """The current quantile in seconds, or None while warming up."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return max(ordered[int(self.quantile * (len(ordered) - 1))], self.min_delay_s)
+
+
+class HedgeBudget:
+    """
+    Token bucket bounding hedges to a fraction of calls.
+
+    Every call earns `ratio` tokens and every hedge spends one, so over time at most
+    `ratio` extra requests are sent per call (plus a burst of `max_tokens`).
+    """
+
+    def __init__(self, ratio: float = 0.05, max_tokens: float = 5.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self._lock = threading.Lock()
+
+    def earn(self) -> None:
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class _ClassStats:
+    def __init__(self, tracker: LatencyTracker):
+        self.tracker = tracker
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        threshold = self.tracker.threshold()
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedged, 3) if self.hedged else None,
+            "budget_denied": self.budget_denied,
+            "hedge_delay_ms": round(threshold * 1000) if threshold is not None else None,
+        }
+
+
+class Hedger:
+    """
+    Runs calls with an optional backup request after the class's latency quantile.
+
+    Args:
+        enabled: When False calls run once (latencies are still tracked).
+        budget_ratio: Fraction of extra requests hedging may add.
+        quantile: Latency quantile after which a backup request is sent.
+        min_samples: Calls observed per class before hedging starts.
+    """
+
+    def __init__(self, enabled: bool = True, budget_ratio: float = 0.05, quantile: float = 0.9, min_samples: int = 20):
+        self.enabled = enabled
+        self.budget = HedgeBudget(budget_ratio)
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._classes: Dict[str, _ClassStats] = {}
+
+    def _stats(self, call_class: str) -> _ClassStats:
+        stats = self._classes.get(call_class)
+        if stats is None:
+            stats = self._classes[call_class] = _ClassStats(LatencyTracker(quantile=self.quantile, min_samples=self.min_samples))
+        return stats
+
+    async def run(self, call_class: str, attempt: Callable[[bool], Awaitable[Any]]) -> Any:
+        """
+        Runs `attempt(False)`, adding `attempt(True)` as a backup if it is slow.
+
+        Args:
+            call_class: Latency class (e.g. the limiter task name).
+            attempt: Starts one request; the argument tells whether it is the backup.
+
+        Returns:
+            The result of the first attempt to succeed.
+
+        Raises:
+            The primary's exception (or the backup's) when no attempt succeeds.
+        """
+        stats = self._stats(call_class)
+        stats.calls += 1
+        self.budget.earn()
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(attempt(False))
+        roles = {primary: "primary"}
+        errors: Dict[str, BaseException] = {}
+        try:
+            delay = stats.tracker.threshold() if self.enabled else None
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done:
+                    if self.budget.try_spend():
+                        stats.hedged += 1
+                        logger.info(f"Hedging {call_class} call: no response after {delay:.2f}s (p{int(self.quantile * 100)}).")
+                        roles[asyncio.ensure_future(attempt(True))] = "hedge"
+                    else:
+                        stats.budget_denied += 1
+
+            pending = set(roles)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: roles[t] != "primary"):
+                    if task.exception() is None:
+                        stats.tracker.record(time.perf_counter() - start)
+                        if roles[task] == "hedge":
+                            stats.hedge_wins += 1
+                        return task.result()
+                    errors[roles[task]] = task.exception()
+            raise errors.get("primary") or errors["hedge"]
+        finally:
+            losers = [task for task in roles if not task.done()]
+            for task in losers:
+                task.cancel()
+            if losers:
+                # Let the losers unwind (release limiter permits, close streams) before returning
+                await asyncio.gather(*losers, return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters for /api/metrics."""
+        classes = {name: stats.snapshot() for name, stats in self._classes.items()}
+        calls = sum(stats.calls for stats in self._classes.values())
+        hedged = sum(stats.hedged for stats in self._classes.values())
+        wins = sum(stats.hedge_wins for stats in self._classes.values())
+        return {
+            "enabled": self.enabled,
+            "budget_ratio": self.budget.ratio,
+            "hedge_rate": round(hedged / calls, 4) if calls else 0.0,
+            "hedge_win_rate": round(wins / hedged, 3) if hedged else None,
+            "classes": classes,
+        }
+
+
+def create_hedger() -> Hedger:
+    """
+    Builds the hedger from the environment: MORPHEO_HEDGE_ENABLED, MORPHEO_HEDGE_BUDGET,
+    MORPHEO_HEDGE_QUANTILE, MORPHEO_HEDGE_MIN_SAMPLES.
+    """
+    enabled = os.getenv("MORPHEO_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+    try:
+        return Hedger(
+            enabled=enabled,
+            budget_ratio=float(os.getenv("MORPHEO_HEDGE_BUDGET", 0.05)),
+            quantile=float(os.getenv("MORPHEO_HEDGE_QUANTILE", 0.9)),
+            min_samples=int(os.getenv("MORPHEO_HEDGE_MIN_SAMPLES", 20)),
+        )
+    except ValueError:
+        logger.warning("Invalid MORPHEO_HEDGE_* setting; using defaults.")
+        return Hedger(enabled=enabled)
@@ -0,0 +1,352 @@
+"""
+Background Log Writer
+
+This module provides a non-blocking, size-capped log pipeline for the request/response
+logs written by ComponentService (gemini_request_log.txt, morpheo_generation_log.jsonl).
+
+Records are sanitized on submission (per-field truncation, binary and data-URL redaction),
+pushed onto a bounded queue and drained by a writer thread that flushes in batches and
+rotates files by size and age. A full queue drops records instead of blocking the caller,
+so logging never stalls a streaming response.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Base64 payloads of 256+ characters inside data URLs are replaced by a size marker.
+_DATA_URL_PATTERN = re.compile(r"data:([\w/+.\-]*);base64,([A-Za-z0-9+/=]{256,})")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) > 256:
+        text = _DATA_URL_PATTERN.sub(lambda m: f"data:{m.group(1)};base64,<{len(m.group(2))} chars redacted>", text)
+    if limit and len(text) > limit:
+        return f"{text[:limit]}...[truncated {len(text) - limit} chars]"
+    return text
+
+
+def sanitize(value: Any, max_chars: int = 2000, _depth: int = 0) -> Any:
+    """
+    Produces a small, JSON-serializable copy of `value` suitable for logging.
+
+    Args:
+        value: Arbitrary log payload (strings, dicts, lists, bytes, SDK Part/File objects).
+        max_chars: Per-string character limit (0 disables truncation).
+
+    Returns:
+        The sanitized value. Binary data is never copied into the result.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return _truncate(value, max_chars)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<binary {len(value)} bytes redacted>"
+    if _depth >= 6:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        return {str(k): sanitize(v, max_chars, _depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [sanitize(v, max_chars, _depth + 1) for v in value]
+
+    # google.genai SDK objects: Part with inline data, Part with text, File handles
+    inline_data = getattr(value, "inline_data", None)
+    if inline_data is not None:
+        data = getattr(inline_data, "data", None) or b""
+        return f"<inline {getattr(inline_data, 'mime_type', 'data')} {len(data)} bytes redacted>"
+    if getattr(value, "text", None) is not None and hasattr(value, "inline_data"):
+        return _truncate(value.text, max_chars)
+    if hasattr(value, "uri") and hasattr(value, "name"):
+        return {"file": getattr(value, "name", None), "uri": getattr(value, "uri", None)}
+    return _truncate(str(value), max_chars)
+
+
+class LogWriter:
+    """
+    Asynchronous, size-capped, rotating log writer.
+
+    `write()` never blocks: records are sanitized, optionally sampled, and queued for a
+    background thread that writes them in batches.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fmt: str = "jsonl",
+        max_bytes: int = 5 * 1024 * 1024,
+        backup_count: int = 3,
+        rotate_interval_s: float = 0.0,
+        queue_size: int = 1000,
+        batch_size: int = 64,
+        flush_interval_s: float = 0.5,
+        sample_rate: float = 1.0,
+        max_field_chars: int = 2000,
+    ):
+        """
+        Args:
+            path: Log file path.
+            fmt: "jsonl" (one JSON object per line) or "text" (human-readable blocks).
+            max_bytes: Rotate once the file grows past this size (0 disables).
+            backup_count: Number of rotated files (path.1 .. path.N) to keep.
+            rotate_interval_s: Rotate files older than this many seconds (0 disables).
+            queue_size: Maximum queued records; further records are dropped.
+            batch_size: Maximum records written per flush.
+            flush_interval_s: Maximum time a record waits in the queue before being flushed.
+            sample_rate: Fraction of non-forced records that are kept.
+            max_field_chars: Per-field character limit applied by `sanitize()`.
+        """
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval_s = rotate_interval_s
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.sample_rate = sample_rate
+        self.max_field_chars = max_field_chars
+
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._opened_at = 0.0
+        self._closed = False
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.rotations = 0
+        self.flushes = 0
+
+    # --- Producer side (called from request handlers) ---
+
+    def write(self, record: Dict[str, Any], force: bool = False) -> bool:
+        """
+        Queues a record for writing.
+
+        Args:
+            record: Fields to log. A "timestamp" field is added if missing.
+            force: Bypass sampling (use for failures that should always be logged).
+
+        Returns:
+            True if the record was queued, False if it was sampled out or dropped.
+        """
+        if self._closed:
+            return False
+        if not force and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        entry = sanitize(record, self.max_field_chars)
+        entry.setdefault("timestamp", datetime.datetime.now().isoformat())
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Blocks until every record queued so far has been written (or `timeout` elapses)."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Flushes outstanding records and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "flushes": self.flushes,
+            "rotations": self.rotations,
+        }
+
+    # --- Consumer side (writer thread) ---
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"log-writer:{os.path.basename(self.path)}", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch: List[Dict[str, Any]] = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval_s)
+            except queue.Empty:
+                continue
+            if item is None:
+                stop = True
+                self._queue.task_done()
+            else:
+                batch.append(item)
+                deadline = time.monotonic() + self.flush_interval_s
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        self._queue.task_done()
+                        break
+                    batch.append(item)
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f"Failed to write {len(batch)} log records to {self.path}: {e}")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        self._maybe_rotate()
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._opened_at = time.time()
+        self._file.write("".join(self._render(entry) for entry in batch))
+        self._file.flush()
+        self.written += len(batch)
+        self.flushes += 1
+
+    def _render(self, entry: Dict[str, Any]) -> str:
+        if self.fmt == "jsonl":
+            return json.dumps(entry, default=str) + "\n"
+        event = entry.get("event", "Request")
+        lines = [f"\n--- {event} ({entry.get('timestamp')}) ---"]
+        for key, value in entry.items():
+            if key in ("event", "timestamp"):
+                continue
+            if not isinstance(value, str):
+                value = json.dumps(value, default=str)
+            lines.append(f"{key}: {value}")
+        lines.append(f"--- End of {event} ---\n")
+        return "\n".join(lines)
+
+    def _maybe_rotate(self) -> None:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        too_big = self.max_bytes and size >= self.max_bytes
+        if not too_big and self.rotate_interval_s:
+            started = self._opened_at or os.path.getmtime(self.path)
+            too_old = time.time() - started >= self.rotate_interval_s
+        else:
+            too_old = False
+        if not (too_big or too_old):
+            return
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+
+# --- Shared writers ---
+
+_WRITER_DEFAULTS = {
+    "requests": ("MORPHEO_REQUEST_LOG_PATH", "gemini_request_log.txt", "text"),
+    "generations": ("MORPHEO_GENERATION_LOG_PATH", "morpheo_generation_log.jsonl", "jsonl"),
+}
+
+_writers: Dict[str, LogWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(name: str) -> LogWriter:
+    """
+    Returns the process-wide writer for a named log ("requests", "generations", ...).
+
+    Paths and limits come from the environment (MORPHEO_<NAME>_LOG_PATH, MORPHEO_LOG_MAX_BYTES,
+    MORPHEO_LOG_BACKUPS, MORPHEO_LOG_ROTATE_SECONDS, MORPHEO_LOG_SAMPLE_RATE, MORPHEO_LOG_FIELD_CHARS).
+    """
+    with _writers_lock:
+        writer = _writers.get(name)
+        if writer is None:
+            env_name, default_path, fmt = _WRITER_DEFAULTS.get(
+                name, (f"MORPHEO_{name.upper()}_LOG_PATH", f"morpheo_{name}_log.jsonl", "jsonl")
+            )
+            writer = LogWriter(
+                os.getenv(env_name, default_path),
+                fmt=fmt,
+                max_bytes=_env_int("MORPHEO_LOG_MAX_BYTES", 5 * 1024 * 1024),
+                backup_count=_env_int("MORPHEO_LOG_BACKUPS", 3),
+                rotate_interval_s=_env_float("MORPHEO_LOG_ROTATE_SECONDS", 0.0),
+                sample_rate=_env_float("MORPHEO_LOG_SAMPLE_RATE", 1.0),
+                max_field_chars=_env_int("MORPHEO_LOG_FIELD_CHARS", 2000),
+            )
+            _writers[name] = writer
+        return writer
+
+
+def close_log_writers() -> None:
+    """Flushes and stops every shared writer (registered at exit; also call on app shutdown)."""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_log_writers)
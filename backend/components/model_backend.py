@@ -0,0 +1,586 @@
+"""
+Model Backends
+
+This module provides pluggable stand-ins for the google-genai client used by
+ComponentService, so the FastAPI app can be load-tested and benchmarked
+without spending Gemini quota.
+
+Backends (selected with MORPHEO_MODEL_BACKEND):
+- gemini:    the real google.genai.Client (default)
+- synthetic: emits generate_content_stream chunks with configurable
+             time-to-first-token, tokens/sec, chunk-size distribution and
+             error / 429 injection, plus an in-memory `aio.caches` for
+             context caching; usage metadata reports cached prompt tokens
+             for explicit handles and for prefixes shared with recent
+             requests (implicit caching)
+- record:    wraps the real client and records every stream (text + timing)
+             to a cassette file
+- replay:    replays recorded cassettes with the original chunking and timing
+"""
+
+import asyncio
+import atexit
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional
+
+import google.genai as genai
+from google.genai import errors as genai_errors
+from google.genai import types as genai_types
+
+from .token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+MODEL_BACKEND_ENV = "MORPHEO_MODEL_BACKEND"
+CASSETTE_PATH_ENV = "MORPHEO_CASSETTE_PATH"
+DEFAULT_CASSETTE_PATH = "morpheo_cassette.jsonl"
+
+# Rough characters-per-token ratio used to size synthetic output.
+CHARS_PER_TOKEN = 4
+
+# Smallest valid PNG (1x1 transparent pixel), returned for synthetic image generation.
+_SYNTHETIC_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid value for {name}; using default {default}.")
+        return default
+
+
+def _make_text_chunk(text: str) -> genai_types.GenerateContentResponse:
+    """Builds an SDK response chunk carrying `text`, identical in shape to a real stream chunk."""
+    return genai_types.GenerateContentResponse(
+        candidates=[genai_types.Candidate(content=genai_types.Content(role="model", parts=[genai_types.Part(text=text)]))]
+    )
+
+
+def _rate_limit_error(retry_after_s: float = 1.0) -> genai_errors.ClientError:
+    return genai_errors.ClientError(429, {"error": {
+        "code": 429,
+        "message": "Resource has been exhausted (synthetic).",
+        "status": "RESOURCE_EXHAUSTED",
+        "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_after_s:g}s"}],
+    }})
+
+
+def _server_error(message: str) -> genai_errors.ServerError:
+    return genai_errors.ServerError(503, {"error": {"code": 503, "message": message, "status": "UNAVAILABLE"}})
+
+
+def _content_key_part(item: Any) -> Any:
+    """Reduces a contents item to a JSON-serializable form; binary payloads are replaced by their hash."""
+    if item is None or isinstance(item, (str, int, float, bool)):
+        return item
+    if isinstance(item, (bytes, bytearray)):
+        return "sha256:" + hashlib.sha256(item).hexdigest()
+    if isinstance(item, dict):
+        return {k: _content_key_part(v) for k, v in sorted(item.items())}
+    if isinstance(item, (list, tuple)):
+        return [_content_key_part(v) for v in item]
+    if isinstance(item, genai_types.File):
+        return {"file": item.name or item.uri}
+    if hasattr(item, "model_dump"):
+        return _content_key_part(item.model_dump(exclude_none=True))
+    return str(item)
+
+
+def contents_fingerprint(model: str, contents: Any) -> str:
+    """Stable key for a (model, contents) request, used to match cassette entries."""
+    payload = json.dumps({"model": model, "contents": _content_key_part(contents)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class SyntheticStreamConfig:
+    """Shape of the synthetic model's output stream."""
+    ttft_ms: float = 400.0              # Time to first token
+    tokens_per_sec: float = 250.0       # Steady-state decode speed
+    chunk_tokens: float = 24.0          # Median tokens per streamed chunk
+    chunk_sigma: float = 0.5            # Log-normal spread of chunk sizes (0 = fixed size)
+    response_tokens: int = 1500         # Total tokens emitted per response
+    error_rate: float = 0.0             # Probability a stream fails mid-way with a 503
+    rate_limit_rate: float = 0.0        # Probability a call is rejected up-front with a 429
+    implicit_cache_min_tokens: int = 1024  # Shortest shared prompt prefix reported as cached
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "SyntheticStreamConfig":
+        seed = os.getenv("MORPHEO_SYNTH_SEED")
+        return cls(
+            ttft_ms=_env_float("MORPHEO_SYNTH_TTFT_MS", cls.ttft_ms),
+            tokens_per_sec=_env_float("MORPHEO_SYNTH_TOKENS_PER_SEC", cls.tokens_per_sec),
+            chunk_tokens=_env_float("MORPHEO_SYNTH_CHUNK_TOKENS", cls.chunk_tokens),
+            chunk_sigma=_env_float("MORPHEO_SYNTH_CHUNK_SIGMA", cls.chunk_sigma),
+            response_tokens=int(_env_float("MORPHEO_SYNTH_RESPONSE_TOKENS", cls.response_tokens)),
+            error_rate=_env_float("MORPHEO_SYNTH_ERROR_RATE", cls.error_rate),
+            rate_limit_rate=_env_float("MORPHEO_SYNTH_429_RATE", cls.rate_limit_rate),
+            implicit_cache_min_tokens=int(_env_float("MORPHEO_SYNTH_IMPLICIT_CACHE_MIN_TOKENS", cls.implicit_cache_min_tokens)),
+            seed=int(seed) if seed else None,
+        )
+
+
+class _Namespace:
+    """Attribute holder mimicking the `client.aio` / `client.files` layout of google.genai.Client."""
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class SyntheticFiles:
+    """Stand-in for `client.files`; uploads are acknowledged but never leave the process."""
+
+    def upload(self, *args, config: Any = None, **kwargs) -> genai_types.File:
+        file_id = uuid.uuid4().hex[:12]
+        mime_type = kwargs.get("mime_type")
+        if mime_type is None and config is not None:
+            mime_type = config.get("mime_type") if isinstance(config, dict) else getattr(config, "mime_type", None)
+        return genai_types.File(name=f"files/{file_id}", uri=f"synthetic://files/{file_id}", mime_type=mime_type)
+
+    def delete(self, name: str, **kwargs) -> None:
+        return None
+
+
+class SyntheticCaches:
+    """Stand-in for `client.aio.caches`; cached contents are held in memory and expire on their TTL."""
+
+    def __init__(self):
+        self._expiry: Dict[str, float] = {}
+        self._models: Dict[str, str] = {}
+        self._tokens: Dict[str, int] = {}
+        self.created = 0
+
+    @staticmethod
+    def _ttl(config: Any) -> float:
+        ttl = config.get("ttl") if isinstance(config, dict) else getattr(config, "ttl", None)
+        return float(str(ttl or "3600s").rstrip("s"))
+
+    def _cached_content(self, name: str) -> genai_types.CachedContent:
+        return genai_types.CachedContent(name=name, model=self._models[name])
+
+    async def create(self, model: str, config: Any = None) -> genai_types.CachedContent:
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        self._expiry[name] = time.monotonic() + self._ttl(config)
+        self._models[name] = model
+        contents = config.get("contents") if isinstance(config, dict) else getattr(config, "contents", None)
+        self._tokens[name] = count_tokens(_prompt_text(contents))
+        self.created += 1
+        return self._cached_content(name)
+
+    async def update(self, name: str, config: Any = None) -> genai_types.CachedContent:
+        if not self.is_live(name):
+            raise _cache_not_found_error()
+        self._expiry[name] = time.monotonic() + self._ttl(config)
+        return self._cached_content(name)
+
+    async def delete(self, name: str, config: Any = None) -> None:
+        self._expiry.pop(name, None)
+
+    def is_live(self, name: str, model: Optional[str] = None) -> bool:
+        return self._expiry.get(name, 0.0) > time.monotonic() and (model is None or self._models.get(name) == model)
+
+    def expire(self, name: str) -> None:
+        """Ages a cached content out immediately (as the upstream TTL would)."""
+        self._expiry[name] = 0.0
+
+    def tokens(self, name: str) -> int:
+        return self._tokens.get(name, 0)
+
+
+def _cache_not_found_error() -> genai_errors.ClientError:
+    return genai_errors.ClientError(403, {"error": {"code": 403, "message": "CachedContent not found (or permission denied)", "status": "PERMISSION_DENIED"}})
+
+
+def _prompt_text(contents: Any) -> str:
+    """Text of a request's contents (prompt strings and text parts, in order)."""
+    if contents is None:
+        return ""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, dict):
+        return contents.get("text") if isinstance(contents.get("text"), str) else _prompt_text(contents.get("parts"))
+    if isinstance(contents, (list, tuple)):
+        return "".join(_prompt_text(item) for item in contents)
+    if isinstance(contents, genai_types.Content):
+        return "".join(part.text or "" for part in contents.parts or [])
+    return ""
+
+
+def _cached_content_name(config: Any) -> Optional[str]:
+    return config.get("cached_content") if isinstance(config, dict) else getattr(config, "cached_content", None)
+
+
+def _has_tools(config: Any) -> bool:
+    tools = config.get("tools") if isinstance(config, dict) else getattr(config, "tools", None)
+    tool_config = config.get("tool_config") if isinstance(config, dict) else getattr(config, "tool_config", None)
+    return bool(tools) or tool_config is not None
+
+
+def _cached_content_with_tools_error() -> genai_errors.ClientError:
+    return genai_errors.ClientError(400, {"error": {
+        "code": 400,
+        "message": "CachedContent can not be used with GenerateContent request setting system_instruction, tools or tool_config.",
+        "status": "INVALID_ARGUMENT",
+    }})
+
+
+class SyntheticModels:
+    """Stand-in for `client.aio.models` that fabricates HTML-shaped output at a configured pace."""
+
+    def __init__(self, config: SyntheticStreamConfig, caches: Optional[SyntheticCaches] = None):
+        self.config = config
+        self.caches = caches
+        self._rng = random.Random(config.seed)
+        self._recent_prompts: Deque[str] = deque(maxlen=32)
+
+    def _chunk_sizes(self, total_tokens: int) -> List[int]:
+        sizes = []
+        remaining = total_tokens
+        while remaining > 0:
+            if self.config.chunk_sigma > 0:
+                size = int(round(self._rng.lognormvariate(0.0, self.config.chunk_sigma) * self.config.chunk_tokens))
+            else:
+                size = int(self.config.chunk_tokens)
+            size = max(1, min(size, remaining))
+            sizes.append(size)
+            remaining -= size
+        return sizes
+
+    def _body(self, total_chars: int) -> str:
+        head = "<!DOCTYPE html>\n<html lang=\"en\">\n<head><meta charset=\"UTF-8\"><title>Synthetic</title></head>\n<body>\n"
+        tail = "\n</body>\n</html>\n"
+        filler_line = "<p>Synthetic Morpheo output for load testing.</p>\n"
+        filler_len = max(0, total_chars - len(head) - len(tail))
+        filler = (filler_line * (filler_len // len(filler_line) + 1))[:filler_len]
+        return head + filler + tail
+
+    def _usage(self, model: str, contents: Any, cached_content: Optional[str]) -> genai_types.GenerateContentResponseUsageMetadata:
+        """Prompt token counts, with the explicitly cached handle or the longest prefix shared with a recent prompt as cached."""
+        text = _prompt_text(contents)
+        explicit = self.caches.tokens(cached_content) if cached_content and self.caches is not None else 0
+        shared = max((len(os.path.commonprefix([text, previous])) for previous in self._recent_prompts), default=0)
+        implicit = count_tokens(text[:shared]) if shared else 0
+        self._recent_prompts.append(text)
+        cached = explicit + (implicit if implicit >= self.config.implicit_cache_min_tokens else 0)
+        return genai_types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=explicit + count_tokens(text),
+            cached_content_token_count=cached or None,
+        )
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> AsyncIterator[genai_types.GenerateContentResponse]:
+        cached_content = _cached_content_name(config)
+        if cached_content and _has_tools(config):
+            raise _cached_content_with_tools_error()  # As the API does
+        if cached_content and (self.caches is None or not self.caches.is_live(cached_content, model)):
+            raise _cache_not_found_error()
+        if self._rng.random() < self.config.rate_limit_rate:
+            await asyncio.sleep(self.config.ttft_ms / 4000.0)
+            raise _rate_limit_error()
+        return self._stream(_resume_offset(contents), self._usage(model, contents, cached_content))
+
+    async def _stream(self, resume_at: int = 0, usage: Optional[genai_types.GenerateContentResponseUsageMetadata] = None) -> AsyncIterator[genai_types.GenerateContentResponse]:
+        body = self._body(self.config.response_tokens * CHARS_PER_TOKEN)[resume_at:]
+        sizes = self._chunk_sizes(max(1, len(body) // CHARS_PER_TOKEN))
+        fail_at = len(sizes) // 2 if self._rng.random() < self.config.error_rate else -1
+        start = time.perf_counter()
+        emitted_tokens = 0
+        offset = 0
+        for index, size in enumerate(sizes):
+            if index == fail_at:
+                raise _server_error("Synthetic stream interrupted.")
+            # Schedule against the stream start so per-chunk overhead does not accumulate as drift.
+            due = self.config.ttft_ms / 1000.0 + emitted_tokens / max(self.config.tokens_per_sec, 1e-6)
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            emitted_tokens += size
+            text = body[offset:offset + size * CHARS_PER_TOKEN] if index < len(sizes) - 1 else body[offset:]
+            offset += len(text)
+            chunk = _make_text_chunk(text)
+            if usage is not None and index == len(sizes) - 1:
+                usage.candidates_token_count = emitted_tokens
+                chunk.usage_metadata = usage  # Reported on the final chunk, as upstream does
+            yield chunk
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> genai_types.GenerateContentResponse:
+        if self._rng.random() < self.config.rate_limit_rate:
+            raise _rate_limit_error()
+        await asyncio.sleep(self.config.ttft_ms / 1000.0)
+        modalities = getattr(config, "response_modalities", None) or []
+        parts = [genai_types.Part(text="Synthetic response.")]
+        if "IMAGE" in modalities:
+            parts.append(genai_types.Part(inline_data=genai_types.Blob(mime_type="image/png", data=_SYNTHETIC_PNG)))
+        return genai_types.GenerateContentResponse(
+            candidates=[genai_types.Candidate(content=genai_types.Content(role="model", parts=parts))]
+        )
+
+
+def _resume_offset(contents: Any) -> int:
+    """Length of the partial output in a continuation request (a trailing model turn + instruction), else 0."""
+    if not isinstance(contents, list) or len(contents) < 2:
+        return 0
+    turn = contents[-2]
+    if not isinstance(turn, dict) or turn.get("role") != "model":
+        return 0
+    return sum(len(part.get("text", "")) for part in turn.get("parts", []) if isinstance(part, dict))
+
+
+class SyntheticGeminiClient:
+    """Drop-in replacement for google.genai.Client that never touches the network."""
+
+    def __init__(self, config: Optional[SyntheticStreamConfig] = None):
+        self.config = config or SyntheticStreamConfig.from_env()
+        caches = SyntheticCaches()
+        self.aio = _Namespace(models=SyntheticModels(self.config, caches), caches=caches)
+        self.files = SyntheticFiles()
+
+
+class Cassette:
+    """
+    Append-only JSONL store of recorded streams.
+
+    Each line holds the request key, model name, the ordered chunk texts with their
+    offsets (seconds since the call started) and, if the stream failed, the error. Takes
+    the consumer abandoned part-way (client disconnect, security abort, cancelled hedge)
+    are written with `"incomplete": true` for inspection but never replayed.
+
+    Lines are written by a background thread, so recording never blocks the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        self._pending: "queue.Queue[str]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed cassette line in {self.path}.")
+                    continue
+                if not entry.get("incomplete"):
+                    self._entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"Loaded {sum(len(v) for v in self._entries.values())} cassette recordings from {self.path}.")
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        """Adds a take (replayable at once unless incomplete) and queues it for writing."""
+        with self._lock:
+            if not entry.get("incomplete"):
+                self._entries.setdefault(entry["key"], []).append(entry)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="cassette-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+        self._pending.put(json.dumps(entry) + "\n")
+
+    def flush(self) -> None:
+        """Blocks until every appended take is on disk."""
+        self._pending.join()
+
+    def _run(self) -> None:
+        while True:
+            lines = [self._pending.get()]
+            while True:
+                try:
+                    lines.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+            except OSError as e:
+                logger.error(f"Failed to write {len(lines)} cassette recording(s) to {self.path}: {e}")
+            finally:
+                for _ in lines:
+                    self._pending.task_done()
+
+    def next_for(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns recordings for `key` round-robin, so repeated requests replay every take."""
+        with self._lock:
+            recordings = self._entries.get(key)
+            if not recordings:
+                return None
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return recordings[index % len(recordings)]
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._entries.values())
+
+
+class RecordingModels:
+    """Wraps a real `client.aio.models` and records stream text and timing into a cassette."""
+
+    def __init__(self, inner: Any, cassette: Cassette):
+        self._inner = inner
+        self._cassette = cassette
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        key = contents_fingerprint(model, contents)
+        start = time.perf_counter()
+        try:
+            stream = await self._inner.generate_content_stream(model=model, contents=contents, config=config)
+        except Exception as e:
+            self._cassette.append({"key": key, "model": model, "chunks": [], "error": _describe_error(e, time.perf_counter() - start)})
+            raise
+        return self._record(stream, key, model, start)
+
+    async def _record(self, stream: AsyncIterator[Any], key: str, model: str, start: float):
+        chunks: List[List[Any]] = []
+        error = None
+        finished = False
+        try:
+            async for chunk in stream:
+                chunks.append([round(time.perf_counter() - start, 6), getattr(chunk, "text", None) or ""])
+                yield chunk
+            finished = True
+        except Exception as e:
+            error = _describe_error(e, time.perf_counter() - start)
+            finished = True
+            raise
+        finally:
+            entry = {"key": key, "model": model, "chunks": chunks, "error": error}
+            if not finished:
+                entry["incomplete"] = True  # Abandoned by the consumer (GeneratorExit / CancelledError): a truncated take
+            self._cassette.append(entry)
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        return await self._inner.generate_content(model=model, contents=contents, config=config)
+
+
+class ReplayModels:
+    """Replays cassette recordings with their original chunk boundaries and timing."""
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0, fallback: Optional[SyntheticModels] = None):
+        self._cassette = cassette
+        self._speed = speed
+        self._fallback = fallback
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        key = contents_fingerprint(model, contents)
+        entry = self._cassette.next_for(key)
+        if entry is None:
+            if self._fallback is not None:
+                logger.info(f"No cassette entry for key {key[:12]}; using synthetic stream.")
+                return await self._fallback.generate_content_stream(model=model, contents=contents, config=config)
+            raise LookupError(f"No cassette recording for request key {key} (model {model}).")
+        if not entry["chunks"] and entry.get("error"):
+            await self._sleep_until(time.perf_counter(), entry["error"].get("at", 0.0))
+            raise _rebuild_error(entry["error"])
+        return self._replay(entry)
+
+    async def _sleep_until(self, start: float, offset: float) -> None:
+        if self._speed <= 0:
+            return
+        delay = offset / self._speed - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _replay(self, entry: Dict[str, Any]):
+        start = time.perf_counter()
+        for offset, text in entry["chunks"]:
+            await self._sleep_until(start, offset)
+            yield _make_text_chunk(text)
+        if entry.get("error"):
+            await self._sleep_until(start, entry["error"].get("at", 0.0))
+            raise _rebuild_error(entry["error"])
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        if self._fallback is None:
+            raise LookupError("Non-streaming calls are not recorded; no synthetic fallback configured.")
+        return await self._fallback.generate_content(model=model, contents=contents, config=config)
+
+
+def _describe_error(e: Exception, at: float) -> Dict[str, Any]:
+    return {
+        "at": round(at, 6),
+        "type": type(e).__name__,
+        "code": getattr(e, "code", None),
+        "status": getattr(e, "status", None),
+        "message": getattr(e, "message", None) or str(e),
+    }
+
+
+def _rebuild_error(error: Dict[str, Any]) -> Exception:
+    code = error.get("code")
+    if isinstance(code, int):
+        body = {"error": {"code": code, "message": error.get("message"), "status": error.get("status")}}
+        return genai_errors.ClientError(code, body) if 400 <= code < 500 else genai_errors.ServerError(code, body)
+    return RuntimeError(error.get("message") or "Replayed stream error")
+
+
+class RecordingGeminiClient:
+    """Real client whose streaming calls are captured to a cassette."""
+
+    def __init__(self, inner: Any, cassette_path: str = DEFAULT_CASSETTE_PATH):
+        self._inner = inner
+        self.cassette = Cassette(cassette_path)
+        self.aio = _Namespace(models=RecordingModels(inner.aio.models, self.cassette), caches=inner.aio.caches)
+        self.files = inner.files
+
+
+class ReplayGeminiClient:
+    """Offline client that serves cassette recordings; unknown requests optionally fall back to synthetic output."""
+
+    def __init__(self, cassette_path: str = DEFAULT_CASSETTE_PATH, speed: float = 1.0, synthetic_fallback: bool = True):
+        self.cassette = Cassette(cassette_path)
+        caches = SyntheticCaches()
+        fallback = SyntheticModels(SyntheticStreamConfig.from_env(), caches) if synthetic_fallback else None
+        self.aio = _Namespace(models=ReplayModels(self.cassette, speed=speed, fallback=fallback), caches=caches)
+        self.files = SyntheticFiles()
+
+
+def create_model_client(backend: Optional[str] = None, gemini_factory: Optional[Callable[[], Any]] = None) -> Any:
+    """
+    Builds the model client selected by `backend` (or MORPHEO_MODEL_BACKEND).
+
+    Args:
+        backend: Backend name; MORPHEO_MODEL_BACKEND when omitted.
+        gemini_factory: Builds the real google-genai client (default: `genai.Client()`).
+
+    Returns:
+        An object exposing the `aio.models` / `files` surface ComponentService uses.
+    """
+    gemini_factory = gemini_factory or genai.Client
+    backend = (backend or os.getenv(MODEL_BACKEND_ENV, "gemini")).strip().lower()
+    cassette_path = os.getenv(CASSETTE_PATH_ENV, DEFAULT_CASSETTE_PATH)
+
+    if backend == "synthetic":
+        logger.info("Using SYNTHETIC model backend (no upstream calls).")
+        return SyntheticGeminiClient()
+    if backend == "replay":
+        speed = _env_float("MORPHEO_REPLAY_SPEED", 1.0)
+        strict = os.getenv("MORPHEO_REPLAY_STRICT", "false").lower() == "true"
+        logger.info(f"Using REPLAY model backend from cassette {cassette_path} (speed x{speed}, strict={strict}).")
+        return ReplayGeminiClient(cassette_path, speed=speed, synthetic_fallback=not strict)
+    if backend == "record":
+        logger.info(f"Using RECORD model backend; streams are captured to {cassette_path}.")
+        return RecordingGeminiClient(gemini_factory(), cassette_path)
+    if backend != "gemini":
+        logger.warning(f"Unknown {MODEL_BACKEND_ENV} '{backend}'; falling back to the real Gemini client.")
+    return gemini_factory()
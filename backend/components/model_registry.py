@@ -0,0 +1,335 @@
+"""
+Model Registry and Routing
+
+This module replaces the model names hardcoded across ComponentService with a registry of
+known models and per-task routing rules. A rule lists candidate models in order of
+preference (cheapest first); the router picks the first candidate that
+
+- has the capabilities the call needs (grounding, image/video/audio input, image output),
+- fits the estimated prompt size and the task's output-token budget,
+- is meeting the task's latency budget (observed time to first chunk), and
+- is not behind an open circuit breaker,
+
+so light models answer chat and suggestions while generation stays on the standard model.
+A candidate skipped for latency gets no new samples, so once its last sample is older than
+`latency_probe_s` one call is let through as a probe and its latency replaces the average
+(like a circuit breaker's half-open state).
+Every decision (with the reasons earlier candidates were skipped) is written to the routing
+log for later analysis.
+
+The built-in registry can be replaced with a JSON file (MORPHEO_MODEL_REGISTRY_PATH) using
+the same shape as DEFAULT_REGISTRY.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from .token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PART_TOKENS = 258  # Rough per-part cost of inline media / file references
+
+
+@dataclass
+class ModelSpec:
+    """A model the service may call."""
+    name: str
+    tier: str = "standard"              # light | standard | heavy
+    context_tokens: int = 1_048_576
+    max_output_tokens: int = 8192
+    input_cost_per_mtok: float = 0.0    # USD per million input tokens
+    output_cost_per_mtok: float = 0.0   # USD per million output tokens
+    capabilities: Tuple[str, ...] = ("text",)
+
+
+@dataclass
+class RouteCandidate:
+    """One entry of a routing rule."""
+    model: str
+    max_prompt_tokens: Optional[int] = None  # Prompts larger than this skip the candidate
+
+
+@dataclass
+class RouteRule:
+    """Routing rule for one service task."""
+    task: str
+    candidates: List[RouteCandidate]
+    output_tokens: int = 2048                   # Expected output budget for the task
+    latency_budget_s: Optional[float] = None    # Skip candidates whose observed first-chunk latency exceeds this
+    needs: Tuple[str, ...] = ()                 # Capabilities every call of the task requires
+
+
+@dataclass
+class RoutingDecision:
+    """The model chosen for a call, and why."""
+    task: str
+    model: str
+    reason: str
+    prompt_tokens: int
+    output_tokens: int
+    estimated_cost_usd: float
+    skipped: List[str] = field(default_factory=list)
+
+
+_MEDIA_INPUT = ("image_input", "video_input", "audio_input")
+
+DEFAULT_REGISTRY: Dict[str, Any] = {
+    "default_model": "gemini-2.0-flash",
+    "models": [
+        {"name": "gemini-2.0-flash-lite", "tier": "light", "input_cost_per_mtok": 0.075, "output_cost_per_mtok": 0.30,
+         "capabilities": ["text", *_MEDIA_INPUT]},
+        {"name": "gemini-2.0-flash", "tier": "standard", "input_cost_per_mtok": 0.10, "output_cost_per_mtok": 0.40,
+         "capabilities": ["text", "grounding", *_MEDIA_INPUT]},
+        {"name": "gemini-2.0-flash-exp", "tier": "standard", "input_cost_per_mtok": 0.10, "output_cost_per_mtok": 0.40,
+         "capabilities": ["text", "image_input", "image_output"]},
+    ],
+    "rules": [
+        {"task": "generation", "candidates": [{"model": "gemini-2.0-flash"}], "output_tokens": 8192},
+        {"task": "modification", "candidates": [{"model": "gemini-2.0-flash"}], "output_tokens": 8192},
+        {"task": "correction", "candidates": [{"model": "gemini-2.0-flash"}], "output_tokens": 8192},
+        {"task": "suggestion", "output_tokens": 512, "latency_budget_s": 3.0, "candidates": [
+            {"model": "gemini-2.0-flash-lite", "max_prompt_tokens": 32000}, {"model": "gemini-2.0-flash"}]},
+        {"task": "chat", "output_tokens": 1024, "latency_budget_s": 2.0, "candidates": [
+            {"model": "gemini-2.0-flash-lite", "max_prompt_tokens": 16000}, {"model": "gemini-2.0-flash"}]},
+        {"task": "image_analysis", "output_tokens": 1024, "latency_budget_s": 3.0, "needs": ["image_input"], "candidates": [
+            {"model": "gemini-2.0-flash-lite", "max_prompt_tokens": 8000}, {"model": "gemini-2.0-flash"}]},
+        {"task": "video_analysis", "output_tokens": 2048, "needs": ["video_input"], "candidates": [{"model": "gemini-2.0-flash"}]},
+        {"task": "audio_analysis", "output_tokens": 2048, "needs": ["audio_input"], "candidates": [{"model": "gemini-2.0-flash"}]},
+        {"task": "image_generation", "output_tokens": 1290, "needs": ["image_output"], "candidates": [{"model": "gemini-2.0-flash-exp"}]},
+    ],
+}
+
+
+def estimate_tokens(contents: Any) -> int:
+    """Rough prompt size in tokens (local text estimate, plus a flat cost per media part)."""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return count_tokens(contents)
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(item) for item in contents)
+    if isinstance(contents, dict):
+        if "parts" in contents:
+            return estimate_tokens(contents["parts"])
+        if "text" in contents:
+            return estimate_tokens(contents["text"])
+        return MEDIA_PART_TOKENS
+    text = getattr(contents, "text", None)
+    if isinstance(text, str):
+        return count_tokens(text)
+    parts = getattr(contents, "parts", None)
+    if parts:
+        return estimate_tokens(list(parts))
+    return MEDIA_PART_TOKENS
+
+
+class ModelRegistry:
+    """
+    Known models, per-task routing rules and observed latencies.
+
+    Args:
+        models: Model specifications.
+        rules: Routing rules; tasks without a rule use `default_model`.
+        default_model: Model for tasks without a rule (and the service's nominal model).
+        routing_log: Optional LogWriter that receives every logged decision.
+        latency_alpha: Smoothing factor of the per-model latency average.
+        latency_probe_s: Age of a model's last latency sample after which a call is let through
+            to re-measure it, even though its average is over the task's latency budget.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[ModelSpec],
+        rules: Sequence[RouteRule],
+        default_model: str,
+        routing_log: Any = None,
+        latency_alpha: float = 0.2,
+        latency_probe_s: float = 30.0,
+    ):
+        self.models: Dict[str, ModelSpec] = {spec.name: spec for spec in models}
+        self.rules: Dict[str, RouteRule] = {rule.task: rule for rule in rules}
+        self.default_model = default_model
+        self.routing_log = routing_log
+        self.latency_alpha = latency_alpha
+        self.latency_probe_s = latency_probe_s
+        self._latency: Dict[str, float] = {}
+        self._latency_at: Dict[str, float] = {}  # monotonic time of the last sample (or probe)
+        self._probing: set = set()
+        self._decisions: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        for rule in rules:
+            for candidate in rule.candidates:
+                if candidate.model not in self.models:
+                    raise ValueError(f"Routing rule for '{rule.task}' references unknown model '{candidate.model}'")
+
+    @classmethod
+    def from_dict(cls, config: Dict[str, Any], routing_log: Any = None) -> "ModelRegistry":
+        models = [ModelSpec(**dict(m, capabilities=tuple(m.get("capabilities", ("text",))))) for m in config["models"]]
+        rules = [
+            RouteRule(
+                task=r["task"],
+                candidates=[RouteCandidate(**c) for c in r["candidates"]],
+                output_tokens=r.get("output_tokens", 2048),
+                latency_budget_s=r.get("latency_budget_s"),
+                needs=tuple(r.get("needs", ())),
+            )
+            for r in config.get("rules", [])
+        ]
+        return cls(models, rules, config.get("default_model", models[0].name), routing_log=routing_log)
+
+    # --- Routing ---
+
+    def primary(self, task: Optional[str]) -> str:
+        """The preferred model for `task`, ignoring prompt size and runtime conditions."""
+        rule = self.rules.get(task or "")
+        return rule.candidates[0].model if rule else self.default_model
+
+    def route(
+        self,
+        task: Optional[str],
+        contents: Any = None,
+        needs: Sequence[str] = (),
+        output_tokens: Optional[int] = None,
+        available: Optional[Callable[[str], bool]] = None,
+        log: bool = True,
+        prompt_tokens: Optional[int] = None,
+    ) -> RoutingDecision:
+        """
+        Chooses the model for one call.
+
+        Args:
+            task: Service task name (e.g. "generation", "chat").
+            contents: Request contents, used to estimate the prompt size.
+            needs: Capabilities required by this call in addition to the rule's (e.g. "grounding").
+            output_tokens: Output budget; defaults to the rule's.
+            available: Returns False for models that should not be used right now (open circuit).
+            log: Write the decision to the routing log.
+            prompt_tokens: Known prompt size; when given, `contents` is not estimated.
+
+        Returns:
+            The decision. When no candidate satisfies every constraint, the last candidate
+            (the most capable by convention) is used and the reason says so.
+        """
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(contents)
+        rule = self.rules.get(task or "")
+        if rule is None:
+            decision = self._decision(task, self.default_model, "no routing rule", prompt_tokens, output_tokens or 2048, [])
+            return self._record(decision, log)
+
+        budget = output_tokens or rule.output_tokens
+        required = set(rule.needs) | set(needs)
+        skipped: List[str] = []
+        for candidate in rule.candidates:
+            why_not = self._rejection(candidate, rule, required, prompt_tokens, budget, available, probe=log)
+            if why_not is None:
+                reason = "preferred" if not skipped else "first eligible candidate"
+                return self._record(self._decision(task, candidate.model, reason, prompt_tokens, budget, skipped), log)
+            skipped.append(f"{candidate.model}: {why_not}")
+        last = rule.candidates[-1].model
+        return self._record(self._decision(task, last, "no candidate met every constraint", prompt_tokens, budget, skipped), log)
+
+    def _rejection(
+        self,
+        candidate: RouteCandidate,
+        rule: RouteRule,
+        required: set,
+        prompt_tokens: int,
+        output_tokens: int,
+        available: Optional[Callable[[str], bool]],
+        probe: bool = True,
+    ) -> Optional[str]:
+        spec = self.models[candidate.model]
+        missing = required - set(spec.capabilities)
+        if missing:
+            return f"lacks {', '.join(sorted(missing))}"
+        limit = candidate.max_prompt_tokens or (spec.context_tokens - output_tokens)
+        if prompt_tokens > limit:
+            return f"prompt ~{prompt_tokens} tokens exceeds {limit}"
+        if output_tokens > spec.max_output_tokens:
+            return f"output budget {output_tokens} exceeds {spec.max_output_tokens}"
+        if available is not None and not available(candidate.model):
+            return "circuit open"
+        latency = self._latency.get(candidate.model)
+        if rule.latency_budget_s is not None and latency is not None and latency > rule.latency_budget_s:
+            if not (probe and self._claim_probe(candidate.model)):
+                return f"observed latency {latency:.2f}s over budget {rule.latency_budget_s:.2f}s"
+            logger.info(f"Probing {candidate.model} for {rule.task}: its latency sample ({latency:.2f}s) is stale.")
+        return None
+
+    def _claim_probe(self, model: str) -> bool:
+        """True (at most once per `latency_probe_s`) when the model's latency sample is stale enough to re-measure."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._latency_at.get(model, now) < self.latency_probe_s:
+                return False
+            self._latency_at[model] = now
+            self._probing.add(model)
+            return True
+
+    def _decision(self, task, model, reason, prompt_tokens, output_tokens, skipped) -> RoutingDecision:
+        spec = self.models.get(model)
+        cost = 0.0
+        if spec is not None:
+            cost = (prompt_tokens * spec.input_cost_per_mtok + output_tokens * spec.output_cost_per_mtok) / 1_000_000
+        return RoutingDecision(task or "default", model, reason, prompt_tokens, output_tokens, round(cost, 6), skipped)
+
+    def _record(self, decision: RoutingDecision, log: bool) -> RoutingDecision:
+        if not log:
+            return decision
+        with self._lock:
+            key = (decision.task, decision.model)
+            self._decisions[key] = self._decisions.get(key, 0) + 1
+        if decision.skipped:
+            logger.info(f"Routed {decision.task} to {decision.model} ({decision.reason}; skipped {'; '.join(decision.skipped)})")
+        if self.routing_log is not None:
+            self.routing_log.write(dict(asdict(decision), event="route", observed_latency_s=self._latency.get(decision.model)))
+        return decision
+
+    # --- Feedback ---
+
+    def observe(self, model: str, latency_s: float) -> None:
+        """Feeds a call's time to first chunk into the model's latency average."""
+        with self._lock:
+            previous = self._latency.get(model)
+            if previous is None or model in self._probing:
+                self._latency[model] = latency_s  # A probe's sample replaces the stale average
+                self._probing.discard(model)
+            else:
+                self._latency[model] = previous + self.latency_alpha * (latency_s - previous)
+            self._latency_at[model] = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Routing counters for /api/metrics."""
+        with self._lock:
+            decisions: Dict[str, Dict[str, int]] = {}
+            for (task, model), count in self._decisions.items():
+                decisions.setdefault(task, {})[model] = count
+            return {
+                "default_model": self.default_model,
+                "latency_s": {model: round(value, 3) for model, value in self._latency.items()},
+                "decisions": decisions,
+            }
+
+
+def create_model_registry(routing_log: Any = None) -> ModelRegistry:
+    """
+    Builds the registry from MORPHEO_MODEL_REGISTRY_PATH (JSON shaped like DEFAULT_REGISTRY),
+    falling back to the built-in registry.
+    """
+    path = os.getenv("MORPHEO_MODEL_REGISTRY_PATH")
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                registry = ModelRegistry.from_dict(json.load(f), routing_log=routing_log)
+            logger.info(f"Loaded model registry from {path} ({len(registry.models)} models, {len(registry.rules)} rules).")
+            return registry
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Could not load model registry from {path}: {e}. Using the built-in registry.")
+    return ModelRegistry.from_dict(DEFAULT_REGISTRY, routing_log=routing_log)
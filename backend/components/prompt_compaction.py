@@ -0,0 +1,246 @@
+"""
+Prompt Compaction
+
+This module produces a compact variant of a prompt template. Everything in a template is
+billed as input tokens on every call, including text the model does not need:
+
+- `//` comment markers outside code examples: the template writes live guidance (file
+  handling, the generation process) as `//` lines, so the marker is dropped and the text kept,
+- whitespace: trailing spaces, runs of blank lines, runs of spaces inside prose lines and
+  indentation shared by every line of a code example,
+- near-duplicate code examples: a later example that mostly repeats an earlier one is
+  replaced by the lines that differ from it.
+
+The compact variant is built at load time by the template store, and can be built ahead of
+time (and its savings reported) from the command line:
+
+    python -m components.prompt_compaction gemini_prompt_template_wc.md -o compact.md
+
+Which variant requests use is switchable (MORPHEO_PROMPT_VARIANT=full|compact|ab); "ab"
+splits requests between the two so their output quality and latency can be compared.
+"""
+
+import argparse
+import difflib
+import hashlib
+import logging
+import os
+import re
+import textwrap
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from .token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+FULL = "full"
+COMPACT = "compact"
+AB = "ab"
+VARIANTS = (FULL, COMPACT)
+
+_FENCE = re.compile(r"^\s*```")
+_COMMENT_MARKER = re.compile(r"^(\s*)// ?")
+_INNER_SPACES = re.compile(r"(?<=\S) {2,}")
+
+
+@dataclass
+class CompactionReport:
+    chars_before: int = 0
+    chars_after: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+    comment_markers: int = 0
+    blank_lines: int = 0
+    duplicate_examples: int = 0
+
+    @property
+    def token_savings(self) -> float:
+        """Fraction of the estimated input tokens removed."""
+        return 1 - self.tokens_after / self.tokens_before if self.tokens_before else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(asdict(self), token_savings=round(self.token_savings, 3))
+
+    def summary(self) -> str:
+        return (
+            f"{self.tokens_before:,} -> {self.tokens_after:,} tokens ({self.token_savings:.1%} saved; "
+            f"{self.chars_before:,} -> {self.chars_after:,} chars; {self.comment_markers} comment markers, "
+            f"{self.blank_lines} blank lines, {self.duplicate_examples} duplicate examples removed)"
+        )
+
+
+def _split_blocks(text: str) -> List[Tuple[bool, List[str]]]:
+    """Splits a template into alternating (is_code, lines) runs; fence lines belong to their code run."""
+    runs: List[Tuple[bool, List[str]]] = []
+    in_code = False
+    current: List[str] = []
+    for line in text.split("\n"):
+        if _FENCE.match(line):
+            if in_code:
+                current.append(line)
+                runs.append((True, current))
+                current, in_code = [], False
+                continue
+            if current:
+                runs.append((False, current))
+            current, in_code = [line], True
+            continue
+        current.append(line)
+    if current:
+        runs.append((in_code, current))
+    return runs
+
+
+def _words(lines: List[str]) -> List[str]:
+    return " ".join(re.sub(r"//.*", "", line) for line in lines).split()
+
+
+def _compact_code(lines: List[str]) -> List[str]:
+    """Trims a fenced example: shared indentation and trailing spaces removed, blank lines dropped."""
+    fence_open, body, fence_close = lines[0].strip(), lines[1:-1], lines[-1].strip() if len(lines) > 1 else ""
+    body = textwrap.dedent("\n".join(line.rstrip() for line in body)).split("\n")
+    return [fence_open] + [line for line in body if line.strip()] + ([fence_close] if fence_close else [])
+
+
+def compact(text: str, duplicate_threshold: float = 0.7, min_example_chars: int = 500) -> Tuple[str, CompactionReport]:
+    """
+    Builds the compact variant of a template.
+
+    Args:
+        text: Full template text.
+        duplicate_threshold: Word-sequence similarity above which a later code example is
+            considered a repeat of an earlier one.
+        min_example_chars: Examples shorter than this are never deduplicated.
+
+    Returns:
+        (compact text, report)
+    """
+    report = CompactionReport(chars_before=len(text), tokens_before=count_tokens(text))
+    out: List[str] = []
+    examples: List[List[str]] = []
+    for is_code, lines in _split_blocks(text):
+        if is_code:
+            code = _compact_code(lines)
+            words = _words(code[1:-1])
+            if sum(len(line) for line in lines) >= min_example_chars:
+                earlier = next(
+                    (prev for prev in examples if difflib.SequenceMatcher(None, _words(prev), words, autojunk=False).ratio() >= duplicate_threshold),
+                    None,
+                )
+                if earlier is not None:
+                    seen = {line.strip() for line in earlier}
+                    differing = [line for line in code[1:-1] if line.strip() not in seen]
+                    report.duplicate_examples += 1
+                    out.append("(Same pattern as the earlier example; only the lines that differ:)")
+                    out.extend([code[0]] + differing + [code[-1]])
+                    continue
+                examples.append(code[1:-1])
+            out.extend(code)
+            continue
+        for line in lines:
+            marker = _COMMENT_MARKER.match(line)
+            if marker:
+                report.comment_markers += 1
+                line = marker.group(1) + line[marker.end():]
+            line = _INNER_SPACES.sub(" ", line.rstrip())
+            if not line and (not out or not out[-1]):
+                report.blank_lines += 1
+                continue
+            out.append(line)
+    compacted = "\n".join(out).strip("\n") + "\n"
+    report.chars_after = len(compacted)
+    report.tokens_after = count_tokens(compacted)
+    return compacted, report
+
+
+class VariantSelector:
+    """
+    Chooses the template variant per request and tallies outcomes per variant.
+
+    Args:
+        mode: "full", "compact", or "ab" (each request text is assigned to one variant by hash,
+            so a repeated request always gets the same variant and cache entries stay valid).
+        compact_share: Fraction of requests given the compact variant in "ab" mode.
+    """
+
+    def __init__(self, mode: str = FULL, compact_share: float = 0.5):
+        if mode not in (FULL, COMPACT, AB):
+            raise ValueError(f"Unknown prompt variant mode '{mode}' (expected full, compact or ab).")
+        self.mode = mode
+        self.compact_share = compact_share
+        self._outcomes: Dict[str, Dict[str, float]] = {v: self._empty() for v in VARIANTS}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty() -> Dict[str, float]:
+        return {"requests": 0, "failures": 0, "complete": 0, "first_chunk_s": 0.0, "seconds": 0.0}
+
+    def choose(self, request_text: str) -> str:
+        if self.mode != AB:
+            return self.mode
+        bucket = int(hashlib.sha256(request_text.strip().lower().encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return COMPACT if bucket < self.compact_share else FULL
+
+    def record(self, variant: str, success: bool, complete: bool, first_chunk_s: float, duration_s: float) -> None:
+        """
+        Tallies one generation made with `variant`.
+
+        Args:
+            success: The call finished without an error.
+            complete: The output is a complete document (the quality signal compared between variants).
+            first_chunk_s: Time to the first streamed chunk.
+            duration_s: Time to the end of the stream.
+        """
+        with self._lock:
+            outcome = self._outcomes.setdefault(variant, self._empty())
+            outcome["requests"] += 1
+            outcome["failures"] += 0 if success else 1
+            outcome["complete"] += 1 if complete else 0
+            outcome["first_chunk_s"] += first_chunk_s
+            outcome["seconds"] += duration_s
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            variants = {}
+            for variant, o in self._outcomes.items():
+                n = o["requests"]
+                variants[variant] = {
+                    "requests": int(n),
+                    "failure_rate": round(o["failures"] / n, 3) if n else 0.0,
+                    "complete_rate": round(o["complete"] / n, 3) if n else 0.0,
+                    "avg_first_chunk_s": round(o["first_chunk_s"] / n, 3) if n else None,
+                    "avg_duration_s": round(o["seconds"] / n, 3) if n else None,
+                }
+            return {"mode": self.mode, "variants": variants}
+
+
+def create_variant_selector() -> VariantSelector:
+    """Builds the selector from MORPHEO_PROMPT_VARIANT (full | compact | ab) and MORPHEO_PROMPT_COMPACT_SHARE."""
+    mode = os.getenv("MORPHEO_PROMPT_VARIANT", FULL).strip().lower()
+    try:
+        return VariantSelector(mode, compact_share=float(os.getenv("MORPHEO_PROMPT_COMPACT_SHARE", 0.5)))
+    except ValueError as e:
+        logger.warning(f"{e} Using the full variant.")
+        return VariantSelector(FULL)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build the compact variant of a prompt template and report the savings.")
+    parser.add_argument("template", help="Template file to compact")
+    parser.add_argument("-o", "--output", help="Write the compact variant here (default: only report)")
+    parser.add_argument("--threshold", type=float, default=0.7, help="Similarity above which a code example counts as a repeat")
+    args = parser.parse_args(argv)
+
+    with open(args.template, "r", encoding="utf-8") as f:
+        compacted, report = compact(f.read(), duplicate_threshold=args.threshold)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(compacted)
+    print(f"{args.template}: {report.summary()}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
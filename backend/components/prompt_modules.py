@@ -0,0 +1,212 @@
+"""
+Intent-Conditional Prompt Modules
+
+Parts of the generation template only matter for some requests (import maps for 3D and
+charting libraries, the `/api/chat` history format, media analysis examples, image
+generation rules, uploaded-file handling). The template tags those parts as modules:
+
+    <!-- @module chat-api when=chat -->
+    ...
+    <!-- @end -->
+
+Text outside any module is always included. A module may be split over several tagged
+blocks and may list several intents (`when=chat,speech`); it is included when any of them
+is detected in the request.
+
+A rendering is the core text followed by the included modules (under MODULES_HEADING), not
+the modules in place: the core is then the same for every request and stays the static,
+cacheable prompt prefix, while the modules travel with the per-request part of the prompt.
+
+Intents are detected from the user request, the MIME types of uploaded files and, for
+modifications, the HTML being modified (an app that already calls `/api/chat` keeps the chat
+module). Detection errs towards inclusion: a missed module costs output quality, an extra
+one only costs tokens.
+"""
+
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from .token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+AUTO = "auto"
+ALL = "all"
+
+_MODULE_START = re.compile(r"^\s*<!--\s*@module\s+([\w-]+)\s+when=([\w,-]+)\s*-->\s*$")
+_MODULE_END = re.compile(r"^\s*<!--\s*@end\s*-->\s*$")
+
+MODULES_HEADING = "\n\n## Additional Guidance For This Request\n\n"
+
+# Intent -> pattern over the request text (and the HTML being modified)
+INTENT_PATTERNS: Dict[str, re.Pattern] = {
+    "libraries": re.compile(
+        r"\b(3d|three\.?js|webgl|chart|graph|plot|visuali[sz]|diagram|dashboard|physics|simulat|game|animat|"
+        r"particle|canvas|globe|cube|map|d3|library|libraries|import ?map)",
+        re.IGNORECASE,
+    ),
+    "chat": re.compile(r"\b(chat|bots?\b|assistant|conversation|ask (the )?ai|\bai\b|gpt|llm|tutor|companion|/api/chat)", re.IGNORECASE),
+    "media": re.compile(
+        r"\b(analy[sz]|describ|recogni[sz]|identif|caption|transcri|detect|classif|upload|camera|webcam|microphone|"
+        r"video|audio|/api/(image|video|audio)-tool)",
+        re.IGNORECASE,
+    ),
+    "speech": re.compile(r"\b(speak|speech|voice|read (it )?aloud|tts|pronounc|narrat|speechSynthesis)", re.IGNORECASE),
+    "images": re.compile(
+        r"\b(image|picture|photo|illustrat|drawing|wallpaper|artwork|poster|logo|icon|avatar|/api/generate-image)",
+        re.IGNORECASE,
+    ),
+    "calculator": re.compile(r"\b(calculat|math|arithmetic|equation|expression|formula|comput|convert)", re.IGNORECASE),
+}
+
+# Uploaded-file MIME type prefix -> intents it implies
+FILE_INTENTS: Dict[str, Tuple[str, ...]] = {
+    "image/": ("media", "images"),
+    "video/": ("media",),
+    "audio/": ("media",),
+}
+
+
+def detect_intents(request_text: str, files: Optional[Iterable[Dict[str, Any]]] = None, current_html: Optional[str] = None) -> FrozenSet[str]:
+    """
+    Intents of a request, used to select template modules.
+
+    Args:
+        request_text: The user's request (or modification request).
+        files: Uploaded file descriptors (`mime_type` is used); any file adds the "files" intent.
+        current_html: HTML being modified; features it already uses keep their modules.
+    """
+    texts = [request_text or ""] + ([current_html] if current_html else [])
+    intents = {intent for intent, pattern in INTENT_PATTERNS.items() if any(pattern.search(text) for text in texts)}
+    for file in files or ():
+        intents.add("files")
+        mime_type = (file.get("mime_type") or "").lower()
+        for prefix, implied in FILE_INTENTS.items():
+            if mime_type.startswith(prefix):
+                intents.update(implied)
+    return frozenset(intents)
+
+
+@dataclass(frozen=True)
+class TemplateModule:
+    name: str
+    intents: FrozenSet[str]
+    tokens: int
+
+
+class ModularTemplate:
+    """
+    A template parsed into always-included text and tagged modules.
+
+    Args:
+        text: Template text with `@module` / `@end` markers (a template without markers has no modules).
+    """
+
+    def __init__(self, text: str):
+        self._parts: List[Tuple[Optional[str], List[str]]] = []  # (module name, or None for core text; lines)
+        intents: Dict[str, set] = {}
+        current: Optional[str] = None
+        lines: List[str] = []
+        for line in text.split("\n"):
+            start = _MODULE_START.match(line)
+            if not start and not _MODULE_END.match(line):
+                lines.append(line)
+                continue
+            if start and current is not None:
+                raise ValueError(f"Template module '{start.group(1)}' starts inside module '{current}'.")
+            if not start and current is None:
+                raise ValueError("Template module end marker without a matching start.")
+            self._parts.append((current, lines))
+            lines = []
+            current = start.group(1) if start else None
+            if start:
+                intents.setdefault(current, set()).update(i for i in start.group(2).split(",") if i)
+        if current is not None:
+            raise ValueError(f"Template module '{current}' is not closed.")
+        self._parts.append((None, lines))
+        bodies: Dict[str, List[str]] = {}
+        for name, part in self._parts:
+            if name is not None:
+                bodies.setdefault(name, []).extend(part)
+        self.modules: Dict[str, TemplateModule] = {
+            name: TemplateModule(name, frozenset(intents[name]), count_tokens("\n".join(body)))
+            for name, body in bodies.items()
+            if "".join(body).strip()
+        }
+
+    def select(self, intents: Optional[Iterable[str]]) -> Tuple[str, ...]:
+        """Names of the modules to include for `intents` (all modules when intents is None)."""
+        if intents is None:
+            return tuple(self.modules)
+        wanted = set(intents)
+        return tuple(name for name, module in self.modules.items() if module.intents & wanted)
+
+    def core(self) -> str:
+        """The always-included text, without markers."""
+        return "\n".join(line for name, part in self._parts if name is None for line in part)
+
+    def render(self, included: Iterable[str]) -> str:
+        """The core text followed by the `included` modules (in template order), without any markers."""
+        keep = set(included)
+        modules = "\n".join(line for name, part in self._parts if name is not None and name in keep for line in part)
+        return self.core() + (MODULES_HEADING + modules.strip("\n") if modules.strip() else "")
+
+
+class ModuleUsage:
+    """
+    Per-module inclusion counts and the template tokens saved by leaving modules out.
+
+    Args:
+        mode: "auto" selects modules per request; "all" always sends every module.
+    """
+
+    def __init__(self, mode: str = AUTO):
+        if mode not in (AUTO, ALL):
+            raise ValueError(f"Unknown prompt module mode '{mode}' (expected auto or all).")
+        self.mode = mode
+        self.prompts = 0
+        self.tokens_sent = 0
+        self.tokens_saved = 0
+        self._included: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def intents(self, request_text: str, files: Optional[Iterable[Dict[str, Any]]] = None, current_html: Optional[str] = None) -> Optional[FrozenSet[str]]:
+        """Intents to render the template for, or None to include every module."""
+        return None if self.mode == ALL else detect_intents(request_text, files, current_html)
+
+    def record(self, modules: Iterable[str], skipped: Iterable[str], tokens: int, tokens_saved: int) -> None:
+        with self._lock:
+            self.prompts += 1
+            self.tokens_sent += tokens
+            self.tokens_saved += tokens_saved
+            for name in modules:
+                self._included[name] = self._included.get(name, 0) + 1
+            for name in skipped:
+                self._included.setdefault(name, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Inclusion rate per module and the average template tokens saved, for /api/metrics."""
+        with self._lock:
+            full = self.tokens_sent + self.tokens_saved
+            return {
+                "mode": self.mode,
+                "prompts": self.prompts,
+                "avg_template_tokens": round(self.tokens_sent / self.prompts) if self.prompts else None,
+                "avg_tokens_saved": round(self.tokens_saved / self.prompts) if self.prompts else None,
+                "token_savings": round(self.tokens_saved / full, 3) if full else 0.0,
+                "inclusion_rate": {name: round(count / self.prompts, 3) if self.prompts else 0.0 for name, count in sorted(self._included.items())},
+            }
+
+
+def create_module_usage() -> ModuleUsage:
+    """Builds module selection from MORPHEO_PROMPT_MODULES (auto | all)."""
+    mode = os.getenv("MORPHEO_PROMPT_MODULES", AUTO).strip().lower()
+    try:
+        return ModuleUsage(mode)
+    except ValueError as e:
+        logger.warning(f"{e} Selecting modules per request.")
+        return ModuleUsage(AUTO)
@@ -0,0 +1,305 @@
+"""
+Prompt Template Store
+
+This module keeps prompt templates in memory instead of reading them from disk on every
+request. Each template is loaded once and compiled into a CompiledTemplate that carries
+everything the prompt builders need per request without touching the text again: the
+content hash (for cache keys), the token estimate (for input budgets) and a hash state
+pre-fed with the template, so the hash of a rendered prompt only costs its suffix.
+
+Templates are hot-reloaded: at most once per check interval the file's mtime and size are
+compared with the loaded version, and a changed file is compiled and swapped in whole, so
+a request always sees one consistent version. A missing or unreadable file keeps the last
+good version (or the built-in fallback).
+
+Each template is also available as a compact variant (see prompt_compaction), built from
+the current full version on first use. Templates tagged with modules (see prompt_modules)
+are rendered per intent set; each rendering is compiled once per template version.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from .generation_cache import template_hash
+from .prompt_compaction import COMPACT, FULL, CompactionReport, compact
+from .prompt_modules import ModularTemplate
+from .token_budget import PromptSection, count_tokens
+
+logger = logging.getLogger(__name__)
+
+WC_TEMPLATE = "gemini_prompt_template_wc.md"
+
+# Used when the Web Component template file is missing (and written out at startup)
+WC_TEMPLATE_FALLBACK = (
+    "You are an expert AI assistant specializing in modern, accessible web development using standard technologies.\n"
+    "\n"
+    "Generate a COMPLETE, runnable, self-contained HTML file (.html) that fulfills the user request below.\n"
+    "\n"
+    "ABSOLUTE REQUIREMENTS:\n"
+    "\n"
+    "0.  **No Placeholders or Excuses:** Attempt the full implementation. Do NOT output placeholder UIs or messages stating the task is too complex.\n"
+    "1.  **DOCTYPE & HTML Structure:** Start with `<!DOCTYPE html>` and include `<html>`, `<head>`, and `<body>` tags.\n"
+    "2.  **Styling:** Use standard CSS within `<style>` tags in the `<head>`. \n"
+    "    Optionally, you can use Tailwind CSS classes IF you include the Tailwind CDN script in the `<head>`: `<script src=\"https://cdn.tailwindcss.com\"></script>`. \n"
+    "    Prioritize clean, responsive design.\n"
+    "3.  **Structure & Interactivity:** Use standard HTML elements. For reusable UI parts and complex logic, DEFINE and USE **Standard Web Components** (using `customElements.define`, `<template>`, and vanilla JavaScript classes extending `HTMLElement`).\n"
+    "4.  **JavaScript:** Prioritize vanilla JS within `<script>` tags for basic interactivity. \n"
+    "    - Use standard DOM APIs (`getElementById`, `querySelector`, `addEventListener`, etc.).\n"
+    "    - **External Libraries:** For complex features (e.g., 3D graphics, advanced charting), you **MUST** actively use well-known external JavaScript libraries. **Use Import Maps** in the `<head>` when using ES Module libraries (like Three.js). Define the library (e.g., `\"three\"`) and addon paths (e.g., `\"three/addons/\"`) mapping to reliable CDN URLs (e.g., from cdnjs, jsdelivr, using `.module.js` files). Remove the `<script src=...>` tags for mapped libraries. In your `<script type=\"module\">`, use `import * as THREE from 'three';` and `import { OrbitControls } from 'three/addons/controls/OrbitControls.js';`. You **MUST** use libraries for complex tasks where vanilla JS is impractical. \n"
+    "5.  **Self-Contained:** The final output MUST be a SINGLE HTML file. No external CSS files (other than Tailwind CDN). External JavaScript libraries are permissible if included via CDN `<script>` tags or referenced via Import Maps. \n"
+    "6.  **Output Format:** Return ONLY the raw HTML code. NO markdown formatting (like ```html ... ```), explanations, or comments outside the code itself.\n"
+    "7.  **Print Optimization:** Include print-specific CSS rules (`@media print`) to optimize the layout for printing or saving as PDF. Hide non-essential interactive elements (like buttons, input forms), ensure content fits standard paper sizes (like A4/Letter) with appropriate margins, use high-contrast text (e.g., black text on a white background regardless of screen theme), and manage page breaks appropriately (`page-break-before`, `page-break-after`, `page-break-inside: avoid`) for long content.\n"
+)
+
+FALLBACKS: Dict[str, str] = {WC_TEMPLATE: WC_TEMPLATE_FALLBACK}
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    An immutable, pre-processed template version.
+
+    Attributes:
+        name: Template file name.
+        text: Template text.
+        digest: Content hash (same value as generation_cache.template_hash).
+        tokens: Uncalibrated local token estimate of `text`.
+        source: "file" or "fallback".
+        version: (mtime_ns, size) of the file it was loaded from.
+        variant: "full", or "compact" for the compacted text.
+        modules: Template modules included in `text`.
+        skipped: Template modules left out of `text`.
+        tokens_saved: Token estimate of the skipped modules.
+        core: For a rendering with modules, the compiled core text it starts with (the part
+            that is the same for every request).
+        source_digest: For a rendering, digest of the template it was rendered from.
+    """
+    name: str
+    text: str
+    digest: str
+    tokens: int
+    source: str = "file"
+    version: Tuple[int, int] = (0, 0)
+    variant: str = FULL
+    modules: Tuple[str, ...] = ()
+    skipped: Tuple[str, ...] = ()
+    tokens_saved: int = 0
+    loaded_at: float = 0.0
+    core: Optional["CompiledTemplate"] = field(default=None, repr=False, compare=False)
+    source_digest: str = ""
+    _hash_state: Any = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_text(cls, name: str, text: str, source: str = "file", version: Tuple[int, int] = (0, 0), variant: str = FULL, **kwargs: Any) -> "CompiledTemplate":
+        hash_state = hashlib.sha256(text.encode("utf-8"))
+        return cls(
+            name=name,
+            text=text,
+            digest=template_hash(text),
+            tokens=count_tokens(text),
+            source=source,
+            version=version,
+            variant=variant,
+            loaded_at=time.time(),
+            _hash_state=hash_state,
+            **kwargs,
+        )
+
+    def content_hash(self, suffix: str = "") -> str:
+        """Hash of this template followed by `suffix`, without re-hashing the template."""
+        state = self._hash_state.copy()
+        state.update(suffix.encode("utf-8"))
+        return state.hexdigest()[:16]
+
+    def section(self, name: str = "template", **kwargs: Any) -> PromptSection:
+        """The template as a prompt section, with its token estimate precomputed."""
+        return PromptSection(name, self.text, tokens=self.tokens, hash_state=self._hash_state, **kwargs)
+
+    @property
+    def static(self) -> "CompiledTemplate":
+        """The part of the template that does not depend on the request's intents."""
+        return self.core if self.core is not None else self
+
+    @property
+    def module_text(self) -> str:
+        """The request's modules, appended after the static part ("" if none)."""
+        return self.text[len(self.core.text):] if self.core is not None else ""
+
+    @property
+    def scope_digest(self) -> str:
+        """Digest identifying the template version and variant, whatever modules were selected."""
+        return self.source_digest or self.digest
+
+    def sections(self, name: str = "template", **kwargs: Any) -> List[PromptSection]:
+        """
+        The template as prompt sections: the static part (with `kwargs`, e.g. cacheable=True)
+        and, when modules were included, a `<name>_modules` section that is never cacheable.
+        """
+        sections = [self.static.section(name, **kwargs)]
+        if self.module_text:
+            sections.append(PromptSection(f"{name}_modules", self.module_text, tokens=max(self.tokens - self.static.tokens, 0), **dict(kwargs, cacheable=False)))
+        return sections
+
+
+class TemplateStore:
+    """
+    In-memory templates from `directory`, reloaded when their file changes.
+
+    Args:
+        directory: Folder the template files live in.
+        check_interval_s: Minimum time between file checks per template (0 checks on every
+            access; a negative value disables hot reload).
+        fallbacks: Built-in text per template name, used when the file cannot be read.
+    """
+
+    def __init__(self, directory: str, check_interval_s: float = 2.0, fallbacks: Optional[Dict[str, str]] = None):
+        self.directory = directory
+        self.check_interval_s = check_interval_s
+        self.fallbacks = dict(FALLBACKS if fallbacks is None else fallbacks)
+        self._templates: Dict[str, CompiledTemplate] = {}
+        self._compact: Dict[str, Tuple[str, CompiledTemplate, CompactionReport]] = {}  # name -> (full digest, compact, report)
+        # (name, variant) -> (source digest, parsed modules, compiled core, {included modules: rendering})
+        self._rendered: Dict[Tuple[str, str], Tuple[str, ModularTemplate, CompiledTemplate, Dict[Tuple[str, ...], CompiledTemplate]]] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, name: str = WC_TEMPLATE, variant: str = FULL, intents: Optional[Iterable[str]] = None) -> CompiledTemplate:
+        """
+        Current version of template `name` (loaded on first use, reloaded if the file changed).
+
+        Args:
+            name: Template file name.
+            variant: "full" or "compact".
+            intents: Detected request intents selecting the template modules (None includes all).
+        """
+        source = self._current(name)
+        if variant == COMPACT:
+            source = self._compact_variant(source)
+        return self._render(source, None if intents is None else frozenset(intents))
+
+    def _current(self, name: str) -> CompiledTemplate:
+        current = self._templates.get(name)
+        now = time.monotonic()
+        if current is not None and (self.check_interval_s < 0 or now - self._checked_at.get(name, 0.0) < self.check_interval_s):
+            return current
+        with self._lock:
+            current = self._templates.get(name)
+            if current is not None and now - self._checked_at.get(name, 0.0) < max(self.check_interval_s, 0.0):
+                return current  # Checked by another thread meanwhile
+            self._checked_at[name] = now
+            return self._refresh(name, current)
+
+    def _refresh(self, name: str, current: Optional[CompiledTemplate]) -> CompiledTemplate:
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            if current is not None and current.source == "file" and current.version == version:
+                return current
+            with open(path, "r", encoding="utf-8") as f:
+                compiled = CompiledTemplate.from_text(name, f.read(), version=version)
+        except OSError as e:
+            if current is not None:
+                return current  # Keep serving the last good version
+            if name not in self.fallbacks:
+                raise
+            logger.error(f"Prompt template {path} could not be read ({e}). Using the built-in fallback.")
+            compiled = CompiledTemplate.from_text(name, self.fallbacks[name], source="fallback")
+        if current is not None:
+            self.reloads += 1
+            logger.info(f"Prompt template {name} reloaded ({current.digest} -> {compiled.digest}).")
+        self._templates[name] = compiled
+        return compiled
+
+    def _compact_variant(self, full: CompiledTemplate) -> CompiledTemplate:
+        cached = self._compact.get(full.name)
+        if cached is not None and cached[0] == full.digest:
+            return cached[1]
+        text, report = compact(full.text)
+        compiled = CompiledTemplate.from_text(full.name, text, source=full.source, version=full.version, variant=COMPACT)
+        self._compact[full.name] = (full.digest, compiled, report)
+        logger.info(f"Compact variant of {full.name}: {report.summary()}")
+        return compiled
+
+    def _render(self, source: CompiledTemplate, intents: Optional[FrozenSet[str]]) -> CompiledTemplate:
+        """`source` with the modules selected by `intents` (unchanged if it has no modules)."""
+        key = (source.name, source.variant)
+        cached = self._rendered.get(key)
+        if cached is None or cached[0] != source.digest:
+            try:
+                modular = ModularTemplate(source.text)
+            except ValueError as e:
+                logger.error(f"Prompt template {source.name} has malformed module markers ({e}); sending it whole.")
+                modular = ModularTemplate("")
+            core = CompiledTemplate.from_text(source.name, modular.core(), source=source.source, version=source.version, variant=source.variant, source_digest=source.digest)
+            cached = self._rendered[key] = (source.digest, modular, core, {})
+        _, modular, core, renderings = cached
+        if not modular.modules:
+            return source
+        included = modular.select(intents)
+        rendering = renderings.get(included)
+        if rendering is None:
+            skipped = tuple(name for name in modular.modules if name not in included)
+            rendering = renderings[included] = CompiledTemplate.from_text(
+                source.name,
+                modular.render(included),
+                source=source.source,
+                version=source.version,
+                variant=source.variant,
+                modules=included,
+                skipped=skipped,
+                tokens_saved=sum(modular.modules[name].tokens for name in skipped),
+                core=core,
+                source_digest=source.digest,
+            )
+        return rendering
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Loaded template versions (and compaction savings) for /api/metrics."""
+        templates = {}
+        for name, t in self._templates.items():
+            templates[name] = {"digest": t.digest, "tokens": t.tokens, "chars": len(t.text), "source": t.source, "loaded_at": t.loaded_at}
+            cached = self._compact.get(name)
+            if cached is not None and cached[0] == t.digest:
+                templates[name]["compact"] = dict(cached[2].as_dict(), digest=cached[1].digest)
+            rendered = self._rendered.get((name, FULL))
+            if rendered is not None and rendered[0] == t.digest and rendered[1].modules:
+                templates[name]["modules"] = {m.name: m.tokens for m in rendered[1].modules.values()}
+                templates[name]["renderings"] = len(rendered[3])
+        return {"reloads": self.reloads, "templates": templates}
+
+
+def ensure_prompt_template_exists(template_path: str, fallback_content: str):
+    """Checks if a prompt template file exists, creates it with fallback content if not."""
+    if not os.path.exists(template_path):
+        logger.warning(f"Prompt template not found at {template_path}. Creating with basic fallback content.")
+        try:
+            # Ensure directory exists
+            os.makedirs(os.path.dirname(template_path), exist_ok=True)
+            with open(template_path, "w", encoding="utf-8") as f:
+                f.write(fallback_content)
+            logger.info(f"Successfully created prompt template: {template_path}")
+        except Exception as e:
+            logger.error(f"Failed to create prompt template file at {template_path}: {e}")
+
+
+def create_template_store() -> TemplateStore:
+    """
+    Builds the store from the environment: MORPHEO_PROMPT_DIR (default: the backend folder) and
+    MORPHEO_PROMPT_RELOAD_SECONDS (negative disables hot reload).
+    """
+    directory = os.getenv("MORPHEO_PROMPT_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    try:
+        interval = float(os.getenv("MORPHEO_PROMPT_RELOAD_SECONDS", 2))
+    except ValueError:
+        interval = 2.0
+    return TemplateStore(directory, check_interval_s=interval)
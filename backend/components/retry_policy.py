@@ -0,0 +1,225 @@
+"""
+Retry Policy
+
+This module decides whether and when a failed model call is retried, and helps resume a
+stream that failed after part of the response was already sent to the client.
+
+- classify_error() sorts failures into transient (5xx, dropped connections, corrupted stream
+  frames), quota (429 / RESOURCE_EXHAUSTED) and invalid (other 4xx) classes.
+- RetryPolicy computes exponential backoff with full jitter, honouring server retry hints
+  (RetryInfo.retryDelay, Retry-After).
+- OverlapSplicer trims the text a continuation request repeats from the end of the partial
+  output, so resumed streams are spliced on without duplicating bytes.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from .errors import is_rate_limit_error
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = "transient"
+QUOTA = "quota"
+INVALID = "invalid"
+
+# HTTP statuses worth retrying besides 429
+_TRANSIENT_STATUSES = {408, 409, 500, 502, 503, 504}
+
+# Exception type names from httpx/aiohttp/google-api-core that indicate a dropped or timed-out connection
+_TRANSIENT_TYPE_NAMES = {
+    "TransportError", "NetworkError", "ConnectError", "ReadError", "WriteError", "RemoteProtocolError",
+    "ReadTimeout", "ConnectTimeout", "PoolTimeout", "TimeoutException", "ServerDisconnectedError",
+    "ClientConnectionError", "ClientPayloadError", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Aborted",
+}
+
+_DURATION_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)s\s*$")
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for attribute in ("code", "status_code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Classifies a failed model call.
+
+    Returns:
+        TRANSIENT, QUOTA or INVALID. Unrecognised errors are INVALID (not retried).
+    """
+    if is_rate_limit_error(error):
+        return QUOTA
+    if isinstance(error, (json.JSONDecodeError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return TRANSIENT
+    status = _status_code(error)
+    if status is not None:
+        if status in _TRANSIENT_STATUSES or status >= 500:
+            return TRANSIENT
+        if 400 <= status < 500:
+            return INVALID
+    if any(cls.__name__ in _TRANSIENT_TYPE_NAMES for cls in type(error).__mro__):
+        return TRANSIENT
+    return INVALID
+
+
+def retry_hint(error: BaseException) -> Optional[float]:
+    """Server-suggested delay in seconds (RetryInfo.retryDelay or a Retry-After header), if any."""
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        details = details.get("error", details).get("details")
+    if isinstance(details, list):
+        for detail in details:
+            if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("RetryInfo"):
+                delay = detail.get("retryDelay")
+                if isinstance(delay, dict):  # {"seconds": 3, "nanos": 0}
+                    return float(delay.get("seconds", 0)) + float(delay.get("nanos", 0)) / 1e9
+                match = _DURATION_PATTERN.match(str(delay or ""))
+                if match:
+                    return float(match.group(1))
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            value = headers.get("retry-after") or headers.get("Retry-After")
+            return float(value) if value is not None else None
+        except (TypeError, ValueError, AttributeError):
+            return None
+    return None
+
+
+@dataclass
+class RetryPolicy:
+    """Retry budget and backoff schedule for model calls."""
+    max_retries: int = 2            # Retries after the first attempt
+    base_delay_s: float = 0.5       # First backoff step
+    max_delay_s: float = 20.0       # Backoff cap; longer server hints are not waited out
+    multiplier: float = 2.0
+
+    def should_retry(self, error_class: str, attempt: int, hint: Optional[float] = None) -> bool:
+        """
+        Args:
+            error_class: Result of classify_error().
+            attempt: Zero-based index of the attempt that just failed.
+            hint: Server retry hint in seconds, if any.
+        """
+        if attempt >= self.max_retries or error_class == INVALID:
+            return False
+        return hint is None or hint <= self.max_delay_s
+
+    def backoff(self, attempt: int, hint: Optional[float] = None) -> float:
+        """Delay before the next attempt: the server hint (plus a little jitter) or capped exponential full jitter."""
+        if hint is not None:
+            return hint * random.uniform(1.0, 1.2)
+        ceiling = min(self.base_delay_s * (self.multiplier ** attempt), self.max_delay_s)
+        return random.uniform(self.base_delay_s / 2, max(ceiling, self.base_delay_s / 2))
+
+
+CONTINUATION_INSTRUCTION = (
+    "Your previous response was cut off. Continue it exactly from the point where it stopped, "
+    "starting with the very next character. Do not repeat any text you already wrote, do not "
+    "restart the document, and do not add explanations or markdown code fences."
+)
+
+_LEADING_FENCE = re.compile(r"^\s*```[A-Za-z]*[ \t]*\n")
+
+
+class OverlapSplicer:
+    """
+    Removes the prefix of a continuation stream that duplicates the end of the partial output.
+
+    The first `window` characters of the continuation are held back, compared against the
+    partial output's tail, and released without the overlapping part.
+
+    Args:
+        previous_tail: The last characters already sent to the client.
+        window: Characters buffered before deciding on the overlap.
+        min_overlap: Shorter matches are treated as coincidence and kept.
+    """
+
+    DEFAULT_WINDOW = 512
+
+    def __init__(self, previous_tail: str, window: int = DEFAULT_WINDOW, min_overlap: int = 8):
+        self.previous_tail = previous_tail[-window:]
+        self.window = window
+        self.min_overlap = min_overlap
+        self._pending = ""
+        self._resolved = False
+        self.trimmed = 0
+
+    def feed(self, chunk: str) -> str:
+        """Returns the part of `chunk` that can be sent now."""
+        if self._resolved:
+            return chunk
+        self._pending += chunk
+        if len(self._pending) < self.window:
+            return ""
+        return self._resolve()
+
+    def flush(self) -> str:
+        """Returns whatever is still held back (call when the continuation ends)."""
+        if self._resolved:
+            return ""
+        return self._resolve()
+
+    def _resolve(self) -> str:
+        self._resolved = True
+        text = _LEADING_FENCE.sub("", self._pending, count=1)
+        self._pending = ""
+        tail = self.previous_tail
+        for size in range(min(len(tail), len(text)), self.min_overlap - 1, -1):
+            if tail.endswith(text[:size]):
+                self.trimmed = size
+                if size:
+                    logger.info(f"Continuation repeated {size} chars of the partial output; trimmed before splicing.")
+                return text[size:]
+        return text
+
+
+def describe(error: BaseException) -> str:
+    """Short description for logs and error markers."""
+    status = _status_code(error)
+    return f"{type(error).__name__}{f' {status}' if status else ''}: {str(error)[:300]}"
+
+
+def continuation_contents(user_turns: Any, partial_output: str) -> list:
+    """
+    Builds role-structured contents for resuming an interrupted response.
+
+    Args:
+        user_turns: The original request as a list of role-structured turns (see ComponentService._as_turns).
+        partial_output: Everything already sent to the client.
+
+    Returns:
+        The original turns, followed by the partial model turn and the continuation instruction.
+    """
+    return list(user_turns) + [
+        {"role": "model", "parts": [{"text": partial_output}]},
+        {"role": "user", "parts": [{"text": CONTINUATION_INSTRUCTION}]},
+    ]
+
+
+def create_retry_policy() -> RetryPolicy:
+    """
+    Builds the policy from the environment: MORPHEO_RETRY_MAX, MORPHEO_RETRY_BASE_DELAY_SECONDS,
+    MORPHEO_RETRY_MAX_DELAY_SECONDS.
+    """
+    try:
+        return RetryPolicy(
+            max_retries=int(os.getenv("MORPHEO_RETRY_MAX", 2)),
+            base_delay_s=float(os.getenv("MORPHEO_RETRY_BASE_DELAY_SECONDS", 0.5)),
+            max_delay_s=float(os.getenv("MORPHEO_RETRY_MAX_DELAY_SECONDS", 20)),
+        )
+    except ValueError:
+        logger.warning("Invalid MORPHEO_RETRY_* setting; using defaults.")
+        return RetryPolicy()
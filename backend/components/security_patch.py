@@ -0,0 +1,181 @@
+"""
+Targeted Security Correction
+
+A full correction sends the original prompt (template included) and the whole unsafe
+document back to the model and has it regenerate everything. Findings almost always sit in
+one or two `<script>` blocks, so the patch mode sends only those blocks, each with a few
+lines of surrounding markup as read-only context, and asks for replacements of just those
+blocks:
+
+    <!-- MORPHEO_PATCH_BLOCK 1 -->
+    <script>...rewritten...</script>
+
+The reply is validated (exactly one complete script element per block, each scanning clean)
+and spliced into the document server-side. When a finding is outside any script block (an
+inline `onclick="eval(...)"`), or the reply cannot be applied, the caller falls back to a
+full regeneration.
+"""
+
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .security_scan import IncrementalScanner, Rule, scan_html
+
+logger = logging.getLogger(__name__)
+
+PATCH_MARKER = "<!-- MORPHEO_PATCH_BLOCK {index} -->"
+
+_SCRIPT_OPEN = re.compile(r"<script\b", re.IGNORECASE)
+_SCRIPT_CLOSE = re.compile(r"</script\s*>", re.IGNORECASE)
+_MARKER = re.compile(r"<!--\s*MORPHEO_PATCH_BLOCK\s+(\d+)\s*-->")
+_FENCE = re.compile(r"^\s*```[\w-]*\s*$", re.MULTILINE)
+
+
+class PatchError(ValueError):
+    """The model's reply cannot be applied to the document."""
+
+
+def script_spans(html: str) -> List[Tuple[int, int]]:
+    """(start, end) of each `<script>` element; an unterminated last one runs to the end of the document."""
+    spans = []
+    pos = 0
+    while True:
+        opening = _SCRIPT_OPEN.search(html, pos)
+        if opening is None:
+            return spans
+        closing = _SCRIPT_CLOSE.search(html, opening.end())
+        pos = closing.end() if closing else len(html)
+        spans.append((opening.start(), pos))
+
+
+@dataclass(frozen=True)
+class ScriptBlock:
+    index: int  # Number shown to the model (1-based)
+    start: int
+    end: int
+    rules: Tuple[Rule, ...]  # Rules the block violates
+
+
+def _context(html: str, start: int, end: int, lines: int, before: bool) -> str:
+    """Up to `lines` lines of markup just before (or after) a block."""
+    if before:
+        cut = start
+        for _ in range(lines + 1):
+            cut = html.rfind("\n", 0, cut)
+            if cut < 0:
+                break
+        return html[cut + 1 if cut >= 0 else 0:start]
+    cut = end
+    for _ in range(lines):
+        cut = html.find("\n", cut + 1)
+        if cut < 0:
+            return html[end:]
+    return html[end:cut]
+
+
+class PatchPlan:
+    """
+    The offending script blocks of a document and the prompt asking for their replacements.
+
+    Args:
+        html: The unsafe document.
+        blocks: Blocks to rewrite, in document order.
+        rules: Rule set the replacements are checked against.
+    """
+
+    def __init__(self, html: str, blocks: List[ScriptBlock], rules: Optional[Iterable[Rule]] = None):
+        self.html = html
+        self.blocks = blocks
+        self.rules = tuple(rules) if rules is not None else None
+
+    def prompt(self, context_lines: int = 6) -> str:
+        """Prompt asking for the rewritten blocks only, with their issues, guidance and context."""
+        fired: Dict[str, Rule] = {rule.name: rule for block in self.blocks for rule in block.rules}
+        guidance = "".join(f"- {rule.guidance}\n" for rule in fired.values() if rule.guidance)
+        parts = [
+            "Some <script> blocks in your previous HTML output had security/best-practice issues. "
+            "Rewrite ONLY the blocks below so they achieve the same behaviour safely; the rest of the document is kept as is.\n\n"
+            f"Specific guidance for correction:\n{guidance}"
+            "- Keep every function, variable and element id that the rest of the document uses.\n"
+            "- Each rewritten block must be one complete <script>...</script> element (same attributes unless they are the problem).\n\n"
+        ]
+        for block in self.blocks:
+            issues = "\n".join(f"- {rule.issue}" for rule in block.rules)
+            parts.append(
+                f"### Block {block.index}\nIssues:\n{issues}\n"
+                f"Context before (do not repeat):\n```html\n{_context(self.html, block.start, block.end, context_lines, True)}\n```\n"
+                f"Block to rewrite:\n```html\n{self.html[block.start:block.end]}\n```\n"
+                f"Context after (do not repeat):\n```html\n{_context(self.html, block.start, block.end, context_lines, False)}\n```\n\n"
+            )
+        markers = "\n".join(PATCH_MARKER.format(index=block.index) + "\n<script>...</script>" for block in self.blocks)
+        parts.append(
+            "Reply with each rewritten block, in order, each preceded by its marker line, and nothing else "
+            f"(no markdown, no explanations):\n{markers}"
+        )
+        return "".join(parts)
+
+    def apply(self, reply: str) -> str:
+        """
+        Splices the rewritten blocks from `reply` into the document.
+
+        Raises:
+            PatchError: A block is missing, duplicated, not a complete script element, or still unsafe.
+        """
+        markers = list(_MARKER.finditer(reply))
+        replacements: Dict[int, str] = {}
+        for i, marker in enumerate(markers):
+            body = reply[marker.end():markers[i + 1].start() if i + 1 < len(markers) else len(reply)]
+            body = _FENCE.sub("", body).strip()
+            index = int(marker.group(1))
+            if index in replacements:
+                raise PatchError(f"Block {index} was returned more than once.")
+            if not _SCRIPT_OPEN.match(body) or not re.search(r"</script\s*>\Z", body, re.IGNORECASE) or len(script_spans(body)) != 1:
+                raise PatchError(f"Block {index} is not a single complete <script> element.")
+            remaining = scan_html(body, self.rules)
+            if remaining:
+                raise PatchError(f"Block {index} is still unsafe: {', '.join(remaining)}")
+            replacements[index] = body
+        expected = {block.index for block in self.blocks}
+        if set(replacements) != expected:
+            raise PatchError(f"Expected blocks {sorted(expected)}, got {sorted(replacements)}.")
+        pieces = []
+        pos = 0
+        for block in self.blocks:
+            pieces += [self.html[pos:block.start], replacements[block.index]]
+            pos = block.end
+        pieces.append(self.html[pos:])
+        return "".join(pieces)
+
+
+def plan_patch(html: str, rules: Optional[Iterable[Rule]] = None) -> Optional[PatchPlan]:
+    """
+    The script blocks to rewrite, or None when the findings are not confined to script blocks.
+
+    Args:
+        html: The complete unsafe document.
+        rules: Rule set to scan with (default rules when omitted).
+    """
+    rules = tuple(rules) if rules is not None else None
+    blocks: List[ScriptBlock] = []
+    outside: List[str] = []
+    pos = 0
+    for start, end in script_spans(html):
+        outside.append(html[pos:start])
+        pos = end
+        scanner = IncrementalScanner(rules)
+        scanner.feed(html[start:end])
+        if scanner.findings:
+            by_name = {rule.name: rule for rule in scanner.rules}
+            blocks.append(ScriptBlock(len(blocks) + 1, start, end, tuple(by_name[f.rule] for f in scanner.findings)))
+        else:
+            outside.append(html[start:end])
+    outside.append(html[pos:])
+    if not blocks:
+        return None
+    # Offending blocks are cut out (not blanked) so the rest scans as the model will see it
+    if scan_html("".join(outside), rules):
+        logger.info("Unsafe patterns outside the offending script blocks; patching is not enough.")
+        return None
+    return PatchPlan(html, blocks, rules)
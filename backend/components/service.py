@@ -6,6 +6,7 @@ It uses AI (Gemini or OpenAI) to compose components into a complete UI based on
 The service no longer relies on templates, instead fully embracing AI-driven component configuration.
 """
 
+import dataclasses
 import json
 import os
 import datetime
@@ -14,7 +15,7 @@ import time
 import random
 import logging
 import sys
-from typing import Dict, List, Any, Optional, Tuple, Union, AsyncIterator, AsyncGenerator
+from typing import Callable, Dict, List, Any, Optional, Tuple, Union, AsyncIterator, AsyncGenerator
 
 from dotenv import load_dotenv
 import traceback
@@ -40,6 +41,28 @@ import google.genai as genai
 from google.genai.types import Part, Blob, GenerationConfig, GenerateContentResponse, Tool, GoogleSearch, File as GeminiSDKFile
 from google.ai import generativelanguage as glm # Keep for now, might be needed elsewhere?
 
+from .circuit_breaker import create_circuit_breakers
+from .concurrency import create_limiter
+from .errors import CircuitOpenError, ModelCallError, ServiceUnavailableError, is_rate_limit_error
+from .generation_cache import create_generation_cache, make_cache_key
+from .hedging import create_hedger
+from .log_writer import get_log_writer
+from .client_manager import ClientManager, get_client_manager
+from .model_backend import contents_fingerprint
+from .model_registry import RoutingDecision, create_model_registry
+from .retry_policy import OverlapSplicer, classify_error, continuation_contents, create_retry_policy, describe, retry_hint
+from .similarity_index import create_similarity_index, similarity_scope
+from .single_flight import SingleFlight
+from .stream_buffer import StreamAccumulator
+from .edit_protocol import EDIT_INSTRUCTIONS, EditError, apply_reply, create_edit_protocol
+from .context_cache import PromptUsage, create_context_cache, is_stale_handle_error
+from .prompt_compaction import FULL, create_variant_selector
+from .prompt_modules import create_module_usage
+from .security_patch import PatchError, plan_patch
+from .security_scan import PATCH, create_security_scanning, scan_html
+from .prompt_store import WC_TEMPLATE, WC_TEMPLATE_FALLBACK, CompiledTemplate, create_template_store, ensure_prompt_template_exists
+from .token_budget import AssembledPrompt, PromptBudgetExceeded, PromptSection, assemble, count_tokens, create_token_estimator, fit_turns, schedule_calibration
+
 # Add GeminiFile type hint if needed, or use Any for now
 # from google.generativeai.types import File as GeminiFile 
 
@@ -49,24 +72,75 @@ class ComponentService:
     Uses standard top-level imports.
     """
     
-    def __init__(self):
-        """Initializes the ComponentService, creating the API client.
-           Configuration (API key) is expected to be handled globally (in main.py).
+    def __init__(self, client: Any = None, client_manager: Optional[ClientManager] = None):
+        """Initializes the ComponentService with the process-wide model client.
+           The API key is read from the environment (GOOGLE_API_KEY) by the client.
+
+        Args:
+            client: Optional pre-built model client (real, synthetic or replay). When omitted,
+                    the shared client of `client_manager` is used.
+            client_manager: Owner of the shared client (default: the process-wide manager).
         """
-        self.error_count = 0 
+        self.error_count = 0
+        self.client_manager = client_manager or get_client_manager()
         try:
-            self.client = genai.Client() # Instantiate the client
-            logger.info("google-genai client created successfully in ComponentService.")
+            self.client = client if client is not None else self.client_manager.get()
+            logger.info(f"Model client ({type(self.client).__name__}) ready in ComponentService.")
         except Exception as e:
             logger.error(f"Failed to create google-genai client in ComponentService: {e}", exc_info=True)
             self.client = None # Ensure client is None on failure
             
+        # Request/response logs are written by background writers so they never block a stream
+        self.request_log = get_log_writer("requests")
+        self.generation_log = get_log_writer("generations")
+
+        # Known models and per-task routing rules; model_name is the nominal (default) model
+        self.models = create_model_registry(routing_log=get_log_writer("routing"))
+        self.model_name = self.models.default_model
+        # Local token estimates (calibrated against upstream counts) for per-task input budgets
+        self.token_estimator = create_token_estimator()
+        # Upstream cached-content handles for the static template prefix
+        self.context_cache = create_context_cache()
+        # Upstream-reported cached prompt tokens (explicit handles and implicit prefix reuse)
+        self.prompt_usage = PromptUsage()
+        # Prompt templates, loaded once and hot-reloaded when the file changes
+        self.templates = create_template_store()
+        # Full vs compact template variant per request (switchable for quality/latency comparison)
+        self.prompt_variants = create_variant_selector()
+        # Template modules included per request intent, with inclusion and token-savings stats
+        self.prompt_modules = create_module_usage()
+        # Content-addressed cache of full-page generations (memory LRU + disk tier)
+        self.generation_cache = create_generation_cache()
+        # Near-duplicate index over past generations, rebuilt from the generation log
+        self.similarity_index = create_similarity_index()
+        self.generation_cache.on_remove = self.similarity_index.remove  # Evicted generations stop matching
+        self.similarity_index.bootstrap_in_background(self.generation_log.path)
+        # Identical requests that overlap in time share one upstream stream
+        self.single_flight = SingleFlight("model-streams")
+        self._flight_models: Dict[str, Dict[str, Any]] = {}  # Models each shared stream actually called
+        # Adaptive bound on concurrent upstream calls (sheds load with OverloadedError when full)
+        self.limiter = create_limiter()
+        # Backoff schedule for failed calls; interrupted streams are resumed, not restarted
+        self.retry_policy = create_retry_policy()
+        # Backup requests for slow collected calls (chat, analysis, suggestions), within a small budget
+        self.hedger = create_hedger()
+        # Per (model, task) circuit breakers: fail fast or fail over while a model is degraded
+        self.breakers = create_circuit_breakers()
+        # Incremental scan of generated HTML; unsafe streams are cut short and corrected early
+        self.security = create_security_scanning()
+        # Modifications as search/replace edits applied server-side, with full rewrites as the fallback
+        self.edit_protocol = create_edit_protocol()
+
         # Configuration is handled globally in main.py
         # print("ComponentService initialized.") 
             
     
-    async def _call_gemini_api(self, contents: Union[str, List[Union[str, Dict[str, Any]]]], **kwargs) -> AsyncIterator[str]:
-        """Calls the Gemini API with the given contents, using top-level imported objects/types."""
+    async def _call_gemini_api(self, contents: Union[str, List[Union[str, Dict[str, Any]]]], accumulator: Optional[StreamAccumulator] = None, **kwargs) -> AsyncIterator[str]:
+        """Calls the Gemini API with the given contents, using top-level imported objects/types.
+
+        Streamed text is appended to `accumulator` when the caller provides one, so the caller
+        can read the full response without keeping its own copy.
+        """
         # --- REMOVED Check for required injected objects/types --- 
         
         # --- Use top-level imports directly --- 
@@ -88,24 +162,15 @@ class ComponentService:
         else:
             print(f"Calling Gemini API with initial contents of type: {type(contents).__name__}")
         
-        # Initial prompt logging remains synchronous (log the raw incoming contents)
-        log_dir = os.path.dirname("gemini_request_log.txt")
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        try:
-            with open("gemini_request_log.txt", "a", encoding="utf-8") as f:
-                f.write(f"\nRequest Time: {datetime.datetime.now()}\n")
-                f.write(f"Contents (Raw Incoming): ") # Corrected spacing
-                f.write(str(contents))
-                f.write("\n--- End of Raw Contents ---\n\n")
-        except Exception as log_e:
-            print(f"Error writing initial contents to log: {log_e}")
-        
         # --- BEGIN REVISED TRANSFORMATION for Multimodal Input & SDK File Objects ---
         processed_contents = []
         is_multimodal_or_files_api = False
+        is_conversation = self._is_conversation(contents)
 
-        if isinstance(contents, str):
+        if is_conversation:
+            # Role-structured turns (chat history, continuation requests) are passed through as is
+            processed_contents = list(contents)
+        elif isinstance(contents, str):
             processed_contents.append(contents)
         elif isinstance(contents, list) and len(contents) > 0:
             # First element is usually the text prompt
@@ -158,7 +223,7 @@ class ComponentService:
                 return
 
         # Final check on processed_contents before API call
-        if not processed_contents or not isinstance(processed_contents[0], str) or not processed_contents[0].strip():
+        if not is_conversation and (not processed_contents or not isinstance(processed_contents[0], str) or not processed_contents[0].strip()):
             # If after all processing, there's no content, or the first part isn't a non-empty string. 
             # This indicates a fundamental issue with how contents were assembled or processed.
             logger.error(f"Processed_contents is empty or does not start with a valid string prompt. Processed: {str(processed_contents)[:200]}...")
@@ -169,8 +234,26 @@ class ComponentService:
         
         api_duration = 0.0
         api_call_start_time = 0.0
-        full_response = "" # Initialize variable to accumulate the full response
-
+        api_config_dict: Optional[Dict[str, Any]] = None
+        # Shared with the caller when provided; otherwise local, only for the request log
+        response_buffer = accumulator if accumulator is not None else StreamAccumulator()
+        call_error = None
+        call_exception: Optional[BaseException] = None
+        stream_completed = False
+        usage = None
+
+        # Route to a model for this task (unless the caller pinned one), then fail fast
+        # (or fail over to the fallback model) while that model's circuit is open
+        model_name = kwargs.get('model') or self._route(kwargs.get('task'), [kwargs.get('static_prefix') or "", contents], enable_grounding=kwargs.get('enable_grounding', False)).model
+        model_name, breaker = self.breakers.select(model_name, kwargs.get('task'))
+        if kwargs.get('models_used') is not None:
+            kwargs['models_used'].append(model_name)  # Lets the caller notice a failover
+        # Wait for an upstream slot (scheduled by task class and user); raises OverloadedError when the queue is full
+        try:
+            permit = await self.limiter.acquire(task=kwargs.get('task'), user=kwargs.get('user_id'))
+        except BaseException:
+            breaker.release()
+            raise
         try:
             # --- Check if client was initialized --- 
             if not self.client:
@@ -178,8 +261,7 @@ class ComponentService:
                  yield "<!-- ERROR: Gemini client failed to initialize -->"
                  return
                  
-            # --- Model name --- 
-            model_name = "gemini-2.0-flash" # TODO: Make configurable
+            # --- Model name (selected above) --- 
             logger.info(f"Using Gemini model: {model_name}")
 
             # --- Grounding Configuration (using google.genai.types) ---
@@ -218,6 +300,17 @@ class ComponentService:
             # --- Use client's async streaming method --- 
             logger.info(f"Calling client.aio.models.generate_content_stream with model: {model_name}, grounding: {enable_grounding and tools is not None}")
             
+            # The static prefix (template) is referenced from the upstream context cache when
+            # possible; otherwise it is sent inline ahead of the per-request contents. The API
+            # rejects cached content combined with tools (grounding), so those requests go inline.
+            static_prefix = kwargs.get('static_prefix')
+            if static_prefix:
+                cached_content = None if tools else await self.context_cache.handle_for(self.client, model_name, static_prefix)
+                if cached_content:
+                    api_config_dict["cached_content"] = cached_content
+                else:
+                    processed_contents = self._with_prefix(processed_contents, static_prefix)
+
             api_kwargs = {
                  "model": model_name,
                  "contents": processed_contents, 
@@ -227,28 +320,31 @@ class ComponentService:
             # if tools:
             #     api_kwargs["tools"] = tools 
                 
-            response_stream = await self.client.aio.models.generate_content_stream(**api_kwargs)
+            try:
+                response_stream = await self.client.aio.models.generate_content_stream(**api_kwargs)
+            except Exception as e:
+                if not (api_config_dict.get("cached_content") and is_stale_handle_error(e)):
+                    raise
+                # The handle expired or was deleted upstream: drop it and send this request inline
+                self.context_cache.invalidate(api_config_dict.pop("cached_content"))
+                api_kwargs["contents"] = self._with_prefix(processed_contents, static_prefix)
+                response_stream = await self.client.aio.models.generate_content_stream(**api_kwargs)
 
             # Iterate asynchronously using async for
             async for chunk in response_stream: 
+                # Usage metadata (prompt and cached token counts) is cumulative; the last one wins
+                usage = getattr(chunk, "usage_metadata", None) or usage
                 # Check chunk structure based on new SDK (might not have candidates)
                 try: 
                     if hasattr(chunk, 'text'):
                         text_chunk = chunk.text
-                        # --- Attempt to further break down large text_chunks ---
-                        if len(text_chunk) > 256: # If a single text_chunk from SDK is large
-                            logger.info(f"SDK yielded large text_chunk ({len(text_chunk)} bytes). Breaking it down.")
-                            sub_chunk_size = 128
-                            for i in range(0, len(text_chunk), sub_chunk_size):
-                                sub_segment = text_chunk[i:i+sub_chunk_size]
-                                full_response += sub_segment
-                                yield sub_segment
-                                await asyncio.sleep(0) # Tiny sleep to encourage flushing
-                        else: # If chunk is already small, yield as is
-                            full_response += text_chunk 
-                            yield text_chunk 
-                            await asyncio.sleep(0) # Tiny sleep here too for consistency
-                        # --- End breakdown ---
+                        if not text_chunk:
+                            continue
+                        # Chunks are passed through as received; coalescing and flush pacing
+                        # are handled by the stream shaper in front of StreamingResponse.
+                        permit.mark_first_chunk()
+                        response_buffer.append(text_chunk)
+                        yield text_chunk
                     elif hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
                          # Handle potential blocking
                          logger.error(f"Stream chunk blocked. Reason: {chunk.prompt_feedback.block_reason}")
@@ -267,144 +363,459 @@ class ComponentService:
 
             stream_end_time = time.perf_counter()
             api_duration = stream_end_time - api_call_start_time
+            stream_completed = True
             logger.info(f"Gemini API stream processing finished successfully in {api_duration:.4f} seconds.")
 
         except core_exceptions.InvalidArgument as e:
              logger.error(f"Gemini API Invalid Argument Error: {e}")
+             call_error, call_exception = str(e), e
              raise 
         except core_exceptions.GoogleAPIError as e:
              logger.error(f"Gemini API Error: {e}")
+             call_error, call_exception = str(e), e
              raise 
         except json.JSONDecodeError as json_err: 
              logger.error(f"JSONDecodeError occurred during stream iteration: {json_err}")
+             call_error, call_exception = str(json_err), json_err
              raise 
         except Exception as e:
             # Check if it's a specific SDK exception we should handle differently
             logger.error(f"An unexpected error occurred during Gemini API call/stream: {e}", exc_info=True)
+            call_error, call_exception = str(e), e
             raise 
         finally:
+            permit.release(
+                rate_limited=call_exception is not None and is_rate_limit_error(call_exception),
+                failed=call_exception is not None,
+            )
+            first_chunk_latency = permit.time_to_first_chunk()
+            if first_chunk_latency is not None:
+                self.models.observe(model_name, first_chunk_latency)
+            prompt_tokens, cached_tokens = self.prompt_usage.record(kwargs.get('task'), usage, first_chunk_latency)
+            breaker.record_outcome(call_exception, first_chunk_latency if first_chunk_latency is not None or not stream_completed else api_duration)
             func_end_time = time.perf_counter()
             total_duration = func_end_time - func_start_time
-            try:
-                with open("gemini_request_log.txt", "a", encoding="utf-8") as f:
-                    # Log the complete accumulated response
-                    f.write(f"Response (Full):\n{full_response}\n\n") 
-                    f.write("\n--- Timing Details ---\n")
-                    f.write(f"Total function duration: {total_duration:.4f} seconds\n")
-                    f.write(f"Gemini API call/stream duration: {api_duration:.4f} seconds\n")
-                    f.write("--- End of Request ---\n\n")
-            except Exception as log_e:
-                print(f"Error writing final details to log: {log_e}")
+            # Queued for the background writer; raw media bytes are redacted, long fields truncated.
+            self.request_log.write({
+                "event": "Request",
+                "contents": contents,
+                "cached_content": (api_config_dict or {}).get("cached_content"),
+                "prompt_tokens": prompt_tokens or None,
+                "cached_tokens": cached_tokens or None,
+                "response": response_buffer.head(self.request_log.max_field_chars),
+                "response_chars": len(response_buffer),
+                "total_duration_s": round(total_duration, 4),
+                "api_duration_s": round(api_duration, 4),
+                "error": call_error,
+            }, force=call_error is not None)
+            if accumulator is None:
+                response_buffer.close()
     
-    # --- MODIFY THE RETRY WRAPPER FUNCTION ---
-    async def _call_gemini_with_retry(self, contents: Union[str, List[Union[str, Dict[str, Any]]]], max_retries: int = 1, delay: int = 1, **kwargs) -> AsyncIterator[str]:
+    def _route(self, task: Optional[str], contents: Any, enable_grounding: bool = False, log: bool = True, prompt_tokens: Optional[int] = None) -> RoutingDecision:
+        """Picks the model for a call from the registry, skipping models whose circuit is open."""
+        return self.models.route(
+            task,
+            contents,
+            needs=("grounding",) if enable_grounding else (),
+            available=lambda model: not self.breakers.get(model, task).refusing(),
+            log=log,
+            prompt_tokens=prompt_tokens,
+        )
+
+    def _route_generation(self, template: CompiledTemplate, user_request: str, enable_grounding: bool = False, log: bool = True) -> RoutingDecision:
+        """Routes a full-code generation, using the template's precomputed token estimate."""
+        return self._route("generation", None, enable_grounding, log=log, prompt_tokens=template.tokens + count_tokens(user_request))
+
+    @staticmethod
+    def _is_conversation(contents: Any) -> bool:
+        """True for role-structured contents: a list of {"role", "parts"} turns or SDK Content objects."""
+        if not isinstance(contents, list) or not contents:
+            return False
+        first = contents[0]
+        return (isinstance(first, dict) and "role" in first) or hasattr(first, "role")
+
+    @classmethod
+    def _with_prefix(cls, contents: List[Any], prefix: str) -> List[Any]:
+        """Prepends a static prefix to processed contents (to the leading prompt, or the first user turn)."""
+        if cls._is_conversation(contents):
+            first = contents[0]
+            if isinstance(first, dict):
+                parts = list(first.get("parts", []))
+                if parts and isinstance(parts[0], dict) and isinstance(parts[0].get("text"), str):
+                    parts[0] = dict(parts[0], text=prefix + parts[0]["text"])
+                else:
+                    parts.insert(0, {"text": prefix})
+                return [dict(first, parts=parts)] + list(contents[1:])
+            return [{"role": "user", "parts": [{"text": prefix}]}] + list(contents)
+        if contents and isinstance(contents[0], str):
+            return [prefix + contents[0]] + list(contents[1:])
+        return [prefix] + list(contents)
+
+    @classmethod
+    def _as_turns(cls, contents: Union[str, List[Any]]) -> List[Any]:
+        """
+        Converts request contents into role-structured turns so a model turn can be appended.
+
+        Args:
+            contents: A prompt string, a [prompt, media...] list, or an existing list of turns.
+
+        Returns:
+            A list of turns; a plain request becomes a single user turn.
+        """
+        if cls._is_conversation(contents):
+            return list(contents)
+        items = [contents] if isinstance(contents, str) else list(contents)
+        parts: List[Any] = []
+        for item in items:
+            if isinstance(item, str):
+                parts.append({"text": item})
+            elif isinstance(item, dict) and 'mime_type' in item and 'data' in item:
+                parts.append(Part(inline_data=Blob(mime_type=item['mime_type'], data=item['data'])))
+            elif isinstance(item, GeminiSDKFile):
+                parts.append(Part.from_uri(file_uri=item.uri, mime_type=item.mime_type))
+            else:
+                parts.append(item)
+        return [{"role": "user", "parts": parts}]
+
+    async def _call_gemini_with_retry(self, contents: Union[str, List[Union[str, Dict[str, Any]]]], max_retries: Optional[int] = None, delay: Optional[float] = None, accumulator: Optional[StreamAccumulator] = None, **kwargs) -> AsyncIterator[str]:
         """
         Calls the Gemini API with retry logic, supporting multimodal contents and kwargs (for grounding).
         Yields chunks from the successful attempt or an error message after max retries.
+
+        Failures are classified (transient / quota / invalid); retryable ones are retried with
+        exponential backoff and jitter, honouring the server's retry hint. When part of the
+        response was already yielded, the retry is a continuation request seeded with that
+        partial output, and the text it repeats is trimmed, so the caller sees one seamless stream.
+
+        Args:
+            contents: Prompt string, [prompt, media...] list, or role-structured turns.
+            max_retries: Overrides the retry policy's retry budget for this call.
+            delay: Overrides the policy's base backoff delay (seconds).
+            accumulator: Receives the spliced response text (error markers excluded).
+            **kwargs: Passed to `_call_gemini_api`; `task` (e.g. "generation", "chat", "suggestion")
+                and `user_id` select the scheduling class and fairness queue used by the concurrency limiter.
         """
-        last_exception = None
-        for attempt in range(max_retries + 1):
+        policy = self.retry_policy
+        if max_retries is not None or delay is not None:
+            policy = dataclasses.replace(
+                policy,
+                max_retries=policy.max_retries if max_retries is None else max_retries,
+                base_delay_s=policy.base_delay_s if delay is None else delay,
+            )
+        emitted = accumulator if accumulator is not None else StreamAccumulator()
+        request_contents = contents
+        splicer: Optional[OverlapSplicer] = None
+        try:
+            for attempt in range(policy.max_retries + 1):
+                try:
+                    logger.info(f"Gemini API call attempt {attempt + 1}/{policy.max_retries + 1} (continuation: {splicer is not None}, kwargs: {kwargs})")
+                    async for chunk in self._call_gemini_api(request_contents, **kwargs):
+                        if "<!-- ERROR:" in chunk:
+                            yield chunk # Error markers are passed through, never spliced or accumulated
+                            continue
+                        if splicer is not None:
+                            chunk = splicer.feed(chunk)
+                            if not chunk:
+                                continue
+                        emitted.append(chunk)
+                        yield chunk
+                    if splicer is not None:
+                        remainder = splicer.flush()
+                        if remainder:
+                            emitted.append(remainder)
+                            yield remainder
+                    logger.info(f"Gemini API call attempt {attempt + 1} successful.")
+                    return # Exit successfully
+
+                except ServiceUnavailableError as e:
+                    # Load shedding / open circuits are the caller's to report (HTTP 503 + Retry-After), not
+                    # retryable failures; once output was sent the refusal can only be reported in-stream
+                    if emitted:
+                        logger.warning(f"Continuation refused after {len(emitted)} chars: {e}")
+                        yield f"<!-- ERROR: Generation interrupted and could not be resumed: {e} -->"
+                        return
+                    raise
+
+                except Exception as e:
+                    error_class = classify_error(e)
+                    hint = retry_hint(e)
+                    if splicer is not None:
+                        # Text held back for overlap detection is genuine output; release it before resuming again
+                        remainder = splicer.flush()
+                        if remainder:
+                            emitted.append(remainder)
+                            yield remainder
+                    if not policy.should_retry(error_class, attempt, hint):
+                        logger.error(f"Gemini call failed on attempt {attempt + 1} ({error_class}, not retried): {describe(e)}", exc_info=True)
+                        yield f"<!-- ERROR: Failed to generate content after {attempt + 1} attempt(s) ({error_class} error): {e} -->"
+                        return
+
+                    wait = policy.backoff(attempt, hint)
+                    if emitted:
+                        # Resume after the output the caller already has instead of restarting it
+                        request_contents = continuation_contents(self._as_turns(contents), emitted.getvalue())
+                        splicer = OverlapSplicer(emitted.tail(OverlapSplicer.DEFAULT_WINDOW))
+                    logger.warning(
+                        f"Attempt {attempt + 1} failed ({error_class}): {describe(e)}. "
+                        f"Retrying in {wait:.2f}s as a {'continuation after ' + str(len(emitted)) + ' chars' if emitted else 'fresh request'}."
+                    )
+                    await asyncio.sleep(wait)
+        finally:
+            if accumulator is None:
+                emitted.close()
+
+    def _template(self, variant: str = FULL) -> CompiledTemplate:
+        """Current version of the Web Component generation template (from the in-memory store)."""
+        return self.templates.get(WC_TEMPLATE, variant)
+
+    def _template_for(self, request_text: str, files: Optional[List[Dict[str, Any]]] = None, current_html: Optional[str] = None) -> CompiledTemplate:
+        """
+        The template for this request: its assigned variant (see prompt_compaction.VariantSelector),
+        rendered with the modules its intents need (see prompt_modules).
+
+        Args:
+            request_text: The user's request.
+            files: Uploaded file descriptors sent with the request.
+            current_html: HTML being modified, for modification requests.
+        """
+        intents = self.prompt_modules.intents(request_text, files, current_html)
+        return self.templates.get(WC_TEMPLATE, self.prompt_variants.choose(request_text), intents)
+
+    def _record_template(self, template: CompiledTemplate, task: str) -> None:
+        """Counts the modules a prompt was built with and logs the template tokens they saved."""
+        self.prompt_modules.record(template.modules, template.skipped, template.tokens, template.tokens_saved)
+        if template.modules or template.skipped:
+            logger.info(
+                f"Prompt template for {task}: modules [{', '.join(template.modules) or 'none'}], "
+                f"~{template.tokens:,} tokens (~{template.tokens_saved:,} saved by skipping {', '.join(template.skipped) or 'nothing'})."
+            )
+
+    def _load_full_code_template(self) -> str:
+        """
+        Returns the Web Component generation template text (built-in instructions if the file is missing).
+
+        Returns:
+            The template text that precedes the user request in the generation prompt.
+        """
+        return self._template().text
+
+    async def _call_gemini_shared(self, contents: Union[str, List[Union[str, Dict[str, Any]]]], accumulator: Optional[StreamAccumulator] = None, models_used: Optional[List[str]] = None, **kwargs) -> AsyncIterator[str]:
+        """
+        `_call_gemini_with_retry`, coalesced with identical in-flight requests.
+
+        The request fingerprint covers the model, the full contents and the call options (but not
+        the caller's identity). Every caller receives the complete stream from the first chunk; the
+        upstream call is cancelled only when all callers have disconnected.
+
+        When `models_used` is given it receives the models the shared stream actually called
+        (the pinned model, or the fallback model after a circuit-breaker failover).
+        """
+        options = {k: v for k, v in kwargs.items() if k != 'user_id'}
+        key = contents_fingerprint(self.model_name, {"contents": contents, "options": options})
+        # Followers never run the upstream call, so the models it used are kept per flight
+        record = self._flight_models.setdefault(key, {"models": [], "callers": 0})
+        record["callers"] += 1
+        try:
+            async for chunk in self.single_flight.stream(key, lambda: self._call_gemini_with_retry(contents, models_used=record["models"], **kwargs)):
+                if accumulator is not None and "<!-- ERROR:" not in chunk:
+                    accumulator.append(chunk)
+                yield chunk
+        finally:
+            if models_used is not None:
+                models_used.extend(record["models"])
+            record["callers"] -= 1
+            if not record["callers"] and self._flight_models.get(key) is record:
+                del self._flight_models[key]
+
+    async def complete_text(self, contents: Union[str, List[Any]], task: str, user_id: Optional[str] = None, shared: bool = False, hedge: bool = True, **kwargs) -> str:
+        """
+        Runs a model call to completion and returns the whole response, hedging slow calls.
+
+        Args:
+            contents: Request contents (see `_call_gemini_api`).
+            task: Limiter task name; also the latency class used for hedging.
+            user_id: Caller identity for fair scheduling.
+            shared: Coalesce the primary request with identical in-flight ones (backup
+                requests always bypass coalescing, otherwise they would join the slow stream).
+            hedge: Allow a backup request for a slow call. Pass False for large prompts, where a
+                backup would re-send the whole prompt (hedging is meant for short calls).
+            **kwargs: Passed to `_call_gemini_with_retry` (e.g. enable_grounding, max_retries).
+
+        Raises:
+            ModelCallError: The call failed after retries.
+            ServiceUnavailableError: The request was shed by the concurrency limiter, or the model's circuit is open.
+        """
+        async def attempt(is_hedge: bool) -> str:
+            buffer = StreamAccumulator()
+            call = self._call_gemini_shared if shared and not is_hedge else self._call_gemini_with_retry
             try:
-                logger.info(f"Gemini API call attempt {attempt + 1}/{max_retries + 1} (kwargs: {kwargs})")
-                async for chunk in self._call_gemini_api(contents, **kwargs):
-                    yield chunk
-                
-                logger.info(f"Gemini API call attempt {attempt + 1} successful.")
-                return # Exit successfully
-                
-            # CATCH json.JSONDecodeError directly for retry
-            except json.JSONDecodeError as json_err:
-                last_exception = json_err
-                logger.warning(f"Attempt {attempt + 1} failed due to specific stream decode error: {json_err}")
-                if attempt < max_retries:
-                    logger.info(f"Retrying in {delay} second(s)...")
-                    await asyncio.sleep(delay)
-                    continue # Go to next attempt
-                else:
-                    logger.error("Max retries reached for stream decode error.")
-                    yield f"<!-- ERROR: Failed to generate content after {max_retries + 1} attempts due to stream corruption. -->"
-                    return # Exit after final failure
+                async for chunk in call(contents, accumulator=buffer, task=task, user_id=user_id, **kwargs):
+                    if "<!-- ERROR:" in chunk:
+                        error_match = re.search(r"<!-- ERROR: (.*) -->", chunk, re.DOTALL)
+                        raise ModelCallError(error_match.group(1) if error_match else chunk)
+                return buffer.getvalue()
+            finally:
+                buffer.close()
+
+        if not hedge:
+            return await attempt(False)
+        return await self.hedger.run(task, attempt)
+
+    def _model_capacity_idle(self) -> bool:
+        """True when the limiter has a free slot and nothing queued (background upstream work may run)."""
+        return self.limiter.in_flight < self.limiter.limit and self.limiter.queue_depth == 0
+
+    def _assemble_prompt(self, task: str, sections: List[PromptSection]) -> AssembledPrompt:
+        """
+        Joins prompt sections within the task's input budget and logs the per-section token cost.
 
-            except Exception as e:
-                # Catch other exceptions (ConnectionError, GoogleAPIError, etc.) 
-                # --- Check if this generic exception looks like our specific JSON decode error ---
-                if "Expecting property name enclosed in double quotes" in str(e):
-                    last_exception = e
-                    logger.warning(f"Attempt {attempt + 1} failed due to likely stream decode error (caught as {type(e).__name__}): {e}")
-                    if attempt < max_retries:
-                        logger.info(f"Retrying in {delay} second(s)...")
-                        await asyncio.sleep(delay)
-                        continue # Go to next attempt
-                    else:
-                        logger.error("Max retries reached for likely stream decode error.")
-                        yield f"<!-- ERROR: Failed to generate content after {max_retries + 1} attempts due to stream corruption. -->"
-                        return # Exit after final failure
-                else:
-                     # Treat other exceptions as truly unrecoverable
-                     logger.error(f"Unrecoverable error during Gemini call attempt {attempt + 1}: {e}", exc_info=True)
-                     yield f"<!-- ERROR: Unrecoverable error during generation: {e} -->"
-                     return # Exit on unrecoverable error
-        
-        # This part should ideally not be reached if logic above is correct, but as a fallback:
-        if last_exception:
-             yield f"<!-- ERROR: Failed to generate content after {max_retries + 1} attempts. Last error: {last_exception} -->"
-    
-    def _create_full_code_prompt(self, user_request: str) -> str:
+        Raises:
+            PromptBudgetExceeded: The untrimmable sections alone are over the budget.
+        """
+        model = self.models.primary(task)
+        assembled = assemble(task, sections, self.token_estimator, model=model)
+        if assembled.trimmed:
+            logger.warning(f"Trimmed to fit the input budget: {assembled.summary()}")
+        else:
+            logger.info(assembled.summary())
+        schedule_calibration(self.token_estimator, self.client, model, assembled.text, idle=self._model_capacity_idle)
+        return assembled
+
+    def fit_conversation(self, task: str, turns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        A conversation within the task's input budget (its oldest turns dropped if needed).
+
+        Raises:
+            PromptBudgetExceeded: The latest turn alone is over the budget.
+        """
+        fitted = fit_turns(task, turns, self.token_estimator, model=self.models.primary(task))
+        if len(fitted) < len(turns):
+            logger.warning(f"Dropped the {len(turns) - len(fitted)} oldest {task} turn(s) to fit the input budget.")
+        return fitted
+
+    @staticmethod
+    def _uploaded_files_section(files: List[Dict[str, Any]], trailing_newline: bool = True) -> PromptSection:
+        """
+        The uploaded-files context block. When over budget, data URLs are omitted first, then
+        long extracted text is shortened, before the block is truncated.
+        """
+        def render(entries: List[Dict[str, Any]]) -> str:
+            body = json.dumps(entries, indent=2, default=str) if entries else "[]"
+            return (
+                f"\n\n--- Uploaded Files Information (Context for AI) ---\n// uploaded_files:\n{body}\n"
+                f"--- End Uploaded Files Information ---{chr(10) if trailing_newline else ''}"
+            )
+
+        def reduced(text_limit: Optional[int]) -> List[Dict[str, Any]]:
+            entries = []
+            for entry in files:
+                entry = dict(entry)
+                if entry.get("content_data_url"):
+                    entry["content_data_url"] = "(omitted to fit the input budget)"
+                text = entry.get("text_content")
+                if text_limit is not None and isinstance(text, str) and len(text) > text_limit:
+                    entry["text_content"] = text[:text_limit] + " ... (truncated to fit the input budget)"
+                entries.append(entry)
+            return entries
+
+        return PromptSection("uploaded_files", render(files), priority=20, alternatives=(render(reduced(None)), render(reduced(2000))))
+
+    def _build_full_code_prompt(self, user_request: str, prompt_template: Union[str, CompiledTemplate, None] = None, files_section: Optional[PromptSection] = None, task: str = "generation") -> AssembledPrompt:
+        """
+        Builds the full-code generation prompt as sections within the task's input budget.
+
+        Args:
+            user_request: The user's request text.
+            prompt_template: Template to use (the store's current version when omitted).
+            files_section: Optional uploaded-files block (see `_uploaded_files_section`).
+            task: Task whose input budget applies.
+
+        Raises:
+            PromptBudgetExceeded: The template and request alone are over the budget.
+        """
+        if prompt_template is None:
+            prompt_template = self._template_for(user_request)
+        elif isinstance(prompt_template, str):
+            prompt_template = CompiledTemplate.from_text(WC_TEMPLATE, prompt_template)
+        # Static template first, per-request content (the request's template modules included) after it,
+        # so requests share the longest possible prefix
+        sections = [
+            *prompt_template.sections(cacheable=True),
+            PromptSection("request", f"\n\n## User Request:\n\n```text\n{user_request}\n```"),
+        ]
+        if files_section is not None:
+            sections.append(files_section)
+        # AI generates the HTML starting from <!DOCTYPE html>...
+        sections.append(PromptSection("output_instructions", "\n\n## Full HTML Output (Remember: Complete, self-contained HTML with CSS and Vanilla JS/Web Components):\n"))
+        return self._assemble_prompt(task, sections)
+
+    def _create_full_code_prompt(self, user_request: str, prompt_template: Union[str, CompiledTemplate, None] = None, files_section: Optional[PromptSection] = None) -> str:
         """
         Creates the prompt for the AI to generate a complete, self-contained HTML file 
         using standard Web Components, HTML, CSS, and vanilla JavaScript.
         
         Args:
             user_request: The user's request text.
+            prompt_template: Template to use (the store's current version when omitted).
+            files_section: Optional uploaded-files block, trimmed first when over budget.
             
         Returns:
             The final prompt string to send to the AI.
         """
-        prompt_template = ""
-        template_path = ""
-        try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            # Use the template specifically for Web Components
-            template_path = os.path.join(current_dir, '..', 'gemini_prompt_template_wc.md')
-            with open(template_path, "r", encoding="utf-8") as f:
-                prompt_template = f.read()
-        except FileNotFoundError:
-            logger.error(f"ERROR: Web Component Prompt template not found at {template_path}. Using basic fallback.")
-            # Basic fallback instructions for HTML/WC generation
-            prompt_template = (
-                "You are an expert AI assistant specializing in modern, accessible web development using standard technologies.\n"
-                "\n"
-                "Generate a COMPLETE, runnable, self-contained HTML file (.html) that fulfills the user request below.\n"
-                "\n"
-                "ABSOLUTE REQUIREMENTS:\n"
-                "\n"
-                "0.  **No Placeholders or Excuses:** Attempt the full implementation. Do NOT output placeholder UIs or messages stating the task is too complex.\n"
-                "1.  **DOCTYPE & HTML Structure:** Start with `<!DOCTYPE html>` and include `<html>`, `<head>`, and `<body>` tags.\n"
-                "2.  **Styling:** Use standard CSS within `<style>` tags in the `<head>`. \n"
-                "    Optionally, you can use Tailwind CSS classes IF you include the Tailwind CDN script in the `<head>`: `<script src=\"https://cdn.tailwindcss.com\"></script>`. \n"
-                "    Prioritize clean, responsive design.\n"
-                "3.  **Structure & Interactivity:** Use standard HTML elements. For reusable UI parts and complex logic, DEFINE and USE **Standard Web Components** (using `customElements.define`, `<template>`, and vanilla JavaScript classes extending `HTMLElement`).\n"
-                "4.  **JavaScript:** Prioritize vanilla JS within `<script>` tags for basic interactivity. \n"
-                "    - Use standard DOM APIs (`getElementById`, `querySelector`, `addEventListener`, etc.).\n"
-                "    - **External Libraries:** For complex features (e.g., 3D graphics, advanced charting), you **MUST** actively use well-known external JavaScript libraries. **Use Import Maps** in the `<head>` when using ES Module libraries (like Three.js). Define the library (e.g., `\"three\"`) and addon paths (e.g., `\"three/addons/\"`) mapping to reliable CDN URLs (e.g., from cdnjs, jsdelivr, using `.module.js` files). Remove the `<script src=...>` tags for mapped libraries. In your `<script type=\"module\">`, use `import * as THREE from 'three';` and `import { OrbitControls } from 'three/addons/controls/OrbitControls.js';`. You **MUST** use libraries for complex tasks where vanilla JS is impractical. \n"
-                "5.  **Self-Contained:** The final output MUST be a SINGLE HTML file. No external CSS files (other than Tailwind CDN). External JavaScript libraries are permissible if included via CDN `<script>` tags or referenced via Import Maps. \n"
-                "6.  **Output Format:** Return ONLY the raw HTML code. NO markdown formatting (like ```html ... ```), explanations, or comments outside the code itself.\n"
-                "7.  **Print Optimization:** Include print-specific CSS rules (`@media print`) to optimize the layout for printing or saving as PDF. Hide non-essential interactive elements (like buttons, input forms), ensure content fits standard paper sizes (like A4/Letter) with appropriate margins, use high-contrast text (e.g., black text on a white background regardless of screen theme), and manage page breaks appropriately (`page-break-before`, `page-break-after`, `page-break-inside: avoid`) for long content.\n"
-            )
-
-        # Construct the final prompt 
-        final_prompt = (
-            f"{prompt_template}\n\n"
-            f"## User Request:\n\n"
-            f"```text\n{user_request}\n```\n\n"
-            f"## Full HTML Output (Remember: Complete, self-contained HTML with CSS and Vanilla JS/Web Components):\n"
-            # AI generates the HTML starting from <!DOCTYPE html>...
-        )
-
+        final_prompt = self._build_full_code_prompt(user_request, prompt_template, files_section).text
         logger.info("Created prompt for FULL standalone HTML/Web Component generation.")
         return final_prompt
     
-    async def generate_full_component_code(self, user_request: str, enable_grounding: bool = False) -> AsyncIterator[str]:
+    def generation_cache_key(self, user_request: str, enable_grounding: bool = False, prompt_template: Optional[str] = None) -> str:
+        """Cache key for a full-code generation request (normalized request, template hash, model, grounding)."""
+        template = self._template_for(user_request) if prompt_template is None else CompiledTemplate.from_text(WC_TEMPLATE, prompt_template)
+        model = self._route_generation(template, user_request, enable_grounding, log=False).model
+        return make_cache_key(user_request, template.scope_digest, model, enable_grounding)
+
+    async def _lookup_cached_generation(self, user_request: str, cache_key: str, scope: str, enable_grounding: bool) -> Tuple[Optional[str], Dict[str, Any]]:
+        """
+        Looks for a reusable generation: an exact (normalized) match first, then a near-duplicate
+        request the similarity index allows serving (off unless a serve threshold is configured).
+        Grounded requests only use exact matches.
+
+        Returns:
+            (html, details) where details describes the hit for the generation log; html is None on a miss.
+        """
+        cached_html = await self.generation_cache.fetch(cache_key)
+        if cached_html is not None:
+            return cached_html, {"cache": "hit"}
+        if enable_grounding:
+            return None, {}
+        match = self.similarity_index.servable(user_request, scope)
+        if match is None:
+            return None, {}
+        cached_html = await self.generation_cache.fetch(match.key)
+        if cached_html is None:
+            self.similarity_index.remove(match.key) # Cache entry expired or was invalidated
+            return None, {}
+        return cached_html, {"cache": "similar", "matched_request": match.request, "similarity": round(match.similarity, 3)}
+
+    async def find_similar_generation(self, user_request: str) -> Optional[Dict[str, Any]]:
+        """
+        Finds a past generation similar enough to show as an instant preview while a fresh one runs.
+
+        Returns:
+            {"html", "matched_request", "similarity"} or None when nothing reaches the preview threshold.
+        """
+        template = self._template_for(user_request)
+        model = self._route_generation(template, user_request, log=False).model
+        match = self.similarity_index.query(
+            user_request, similarity_scope(template.scope_digest, model), min_similarity=self.similarity_index.preview_threshold
+        )
+        if match is None:
+            return None
+        cached_html = await self.generation_cache.fetch(match.key)
+        if cached_html is None:
+            self.similarity_index.remove(match.key)
+            return None
+        return {"html": cached_html, "matched_request": match.request, "similarity": round(match.similarity, 3)}
+
+    async def generate_full_component_code(self, user_request: str, enable_grounding: bool = False, use_cache: bool = True, user_id: Optional[str] = None) -> AsyncIterator[str]:
         """
         Generates a complete, runnable HTML file string (using Web Components)
         based on a user prompt, yielding chunks as they arrive from the API.
@@ -412,17 +823,52 @@ class ComponentService:
         Args:
             user_request: A description of the application the user wants to create.
             enable_grounding: Whether to enable Google Search grounding.
+            use_cache: Serve/store the result through the generation cache (False bypasses it).
+            user_id: Requesting user, for fair scheduling of the model call.
             
         Yields:
             String chunks of the generated HTML.
         """
         logger.info(f"Starting ASYNC generation for: {user_request[:50]}... (Grounding: {enable_grounding})")
         prompt: str = ""
-        full_response = "" # To capture full response for logging
+        assembled: Optional[AssembledPrompt] = None
+        response_buffer = StreamAccumulator() # Filled with the spliced model response; read here for logging
         success = False # Track success for logging
 
-        # Step 1: Create the prompt (sync operation)
-        prompt = self._create_full_code_prompt(user_request)
+        # Step 0: Serve identical or near-duplicate requests from the generation cache
+        # One template version for the whole request, even if the file is reloaded meanwhile
+        template = self._template_for(user_request)
+        digest = template.scope_digest
+        # Routed once up front so the cache key, similarity scope and the call agree on the model
+        model = self._route_generation(template, user_request, enable_grounding).model
+        cache_key = make_cache_key(user_request, digest, model, enable_grounding)
+        scope = similarity_scope(digest, model)
+        if not use_cache:
+            self.generation_cache.stats.bypassed += 1
+        else:
+            cached_html, cache_details = await self._lookup_cached_generation(user_request, cache_key, scope, enable_grounding)
+            if cached_html is not None:
+                logger.info(f"Generation cache {cache_details['cache'].upper()} ({cache_key[:12]}) for: {user_request[:50]}...")
+                yield cached_html
+                self.generation_log.write(dict(
+                    cache_details,
+                    type="generation",
+                    user_request=user_request,
+                    cache_key=cache_key,
+                    response_preview=cached_html[:200] + ("..." if len(cached_html) > 200 else ""),
+                    status="Success",
+                ))
+                return
+
+        # Step 1: Create the prompt (sync operation), within the generation input budget
+        try:
+            assembled = self._build_full_code_prompt(user_request, template)
+            prompt = assembled.text
+            self._record_template(template, "generation")
+        except PromptBudgetExceeded as e:
+            logger.warning(str(e))
+            yield f"<!-- ERROR: {e} -->"
+            return
         if not prompt:
             logger.error("Full HTML/WC prompt creation failed (template likely missing).")
             self.error_count += 1
@@ -430,23 +876,39 @@ class ComponentService:
             return # Exit early
 
         # Step 2: Call the streaming API via the RETRY WRAPPER
-        logger.info("Calling _call_gemini_with_retry for full code generation")
+        logger.info("Calling _call_gemini_shared for full code generation")
         stream_successful = True # Assume success unless error occurs during streaming
+        stream_start = time.perf_counter()
+        first_chunk_s: Optional[float] = None
+        models_used: List[str] = []
         try:
-            async for chunk in self._call_gemini_with_retry(prompt, enable_grounding=enable_grounding):
+            async for chunk in self._call_gemini_shared(assembled.suffix, static_prefix=assembled.prefix, enable_grounding=enable_grounding, accumulator=response_buffer, models_used=models_used, task="generation", user_id=user_id, model=model):
                 if "<!-- ERROR:" in chunk: 
                     stream_successful = False
-                full_response += chunk
+                elif first_chunk_s is None:
+                    first_chunk_s = time.perf_counter() - stream_start
                 yield chunk
         except Exception as e:
             logger.error(f"Unexpected error iterating over retry wrapper stream: {e}", exc_info=True)
             yield f"<!-- ERROR: Unexpected error processing stream: {e} -->"
             stream_successful = False
             
+        duration_s = time.perf_counter() - stream_start
+        complete = "</html>" in response_buffer.tail(64).lower()
+        # The cache key and similarity scope name the routed model; a fallback model's page is not stored under them
+        failed_over = [m for m in models_used if m != model]
+        self.prompt_variants.record(template.variant, stream_successful, complete, first_chunk_s if first_chunk_s is not None else duration_s, duration_s)
         if stream_successful:
              logger.info("Finished yielding chunks from _call_gemini_with_retry.")
              self.error_count = 0 
              success = True 
+             # Only complete documents are cached; a truncated page would be replayed forever
+             if use_cache and complete and failed_over:
+                 logger.info(f"Not caching generation {cache_key[:12]}: served by fallback model {failed_over[-1]} instead of {model}")
+             elif use_cache and complete:
+                 await self.generation_cache.store(cache_key, response_buffer.getvalue(), grounding=enable_grounding, user_request=user_request)
+                 if not enable_grounding:
+                     self.similarity_index.add(user_request, cache_key, scope)
         else:
              logger.error("Stream processing finished with errors signaled by the retry wrapper.")
              self.error_count += 1
@@ -456,53 +918,53 @@ class ComponentService:
             "timestamp": datetime.datetime.now().isoformat(),
             "type": "generation",
             "user_request": user_request,
+            "cache_key": cache_key,
+            "cache": ("failover" if failed_over else "miss") if use_cache else "bypass",
+            "template_hash": digest,
+            "prompt_variant": template.variant,
+            "prompt_modules": list(template.modules),
+            "prompt_tokens_saved": template.tokens_saved,
+            "model": model,
+            "models_used": models_used,
+            "grounding": enable_grounding,
             "prompt_preview": (prompt[:200] + '...') if prompt else "(Prompt creation failed)",
-            "response_preview": (full_response[:200] + '...') if full_response else "(Empty/Failed)",
+            "prompt_hash": assembled.digest if assembled else None,
+            "prompt_tokens": assembled.tokens if assembled else None,
+            "prompt_trimmed": assembled.trimmed if assembled else None,
+            "response_preview": response_buffer.preview(200) if response_buffer else "(Empty/Failed)",
+            "first_chunk_s": round(first_chunk_s, 3) if first_chunk_s is not None else None,
+            "duration_s": round(duration_s, 3),
             "status": "Success" if success else "Failure",
         }
-        try:
-            with open("morpheo_generation_log.jsonl", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
-        except Exception as log_err:
-            logger.error(f"Failed to write structured log for generation: {log_err}")
+        self.generation_log.write(log_entry, force=not success)
+        response_buffer.close()
 
-    def _create_modification_prompt(self, modification_request: str, current_html: str) -> str:
+    def _build_modification_prompt(self, modification_request: str, current_html: str, files_section: Optional[PromptSection] = None, uploaded_files: Optional[List[Dict[str, Any]]] = None, edits: bool = False, template: Optional[CompiledTemplate] = None) -> AssembledPrompt:
         """
-        Creates the prompt for the AI to modify an existing HTML file 
-        using standard Web Components, HTML, CSS, and vanilla JavaScript.
-        
+        Builds the modification prompt as sections within the modification input budget.
+
+        The static parts (the base template and the modification instructions) come first and
+        form the cacheable prefix; the existing HTML, the request and any files follow.
+        With `edits`, the model is asked for search/replace edits instead of the whole file.
+
         Args:
             modification_request: The user's modification instructions.
             current_html: The current HTML code string.
-            
-        Returns:
-            The final prompt string to send to the AI.
+            files_section: Optional uploaded-files block placed after the request.
+            uploaded_files: Descriptors of the uploaded files, for template module selection.
+            edits: Ask for search/replace edits (see edit_protocol) rather than the full modified file.
+            template: Base template already chosen for this request (see `_template_for`). The
+                caller records it once per request with `_record_template`, however often the
+                prompt is rebuilt.
+
+        Raises:
+            PromptBudgetExceeded: The request and current HTML alone are over the modification budget.
         """
-        base_prompt_template = "" # Re-initialize for safety
-        template_path = ""
-        try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            template_path = os.path.join(current_dir, '..', 'gemini_prompt_template_wc.md')
-            with open(template_path, "r", encoding="utf-8") as f:
-                # Read the core generation rules from the existing template
-                base_prompt_template = f.read()
-        except FileNotFoundError:
-            logger.error(f"ERROR: Web Component Prompt template not found at {template_path}. Using basic fallback for modification.")
-            # Keep a basic fallback, but we'll augment it below
-            base_prompt_template = (
-                "You are an expert AI assistant specializing in modern, accessible web development using standard technologies.\n"
-                "\n"
-                "ABSOLUTE REQUIREMENTS (Apply these to the modification):\n"
-                "\n"
-                "1.  **DOCTYPE & HTML Structure:** Ensure the final output is a complete HTML file starting with `<!DOCTYPE html>`.\n"
-                "2.  **Styling:** Use standard CSS within `<style>` tags OR Tailwind CSS classes (assuming CDN is present). Prioritize clean, responsive design.\n"
-                "3.  **Structure & Interactivity:** Use standard HTML and **Standard Web Components** (customElements.define, template, vanilla JS classes extending HTMLElement) for UI parts and logic.\n"
-                "4.  **JavaScript:** All JavaScript MUST be vanilla JS. Use standard DOM APIs. NO external libraries/frameworks (except optional Tailwind CDN).\n"
-            )
+        base_template = template or self._template_for(modification_request, uploaded_files, current_html)
 
-        # --- Modification-Specific Instructions (Prepended for Emphasis) ---
-        modification_prefix = (
-            "**IMPORTANT: THIS IS A MODIFICATION TASK, NOT A GENERATION TASK.**\n"
+        # --- Modification-Specific Instructions (after the base rules, so they take precedence) ---
+        modification_instructions = (
+            "\n\n**IMPORTANT: THIS IS A MODIFICATION TASK, NOT A GENERATION TASK.**\n"
             "Your goal is to **MODIFY** the provided **EXISTING HTML CODE** based *only* on the **USER MODIFICATION REQUEST**.\n"
             "**DO NOT REWRITE THE ENTIRE FILE.** Make only the necessary incremental changes.\n"
             "Preserve the existing structure, styles, IDs, classes, and JavaScript logic unless the request explicitly asks to change them.\n"
@@ -512,25 +974,117 @@ class ComponentService:
             "- Do *not* change how the JavaScript *processes* the API response unless the request *also* specifies how to handle a potentially different response format. Assume the basic response structure remains similar unless told otherwise.\n"
             "- Do *not* invent new API endpoints or assume backend changes.\n"
             "\n"
-            "Output the *entire* modified HTML file, ensuring it remains valid and runnable.\n"
-            "--- USER MODIFICATION REQUEST ---\n"
-            f"{modification_request}\n"
-            "\n"
-            "--- EXISTING HTML CODE TO MODIFY ---\n"
-            f"{current_html}\n"
-            "\n"
-            "--- FULL MODIFIED HTML CODE (Your Output - Remember: Modify, don't rewrite!) ---"
         )
+        if edits:
+            modification_instructions += EDIT_INSTRUCTIONS + "The edited file must remain valid and runnable.\n"
+            output_instructions = "\n\n--- SEARCH/REPLACE EDITS (Your Output - Edits only, not the whole file!) ---"
+        else:
+            modification_instructions += "Output the *entire* modified HTML file, ensuring it remains valid and runnable.\n"
+            output_instructions = "\n\n--- FULL MODIFIED HTML CODE (Your Output - Remember: Modify, don't rewrite!) ---"
+        requirements_header = "--- GENERAL REQUIREMENTS (Apply to modification) ---\n"
+        static_template = base_template.static
+        sections = [
+            # The base rules (which might be redundant now but kept for safety) are the first thing trimmed
+            PromptSection(
+                "general_requirements",
+                requirements_header + static_template.text,
+                priority=10,
+                cacheable=True,
+                tokens=count_tokens(requirements_header) + static_template.tokens,
+            ),
+            PromptSection("instructions", modification_instructions, cacheable=True),
+        ]
+        if base_template.module_text:
+            # The request's template modules are per-request, so they follow the cacheable prefix
+            sections.append(PromptSection("general_requirements_modules", base_template.module_text, priority=10))
+        sections += [
+            PromptSection("current_html", f"\n--- EXISTING HTML CODE TO MODIFY ---\n{current_html}\n"),
+            PromptSection("request", f"\n--- USER MODIFICATION REQUEST ---\n{modification_request}"),
+        ]
+        if files_section is not None:
+            sections.append(files_section)
+        sections.append(PromptSection("output_instructions", output_instructions))
+        return self._assemble_prompt("modification", sections)
+
+    def _create_modification_prompt(self, modification_request: str, current_html: str, files_section: Optional[PromptSection] = None, uploaded_files: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        Creates the prompt for the AI to modify an existing HTML file 
+        using standard Web Components, HTML, CSS, and vanilla JavaScript.
         
-        # Combine the modification prefix with the base rules (which might be redundant now but kept for safety)
-        final_prompt = modification_prefix + "\n\n--- GENERAL REQUIREMENTS (Apply to modification) ---\n" + base_prompt_template
-        
-        # Log the first few chars for debugging if needed
-        # logger.debug(f"Modification Prompt Start: {final_prompt[:500]}") 
-        
-        return final_prompt
+        Args:
+            modification_request: The user's modification instructions.
+            current_html: The current HTML code string.
+            files_section: Optional uploaded-files block placed after the request.
+            uploaded_files: Descriptors of the uploaded files, for template module selection.
+            
+        Returns:
+            The final prompt string to send to the AI.
 
-    async def modify_full_component_code(self, modification_request: str, current_html: str, enable_grounding: bool = False) -> AsyncIterator[str]:
+        Raises:
+            PromptBudgetExceeded: The request and current HTML alone are over the modification budget.
+        """
+        template = self._template_for(modification_request, uploaded_files, current_html)
+        assembled = self._build_modification_prompt(modification_request, current_html, files_section, uploaded_files, template=template)
+        self._record_template(template, "modification")
+        return assembled.text
+
+    async def _modify_with_edits(
+        self,
+        assembled: AssembledPrompt,
+        current_html: str,
+        file_objects: Optional[List[Any]] = None,
+        enable_grounding: bool = False,
+        user_id: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Runs an edit-mode modification prompt and applies the returned edits to `current_html`.
+
+        Args:
+            assembled: Modification prompt built with `edits=True`.
+            current_html: The document the edits apply to.
+            file_objects: Uploaded file objects sent after the prompt.
+            enable_grounding: Whether to enable Google Search grounding.
+            user_id: Fairness key for the concurrency limiter.
+
+        Returns:
+            The modified document, or None when the edits could not be obtained or applied (the
+            caller falls back to a full rewrite; nothing has been sent to the client yet).
+
+        Raises:
+            ServiceUnavailableError: The call was shed or the circuit is open; a full rewrite
+                would only add load, so there is no fallback.
+        """
+        start = time.perf_counter()
+        try:
+            reply = await self.complete_text(
+                [assembled.suffix] + list(file_objects or []),
+                task="modification",
+                user_id=user_id,
+                hedge=False, # The prompt carries the whole document; a backup would re-send it
+                static_prefix=assembled.prefix,
+                enable_grounding=enable_grounding,
+            )
+            edited_html, edit_count = apply_reply(current_html, reply)
+        except (EditError, ModelCallError) as e:
+            logger.warning(f"Modification edits not applied; falling back to a full rewrite: {e}")
+            self.edit_protocol.record_fallback()
+            return None
+        duration_s = time.perf_counter() - start
+        edited_tokens = count_tokens(edited_html)
+        tokens_saved = edited_tokens - count_tokens(reply)
+        rewrite_s = self.edit_protocol.estimate_rewrite_s(edited_tokens)
+        saved_s = rewrite_s - duration_s if rewrite_s is not None else None
+        self.edit_protocol.record_applied(edit_count, tokens_saved, saved_s)
+        if edit_count:
+            logger.info(
+                f"Applied {edit_count} modification edit(s) in {duration_s:.2f}s: ~{tokens_saved:,} output tokens saved"
+                f"{f', ~{saved_s:.2f}s saved' if saved_s is not None else ''} against a full rewrite."
+            )
+        else:
+            logger.info("Edit-mode modification returned the whole file; using it as is.")
+        return edited_html
+
+    async def modify_full_component_code(self, modification_request: str, current_html: str, enable_grounding: bool = False, user_id: Optional[str] = None) -> AsyncIterator[str]:
         """
         Modifies an existing HTML file string (using Web Components)
         based on user instructions, yielding chunks as they arrive.
@@ -545,11 +1099,50 @@ class ComponentService:
         """
         logger.info(f"Starting ASYNC modification for: {modification_request[:50]}... (Grounding: {enable_grounding})")
         prompt: str = ""
-        full_response = "" # To capture full response for logging
         success = False # Track success
+        use_edits = self.edit_protocol.enabled
+
+        # Step 1: Create the modification prompt (sync operation), within the modification input budget
+        # One template for the request, recorded once even if the prompt is rebuilt for a fallback
+        template = self._template_for(modification_request, current_html=current_html)
+        self._record_template(template, "modification")
+        try:
+            assembled = self._build_modification_prompt(modification_request, current_html, edits=use_edits, template=template)
+            prompt = assembled.text
+        except PromptBudgetExceeded as e:
+            logger.warning(str(e))
+            yield f"<!-- ERROR: {e} -->"
+            return
 
-        # Step 1: Create the modification prompt (sync operation)
-        prompt = self._create_modification_prompt(modification_request, current_html)
+        # Step 1b: Ask for edits and apply them; the patched document replaces the content like a rewrite would
+        if use_edits and prompt:
+            try:
+                edited_html = await self._modify_with_edits(assembled, current_html, enable_grounding=enable_grounding, user_id=user_id)
+            except ServiceUnavailableError as e:
+                logger.warning(f"Modification refused: {e}")
+                self.error_count += 1
+                yield f"<!-- ERROR: {e} -->"
+                return
+            if edited_html is not None:
+                self.error_count = 0
+                yield edited_html
+                self.generation_log.write({
+                    "timestamp": datetime.datetime.now().isoformat(),
+                    "type": "modification",
+                    "modification_mode": "edits",
+                    "modification_request": modification_request,
+                    "prompt_preview": prompt[:200] + '...',
+                    "response_preview": edited_html[:200],
+                    "status": "Success",
+                })
+                return
+            try:
+                assembled = self._build_modification_prompt(modification_request, current_html, template=template)
+                prompt = assembled.text
+            except PromptBudgetExceeded as e:
+                logger.warning(str(e))
+                yield f"<!-- ERROR: {e} -->"
+                return
         if not prompt:
             logger.error("Modification prompt creation failed (template likely missing).")
             self.error_count += 1
@@ -558,12 +1151,13 @@ class ComponentService:
 
         # Step 2: Call the streaming API via the RETRY WRAPPER
         logger.info("Calling _call_gemini_with_retry for modification")
+        response_buffer = StreamAccumulator() # Filled with the spliced model response; read here for logging
         stream_successful = True
+        stream_start = time.perf_counter()
         try:
-            async for chunk in self._call_gemini_with_retry(prompt, enable_grounding=enable_grounding):
+            async for chunk in self._call_gemini_with_retry(assembled.suffix, static_prefix=assembled.prefix, enable_grounding=enable_grounding, accumulator=response_buffer, task="modification", user_id=user_id):
                  if "<!-- ERROR:" in chunk:
                      stream_successful = False
-                 full_response += chunk
                  yield chunk
         except Exception as e:
             logger.error(f"Unexpected error iterating over retry wrapper stream during modification: {e}", exc_info=True)
@@ -574,6 +1168,7 @@ class ComponentService:
              logger.info("Finished yielding modification chunks from _call_gemini_with_retry.")
              self.error_count = 0
              success = True
+             self.edit_protocol.record_rewrite(count_tokens(response_buffer.getvalue()), time.perf_counter() - stream_start)
         else:
              logger.error("Modification stream processing finished with errors signaled by the retry wrapper.")
              self.error_count += 1
@@ -582,28 +1177,30 @@ class ComponentService:
         log_entry = {
             "timestamp": datetime.datetime.now().isoformat(),
             "type": "modification",
+            "modification_mode": "full",
             "modification_request": modification_request,
             "prompt_preview": (prompt[:200] + '...') if prompt else "(Prompt creation failed)",
-            "response_preview": (full_response[:200] + '...') if full_response else "(Empty/Failed)",
+            "response_preview": response_buffer.preview(200) if response_buffer else "(Empty/Failed)",
             "status": "Success" if success else "Failure",
         }
-        try:
-            with open("morpheo_generation_log.jsonl", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
-        except Exception as log_err:
-            logger.error(f"Failed to write structured log for modification: {log_err}")
+        self.generation_log.write(log_entry, force=not success)
+        response_buffer.close()
 
     # --- NEW Image Generation Method ---
-    async def generate_image(self, prompt: str) -> Dict[str, Optional[str]]:
-        """Generates an image using the experimental Gemini image generation model."""
+    async def generate_image(self, prompt: str, user_id: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """Generates an image using the experimental Gemini image generation model.
+
+        Raises:
+            ServiceUnavailableError: The call was shed by the concurrency limiter, or the model's circuit is open.
+        """
         logger.info(f"Starting image generation (Gemini experimental) for prompt: {prompt[:50]}...")
         
         if not self.client:
             logger.error("Gemini client not initialized in ComponentService. Cannot generate image.")
             return {"error": "Image generation client failed to initialize"}
             
-        # Use the experimental Gemini model for image generation
-        model_name = "gemini-2.0-flash-exp"
+        # Image output needs a model with the image_output capability (the experimental Gemini model by default)
+        model_name = self._route("image_generation", prompt).model
         # Configuration to request only image output
         # Need to ensure GenerateContentConfig is imported from google.genai.types
         try:
@@ -615,14 +1212,32 @@ class ComponentService:
              logger.error("Failed to find genai.types.GenerateContentConfig. Make sure google-genai SDK is up-to-date and imported correctly.")
              return {"error": "Internal server configuration error for image generation."}
         
+        # No fallback here: the breakers' fallback model cannot produce images
+        breaker = self.breakers.get(model_name, "image_generation")
+        if not breaker.allow():
+            raise CircuitOpenError(f"Model {model_name} is temporarily unavailable for image_generation (circuit open).", breaker.retry_after())
+        permit = None
+        call_exception: Optional[BaseException] = None
         try:
+            permit = await self.limiter.acquire(task="image_generation", user=user_id)
             logger.info(f"Calling client.aio.models.generate_content with model: {model_name} for image generation")
             # Call generate_content, not generate_images
-            response = await self.client.aio.models.generate_content(
-                model=model_name,
-                contents=prompt, # Pass the prompt string as contents
-                config=config # Pass the config requesting image modality
-            )
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=model_name,
+                    contents=prompt, # Pass the prompt string as contents
+                    config=config # Pass the config requesting image modality
+                )
+                permit.mark_first_chunk()
+            except Exception as e:
+                call_exception = e
+                raise
+            finally:
+                permit.release(
+                    rate_limited=call_exception is not None and is_rate_limit_error(call_exception),
+                    failed=call_exception is not None,
+                )
+                breaker.record_outcome(call_exception, permit.time_to_first_chunk())
             
             # Process the response to find the image data
             image_part = None
@@ -650,6 +1265,10 @@ class ComponentService:
                     return {"error": f"Image generation blocked due to safety reasons: {block_reason}"}
                 return {"error": "Image generation failed to produce an image part."}
                 
+        except ServiceUnavailableError:
+            if permit is None:
+                breaker.release()  # Shed by the limiter before the call; frees a half-open probe
+            raise # Reported by the endpoint as 503 + Retry-After
         except Exception as e:
             logger.error(f"An unexpected error occurred during {model_name} API call: {e}", exc_info=True)
             # Check if it's an invalid argument error specifically mentioning the model
@@ -659,8 +1278,11 @@ class ComponentService:
     # --- End REVISED Image Generation Method ---
 
     # --- NEW Video Analysis Method (Inline Data Approach) ---
-    async def analyze_video_from_bytes(self, prompt: str, video_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
-        """Analyzes a video provided as bytes using inline data with Gemini."""
+    async def analyze_video_from_bytes(self, prompt: str, video_bytes: bytes, mime_type: str, accumulator: Optional[StreamAccumulator] = None, user_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Analyzes a video provided as bytes using inline data with Gemini.
+
+        Streamed text is also appended to `accumulator` when provided (the endpoint reads the analysis from it).
+        """
         logger.info(f"Starting video analysis from bytes (INLINE DATA) ({len(video_bytes)} bytes, type: {mime_type}), prompt: {prompt[:50]}...")
 
         if not self.client:
@@ -671,11 +1293,14 @@ class ComponentService:
         # 2. Generate content using inline video data
         api_duration = 0.0
         api_call_start_time = 0.0
-        full_response = "" 
+        response_buffer = accumulator if accumulator is not None else StreamAccumulator()
+        permit = None
+        breaker = None
+        call_exception: Optional[BaseException] = None
 
         try:
             # Model selection (ensure it supports video)
-            model_name = "gemini-2.0-flash" 
+            model_name, breaker = self.breakers.select(self._route("video_analysis", prompt).model, "video_analysis")
             logger.info(f"Using Gemini model for video analysis: {model_name}")
 
             # Configuration
@@ -700,6 +1325,7 @@ class ComponentService:
                  yield f"<!-- ERROR: Internal setup error constructing request ({const_e}) -->"
                  return
 
+            permit = await self.limiter.acquire(task="video_analysis", user=user_id)
             api_call_start_time = time.perf_counter()
             
             # Use client's async streaming method directly with inline data
@@ -715,7 +1341,8 @@ class ComponentService:
                 try:
                     if hasattr(chunk, 'text'):
                         text_chunk = chunk.text
-                        full_response += text_chunk
+                        permit.mark_first_chunk()
+                        response_buffer.append(text_chunk)
                         yield text_chunk
                     elif hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
                          logger.error(f"Video analysis stream chunk blocked. Reason: {chunk.prompt_feedback.block_reason}")
@@ -730,29 +1357,40 @@ class ComponentService:
             api_duration = stream_end_time - api_call_start_time
             logger.info(f"Gemini video analysis stream (inline data) finished successfully in {api_duration:.4f} seconds.")
 
+        except ServiceUnavailableError:
+            raise # Reported by the endpoint as 503 + Retry-After
         except Exception as e:
             logger.error(f"An unexpected error occurred during Gemini video analysis call/stream (inline data): {e}", exc_info=True)
+            call_exception = e
             yield f"<!-- ERROR: Failed during video analysis generation: {e} -->"
         finally:
-            # Log full response etc. (Consider logging video details too)
-            try:
-                with open("gemini_request_log.txt", "a", encoding="utf-8") as f:
-                    f.write(f"\n--- Video Analysis (Inline Data) ({datetime.datetime.now()}) ---\n")
-                    f.write(f"Prompt: {prompt}\n")
-                    f.write(f"Video Mime Type: {mime_type}\n")
-                    f.write(f"Video Size (bytes): {len(video_bytes)}\n")
-                    # No uploaded file URI to log
-                    f.write(f"Response (Full):\n{full_response}\n") 
-                    # No upload duration to log
-                    f.write(f"API Stream Duration: {api_duration:.4f}s\n")
-                    f.write("--- End of Video Analysis (Inline Data) ---\n\n")
-            except Exception as log_e:
-                print(f"Error writing video analysis details to log: {log_e}")
+            if permit is not None:
+                permit.release(
+                    rate_limited=call_exception is not None and is_rate_limit_error(call_exception),
+                    failed=call_exception is not None,
+                )
+            if breaker is not None:
+                breaker.record_outcome(call_exception, permit.time_to_first_chunk() if permit is not None else None)
+            # Log prompt, media metadata and response (the video bytes themselves are never logged)
+            self.request_log.write({
+                "event": "Video Analysis (Inline Data)",
+                "prompt": prompt,
+                "mime_type": mime_type,
+                "size_bytes": len(video_bytes),
+                "response": response_buffer.head(self.request_log.max_field_chars),
+                "response_chars": len(response_buffer),
+                "api_duration_s": round(api_duration, 4),
+            })
+            if accumulator is None:
+                response_buffer.close()
     # --- End REVISED Video Analysis Method ---
 
     # --- NEW Audio Analysis Method (Inline Data Approach) ---
-    async def analyze_audio_from_bytes(self, prompt: str, audio_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
-        """Analyzes audio provided as bytes using inline data with Gemini."""
+    async def analyze_audio_from_bytes(self, prompt: str, audio_bytes: bytes, mime_type: str, accumulator: Optional[StreamAccumulator] = None, user_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Analyzes audio provided as bytes using inline data with Gemini.
+
+        Streamed text is also appended to `accumulator` when provided (the endpoint reads the analysis from it).
+        """
         logger.info(f"Starting audio analysis from bytes (INLINE DATA) ({len(audio_bytes)} bytes, type: {mime_type}), prompt: {prompt[:50]}...")
 
         if not self.client:
@@ -763,11 +1401,14 @@ class ComponentService:
         # Generate content using inline audio data
         api_duration = 0.0
         api_call_start_time = 0.0
-        full_response = "" 
+        response_buffer = accumulator if accumulator is not None else StreamAccumulator()
+        permit = None
+        breaker = None
+        call_exception: Optional[BaseException] = None
 
         try:
             # Model selection (ensure it supports audio - likely the same multimodal model)
-            model_name = "gemini-2.0-flash" 
+            model_name, breaker = self.breakers.select(self._route("audio_analysis", prompt).model, "audio_analysis")
             logger.info(f"Using Gemini model for audio analysis: {model_name}")
 
             # Configuration
@@ -791,6 +1432,7 @@ class ComponentService:
                  yield f"<!-- ERROR: Internal setup error constructing request ({const_e}) -->"
                  return
 
+            permit = await self.limiter.acquire(task="audio_analysis", user=user_id)
             api_call_start_time = time.perf_counter()
             
             # Use client's async streaming method directly with inline data
@@ -806,7 +1448,8 @@ class ComponentService:
                 try:
                     if hasattr(chunk, 'text'):
                         text_chunk = chunk.text
-                        full_response += text_chunk
+                        permit.mark_first_chunk()
+                        response_buffer.append(text_chunk)
                         yield text_chunk
                     elif hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
                          logger.error(f"Audio analysis stream chunk blocked. Reason: {chunk.prompt_feedback.block_reason}")
@@ -819,29 +1462,44 @@ class ComponentService:
             api_duration = stream_end_time - api_call_start_time
             logger.info(f"Gemini audio analysis stream (inline data) finished successfully in {api_duration:.4f} seconds.")
 
+        except ServiceUnavailableError:
+            raise # Reported by the endpoint as 503 + Retry-After
         except Exception as e:
             logger.error(f"An unexpected error occurred during Gemini audio analysis call/stream (inline data): {e}", exc_info=True)
+            call_exception = e
             yield f"<!-- ERROR: Failed during audio analysis generation: {e} -->"
         finally:
-            # Log full response etc.
-            try:
-                with open("gemini_request_log.txt", "a", encoding="utf-8") as f:
-                    f.write(f"\n--- Audio Analysis (Inline Data) ({datetime.datetime.now()}) ---\n")
-                    f.write(f"Prompt: {prompt}\n")
-                    f.write(f"Audio Mime Type: {mime_type}\n")
-                    f.write(f"Audio Size (bytes): {len(audio_bytes)}\n")
-                    f.write(f"Response (Full):\n{full_response}\n") 
-                    f.write(f"API Stream Duration: {api_duration:.4f}s\n")
-                    f.write("--- End of Audio Analysis (Inline Data) ---\n\n")
-            except Exception as log_e:
-                print(f"Error writing audio analysis details to log: {log_e}")
+            if permit is not None:
+                permit.release(
+                    rate_limited=call_exception is not None and is_rate_limit_error(call_exception),
+                    failed=call_exception is not None,
+                )
+            if breaker is not None:
+                breaker.record_outcome(call_exception, permit.time_to_first_chunk() if permit is not None else None)
+            # Log prompt, media metadata and response (the audio bytes themselves are never logged)
+            self.request_log.write({
+                "event": "Audio Analysis (Inline Data)",
+                "prompt": prompt,
+                "mime_type": mime_type,
+                "size_bytes": len(audio_bytes),
+                "response": response_buffer.head(self.request_log.max_field_chars),
+                "response_chars": len(response_buffer),
+                "api_duration_s": round(api_duration, 4),
+            })
+            if accumulator is None:
+                response_buffer.close()
     # --- End NEW Audio Analysis Method ---
 
     # --- NEW Suggestion Prompt Method --- 
     def _create_suggestion_prompt(self, current_html: str) -> str:
-        """Creates a prompt to ask the AI for modification suggestions."""
-        # Use f-string for easier multi-line definition and interpolation
-        prompt = f"""You are a super friendly and patient creative helper, like a fun teacher explaining things to a young child who is excited to build their first webpage! Forget all technical jargon.
+        """
+        Creates a prompt to ask the AI for modification suggestions.
+
+        Raises:
+            PromptBudgetExceeded: The instructions alone are over the suggestion budget.
+        """
+        # The HTML is cut in the middle (keeping its head and the end of its scripts) when over budget
+        instructions = f"""You are a super friendly and patient creative helper, like a fun teacher explaining things to a young child who is excited to build their first webpage! Forget all technical jargon.
 
 Take a look at this HTML code. Now, can you dream up 3-5 cool and simple ideas to make it even more awesome? 
 
@@ -864,19 +1522,24 @@ Example of how to talk (pretend this is for a simple drawing app):
 --- 
 HTML to Analyze:
 ```html
-{current_html}
+"""
+        closing = """
 ```
 
 ---
 Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence each):
 """
-        return prompt
+        sections = [
+            PromptSection("instructions", instructions),
+            PromptSection("current_html", current_html, priority=10, trim="middle"),
+            PromptSection("output_instructions", closing),
+        ]
+        return self._assemble_prompt("suggestion", sections).text
 
     # --- NEW Suggestion Service Method --- 
-    async def suggest_modifications(self, current_html: str) -> List[str]:
+    async def suggest_modifications(self, current_html: str, user_id: Optional[str] = None) -> List[str]:
         """Calls the AI to get modification suggestions for the given HTML."""
         logger.info(f"Requesting modification suggestions for HTML (length: {len(current_html)})...")
-        prompt = self._create_suggestion_prompt(current_html)
         suggestions = []
 
         if not self.client:
@@ -884,21 +1547,13 @@ Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence ea
             return ["Error: AI client not available."]
 
         try:
-            # Use the standard generate_content for a non-streaming response
-            # We'll use the retry wrapper but expect only one result chunk essentially
-            full_response = ""
-            # Use _call_gemini_api directly for non-streaming, parse response
-            # We need the non-async generate_content or adapt _call_gemini_api
-            # Let's adapt _call_gemini_api to handle non-streaming internally or make a sync version?
-            # For now, let's assume _call_gemini_with_retry returns the full string if stream=False (needs change)
-            # OR aggregate the stream here.
-            
-            # Aggregate stream approach:
-            async for chunk in self._call_gemini_with_retry(prompt, max_retries=1): 
-                 if "<!-- ERROR:" in chunk:
-                    logger.error(f"Error signaled during suggestion generation: {chunk}")
-                    raise Exception(f"AI error during suggestion generation: {chunk}")
-                 full_response += chunk
+            prompt = self._create_suggestion_prompt(current_html)
+            # Collected (not streamed) response; slow calls may be hedged with a backup request
+            try:
+                full_response = await self.complete_text(prompt, task="suggestion", user_id=user_id, max_retries=1)
+            except ModelCallError as e:
+                logger.error(f"Error signaled during suggestion generation: {e}")
+                raise Exception(f"AI error during suggestion generation: {e}")
             
             # Ensure the full response is processed *after* the loop finishes
             if not full_response:
@@ -919,6 +1574,8 @@ Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence ea
             logger.info(f"Parsed {len(suggestions)} suggestions.")
             return suggestions
         
+        except ServiceUnavailableError:
+            raise # Reported by the endpoint as 503 + Retry-After
         except Exception as e:
             logger.exception(f"Error getting modification suggestions: {e}")
             return [f"Error generating suggestions: {e}"]
@@ -926,66 +1583,262 @@ Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence ea
     # --- New method for UI generation with files ---
     def _read_prompt_template(self) -> str:
         """Helper to read the main prompt template."""
-        # This path assumes service.py is in backend/components/ and template is in backend/
-        template_path = os.path.join(os.path.dirname(__file__), "..", "gemini_prompt_template_wc.md")
-        try:
-            with open(template_path, "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            logger.error(f"Prompt template file not found at {template_path}")
-            return "<!-- ERROR: Prompt template file not found. Cannot generate UI. -->"
-        except Exception as e:
-            logger.error(f"Error reading prompt template file {template_path}: {e}")
-            return f"<!-- ERROR: Could not read prompt template: {e} -->"
+        return self._template().text
 
     # --- NEW: Security Scanning and Correction ---
     def _scan_for_unsafe_patterns(self, html_content: str) -> List[str]:
-        """Scans HTML content for potentially unsafe patterns."""
-        issues_found = [] 
-        # Regex to find eval\s*\( (eval followed by optional spaces and opening parenthesis)
-        if re.search(r"eval\s*\(", html_content, re.IGNORECASE):
-            issues_found.append("Detected use of 'eval()'.")
-        
-        # Regex to find very long base64 strings (e.g., > 1KB) inside <script> tags
-        # This looks for data:[mime_type];base64,[A-Za-z0-9+/=]{1000,}
-        # It specifically looks for it *within* <script>...</script> blocks
-        script_pattern = r"<script[^>]*>(.*?)</script>"
-        long_base64_pattern = r"data:[a-zA-Z0-9\/\.\+\-]*;base64,([A-Za-z0-9\+\/\=]{1024,})"
-
-        for match in re.finditer(script_pattern, html_content, re.DOTALL | re.IGNORECASE):
-            script_content = match.group(1)
-            if re.search(long_base64_pattern, script_content):
-                issues_found.append("Detected excessively long Base64 string embedded in a script tag. This is often for audio or large data and should be avoided. Use Web Audio API for simple sounds or ensure media is appropriately linked, not embedded in scripts.")
-                # No need to find all instances, one is enough to trigger correction for this type.
-                break
-
-        # Add other security checks here as needed
-        return issues_found
+        """Scans complete HTML content for potentially unsafe patterns (streams are scanned as they arrive)."""
+        return scan_html(html_content, self.security.rules)
 
     def _create_security_correction_prompt(
         self,
         original_full_prompt: str, # The very first prompt from the user to the generation service
         original_html_response: str, # The AI's first unsafe response
-        issues_detected: List[str]
+        issues_detected: List[str],
+        truncated: bool = False # The response was cut off where the first issue was detected
     ) -> str:
-        """Creates a prompt to ask the AI to correct its previous unsafe response."""
+        """
+        Creates a prompt to ask the AI to correct its previous unsafe response.
+
+        Within the correction budget the previous output is cut first, then the original prompt
+        (both in the middle).
+
+        Raises:
+            PromptBudgetExceeded: The guidance and issue list alone are over the correction budget.
+        """
         issues_string = "\n".join([f"- {issue}" for issue in issues_detected])
+        guidance = "".join(f"- {rule.guidance}\n" for rule in self.security.rules if rule.guidance)
         # Construct a new prompt for the AI to correct itself.
         # It's crucial to give it the original request and its problematic response.
-        correction_prompt = (
-            f"Your previous HTML generation attempt had some security/best-practice issues. "
-            f"Please review your previous response and the original user request, then regenerate the HTML, fixing the identified problems.\n\n"
-            f"The following issues were detected in your previous HTML output:\n"
-            f"{issues_string}\n\n"
-            f"Specific guidance for correction:\n"
-            f"- If 'eval()' was used: REMOVE ALL USES OF 'eval()'. If it was for mathematical expressions, you MUST implement a JavaScript function to parse and compute the result (e.g., using shunting-yard or similar, or for very simple cases, `new Function('return ' + expressionString)()` as a last resort). DO NOT simply comment out 'eval'. Rewrite the logic to be safe. Do not mention 'eval' in comments."
-            f"- If an excessively long Base64 string was embedded in a script (often for audio/data): REMOVE the embedded Base64 string. If it was for a simple sound, use the Web Audio API (`AudioContext`) to generate a tone programmatically. For other large data, this embedding method is inappropriate. Do not simply comment it out. Find an alternative, standards-compliant way to achieve the original goal without embedding large data directly in scripts.\n"
-            f"- Adhere STRICTLY to all original formatting and generation rules, especially regarding NO MARKDOWN and PURE HTML output.\n\n"
-            f"Original User Request was:\n---BEGIN ORIGINAL USER REQUEST---\n{original_full_prompt}\n---END ORIGINAL USER REQUEST---\n\n"
-            f"Your Previous (Problematic) HTML Output was:\n---BEGIN PREVIOUS HTML OUTPUT---\n{original_html_response}\n---END PREVIOUS HTML OUTPUT---\n\n"
-            f"Now, provide the new, corrected, FULL HTML output. REMEMBER: PURE HTML ONLY, starting with <!DOCTYPE html> and ending with </html>."
+        # The fixed guidance comes first and the per-request parts last, so corrections share a prefix.
+        sections = [
+            PromptSection("instructions", (
+                f"Your previous HTML generation attempt had some security/best-practice issues. "
+                f"Please review your previous response and the original user request, then regenerate the HTML, fixing the identified problems.\n\n"
+                f"Specific guidance for correction:\n"
+                f"{guidance}"
+                f"- Adhere STRICTLY to all original formatting and generation rules, especially regarding NO MARKDOWN and PURE HTML output.\n\n"
+                f"The following issues were detected in your previous HTML output:\n"
+                f"{issues_string}\n\n"
+                f"Original User Request was:\n---BEGIN ORIGINAL USER REQUEST---\n"
+            )),
+            PromptSection("original_prompt", original_full_prompt, priority=20, trim="middle"),
+            PromptSection("previous_html_header", (
+                f"\n---END ORIGINAL USER REQUEST---\n\n"
+                f"Your Previous (Problematic) HTML Output was{' (cut off where the first issue was detected)' if truncated else ''}:\n---BEGIN PREVIOUS HTML OUTPUT---\n"
+            )),
+            PromptSection("previous_html", original_html_response, priority=10, trim="middle"),
+            PromptSection("output_instructions", (
+                f"\n---END PREVIOUS HTML OUTPUT---\n\n"
+                f"Now, provide the new, corrected, FULL HTML output. REMEMBER: PURE HTML ONLY, starting with <!DOCTYPE html> and ending with </html>."
+            )),
+        ]
+        return self._assemble_prompt("correction", sections).text
+
+    async def _patch_unsafe_scripts(self, html: str, full_correction_prompt: str, task: str, user_id: Optional[str] = None) -> Optional[str]:
+        """
+        Rewrites only the offending script blocks of `html` and splices them back in.
+
+        Args:
+            html: The complete unsafe document.
+            full_correction_prompt: The full-regeneration prompt, used only to report the tokens saved.
+            task: "generation" or "modification" (log wording).
+            user_id: Fairness key for the concurrency limiter.
+
+        Returns:
+            The patched document, or None when a full regeneration is needed instead.
+        """
+        plan = plan_patch(html, self.security.rules)
+        if plan is None:
+            logger.info(f"Security findings in {task} are not confined to script blocks; regenerating in full.")
+            self.security.record_patch(applied=False)
+            return None
+        patch_prompt = plan.prompt()
+        try:
+            # Not hedged: the patch prompt quotes the document around each block, and a backup would re-send it
+            reply = await self.complete_text([patch_prompt], task="correction", user_id=user_id, hedge=False)
+            patched_html = plan.apply(reply)
+        except (ModelCallError, ServiceUnavailableError, PatchError) as e:
+            logger.warning(f"Patch correction ({task}) failed; regenerating in full: {e}")
+            self.security.record_patch(applied=False)
+            return None
+        # Against a full regeneration: its prompt in, the whole corrected document out
+        input_saved = count_tokens(full_correction_prompt) - count_tokens(patch_prompt)
+        output_saved = count_tokens(patched_html) - count_tokens(reply)
+        self.security.record_patch(applied=True, input_tokens_saved=input_saved, output_tokens_saved=output_saved)
+        logger.info(
+            f"Patched {len(plan.blocks)} script block(s) in {task}; saved ~{input_saved} input and ~{output_saved} output tokens "
+            f"against a full regeneration."
         )
-        return correction_prompt
+        return patched_html
+
+    async def _stream_with_security_scan(
+        self,
+        contents: List[Any],
+        static_prefix: Optional[str],
+        original_prompt: Union[str, Callable[[], str]],
+        task: str,
+        user_id: Optional[str] = None,
+        enable_grounding: bool = False,
+        produced_html: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Streams a generation or modification while scanning it, and corrects unsafe output.
+
+        Chunks are scanned as they arrive. In patch mode the stream runs to the end and only
+        the offending script blocks are rewritten and spliced back in; a full regeneration is
+        the fallback. In full mode with early abort enabled, the upstream stream is closed at
+        the first finding (the chunk that completes it is not forwarded) and the regeneration
+        starts right away.
+
+        A patched document is sent whole between the replace markers. A regeneration is
+        streamed as it arrives between MORPHEO_CORRECTION_TENTATIVE_START and a final
+        MORPHEO_CORRECTION_COMMIT (it scanned clean) or MORPHEO_CORRECTION_ROLLBACK (the
+        client restores the content it had before the tentative replacement). When the
+        original stream was cut short, that content is an unterminated document, so the
+        rollback is followed by MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE.
+
+        Args:
+            contents: Per-request contents (the static prefix is passed separately).
+            static_prefix: Template prefix, sent from the upstream context cache when available.
+            original_prompt: Full prompt text, quoted in the correction prompt (or a callable
+                building it, called only when a correction is needed).
+            task: "generation" or "modification" (routing, scheduling and log wording).
+            user_id: Fairness key for the concurrency limiter.
+            enable_grounding: Ground the initial call with Google Search.
+            produced_html: A document already produced (a modification built from edits); it is
+                sent and checked in place of the initial model call.
+        """
+        initial_html_buffer = StreamAccumulator() # Filled with the spliced model response; quoted in the correction prompt
+        scanner = self.security.scanner()
+        aborted = False
+        if produced_html is not None:
+            async def produced() -> AsyncIterator[str]:
+                initial_html_buffer.append(produced_html)
+                yield produced_html
+            stream = produced()
+        else:
+            stream = self._call_gemini_with_retry(
+                contents=contents,
+                static_prefix=static_prefix,
+                enable_grounding=enable_grounding,
+                accumulator=initial_html_buffer,
+                task=task,
+                user_id=user_id,
+            )
+        stream_start = time.perf_counter()
+        try:
+            async for chunk in stream:
+                if "<!-- ERROR:" in chunk:
+                    logger.error(f"Initial {task} failed or returned an error during stream: {chunk}")
+                    yield chunk
+                    logger.error(f"Initial {task} phase ended with an error. Skipping security checks.")
+                    return
+                if scanner.feed(chunk) and self.security.abort_early:
+                    aborted = True
+                    break
+                yield chunk
+            if task == "modification" and produced_html is None and not aborted:
+                # Full rewrites are the baseline for the latency saved by edits
+                self.edit_protocol.record_rewrite(count_tokens(initial_html_buffer.getvalue()), time.perf_counter() - stream_start)
+        except ServiceUnavailableError as e:
+            # Refused before any output; the 200 response has already started, so report it in-stream
+            logger.warning(f"Initial {task} refused: {e}")
+            yield f"<!-- ERROR: {e} -->"
+            return
+        finally:
+            await stream.aclose() # Closes the upstream stream when it was cut short
+            self.security.record_scan(scanner, aborted)
+            if not scanner.findings:
+                initial_html_buffer.close()
+
+        if not scanner.findings:
+            logger.info(f"No security issues detected in initial {task}.")
+            return
+
+        detected_issues = scanner.issues
+        logger.info(
+            f"Unsafe patterns found in {task} at char {scanner.findings[0].offset}: {detected_issues}. "
+            f"{'Upstream stream aborted; correcting now.' if aborted else 'Attempting correction.'}"
+        )
+        yield "<!-- MORPHEO_SECURITY_CORRECTION_START -->"
+        initial_html = initial_html_buffer.getvalue()
+        initial_html_buffer.close()
+        if callable(original_prompt):
+            original_prompt = original_prompt()
+        try:
+            correction_prompt_text = self._create_security_correction_prompt(original_prompt, initial_html, detected_issues, truncated=aborted)
+        except PromptBudgetExceeded as e:
+            logger.error(f"Security correction ({task}) skipped: {e}")
+            self.security.record_correction("failed")
+            yield f"<!-- ERROR: Security correction unavailable: {e} -->"
+            yield "<!-- MORPHEO_SECURITY_CORRECTION_FAILED_AI_ERROR -->"
+            yield "<!-- MORPHEO_SECURITY_CORRECTION_END -->"
+            return
+
+        if self.security.correction_mode == PATCH and not aborted:
+            patched_html = await self._patch_unsafe_scripts(initial_html, correction_prompt_text, task, user_id)
+            if patched_html is not None:
+                self.security.record_correction("succeeded")
+                yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_START -->"
+                yield patched_html
+                yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_END -->"
+                yield "<!-- MORPHEO_SECURITY_CORRECTION_END -->"
+                return
+
+        # The regeneration is streamed live as a tentative replacement, then committed if it
+        # scans clean or rolled back (the client restores the original content) if not
+        correction_scanner = self.security.scanner()
+        correction_failed = False
+        correction_start = time.perf_counter()
+        first_byte_s: Optional[float] = None
+        correction = self._call_gemini_with_retry(
+            contents=[correction_prompt_text], # The correction is text-only; uploaded files are not resent
+            enable_grounding=False, # Grounding usually not needed for correction
+            task="correction",
+            user_id=user_id,
+        )
+        yield "<!-- MORPHEO_CORRECTION_TENTATIVE_START -->"
+        try:
+            async for correction_chunk in correction:
+                if "<!-- ERROR:" in correction_chunk:
+                    correction_failed = True
+                    logger.error(f"Security correction call ({task}) failed or returned an error during stream: {correction_chunk}")
+                    yield correction_chunk # Yield error from correction attempt
+                    break
+                if correction_scanner.feed(correction_chunk):
+                    break # The correction is unsafe too: it will be rolled back, so stop reading and forwarding it
+                if first_byte_s is None:
+                    first_byte_s = time.perf_counter() - correction_start
+                yield correction_chunk
+        except ServiceUnavailableError as e:
+            correction_failed = True
+            logger.warning(f"Security correction call ({task}) refused: {e}")
+            yield f"<!-- ERROR: Security correction unavailable: {e} -->"
+        finally:
+            await correction.aclose()
+
+        if correction_failed:
+            logger.error(f"Correction phase ({task}) failed. Rolling back to the original (potentially unsafe) streamed content.")
+            self.security.record_correction("failed", first_byte_s)
+            yield "<!-- MORPHEO_CORRECTION_ROLLBACK -->"
+            if aborted:
+                yield "<!-- MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE -->"
+            yield "<!-- MORPHEO_SECURITY_CORRECTION_FAILED_AI_ERROR -->"
+        elif not correction_scanner.findings:
+            logger.info(f"Security correction successful ({task}); first corrected byte after {first_byte_s or 0:.2f}s. Committing.")
+            self.security.record_correction("succeeded", first_byte_s)
+            yield "<!-- MORPHEO_CORRECTION_COMMIT -->"
+        else:
+            final_issues_after_correction = correction_scanner.issues
+            logger.warning(f"Security correction attempted ({task}), but issues persist: {final_issues_after_correction}. Rolling back to the original streamed content.")
+            self.security.record_correction("issues_persist", first_byte_s)
+            yield "<!-- MORPHEO_CORRECTION_ROLLBACK -->"
+            if aborted:
+                yield "<!-- MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE -->"
+            yield f"<!-- MORPHEO_SECURITY_WARNING: Automated correction attempted, but issues may persist in the already streamed content: {', '.join(final_issues_after_correction)} -->"
+
+        yield "<!-- MORPHEO_SECURITY_CORRECTION_END -->"
 
     async def generate_ui_from_prompt_and_files(
         self,
@@ -1015,99 +1868,34 @@ Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence ea
             if file_info.get("text_content"):
                 file_obj["text_content"] = file_info["text_content"]
             files_json_array.append(file_obj)
-        files_json_str = json.dumps(files_json_array, indent=2)
-        files_context_string = f"\n\n--- Uploaded Files Information (Context for AI) ---\n// uploaded_files:\n{files_json_str}\n--- End Uploaded Files Information ---\n"
 
-        combined_user_request_with_file_context = f"{text_prompt}\n{files_context_string}"
-
-        main_textual_prompt_part = self._create_full_code_prompt(combined_user_request_with_file_context)
-        gemini_api_contents = [main_textual_prompt_part]
+        # The files block is the first thing trimmed if the prompt is over the generation budget
+        template = self._template_for(text_prompt, files_json_array)
+        try:
+            assembled = self._build_full_code_prompt(text_prompt, template, files_section=self._uploaded_files_section(files_json_array, trailing_newline=False))
+            self._record_template(template, "generation")
+        except PromptBudgetExceeded as e:
+            logger.warning(str(e))
+            yield f"<!-- ERROR: {e} -->"
+            return
+        main_textual_prompt_part = assembled.text
+        # The template prefix is sent separately (from the upstream context cache when available)
+        gemini_api_contents = [assembled.suffix]
         if gemini_file_objects:
             for sdk_file_obj in gemini_file_objects:
                 gemini_api_contents.append(sdk_file_obj)
         logger.info(f"Constructed Gemini API contents for initial generation. Main text part length: {len(main_textual_prompt_part)}, Number of SDK file objects: {len(gemini_file_objects)}")
 
-        # --- MODIFIED FOR STREAMING BEFORE SECURITY SCAN ---
-        full_initial_html_for_scan = ""
-        initial_generation_failed = False
-
-        # Phase 1: Stream the initial generation and accumulate for scan
-        logger.info("Phase 1: Streaming initial generation and accumulating for security scan.")
-        # yield "<!-- MORPHEO_INITIAL_STREAM_START -->" # Frontend may not need this if it starts on first chunk
-
-        async for chunk in self._call_gemini_with_retry(
+        # Streamed with an incremental security scan; unsafe output is cut short and corrected
+        async for chunk in self._stream_with_security_scan(
             contents=gemini_api_contents,
-            enable_grounding=enable_grounding
+            static_prefix=assembled.prefix,
+            original_prompt=main_textual_prompt_part,
+            task="generation",
+            user_id=getattr(user, 'username', None),
+            enable_grounding=enable_grounding,
         ):
-            if "<!-- ERROR:" in chunk:
-                initial_generation_failed = True
-                logger.error(f"Initial generation failed or returned an error during stream: {chunk}")
-                full_initial_html_for_scan += chunk 
-                yield chunk 
-                break 
-
-            full_initial_html_for_scan += chunk
-            yield chunk 
-            # The asyncio.sleep(0) is already in _call_gemini_api for its sub-chunks.
-            # Adding another one here might be redundant or slightly alter pacing.
-            # Let's rely on the sleeps in _call_gemini_api.
-
-        # yield "<!-- MORPHEO_INITIAL_STREAM_END -->" # Frontend can detect stream end by server closing connection
-
-        if initial_generation_failed:
-            logger.error("Initial generation phase ended with an error. Skipping security checks.")
-            return
-
-        # Phase 2: Security Scan and Correction (if needed) - This part sends signals *after* initial stream.
-        logger.info("Phase 2: Performing security scan on accumulated initial HTML.")
-        detected_issues = self._scan_for_unsafe_patterns(full_initial_html_for_scan)
-        
-        if detected_issues:
-            logger.info(f"Unsafe patterns found. Issues: {detected_issues}. Attempting correction.")
-            yield "<!-- MORPHEO_SECURITY_CORRECTION_START -->"
-            
-            corrected_html_accumulator = ""
-            correction_prompt_text = self._create_security_correction_prompt(main_textual_prompt_part, full_initial_html_for_scan, detected_issues)
-            correction_api_contents = [correction_prompt_text]
-
-            correction_failed = False
-            async for correction_chunk in self._call_gemini_with_retry(
-                contents=correction_api_contents,
-                enable_grounding=False
-            ):
-                if "<!-- ERROR:" in correction_chunk:
-                    correction_failed = True
-                    logger.error(f"Security correction call failed or returned an error during stream: {correction_chunk}")
-                    # corrected_html_accumulator += correction_chunk # Don't accumulate error if we're not sending it
-                    yield correction_chunk # Yield error from correction attempt
-                    break
-                corrected_html_accumulator += correction_chunk
-            
-            if correction_failed:
-                logger.error("Correction phase failed. Original (potentially unsafe) streamed content remains on client.")
-                yield "<!-- MORPHEO_SECURITY_CORRECTION_FAILED_AI_ERROR -->"
-            else:
-                final_issues_after_correction = self._scan_for_unsafe_patterns(corrected_html_accumulator)
-                if not final_issues_after_correction:
-                    logger.info("Security correction successful. No unsafe patterns found in corrected code.")
-                    # Signal frontend to replace its content.
-                    yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_START -->"
-                    corrected_chunk_size = 128 
-                    for i in range(0, len(corrected_html_accumulator), corrected_chunk_size):
-                        yield corrected_html_accumulator[i:i+corrected_chunk_size]
-                        await asyncio.sleep(0) # Ensure chunks are flushed for the replacement stream
-                    yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_END -->"
-                else:
-                    logger.warning(f"Security correction attempted, but issues persist: {final_issues_after_correction}. Original streamed content remains on client.")
-                    warning_message = f"<!-- MORPHEO_SECURITY_WARNING: Automated correction attempted, but issues may persist in the already streamed content: {', '.join(final_issues_after_correction)} -->"
-                    yield warning_message
-            
-            yield "<!-- MORPHEO_SECURITY_CORRECTION_END -->"
-        else:
-            logger.info("No security issues detected in initial generation.")
-            # Optionally send: yield "<!-- MORPHEO_SECURITY_CHECKS_PASSED -->"
-
-        # --- END MODIFICATION FOR STREAMING BEFORE SECURITY SCAN ---
+            yield chunk
 
     async def modify_ui_from_prompt_and_files(
         self,
@@ -1123,147 +1911,84 @@ Your Super Simple and Fun Ideas (Numbered List Only, tiny words, one sentence ea
         logger.info(f"Number of uploaded_files_info entries: {len(uploaded_files_info)}")
         logger.info(f"Number of Gemini SDK file objects passed: {len(gemini_file_objects)}")
 
-        # Prepare file information string for the prompt context
-        uploaded_files_summary = "// uploaded_files:\n"
-        if uploaded_files_info:
-             try:
-                 file_info_json = json.dumps(uploaded_files_info, indent=2)
-                 uploaded_files_summary += file_info_json
-             except Exception as e:
-                 logger.error(f"Error converting file info to JSON: {e}")
-                 uploaded_files_summary += "[Error processing file details]"
-        else:
-             uploaded_files_summary += "[]"
-
         # --- MODIFICATION START ---
-        # Combine the user's modification prompt with the file context
-        combined_modification_request = f"{modification_prompt}\n\n--- Uploaded Files Information (Context for AI) ---\n{uploaded_files_summary}\n--- End Uploaded Files Information ---"
+        # The user's modification prompt is followed by the file context (trimmed first if over budget)
+        files_section = self._uploaded_files_section(uploaded_files_info or [], trailing_newline=False)
+        user_id = getattr(user, 'username', None)
+        use_edits = self.edit_protocol.enabled
+        edited_html: Optional[str] = None
+        # One template for the request, recorded once although the prompt may be built up to three times
+        template = self._template_for(modification_prompt, uploaded_files_info, current_html)
+        self._record_template(template, "modification")
+
+        def full_rewrite_prompt() -> AssembledPrompt:
+            return self._build_modification_prompt(
+                modification_request=modification_prompt,
+                current_html=current_html,
+                files_section=files_section,
+                uploaded_files=uploaded_files_info,
+                template=template,
+            )
 
-        # Use the correct prompt creation method for modifications
-        full_prompt_text = self._create_modification_prompt(
-            modification_request=combined_modification_request, # Pass the combined text
-            current_html=current_html
-        )
+        try:
+            if use_edits:
+                # Edit instructions are longer than the full-rewrite ones, so if this prompt fits, so does the full one
+                edit_prompt = self._build_modification_prompt(
+                    modification_request=modification_prompt,
+                    current_html=current_html,
+                    files_section=files_section,
+                    uploaded_files=uploaded_files_info,
+                    edits=True,
+                    template=template,
+                )
+                edited_html = await self._modify_with_edits(edit_prompt, current_html, gemini_file_objects, enable_grounding, user_id)
+            assembled = full_rewrite_prompt() if edited_html is None else None
+        except PromptBudgetExceeded as e:
+            logger.warning(str(e))
+            yield f"<!-- ERROR: {e} -->"
+            return
+        except ServiceUnavailableError as e:
+            logger.warning(f"Modification refused: {e}")
+            yield f"<!-- ERROR: {e} -->"
+            return
         # --- MODIFICATION END ---
 
-        # Prepare the 'contents' list for the Gemini API call
-        contents_for_api: List[Union[str, Any]] = [full_prompt_text]
+        if assembled is None:
+            # The edited document is checked like a streamed one; a correction regenerates the
+            # whole file, so it quotes the full-rewrite prompt (built only if a correction runs)
+            async for chunk in self._stream_with_security_scan(
+                contents=[],
+                static_prefix=None,
+                original_prompt=lambda: full_rewrite_prompt().text,
+                task="modification",
+                user_id=user_id,
+                produced_html=edited_html,
+            ):
+                yield chunk
+            logger.info("Finished yielding edited modification (with potential security correction).")
+            return
+
+        # Prepare the 'contents' list for the Gemini API call; the static prefix (base rules and
+        # modification instructions) is sent separately, from the upstream context cache when available
+        full_prompt_text = assembled.text
+        contents_for_api: List[Union[str, Any]] = [assembled.suffix]
         if gemini_file_objects:
             contents_for_api.extend(gemini_file_objects)
         
         logger.info(f"Constructed Gemini API contents for modification. Main text part length: {len(full_prompt_text)}, Number of SDK file objects: {len(gemini_file_objects)}")
 
-        # --- MODIFIED FOR SECURITY SCAN AND CORRECTION (mirroring generation flow) ---
-        full_initial_modified_html_for_scan = ""
-        initial_modification_failed = False
-
-        # Phase 1: Stream the initial modification and accumulate for scan
-        logger.info("Phase 1 (Modification): Streaming initial modification and accumulating for security scan.")
-        
-        async for chunk in self._call_gemini_with_retry(
+        # Same incremental scan and correction as the generation flow
+        async for chunk in self._stream_with_security_scan(
             contents=contents_for_api,
-            enable_grounding=enable_grounding
+            static_prefix=assembled.prefix,
+            original_prompt=full_prompt_text,
+            task="modification",
+            user_id=user_id,
+            enable_grounding=enable_grounding,
         ):
-            if "<!-- ERROR:" in chunk:
-                initial_modification_failed = True
-                logger.error(f"Initial modification failed or returned an error during stream: {chunk}")
-                full_initial_modified_html_for_scan += chunk
-                yield chunk
-                break
-            
-            full_initial_modified_html_for_scan += chunk
             yield chunk
-            # asyncio.sleep(0) is in _call_gemini_api
-
-        if initial_modification_failed:
-            logger.error("Initial modification phase ended with an error. Skipping security checks.")
-            return
-
-        # Phase 2: Security Scan and Correction (if needed)
-        logger.info("Phase 2 (Modification): Performing security scan on accumulated initial modified HTML.")
-        detected_issues = self._scan_for_unsafe_patterns(full_initial_modified_html_for_scan)
-
-        if detected_issues:
-            logger.info(f"Unsafe patterns found in modification. Issues: {detected_issues}. Attempting correction.")
-            yield "<!-- MORPHEO_SECURITY_CORRECTION_START -->"
-            
-            corrected_html_accumulator = ""
-            # Use the same correction prompt creation logic
-            correction_prompt_text = self._create_security_correction_prompt(main_textual_prompt_part, full_initial_modified_html_for_scan, detected_issues)
-            # For modifications, the correction is just text-based, no extra files needed.
-            correction_api_contents = [correction_prompt_text] 
-
-            correction_failed = False
-            async for correction_chunk in self._call_gemini_with_retry(
-                contents=correction_api_contents, # Pass the simple list with correction prompt
-                enable_grounding=False # Grounding usually not needed for correction
-            ):
-                if "<!-- ERROR:" in correction_chunk:
-                    correction_failed = True
-                    logger.error(f"Security correction call (for modification) failed or returned an error: {correction_chunk}")
-                    yield correction_chunk 
-                    break
-                corrected_html_accumulator += correction_chunk
-            
-            if correction_failed:
-                logger.error("Correction phase (for modification) failed. Original (potentially unsafe) streamed modification remains.")
-                yield "<!-- MORPHEO_SECURITY_CORRECTION_FAILED_AI_ERROR -->"
-            else:
-                final_issues_after_correction = self._scan_for_unsafe_patterns(corrected_html_accumulator)
-                if not final_issues_after_correction:
-                    logger.info("Security correction successful for modification.")
-                    yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_START -->"
-                    corrected_chunk_size = 128
-                    for i in range(0, len(corrected_html_accumulator), corrected_chunk_size):
-                        yield corrected_html_accumulator[i:i+corrected_chunk_size]
-                        await asyncio.sleep(0) 
-                    yield "<!-- MORPHEO_REPLACE_WITH_CORRECTED_END -->"
-                else:
-                    logger.warning(f"Security correction attempted for modification, but issues persist: {final_issues_after_correction}.")
-                    warning_message = f"<!-- MORPHEO_SECURITY_WARNING: Automated correction attempted for modification, but issues may persist: {', '.join(final_issues_after_correction)} -->"
-                    yield warning_message
-            
-            yield "<!-- MORPHEO_SECURITY_CORRECTION_END -->"
-        else:
-            logger.info("No security issues detected in initial modification.")
-            # Optionally: yield "<!-- MORPHEO_SECURITY_CHECKS_PASSED_MODIFICATION -->"
-        
         logger.info("Finished yielding modification chunks (with potential security correction).")
-        # --- END SECURITY SCAN AND CORRECTION FOR MODIFICATION ---
-
-def ensure_prompt_template_exists(template_path: str, fallback_content: str):
-    """Checks if a prompt template file exists, creates it with fallback content if not."""
-    if not os.path.exists(template_path):
-        logger.warning(f"Prompt template not found at {template_path}. Creating with basic fallback content.")
-        try:
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(template_path), exist_ok=True)
-            with open(template_path, "w", encoding="utf-8") as f:
-                f.write(fallback_content)
-            logger.info(f"Successfully created prompt template: {template_path}")
-        except Exception as e:
-            logger.error(f"Failed to create prompt template file at {template_path}: {e}")
 
 # Ensure the new Web Component prompt template exists on startup
-wc_template_fallback = (
-    "You are an expert AI assistant specializing in modern, accessible web development using standard technologies.\n"
-    "\n"
-    "Generate a COMPLETE, runnable, self-contained HTML file (.html) that fulfills the user request below.\n"
-    "\n"
-    "ABSOLUTE REQUIREMENTS:\n"
-    "\n"
-    "0.  **No Placeholders or Excuses:** Attempt the full implementation. Do NOT output placeholder UIs or messages stating the task is too complex.\n"
-    "1.  **DOCTYPE & HTML Structure:** Start with `<!DOCTYPE html>` and include `<html>`, `<head>`, and `<body>` tags.\n"
-    "2.  **Styling:** Use standard CSS within `<style>` tags in the `<head>`. \n"
-    "    Optionally, you can use Tailwind CSS classes IF you include the Tailwind CDN script in the `<head>`: `<script src=\"https://cdn.tailwindcss.com\"></script>`. \n"
-    "    Prioritize clean, responsive design.\n"
-    "3.  **Structure & Interactivity:** Use standard HTML elements. For reusable UI parts and complex logic, DEFINE and USE **Standard Web Components** (using `customElements.define`, `<template>`, and vanilla JavaScript classes extending `HTMLElement`).\n"
-    "4.  **JavaScript:** Prioritize vanilla JS within `<script>` tags for basic interactivity. \n"
-    "    - Use standard DOM APIs (`getElementById`, `querySelector`, `addEventListener`, etc.).\n"
-    "    - **External Libraries:** For complex features (e.g., 3D graphics, advanced charting), you **MUST** actively use well-known external JavaScript libraries. **Use Import Maps** in the `<head>` when using ES Module libraries (like Three.js). Define the library (e.g., `\"three\"`) and addon paths (e.g., `\"three/addons/\"`) mapping to reliable CDN URLs (e.g., from cdnjs, jsdelivr, using `.module.js` files). Remove the `<script src=...>` tags for mapped libraries. In your `<script type=\"module\">`, use `import * as THREE from 'three';` and `import { OrbitControls } from 'three/addons/controls/OrbitControls.js';`. You **MUST** use libraries for complex tasks where vanilla JS is impractical. \n"
-    "5.  **Self-Contained:** The final output MUST be a SINGLE HTML file. No external CSS files (other than Tailwind CDN). External JavaScript libraries are permissible if included via CDN `<script>` tags or referenced via Import Maps. \n"
-    "6.  **Output Format:** Return ONLY the raw HTML code. NO markdown formatting (like ```html ... ```), explanations, or comments outside the code itself.\n"
-    "7.  **Print Optimization:** Include print-specific CSS rules (`@media print`) to optimize the layout for printing or saving as PDF. Hide non-essential interactive elements (like buttons, input forms), ensure content fits standard paper sizes (like A4/Letter) with appropriate margins, use high-contrast text (e.g., black text on a white background regardless of screen theme), and manage page breaks appropriately (`page-break-before`, `page-break-after`, `page-break-inside: avoid`) for long content.\n"
-)
 wc_template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gemini_prompt_template_wc.md')
-ensure_prompt_template_exists(wc_template_path, wc_template_fallback)
\ No newline at end of file
+ensure_prompt_template_exists(wc_template_path, WC_TEMPLATE_FALLBACK)
\ No newline at end of file
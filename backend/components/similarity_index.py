@@ -0,0 +1,360 @@
+"""
+Prompt Similarity Index
+
+This module provides a local near-duplicate index over past successful generations, so a
+paraphrased request ("make me a calculator" / "a simple calculator app") can be answered
+from the generation cache without calling the model.
+
+Requests are represented by MinHash signatures over character n-grams of the normalized
+prompt and bucketed with LSH banding. A lookup hashes the query once, collects candidates
+from its band buckets and scores them with a single vectorized NumPy comparison, which
+keeps lookups under a millisecond at 100k entries (about 0.6 ms on a clustered vocabulary,
+where many prompts share buckets and every bucket scan hits its bound). The index stores only signatures
+and generation cache keys; the HTML itself stays in the generation cache.
+
+N-gram similarity cannot tell "25 minute sessions" from "50 minute sessions" (they score
+above 0.9), so serving a match as the answer is off by default: near-duplicates are only
+offered as previews. When a serve threshold is configured, a match is also served only if
+both requests contain exactly the same numbers.
+
+The index holds at most `max_entries` requests; the oldest are evicted first. Removed and
+evicted rows are reclaimed by compacting the arrays and buckets once dead rows outnumber
+live ones. The service removes entries the generation cache evicts or invalidates.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .generation_cache import normalize_request
+
+logger = logging.getLogger(__name__)
+
+_PRIME = np.uint64((1 << 31) - 1)
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def _numbers(text: str) -> List[str]:
+    return sorted(_NUMBER.findall(normalize_request(text)))
+
+
+@dataclass
+class SimilarMatch:
+    """Best index match for a query."""
+    key: str            # Generation cache key of the matched request
+    request: str        # The matched (original) user request
+    similarity: float   # Estimated Jaccard similarity of the n-gram sets
+
+
+class MinHasher:
+    """Computes MinHash signatures over character n-grams."""
+
+    def __init__(self, num_perm: int = 64, ngram: int = 3, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.ngram = ngram
+        self._a = rng.integers(1, int(_PRIME), num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        padded = f" {normalize_request(text)} "
+        n = self.ngram
+        grams = {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+        return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, text: str) -> np.ndarray:
+        x = self.shingles(text)
+        # (a*x + b) mod p; a < 2^31 and x < 2^32 so the product fits in uint64
+        hashed = (np.multiply.outer(x, self._a) + self._b) % _PRIME
+        return hashed.min(axis=0).astype(np.uint32)
+
+
+class SimilarityIndex:
+    """
+    MinHash/LSH index of past generation requests.
+
+    Entries are partitioned by `scope` (prompt template hash and model), so a match is
+    only ever served for the same template and model it was generated with.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 64,
+        bands: int = 16,
+        ngram: int = 3,
+        serve_threshold: Optional[float] = None,
+        preview_threshold: float = 0.6,
+        max_bucket_scan: int = 128,
+        enabled: bool = True,
+        max_entries: int = 100_000,
+    ):
+        """
+        Args:
+            num_perm: Signature length (must be divisible by `bands`).
+            bands: LSH bands; with 64/16 the candidate threshold is roughly 0.5 similarity.
+            ngram: Character n-gram size.
+            serve_threshold: Similarity at which a cached result is served as the answer
+                (None: near-duplicates are never served, only previewed).
+            preview_threshold: Similarity at which a cached result is offered as a preview.
+            max_bucket_scan: Most recent rows scored per bucket; bounds lookups when many
+                near-identical prompts pile into the same buckets.
+            enabled: When False lookups always miss and nothing is indexed.
+            max_entries: Most requests indexed; adding one more evicts the oldest.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.hasher = MinHasher(num_perm, ngram)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.serve_threshold = serve_threshold
+        self.preview_threshold = preview_threshold
+        self.max_bucket_scan = max_bucket_scan
+        self.enabled = enabled
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._size = 0
+        self._oldest = 0  # First row that may still be alive
+        self._keys: List[str] = []
+        self._requests: List[str] = []
+        self._scopes: List[str] = []
+        self._rows_by_key: Dict[str, int] = {}
+        self._buckets: List[Dict[Tuple[str, bytes], List[int]]] = [{} for _ in range(bands)]
+
+        self.lookups = 0
+        self.matches = 0
+        self.serve_refused = 0
+        self.evictions = 0
+        self.compactions = 0
+
+    def __len__(self) -> int:
+        return len(self._rows_by_key)
+
+    # --- Indexing ---
+
+    def add(self, request: str, key: str, scope: str = "") -> bool:
+        """
+        Indexes a successful generation.
+
+        Returns:
+            False if `key` was already indexed (or the index is disabled).
+        """
+        if not self.enabled or not request:
+            return False
+        signature = self.hasher.signature(request)
+        with self._lock:
+            if key in self._rows_by_key:
+                return False
+            while len(self._rows_by_key) >= self.max_entries > 0:
+                self._evict_oldest()
+            if self._size == len(self._signatures) and self._size - len(self._rows_by_key) > len(self._rows_by_key):
+                self._compact()
+            row = self._size
+            if row == len(self._signatures):
+                self._signatures = np.concatenate([self._signatures, np.zeros_like(self._signatures)])
+                self._alive = np.concatenate([self._alive, np.zeros_like(self._alive)])
+            self._signatures[row] = signature
+            self._alive[row] = True
+            self._size += 1
+            self._keys.append(key)
+            self._requests.append(request)
+            self._scopes.append(scope)
+            self._rows_by_key[key] = row
+            for band, bucket_key in enumerate(self._band_keys(signature, scope)):
+                self._buckets[band].setdefault(bucket_key, []).append(row)
+        return True
+
+    def remove(self, key: str) -> None:
+        """Stops matching `key` (e.g. its cache entry expired)."""
+        with self._lock:
+            row = self._rows_by_key.pop(key, None)
+            if row is not None:
+                self._alive[row] = False
+                if self._size - len(self._rows_by_key) > max(len(self._rows_by_key), 1024):
+                    self._compact()
+
+    def _evict_oldest(self) -> None:
+        """Drops the oldest live entry. Call with the lock held."""
+        while not self._alive[self._oldest]:
+            self._oldest += 1
+        self._alive[self._oldest] = False
+        del self._rows_by_key[self._keys[self._oldest]]
+        self.evictions += 1
+
+    def _compact(self) -> None:
+        """Rebuilds the arrays and buckets from the live rows (oldest first). Call with the lock held."""
+        live = np.flatnonzero(self._alive[:self._size])
+        capacity = max(1024, len(live) * 2)
+        signatures = np.zeros((capacity, self.hasher.num_perm), dtype=np.uint32)
+        signatures[:len(live)] = self._signatures[live]
+        self._signatures = signatures
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._alive[:len(live)] = True
+        self._keys = [self._keys[row] for row in live]
+        self._requests = [self._requests[row] for row in live]
+        self._scopes = [self._scopes[row] for row in live]
+        self._size = len(live)
+        self._oldest = 0
+        self._rows_by_key = {key: row for row, key in enumerate(self._keys)}
+        self._buckets = [{} for _ in range(self.bands)]
+        for row in range(self._size):
+            for band, bucket_key in enumerate(self._band_keys(self._signatures[row], self._scopes[row])):
+                self._buckets[band].setdefault(bucket_key, []).append(row)
+        self.compactions += 1
+
+    # --- Lookup ---
+
+    def query(self, request: str, scope: str = "", min_similarity: float = 0.0) -> Optional[SimilarMatch]:
+        """
+        Returns the most similar indexed request in `scope`, if it reaches `min_similarity`.
+        """
+        if not self.enabled or not self._rows_by_key:
+            return None
+        signature = self.hasher.signature(request)
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band, bucket_key in enumerate(self._band_keys(signature, scope)):
+                rows = self._buckets[band].get(bucket_key)
+                if rows:
+                    candidates.update(rows[-self.max_bucket_scan:] if len(rows) > self.max_bucket_scan else rows)
+            if not candidates:
+                return None
+            rows = np.array(list(candidates), dtype=np.int64)
+            rows = rows[self._alive[rows]]
+            if not len(rows):
+                return None
+            agreements = np.count_nonzero(self._signatures[rows] == signature, axis=1)
+            best = int(np.argmax(agreements))
+            similarity = float(agreements[best]) / self.hasher.num_perm
+            if similarity < min_similarity:
+                return None
+            row = int(rows[best])
+            self.matches += 1
+            return SimilarMatch(key=self._keys[row], request=self._requests[row], similarity=similarity)
+
+    def servable(self, request: str, scope: str = "") -> Optional[SimilarMatch]:
+        """
+        Returns a match close enough to serve as the answer to `request`: at the serve threshold
+        and with exactly the same numbers. None when serving is disabled.
+        """
+        if self.serve_threshold is None:
+            return None
+        match = self.query(request, scope, min_similarity=self.serve_threshold)
+        if match is not None and _numbers(match.request) != _numbers(request):
+            with self._lock:
+                self.serve_refused += 1
+            return None
+        return match
+
+    def snapshot(self) -> Dict[str, object]:
+        """Counters for /api/metrics."""
+        return {
+            "enabled": self.enabled,
+            "entries": len(self),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "serve_refused": self.serve_refused,
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "compactions": self.compactions,
+            "serve_threshold": self.serve_threshold,
+            "preview_threshold": self.preview_threshold,
+        }
+
+    # --- Bootstrap ---
+
+    def load_generation_log(self, path: str) -> int:
+        """
+        Indexes successful, cacheable generations recorded in a generation log (JSONL),
+        including its rotated backups (path.1, path.2, ...).
+
+        Returns:
+            The number of entries added.
+        """
+        added = 0
+        for log_path in _with_backups(path):
+            try:
+                with open(log_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        entry = _parse(line)
+                        if not entry or entry.get("status") != "Success" or entry.get("grounding"):
+                            continue
+                        if entry.get("cache") != "miss" or not entry.get("cache_key"):
+                            continue
+                        scope = similarity_scope(entry.get("template_hash", ""), entry.get("model", ""))
+                        if self.add(entry.get("user_request", ""), entry["cache_key"], scope):
+                            added += 1
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Could not read generation log {log_path} for the similarity index: {e}")
+        if added:
+            logger.info(f"Similarity index bootstrapped with {added} generations from {path}.")
+        return added
+
+    def bootstrap_in_background(self, path: str) -> Optional[threading.Thread]:
+        """Runs `load_generation_log()` on a daemon thread so startup is not delayed."""
+        if not self.enabled:
+            return None
+        thread = threading.Thread(target=self.load_generation_log, args=(path,), name="similarity-bootstrap", daemon=True)
+        thread.start()
+        return thread
+
+    def _band_keys(self, signature: np.ndarray, scope: str) -> Iterable[Tuple[str, bytes]]:
+        rows = self.rows
+        for band in range(self.bands):
+            yield scope, signature[band * rows:(band + 1) * rows].tobytes()
+
+
+def similarity_scope(template_digest: str, model: str) -> str:
+    """Partition key for index entries: a match is only valid for the same template and model."""
+    return f"{template_digest}:{model}"
+
+
+def _with_backups(path: str) -> List[str]:
+    paths = [path]
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        paths.append(f"{path}.{index}")
+        index += 1
+    return list(reversed(paths))  # Oldest first
+
+
+def _parse(line: str) -> Optional[dict]:
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def create_similarity_index() -> SimilarityIndex:
+    """
+    Builds the index from the environment: MORPHEO_SIMILARITY_ENABLED,
+    MORPHEO_SIMILARITY_SERVE_THRESHOLD (unset or empty: previews only),
+    MORPHEO_SIMILARITY_PREVIEW_THRESHOLD, MORPHEO_SIMILARITY_MAX_ENTRIES.
+    """
+    enabled = os.getenv("MORPHEO_SIMILARITY_ENABLED", "true").lower() in ("1", "true", "yes")
+    try:
+        serve_value = os.getenv("MORPHEO_SIMILARITY_SERVE_THRESHOLD", "").strip()
+        serve_threshold = float(serve_value) if serve_value else None
+        preview_threshold = float(os.getenv("MORPHEO_SIMILARITY_PREVIEW_THRESHOLD", 0.6))
+    except ValueError:
+        logger.warning("Invalid MORPHEO_SIMILARITY_* threshold; using defaults.")
+        serve_threshold, preview_threshold = None, 0.6
+    try:
+        max_entries = int(os.getenv("MORPHEO_SIMILARITY_MAX_ENTRIES", 100_000))
+    except ValueError:
+        logger.warning("Invalid MORPHEO_SIMILARITY_MAX_ENTRIES; using 100000.")
+        max_entries = 100_000
+    return SimilarityIndex(serve_threshold=serve_threshold, preview_threshold=preview_threshold, enabled=enabled, max_entries=max_entries)
@@ -0,0 +1,134 @@
+"""
+Single-Flight Stream Coalescing
+
+This module lets identical in-flight model requests share one upstream stream. The first
+caller for a request fingerprint starts a driver task that pulls the upstream stream into
+a replay buffer; every caller (including the first) is a subscriber that reads that buffer
+from chunk 0 at its own pace. A subscriber leaving only detaches that subscriber; the
+upstream call is cancelled when the last subscriber is gone.
+
+Finished flights are forgotten immediately, so this only merges requests that overlap in
+time (completed results are the generation cache's job).
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """One shared upstream stream and its replay buffer."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self) -> None:
+        """Wakes every subscriber waiting for new chunks."""
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self) -> None:
+        await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent streams that share a key.
+
+    Args:
+        name: Label used in logs and metrics.
+    """
+
+    def __init__(self, name: str = "single-flight"):
+        self.name = name
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Yields the chunks of the stream identified by `key`.
+
+        Args:
+            key: Request fingerprint; callers with equal keys share one upstream stream.
+            factory: Creates the upstream stream. Only called by the first caller for `key`.
+
+        Yields:
+            Every chunk of the shared stream, starting from the first one.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(key)
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._drive(flight, factory()))
+            self.leaders += 1
+        else:
+            self.followers += 1
+            logger.info(f"{self.name}: attached subscriber {flight.subscribers + 1} to in-flight stream {key[:12]}")
+        flight.subscribers += 1
+
+        position = 0
+        try:
+            while True:
+                if position < len(flight.chunks):
+                    chunk = flight.chunks[position]
+                    position += 1
+                    yield chunk
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                logger.info(f"{self.name}: last subscriber left stream {key[:12]}; cancelling upstream call")
+                self.cancelled += 1
+                self._forget(flight)
+                flight.task.cancel()
+
+    async def _drive(self, flight: _Flight, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                flight.chunks.append(chunk)
+                flight.publish()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(flight)
+            flight.publish()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+
+    def _forget(self, flight: _Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def snapshot(self) -> Dict[str, int]:
+        """Counters for /api/metrics."""
+        return {
+            "in_flight": self.in_flight(),
+            "leaders": self.leaders,
+            "coalesced": self.followers,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,113 @@
+"""
+Stream Accumulator
+
+This module provides StreamAccumulator, the single buffer in which a model stream is
+collected. One accumulator is created per request and shared by everything that needs
+the streamed text (request logging, generation logging, security scanning, endpoint
+responses), replacing repeated `full_response += chunk` copies.
+
+Appends are amortized O(1): text is written to an io buffer that spills to a temp file
+once it grows past a threshold. Prefix and tail views are kept separately so log
+previews never materialize the whole response.
+"""
+
+import collections
+import logging
+import os
+import tempfile
+from typing import Deque, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPILL_BYTES = int(os.getenv("MORPHEO_STREAM_SPILL_BYTES", 2 * 1024 * 1024))
+DEFAULT_VIEW_CHARS = 4096
+
+
+class StreamAccumulator:
+    """
+    Append-only text buffer for one model stream.
+
+    Args:
+        spill_bytes: Size after which the buffer moves from memory to a temp file.
+        view_chars: Characters retained for the cheap head()/tail() views.
+    """
+
+    def __init__(self, spill_bytes: int = DEFAULT_SPILL_BYTES, view_chars: int = DEFAULT_VIEW_CHARS):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spill_bytes, mode="w+b")
+        self._view_chars = view_chars
+        self._head_parts = []
+        self._head_len = 0
+        self._tail: Deque[str] = collections.deque()
+        self._tail_len = 0
+        self._length = 0
+        self._cached: Optional[str] = None
+        self.chunks = 0
+
+    def append(self, chunk: str) -> None:
+        """Adds a chunk to the end of the buffer."""
+        if not chunk:
+            return
+        self._file.write(chunk.encode("utf-8"))
+        self._length += len(chunk)
+        self.chunks += 1
+        self._cached = None
+
+        if self._head_len < self._view_chars:
+            piece = chunk[: self._view_chars - self._head_len]
+            self._head_parts.append(piece)
+            self._head_len += len(piece)
+
+        self._tail.append(chunk)
+        self._tail_len += len(chunk)
+        while self._tail and self._tail_len - len(self._tail[0]) >= self._view_chars:
+            self._tail_len -= len(self._tail.popleft())
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def __repr__(self) -> str:
+        return f"<StreamAccumulator chars={self._length} chunks={self.chunks} spilled={self.spilled}>"
+
+    @property
+    def spilled(self) -> bool:
+        """True once the buffer has moved to a temp file on disk."""
+        return bool(getattr(self._file, "_rolled", False))
+
+    def head(self, n: int) -> str:
+        """First `n` characters (free for n <= view_chars)."""
+        if n <= self._head_len:
+            return "".join(self._head_parts)[:n]
+        return self.getvalue()[:n]
+
+    def tail(self, n: int) -> str:
+        """Last `n` characters (free for n <= view_chars)."""
+        if n <= self._tail_len:
+            return "".join(self._tail)[-n:] if n else ""
+        return self.getvalue()[-n:] if n else ""
+
+    def preview(self, n: int = 200, ellipsis: str = "...") -> str:
+        """Log-friendly prefix: the first `n` characters followed by `ellipsis` if there is more."""
+        return self.head(n) + (ellipsis if self._length > n else "")
+
+    def getvalue(self) -> str:
+        """The full accumulated text. The result is cached until the next append."""
+        if self._cached is None:
+            position = self._file.tell()
+            self._file.seek(0)
+            self._cached = self._file.read().decode("utf-8")
+            self._file.seek(position)
+        return self._cached
+
+    def close(self) -> None:
+        """Releases the underlying buffer (and temp file, if spilled)."""
+        self._cached = None
+        self._file.close()
+
+    def __enter__(self) -> "StreamAccumulator":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,191 @@
+"""
+Stream Shaper
+
+This module sits between ComponentService's chunk generators and FastAPI's
+StreamingResponse. It coalesces small upstream chunks into larger writes, bounded
+by a byte budget and a flush deadline ("flush every 20ms or 4KB"), and reads the
+upstream through a bounded buffer so a slow client applies backpressure to the
+model stream instead of growing memory.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    """When to flush coalesced output to the client."""
+    max_bytes: int = 4096           # Flush once this many characters (~bytes) are buffered
+    max_delay_ms: float = 20.0      # ...or once the oldest buffered chunk is this old
+    max_buffered_chunks: int = 64   # Upstream chunks held before the producer is paused
+    flush_first: bool = True        # Send the first chunk immediately (keeps time-to-first-byte low)
+
+
+DEFAULT_FLUSH_POLICY = FlushPolicy()
+
+# Per-endpoint policies. Full-page generations favour fewer, larger writes; the
+# modification endpoints flush sooner because users watch small edits land.
+FLUSH_POLICIES: Dict[str, FlushPolicy] = {
+    "generate-full-code": FlushPolicy(max_bytes=4096, max_delay_ms=20.0),
+    "modify-full-code": FlushPolicy(max_bytes=2048, max_delay_ms=15.0),
+    "v2-generate-full-code-with-files": FlushPolicy(max_bytes=4096, max_delay_ms=20.0),
+    "v2-modify-full-code-with-files": FlushPolicy(max_bytes=2048, max_delay_ms=15.0),
+}
+
+
+def get_flush_policy(endpoint: str) -> FlushPolicy:
+    """
+    Returns the flush policy for an endpoint.
+
+    MORPHEO_FLUSH_MAX_BYTES / MORPHEO_FLUSH_MAX_DELAY_MS override the byte budget and
+    deadline for every endpoint (useful when benchmarking).
+    """
+    policy = FLUSH_POLICIES.get(endpoint, DEFAULT_FLUSH_POLICY)
+    max_bytes = os.getenv("MORPHEO_FLUSH_MAX_BYTES")
+    max_delay_ms = os.getenv("MORPHEO_FLUSH_MAX_DELAY_MS")
+    if max_bytes or max_delay_ms:
+        policy = FlushPolicy(
+            max_bytes=int(max_bytes) if max_bytes else policy.max_bytes,
+            max_delay_ms=float(max_delay_ms) if max_delay_ms else policy.max_delay_ms,
+            max_buffered_chunks=policy.max_buffered_chunks,
+            flush_first=policy.flush_first,
+        )
+    return policy
+
+
+class StreamStats:
+    """Per-stream counters reported when a shaped stream finishes."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.chunks_in = 0
+        self.flushes = 0
+        self.bytes_out = 0
+        self.started_at = time.perf_counter()
+        self.first_flush_s: Optional[float] = None
+        self.duration_s = 0.0
+
+
+class ShaperMetrics:
+    """Process-wide aggregates of shaped streams, keyed by endpoint name."""
+
+    def __init__(self):
+        self._by_name: Dict[str, Dict[str, float]] = {}
+
+    def record(self, stats: StreamStats) -> None:
+        entry = self._by_name.setdefault(stats.name, {"streams": 0, "chunks_in": 0, "flushes": 0, "bytes_out": 0})
+        entry["streams"] += 1
+        entry["chunks_in"] += stats.chunks_in
+        entry["flushes"] += stats.flushes
+        entry["bytes_out"] += stats.bytes_out
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for name, entry in self._by_name.items():
+            streams = max(entry["streams"], 1)
+            result[name] = dict(entry, avg_flushes_per_stream=round(entry["flushes"] / streams, 2))
+        return result
+
+
+shaper_metrics = ShaperMetrics()
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def shape_stream(
+    source: AsyncIterator[str],
+    policy: FlushPolicy = DEFAULT_FLUSH_POLICY,
+    name: str = "stream",
+) -> AsyncIterator[str]:
+    """
+    Coalesces `source` chunks according to `policy`.
+
+    A producer task pulls from `source` into a bounded queue; this generator drains the
+    queue and yields joined chunks. When the client stops reading, the queue fills up and
+    the producer stops pulling from upstream. Closing this generator (client disconnect)
+    cancels the producer, which closes `source`.
+
+    Yields:
+        Coalesced string chunks.
+    """
+    stats = StreamStats(name)
+    buffer_queue: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=max(policy.max_buffered_chunks, 1))
+
+    async def produce():
+        try:
+            async for chunk in source:
+                if chunk:
+                    await buffer_queue.put(chunk)
+            await buffer_queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            await buffer_queue.put(_Failure(e))
+
+    producer = asyncio.create_task(produce())
+    max_delay_s = policy.max_delay_ms / 1000.0
+    pending = []
+    pending_bytes = 0
+    finished = False
+
+    def take() -> str:
+        nonlocal pending, pending_bytes
+        data = pending[0] if len(pending) == 1 else "".join(pending)
+        pending = []
+        pending_bytes = 0
+        stats.flushes += 1
+        stats.bytes_out += len(data)
+        if stats.first_flush_s is None:
+            stats.first_flush_s = time.perf_counter() - stats.started_at
+        return data
+
+    try:
+        while not finished:
+            item = await buffer_queue.get()
+            deadline = time.perf_counter() + max_delay_s
+            while True:
+                if item is _END:
+                    finished = True
+                    break
+                if isinstance(item, _Failure):
+                    if pending:
+                        yield take()
+                    raise item.error
+                pending.append(item)
+                pending_bytes += len(item)
+                stats.chunks_in += 1
+                if pending_bytes >= policy.max_bytes or (policy.flush_first and stats.flushes == 0):
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(buffer_queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            if pending:
+                yield take()
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+        stats.duration_s = time.perf_counter() - stats.started_at
+        shaper_metrics.record(stats)
+        logger.info(
+            f"Shaped stream '{name}' finished: {stats.chunks_in} chunks in, {stats.flushes} flushes, "
+            f"{stats.bytes_out} chars out in {stats.duration_s:.3f}s"
+        )
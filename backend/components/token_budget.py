@@ -0,0 +1,375 @@
+"""
+Token Budgets
+
+This module estimates prompt sizes locally and keeps prompts within per-task input budgets
+before they are sent, instead of finding out from a failed or slow call.
+
+- TokenEstimator approximates BPE token counts with a single regex pass (alphanumeric runs
+  count one token per 4 characters, every other non-space character one token). When a client
+  exposing `aio.models.count_tokens` is available, a few real counts per model calibrate it.
+- Prompt builders describe their prompt as PromptSections (template, user request, current
+  HTML, uploaded-files block, ...). assemble() joins them, trimming the lowest-priority
+  sections first (smaller alternatives, then truncation, then dropping) until the prompt fits,
+  and returns a per-section cost report.
+- Conversations (chat history) are fitted with fit_turns(), which drops the oldest turns.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]{1,4}|[^\sA-Za-z0-9]")
+
+# Default input budgets per service task (tokens); MORPHEO_INPUT_BUDGET_<TASK> overrides
+DEFAULT_INPUT_BUDGETS: Dict[str, int] = {
+    "generation": 100_000,
+    "modification": 200_000,
+    "correction": 200_000,
+    "suggestion": 60_000,
+    "chat": 32_000,
+}
+
+REQUIRED = 100  # Priority of sections that are never trimmed
+
+
+def count_tokens(text: str) -> int:
+    """Uncalibrated local token count of `text`."""
+    return len(_TOKEN_PATTERN.findall(text)) if text else 0
+
+
+class PromptBudgetExceeded(ValueError):
+    """Even with every trimmable section removed, the prompt is over the task's input budget."""
+
+    def __init__(self, task: str, tokens: int, budget: int):
+        super().__init__(f"The {task} request is too large: about {tokens:,} input tokens for a budget of {budget:,}.")
+        self.task = task
+        self.tokens = tokens
+        self.budget = budget
+
+
+@dataclass
+class PromptSection:
+    """
+    One part of a prompt.
+
+    Attributes:
+        name: Label used in the cost report.
+        text: Full text of the section.
+        priority: Higher survives longer; REQUIRED sections are never trimmed.
+        alternatives: Progressively smaller renditions, tried in order before truncating.
+        trim: "tail" keeps the start, "middle" keeps both ends, "drop" removes the section whole.
+        cacheable: Static text that may be served from an upstream context cache; only an
+            untrimmed run of cacheable sections at the start of the prompt forms the prefix.
+        tokens: Precomputed uncalibrated estimate of `text` (saves re-counting static text).
+        hash_state: hashlib object already fed with `text`; used when this is the first section.
+    """
+    name: str
+    text: str
+    priority: int = REQUIRED
+    alternatives: Sequence[str] = ()
+    trim: str = "tail"
+    cacheable: bool = False
+    tokens: Optional[int] = None
+    hash_state: Any = field(default=None, repr=False)
+
+
+@dataclass
+class SectionReport:
+    name: str
+    tokens: int
+    original_tokens: int
+    action: str = "kept"  # kept | reduced | truncated | dropped
+
+
+@dataclass
+class AssembledPrompt:
+    """A prompt that fits its budget, with the per-section cost report."""
+    task: str
+    text: str
+    tokens: int
+    budget: int
+    sections: List[SectionReport] = field(default_factory=list)
+    prefix_chars: int = 0  # Length of the leading static (cacheable) text
+    digest: str = ""  # Content hash of `text`
+
+    @property
+    def trimmed(self) -> bool:
+        return any(section.action != "kept" for section in self.sections)
+
+    @property
+    def prefix(self) -> str:
+        """Static leading text, suitable for an upstream context cache ("" if none)."""
+        return self.text[:self.prefix_chars]
+
+    @property
+    def suffix(self) -> str:
+        """Per-request remainder of the prompt."""
+        return self.text[self.prefix_chars:]
+
+    def summary(self) -> str:
+        parts = ", ".join(
+            f"{s.name} {s.tokens:,}" + (f" ({s.action} from {s.original_tokens:,})" if s.action != "kept" else "")
+            for s in self.sections
+        )
+        return f"{self.task} prompt ~{self.tokens:,}/{self.budget:,} tokens: {parts}"
+
+
+class TokenEstimator:
+    """
+    Fast local token counts, optionally calibrated per model against the upstream tokenizer.
+
+    At most one calibration per model is in flight, and a failed count backs the model off
+    (doubling up to `max_retry_after_failure_s`) so calibration adds no load while the upstream
+    is erroring or rate limiting.
+
+    Args:
+        calibration_samples: Upstream counts taken per model before calibration stops.
+        retry_after_failure_s: Wait after a model's first failed count before trying again.
+        max_retry_after_failure_s: Cap of the doubling back-off.
+    """
+
+    def __init__(self, calibration_samples: int = 5, retry_after_failure_s: float = 60.0, max_retry_after_failure_s: float = 900.0):
+        self.calibration_samples = calibration_samples
+        self.retry_after_failure_s = retry_after_failure_s
+        self.max_retry_after_failure_s = max_retry_after_failure_s
+        self._factors: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+        self._failures: Dict[str, int] = {}
+        self._retry_at: Dict[str, float] = {}
+        self._pending: Dict[str, asyncio.Task] = {}  # Strong references to in-flight calibrations
+        self._lock = threading.Lock()
+
+    def raw(self, text: str) -> int:
+        return count_tokens(text)
+
+    def estimate(self, text: str, model: Optional[str] = None) -> int:
+        """Estimated token count of `text` (scaled by the model's calibration factor, if any)."""
+        return self.scale(self.raw(text), model)
+
+    def scale(self, raw_tokens: int, model: Optional[str] = None) -> int:
+        """Applies the model's calibration factor to an uncalibrated count."""
+        return int(round(raw_tokens * self._factors.get(model or "", 1.0)))
+
+    def needs_calibration(self, model: str) -> bool:
+        return self._samples.get(model, 0) < self.calibration_samples
+
+    def can_calibrate(self, model: str) -> bool:
+        """True when `model` needs calibration, has none in flight and is not backing off after a failure."""
+        return (
+            self.needs_calibration(model)
+            and model not in self._pending
+            and time.monotonic() >= self._retry_at.get(model, 0.0)
+        )
+
+    def start_calibration(self, client: Any, model: str, text: str) -> Optional[asyncio.Task]:
+        """Starts a background calibration and keeps it referenced until done (needs a running loop)."""
+        if not self.can_calibrate(model):
+            return None
+        task = asyncio.get_running_loop().create_task(self.calibrate(client, model, text))
+        self._pending[model] = task
+        task.add_done_callback(lambda _: self._pending.pop(model, None))
+        return task
+
+    def _failed(self, model: str) -> None:
+        with self._lock:
+            failures = self._failures.get(model, 0) + 1
+            self._failures[model] = failures
+            delay = min(self.retry_after_failure_s * 2 ** (failures - 1), self.max_retry_after_failure_s)
+            self._retry_at[model] = time.monotonic() + delay
+
+    async def calibrate(self, client: Any, model: str, text: str) -> Optional[float]:
+        """
+        Counts `text` upstream and folds the ratio into the model's factor.
+
+        Returns:
+            The new factor, or None if the client cannot count tokens.
+        """
+        count_tokens = getattr(getattr(getattr(client, "aio", None), "models", None), "count_tokens", None)
+        raw = self.raw(text)
+        if count_tokens is None or raw == 0:
+            return None
+        try:
+            response = await count_tokens(model=model, contents=text)
+            actual = getattr(response, "total_tokens", None)
+        except Exception as e:
+            logger.debug(f"Token calibration for {model} failed: {e}")
+            self._failed(model)
+            return None
+        if not actual:
+            self._failed(model)
+            return None
+        with self._lock:
+            self._failures.pop(model, None)
+            samples = self._samples.get(model, 0)
+            previous = self._factors.get(model, 1.0)
+            factor = actual / raw if samples == 0 else previous + (actual / raw - previous) / (samples + 1)
+            self._factors[model] = factor
+            self._samples[model] = samples + 1
+        logger.info(f"Token estimator calibrated for {model}: factor {factor:.3f} ({actual} upstream vs {raw} local).")
+        return factor
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"calibration": {model: round(factor, 3) for model, factor in self._factors.items()}}
+
+
+def input_budget(task: str) -> int:
+    """Input budget in tokens for a service task (MORPHEO_INPUT_BUDGET_<TASK> overrides the default)."""
+    default = DEFAULT_INPUT_BUDGETS.get(task, 100_000)
+    try:
+        return int(os.getenv(f"MORPHEO_INPUT_BUDGET_{task.upper()}", default))
+    except ValueError:
+        return default
+
+
+def _truncate(text: str, target_tokens: int, tokens: int, mode: str, estimate: Callable[[str], int]) -> str:
+    """Cuts `text` (with an omission marker) to at most `target_tokens`, or returns "" if it cannot."""
+    keep = int(len(text) * target_tokens / tokens) if tokens > 0 else 0
+    while keep > 0:
+        marker = f"\n[... {len(text) - keep:,} characters omitted to fit the input budget ...]\n"
+        if mode == "middle":
+            cut = text[: keep // 2] + marker + text[len(text) - keep // 2:]
+        else:
+            cut = text[:keep] + marker
+        if estimate(cut) <= target_tokens:
+            return cut
+        keep -= max(keep // 20, 16)
+    return ""
+
+
+def assemble(
+    task: str,
+    sections: Sequence[PromptSection],
+    estimator: TokenEstimator,
+    budget: Optional[int] = None,
+    model: Optional[str] = None,
+) -> AssembledPrompt:
+    """
+    Joins `sections` into one prompt that fits `budget`, trimming low-priority sections first.
+
+    Raises:
+        PromptBudgetExceeded: The required sections alone are over the budget.
+    """
+    budget = budget if budget is not None else input_budget(task)
+    texts = [section.text for section in sections]
+    original = [
+        estimator.scale(section.tokens, model) if section.tokens is not None else estimator.estimate(section.text, model)
+        for section in sections
+    ]
+    tokens = list(original)
+    actions = ["kept"] * len(sections)
+
+    order = sorted((i for i, s in enumerate(sections) if s.priority < REQUIRED), key=lambda i: sections[i].priority)
+    for i in order:
+        excess = sum(tokens) - budget
+        if excess <= 0:
+            break
+        section = sections[i]
+        for alternative in section.alternatives:
+            alt_tokens = estimator.estimate(alternative, model)
+            if alt_tokens < tokens[i]:
+                texts[i], tokens[i], actions[i] = alternative, alt_tokens, "reduced"
+                if sum(tokens) <= budget:
+                    break
+        excess = sum(tokens) - budget
+        if excess <= 0:
+            break
+        target = tokens[i] - excess
+        if section.trim == "drop" or target < 64:
+            texts[i], tokens[i], actions[i] = "", 0, "dropped"
+        else:
+            texts[i] = _truncate(texts[i], target, tokens[i], section.trim, lambda text: estimator.estimate(text, model))
+            tokens[i], actions[i] = estimator.estimate(texts[i], model), "truncated" if texts[i] else "dropped"
+
+    total = sum(tokens)
+    if total > budget:
+        raise PromptBudgetExceeded(task, total, budget)
+    reports = [SectionReport(s.name, tokens[i], original[i], actions[i]) for i, s in enumerate(sections)]
+    prefix_chars = 0
+    for i, section in enumerate(sections):
+        if not section.cacheable or actions[i] != "kept":
+            break
+        prefix_chars += len(texts[i])
+    text = "".join(texts)
+    if sections and sections[0].hash_state is not None and actions[0] == "kept":
+        state = sections[0].hash_state.copy()
+        state.update(text[len(texts[0]):].encode("utf-8"))
+    else:
+        state = hashlib.sha256(text.encode("utf-8"))
+    return AssembledPrompt(
+        task=task, text=text, tokens=total, budget=budget, sections=reports,
+        prefix_chars=prefix_chars, digest=state.hexdigest()[:16],
+    )
+
+
+def _turn_text(turn: Any) -> str:
+    parts = turn.get("parts", []) if isinstance(turn, dict) else getattr(turn, "parts", None) or []
+    return "".join(part.get("text", "") if isinstance(part, dict) else getattr(part, "text", None) or "" for part in parts)
+
+
+def _role(turn: Any) -> Optional[str]:
+    return turn.get("role") if isinstance(turn, dict) else getattr(turn, "role", None)
+
+
+def fit_turns(
+    task: str,
+    turns: Sequence[Any],
+    estimator: TokenEstimator,
+    budget: Optional[int] = None,
+    model: Optional[str] = None,
+) -> List[Any]:
+    """
+    Drops the oldest turns of a conversation until it fits `budget`. The last turn is always
+    kept, and a trimmed conversation starts with a user turn.
+
+    Raises:
+        PromptBudgetExceeded: The last turn alone is over the budget.
+    """
+    budget = budget if budget is not None else input_budget(task)
+    costs = [estimator.estimate(_turn_text(turn), model) for turn in turns]
+    total = sum(costs)
+    start = 0
+    while total > budget and start < len(turns) - 1:
+        total -= costs[start]
+        start += 1
+    while 0 < start < len(turns) - 1 and _role(turns[start]) != "user":
+        total -= costs[start]
+        start += 1
+    if total > budget:
+        raise PromptBudgetExceeded(task, total, budget)
+    return list(turns[start:])
+
+
+def schedule_calibration(
+    estimator: TokenEstimator, client: Any, model: str, text: str, idle: Optional[Callable[[], bool]] = None
+) -> None:
+    """
+    Starts a background calibration for `model` when one is still needed (no-op outside an event loop).
+
+    Args:
+        idle: Returns False while model capacity is in use; calibration is then skipped, so it
+            never competes with user calls for upstream quota.
+    """
+    if client is None or not estimator.can_calibrate(model) or (idle is not None and not idle()):
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    estimator.start_calibration(client, model, text)
+
+
+def create_token_estimator() -> TokenEstimator:
+    """Builds the estimator; MORPHEO_TOKEN_CALIBRATION_SAMPLES=0 disables upstream calibration."""
+    try:
+        samples = int(os.getenv("MORPHEO_TOKEN_CALIBRATION_SAMPLES", 5))
+    except ValueError:
+        samples = 5
+    return TokenEstimator(calibration_samples=samples)
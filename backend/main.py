@@ -57,6 +57,7 @@ import requests
 import shutil
 import mimetypes
 import base64
+import io
 
 # --- Remove previous environment diagnostics ---
 # print(f"DEBUG (main.py): Running Python executable: {sys.executable}")
@@ -83,27 +84,24 @@ from google.ai import generativelanguage as glm
 # from google.generativeai import GenerativeModel # REMOVED - Not used directly here
 # --- End direct imports ---
 
-# --- Configure GenAI globally here ---
-try:
-    if genai:
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if api_key:
-            genai.configure(api_key=api_key)
-            print("DEBUG (main.py): google.genai configured successfully.")
-        else:
-            print("Warning (main.py): GOOGLE_API_KEY not set, google.genai configuration skipped.")
-    else:
-        print("DEBUG (main.py): google.genai module not imported, configuration skipped.")
-except Exception as config_e:
-    print(f"ERROR (main.py): Failed to configure google.genai: {config_e}")
-# --- End GenAI Configuration ---
+# --- GenAI client ---
+# One process-wide client (connection pool, keep-alive) is built by the client manager,
+# warmed at startup and shared by ComponentService and the Files API endpoints.
+# google.genai.Client reads GOOGLE_API_KEY itself; no global configure step is needed.
 
 # --- Component Service Class Import AFTER Google Imports ---
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from components.service import ComponentService # Import the CLASS
+from components.client_manager import get_client_manager
+from components.log_writer import close_log_writers, get_log_writer
+from components.stream_shaper import get_flush_policy, shape_stream, shaper_metrics
+from components.stream_buffer import StreamAccumulator
+from components.errors import ModelCallError, ServiceUnavailableError
+from components.token_budget import PromptBudgetExceeded
 
 # --- Simple Instantiation ---
-component_service_instance = ComponentService()
+client_manager = get_client_manager()
+component_service_instance = ComponentService(client_manager=client_manager)
 
 # Set up logging (basic configuration)
 logging.basicConfig(level=logging.INFO)
@@ -177,6 +175,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup_event():
+    """Opens the shared model client's first upstream connection before traffic arrives."""
+    await client_manager.warm(component_service_instance.model_name)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Closes the model client's connection pools and flushes queued request/generation log records."""
+    await client_manager.aclose()
+    await asyncio.to_thread(close_log_writers)
+
+# --- Load Shedding ---
+@app.exception_handler(ServiceUnavailableError)
+async def service_unavailable_handler(request: Request, exc: ServiceUnavailableError):
+    """Maps refused work (limiter queue full, deadline exceeded, circuit open) to 503 + Retry-After."""
+    logger.warning(f"Rejecting {request.url.path} with 503: {exc}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "retry_after": exc.retry_after_header},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+def require_model_capacity(task: str):
+    """
+    Endpoint dependency factory: fails fast with 503 before any work starts if the model's
+    circuit is open for this task (with no fallback model available), or if the model queue is
+    full (unless the endpoint's task outranks work already queued).
+    """
+    async def check_capacity():
+        component_service_instance.breakers.check(component_service_instance.models.primary(task), task)
+        component_service_instance.limiter.check_admission(task)
+    return check_capacity
+# --- End Load Shedding ---
+
 # Security configurations
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
@@ -213,6 +245,7 @@ class UserInDB(User):
 
 class PromptRequest(BaseModel):
     prompt: str
+    bypass_cache: bool = False # Force a fresh generation instead of a cached one
 
 class ModifyCodeRequest(BaseModel):
     modification_prompt: str
@@ -557,7 +590,7 @@ if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
 
-@app.post("/api/generate-full-code")
+@app.post("/api/generate-full-code", dependencies=[Depends(require_model_capacity("generation"))])
 async def generate_full_code_endpoint(request: PromptRequest, current_user: User = Depends(get_current_user)):
     """Generates the full, self-contained HTML file using Web Components via streaming."""
     logger.info(f"Received STREAMING request for /api/generate-full-code from user: {current_user.username}")
@@ -576,10 +609,13 @@ async def generate_full_code_endpoint(request: PromptRequest, current_user: User
         # Get the async generator from the service, passing the flag
         content_stream = component_service_instance.generate_full_component_code(
             request.prompt,
-            enable_grounding=enable_grounding # Pass the flag
+            enable_grounding=enable_grounding, # Pass the flag
+            use_cache=not request.bypass_cache,
+            user_id=current_user.username
         )
-        # Return a StreamingResponse
-        return StreamingResponse(content_stream, media_type="text/event-stream")
+        # Return a StreamingResponse (coalesced by the stream shaper)
+        shaped_stream = shape_stream(content_stream, get_flush_policy("generate-full-code"), name="generate-full-code")
+        return StreamingResponse(shaped_stream, media_type="text/event-stream")
 
     except Exception as e:
         # Handle exceptions during the setup before streaming starts
@@ -590,7 +626,7 @@ async def generate_full_code_endpoint(request: PromptRequest, current_user: User
             content={"error": f"Internal server error during stream setup: {str(e)}"}
         )
 
-@app.post("/api/modify-full-code")
+@app.post("/api/modify-full-code", dependencies=[Depends(require_model_capacity("modification"))])
 async def modify_full_code_endpoint(request: ModifyCodeRequest, current_user: User = Depends(get_current_user)):
     """Modifies an existing HTML file string based on user instructions via streaming."""
     logger.info(f"Received STREAMING request for /api/modify-full-code from user: {current_user.username}")
@@ -613,10 +649,12 @@ async def modify_full_code_endpoint(request: ModifyCodeRequest, current_user: Us
         content_stream = component_service_instance.modify_full_component_code(
             modification_request=request.modification_prompt,
             current_html=request.current_html,
-            enable_grounding=enable_grounding # Pass the flag
+            enable_grounding=enable_grounding, # Pass the flag
+            user_id=current_user.username
         )
-        # Return a StreamingResponse
-        return StreamingResponse(content_stream, media_type="text/event-stream")
+        # Return a StreamingResponse (coalesced by the stream shaper)
+        shaped_stream = shape_stream(content_stream, get_flush_policy("modify-full-code"), name="modify-full-code")
+        return StreamingResponse(shaped_stream, media_type="text/event-stream")
 
     except Exception as e:
         logger.exception(f"An unexpected error occurred setting up streaming modification: {e}")
@@ -625,6 +663,75 @@ async def modify_full_code_endpoint(request: ModifyCodeRequest, current_user: Us
             content={"error": f"Internal server error during stream setup: {str(e)}"}
         )
 
+# --- Service Metrics Endpoint ---
+@app.get("/api/metrics")
+async def metrics_endpoint(current_user: User = Depends(get_current_user)):
+    """Returns in-process serving metrics (stream shaping, log pipeline)."""
+    return {
+        "streams": shaper_metrics.snapshot(),
+        "logs": {name: get_log_writer(name).stats() for name in ("requests", "generations")},
+        "generation_cache": component_service_instance.generation_cache.snapshot(),
+        "similarity_index": component_service_instance.similarity_index.snapshot(),
+        "single_flight": component_service_instance.single_flight.snapshot(),
+        "limiter": component_service_instance.limiter.snapshot(),
+        "hedging": component_service_instance.hedger.snapshot(),
+        "circuit_breakers": component_service_instance.breakers.snapshot(),
+        "routing": component_service_instance.models.snapshot(),
+        "token_estimator": component_service_instance.token_estimator.snapshot(),
+        "context_cache": component_service_instance.context_cache.snapshot(),
+        "model_client": client_manager.snapshot(),
+        "prompt_cache_usage": component_service_instance.prompt_usage.snapshot(),
+        "prompt_templates": component_service_instance.templates.snapshot(),
+        "prompt_variants": component_service_instance.prompt_variants.snapshot(),
+        "prompt_modules": component_service_instance.prompt_modules.snapshot(),
+        "security_scans": component_service_instance.security.snapshot(),
+        "modification_edits": component_service_instance.edit_protocol.snapshot(),
+    }
+# --- End Service Metrics Endpoint ---
+
+# --- Instant Preview From Similar Past Generations ---
+@app.post("/api/generation-preview")
+async def generation_preview_endpoint(request: PromptRequest, current_user: User = Depends(get_current_user)):
+    """
+    Returns a cached generation for a similar past prompt (no model call), which the client can
+    show while /api/generate-full-code produces the real result.
+    """
+    if not request.prompt:
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty.")
+    preview = await component_service_instance.find_similar_generation(request.prompt)
+    if preview is None:
+        return {"found": False}
+    return dict(preview, found=True)
+# --- End Instant Preview ---
+
+# --- Generation Cache Invalidation ---
+# The generation cache is shared by every user, so dropping entries is reserved for the
+# operators listed in MORPHEO_ADMIN_USERS (comma-separated UIDs or emails; empty: nobody)
+ADMIN_USERS = {entry.strip() for entry in os.getenv("MORPHEO_ADMIN_USERS", "").split(",") if entry.strip()}
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if not ({current_user.uid, current_user.email, current_user.username} & ADMIN_USERS):
+        logger.warning(f"User {current_user.username} is not allowed to run admin operations.")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin privileges required.")
+    return current_user
+
+@app.delete("/api/cache/generations")
+async def invalidate_generation_cache(
+    prompt: Optional[str] = Query(None, description="Invalidate only the entry for this prompt; omit to clear the cache."),
+    grounding: bool = Query(False),
+    current_user: User = Depends(get_admin_user)
+):
+    """Drops one cached generation (by prompt) or the whole generation cache (admins only)."""
+    cache = component_service_instance.generation_cache
+    if prompt:
+        key = component_service_instance.generation_cache_key(prompt, enable_grounding=grounding)
+        removed = await asyncio.to_thread(cache.invalidate, key)
+    else:
+        removed = await asyncio.to_thread(cache.invalidate)
+    logger.info(f"User {current_user.username} invalidated {removed} generation cache entries (prompt={'yes' if prompt else 'all'}).")
+    return {"removed": removed}
+# --- End Generation Cache Invalidation ---
+
 # --- NEW Chat Models ---
 class ChatMessage(BaseModel):
     role: str # Typically "user" or "model"
@@ -635,7 +742,7 @@ class ChatRequest(BaseModel):
     history: Optional[List[ChatMessage]] = None # Optional history
 
 # --- NEW Chat Endpoint ---
-@app.post("/api/chat")
+@app.post("/api/chat", dependencies=[Depends(require_model_capacity("chat"))])
 async def chat_endpoint(request: ChatRequest, current_user: User = Depends(get_current_user)):
     """Handles multi-turn chat requests using Gemini."""
     logger.info(f"Received request for /api/chat from user: {current_user.username}")
@@ -652,23 +759,20 @@ async def chat_endpoint(request: ChatRequest, current_user: User = Depends(get_c
 
     # Add the new user message
     gemini_history.append({"role": "user", "parts": [{"text": request.message}]})
-
-    full_response = ""
-    error_message = None
+    # Oldest turns are dropped when the conversation is over the chat input budget
+    try:
+        gemini_history = component_service_instance.fit_conversation("chat", gemini_history)
+    except PromptBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
     try:
-        # 3. Call Gemini via the component service's retry wrapper
+        # 3. Call Gemini via the component service (coalesced with identical chats; slow calls are hedged)
         logger.info(f"Calling component_service for chat with structured history (length: {len(gemini_history)}) and GROUNDING ENABLED")
-        async for chunk in component_service_instance._call_gemini_with_retry(gemini_history, enable_grounding=True):
-            if "<!-- ERROR:" in chunk:
-                logger.error(f"Gemini wrapper signaled error during chat: {chunk}")
-                error_match = re.search(r"<!-- ERROR: (.*) -->", chunk)
-                error_message = error_match.group(1) if error_match else "Failed to get chat response due to API error."
-                break
-            full_response += chunk
-
-        if error_message:
-            raise HTTPException(status_code=500, detail=error_message)
+        try:
+            full_response = await component_service_instance.complete_text(gemini_history, task="chat", user_id=current_user.username, shared=True, enable_grounding=True)
+        except ModelCallError as e:
+            logger.error(f"Gemini wrapper signaled error during chat: {e}")
+            raise HTTPException(status_code=500, detail=str(e) or "Failed to get chat response due to API error.")
 
         if not full_response.strip():
             logger.warning("Gemini returned an empty chat response.")
@@ -680,6 +784,8 @@ async def chat_endpoint(request: ChatRequest, current_user: User = Depends(get_c
         # The frontend will need to add this response to the history with role 'model'
         return {"response": full_response.strip()}
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
@@ -702,7 +808,7 @@ class AudioAnalysisJSONRequest(BaseModel):
 # --- End NEW JSON Request Models ---
 
 # --- Re-added Image Tool Endpoint ---
-@app.post("/api/image-tool")
+@app.post("/api/image-tool", dependencies=[Depends(require_model_capacity("image_analysis"))])
 async def image_tool_endpoint(
     request: ImageAnalysisJSONRequest, # Reuse model from before
     current_user: User = Depends(get_current_user)
@@ -728,9 +834,6 @@ async def image_tool_endpoint(
         logger.warning(f"User {current_user.username} provided invalid data URL type: {mime_type}")
         raise HTTPException(status_code=400, detail=f"Invalid file type from data URL: {mime_type}. Allowed types: {', '.join(allowed_mime_types)}")
 
-    full_response = ""
-    error_message = None
-
     try:
         # 3. Construct contents for ComponentService (multimodal analysis)
         gemini_contents = [
@@ -738,19 +841,13 @@ async def image_tool_endpoint(
             {"mime_type": mime_type, "data": image_data} # Simple dict for service
         ]
 
-        # 4. Call ComponentService's _call_gemini_with_retry for analysis
+        # 4. Call ComponentService for analysis (slow calls are hedged)
         logger.info(f"Calling component_service for image analysis (prompt: '{effective_prompt[:30]}...', image: {len(image_data)} bytes)")
-        # Pass the list directly to the service function
-        async for chunk in component_service_instance._call_gemini_with_retry(gemini_contents):
-            if "<!-- ERROR:" in chunk:
-                logger.error(f"Gemini wrapper signaled error during image analysis: {chunk}")
-                error_match = re.search(r"<!-- ERROR: (.*) -->", chunk)
-                error_message = error_match.group(1) if error_match else "Failed to analyze image due to API error."
-                break
-            full_response += chunk
-
-        if error_message:
-            raise HTTPException(status_code=500, detail=error_message)
+        try:
+            full_response = await component_service_instance.complete_text(gemini_contents, task="image_analysis", user_id=current_user.username)
+        except ModelCallError as e:
+            logger.error(f"Gemini wrapper signaled error during image analysis: {e}")
+            raise HTTPException(status_code=500, detail=str(e) or "Failed to analyze image due to API error.")
 
         if not full_response.strip():
             logger.warning("Gemini returned an empty analysis for the image.")
@@ -760,6 +857,8 @@ async def image_tool_endpoint(
         logger.info(f"Successfully generated image analysis (length: {len(full_response)}).")
         return {"analysis": full_response.strip()} # Return analysis field
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
@@ -768,7 +867,7 @@ async def image_tool_endpoint(
 # --- End Re-added Image Tool Endpoint ---
 
 # --- NEW Image Generation Endpoint ---
-@app.post("/api/generate-image")
+@app.post("/api/generate-image", dependencies=[Depends(require_model_capacity("image_generation"))])
 async def generate_image_endpoint(
     request: ImageGenerationRequest, 
     current_user: User = Depends(get_current_user)
@@ -782,7 +881,7 @@ async def generate_image_endpoint(
 
     try:
         # Call the service method
-        result = await component_service_instance.generate_image(request.prompt)
+        result = await component_service_instance.generate_image(request.prompt, user_id=current_user.username)
 
         # Check the result from the service
         if "error" in result and result["error"]:
@@ -797,6 +896,8 @@ async def generate_image_endpoint(
             logger.error(f"Image generation returned unexpected result for user {current_user.username}: {result}")
             raise HTTPException(status_code=500, detail="Image generation returned an unexpected result.")
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         # Re-raise HTTPException to keep FastAPI handling
         raise http_exc
@@ -806,7 +907,7 @@ async def generate_image_endpoint(
 # --- End NEW Image Generation Endpoint ---
 
 # --- NEW Video Analysis Endpoint (Data URL approach) ---
-@app.post("/api/video-tool")
+@app.post("/api/video-tool", dependencies=[Depends(require_model_capacity("video_analysis"))])
 async def video_tool_endpoint(
     request: VideoAnalysisJSONRequest, 
     current_user: User = Depends(get_current_user)
@@ -837,26 +938,31 @@ async def video_tool_endpoint(
 
     # 3. Call the service method (async streaming)
     try:
+        analysis_buffer = StreamAccumulator() # Filled by the service as chunks arrive
         content_stream = component_service_instance.analyze_video_from_bytes(
             prompt=effective_prompt,
             video_bytes=video_data,
-            mime_type=mime_type
+            mime_type=mime_type,
+            accumulator=analysis_buffer,
+            user_id=current_user.username
         )
         
         # --- Consume the stream and return JSON --- 
-        full_analysis = ""
         async for chunk in content_stream:
             if "<!-- ERROR:" in chunk:
                 logger.error(f"Video analysis service signaled error: {chunk}")
                 error_match = re.search(r"<!-- ERROR: (.*) -->", chunk)
                 error_message = error_match.group(1) if error_match else "Video analysis failed."
                 raise HTTPException(status_code=500, detail=error_message)
-            full_analysis += chunk
+        full_analysis = analysis_buffer.getvalue()
+        analysis_buffer.close()
         
         logger.info(f"Successfully collected video analysis (length: {len(full_analysis)}). Returning JSON.")
         return JSONResponse(content={"analysis": full_analysis.strip()})
         # --- End JSON response section ---
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         # Re-raise HTTPException if service raises one (e.g., init failure) or if we raise one above
         raise http_exc
@@ -871,7 +977,7 @@ async def video_tool_endpoint(
 # --- End NEW Video Analysis Endpoint ---
 
 # --- NEW Audio Analysis Endpoint (Data URL approach) ---
-@app.post("/api/audio-tool")
+@app.post("/api/audio-tool", dependencies=[Depends(require_model_capacity("audio_analysis"))])
 async def audio_tool_endpoint(
     request: AudioAnalysisJSONRequest, 
     current_user: User = Depends(get_current_user)
@@ -906,25 +1012,30 @@ async def audio_tool_endpoint(
 
     # 3. Call the service method and return JSON response
     try:
+        analysis_buffer = StreamAccumulator() # Filled by the service as chunks arrive
         content_stream = component_service_instance.analyze_audio_from_bytes(
             prompt=request.prompt,
             audio_bytes=audio_data,
-            mime_type=mime_type
+            mime_type=mime_type,
+            accumulator=analysis_buffer,
+            user_id=current_user.username
         )
         
         # Consume the stream and return JSON
-        full_analysis = ""
         async for chunk in content_stream:
             if "<!-- ERROR:" in chunk:
                 logger.error(f"Audio analysis service signaled error: {chunk}")
                 error_match = re.search(r"<!-- ERROR: (.*) -->", chunk)
                 error_message = error_match.group(1) if error_match else "Audio analysis failed."
                 raise HTTPException(status_code=500, detail=error_message)
-            full_analysis += chunk
+        full_analysis = analysis_buffer.getvalue()
+        analysis_buffer.close()
         
         logger.info(f"Successfully collected audio analysis (length: {len(full_analysis)}). Returning JSON.")
         return JSONResponse(content={"analysis": full_analysis.strip()})
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
@@ -1109,7 +1220,7 @@ async def delete_generation(
 # --- End Delete Endpoint ---
 
 # --- NEW Suggest Modifications Endpoint --- 
-@app.post("/api/suggest-modifications", response_model=SuggestModificationsResponse)
+@app.post("/api/suggest-modifications", response_model=SuggestModificationsResponse, dependencies=[Depends(require_model_capacity("suggestion"))])
 async def suggest_modifications_endpoint(
     request: SuggestModificationsRequest, 
     current_user: User = Depends(get_current_user)
@@ -1122,7 +1233,7 @@ async def suggest_modifications_endpoint(
 
     try:
         # Call the service method
-        suggestions_list = await component_service_instance.suggest_modifications(request.current_html)
+        suggestions_list = await component_service_instance.suggest_modifications(request.current_html, user_id=current_user.username)
 
         # Check if the first suggestion indicates an error from the service
         if suggestions_list and suggestions_list[0].startswith("Error:"): 
@@ -1132,6 +1243,8 @@ async def suggest_modifications_endpoint(
         logger.info(f"Successfully generated {len(suggestions_list)} suggestions for user {current_user.username}.")
         return SuggestModificationsResponse(suggestions=suggestions_list)
 
+    except ServiceUnavailableError:
+        raise # Rendered as 503 + Retry-After by service_unavailable_handler
     except HTTPException as http_exc:
         # Re-raise HTTPException to keep FastAPI handling
         raise http_exc
@@ -1141,7 +1254,7 @@ async def suggest_modifications_endpoint(
 # --- End NEW Suggest Modifications Endpoint --- 
 
 # --- NEW ENDPOINT FOR UI GENERATION WITH FILES ---
-@app.post("/api/v2/generate-full-code-with-files")
+@app.post("/api/v2/generate-full-code-with-files", dependencies=[Depends(require_model_capacity("generation"))])
 async def generate_full_code_with_files_endpoint(
     prompt: str = Form(...),
     files: List[UploadFile] = File(default=[]), # Make files optional
@@ -1159,17 +1272,10 @@ async def generate_full_code_with_files_endpoint(
         # For now, we prepare as much as possible.
         # raise HTTPException(status_code=500, detail="AI service not configured for file uploads.")
 
-    gemini_client = None
-    try:
-        if os.getenv("GOOGLE_API_KEY"): # Only initialize client if API key is available
-            gemini_client = genai.Client() # Assumes genai.configure() has been called
-            if not gemini_client:
-                 logger.warning("Failed to initialize Gemini Client, Files API uploads will not be possible.")
-        else:
-            logger.warning("GOOGLE_API_KEY not set. Gemini Files API uploads will not be possible.")
-    except Exception as e:
-        logger.error(f"Error initializing Gemini Client: {e}. Files API uploads will not be possible.")
-        gemini_client = None # Ensure client is None if init fails
+    # The shared client (built and warmed at startup); None if it could not be created
+    gemini_client = component_service_instance.client
+    if not gemini_client:
+        logger.warning("Model client not available. Gemini Files API uploads will not be possible.")
 
     with tempfile.TemporaryDirectory() as temp_dir:
         for uploaded_file in files:
@@ -1230,10 +1336,10 @@ async def generate_full_code_with_files_endpoint(
                     with open(temp_local_path, 'wb') as temp_f:
                         temp_f.write(file_bytes)
                     logger.info(f"Attempting to upload '{uploaded_file.filename}' to Gemini Files API from path: {temp_local_path}")
-                    gemini_uploaded_file_obj = gemini_client.files.upload(
-                        path=temp_local_path,
-                        display_name=uploaded_file.filename,
-                        mime_type=uploaded_file.content_type
+                    gemini_uploaded_file_obj = await asyncio.to_thread(
+                        gemini_client.files.upload,
+                        file=temp_local_path,
+                        config={"display_name": uploaded_file.filename, "mime_type": uploaded_file.content_type},
                     )
                     if gemini_uploaded_file_obj:
                         metadata["id"] = gemini_uploaded_file_obj.name
@@ -1257,20 +1363,25 @@ async def generate_full_code_with_files_endpoint(
     
     try:
         logger.info(f"Calling component service for UI generation. Prompt: '{prompt[:100]}...', {len(processed_files_metadata)} files processed, {len(gemini_sdk_file_objects)} for Gemini Files API.")
-        content_stream = component_service_instance.generate_ui_from_prompt_and_files(
-            text_prompt=prompt,
-            uploaded_files_info=processed_files_metadata,
-            gemini_file_objects=gemini_sdk_file_objects,
-            user=current_user
-        )
-        if gemini_client:
-            for sdk_file_obj in gemini_sdk_file_objects:
-                try:
-                    logger.info(f"Attempting to delete file {sdk_file_obj.name} from Gemini Files API.")
-                    gemini_client.files.delete(name=sdk_file_obj.name)
-                except Exception as del_e:
-                    logger.error(f"Failed to delete file {sdk_file_obj.name} from Gemini Files API: {del_e}", exc_info=True)
-        return StreamingResponse(content_stream, media_type="text/event-stream")
+        async def content_stream():
+            try:
+                async for chunk in component_service_instance.generate_ui_from_prompt_and_files(
+                    text_prompt=prompt,
+                    uploaded_files_info=processed_files_metadata,
+                    gemini_file_objects=gemini_sdk_file_objects,
+                    user=current_user
+                ):
+                    yield chunk
+            finally:
+                # Uploaded files are deleted once the generation that references them has finished
+                for sdk_file_obj in gemini_sdk_file_objects:
+                    try:
+                        logger.info(f"Attempting to delete file {sdk_file_obj.name} from Gemini Files API.")
+                        await asyncio.to_thread(gemini_client.files.delete, name=sdk_file_obj.name)
+                    except Exception as del_e:
+                        logger.error(f"Failed to delete file {sdk_file_obj.name} from Gemini Files API: {del_e}", exc_info=True)
+        shaped_stream = shape_stream(content_stream(), get_flush_policy("v2-generate-full-code-with-files"), name="v2-generate-full-code-with-files")
+        return StreamingResponse(shaped_stream, media_type="text/event-stream")
     except HTTPException:
         raise
     except Exception as e:
@@ -1281,7 +1392,7 @@ async def generate_full_code_with_files_endpoint(
         )
 
 # --- NEW ENDPOINT FOR MODIFICATION WITH FILES ---
-@app.post("/api/v2/modify-full-code-with-files")
+@app.post("/api/v2/modify-full-code-with-files", dependencies=[Depends(require_model_capacity("modification"))])
 async def modify_full_code_with_files_endpoint(
     modification_prompt: str = Form(...),
     current_html: str = Form(...),
@@ -1337,22 +1448,25 @@ async def modify_full_code_with_files_endpoint(
                 file_info["id"] = file.filename # Use filename as ID if not using Files API
                 logger.debug(f"Included data URL for {file.filename}")
             
-            # OTHER/LARGE FILES: Upload to Gemini Files API (requires genai configured)
+            # OTHER/LARGE FILES: Upload to Gemini Files API (through the shared model client)
             else:
                 try:
                     logger.debug(f"Attempting to upload {file.filename} ({mime_type}) to Gemini Files API...")
-                    # Ensure genai is initialized (ideally done globally)
-                    if not component_service_instance.genai_configured:
-                         component_service_instance.configure_genai() # Make sure it's configured
-                    
-                    uploaded_file = component_service_instance.upload_file(file.filename, file_content, mime_type)
+                    # Uploaded through the shared client (built and warmed at startup)
+                    if not component_service_instance.client:
+                        raise RuntimeError("Model client not available")
+                    uploaded_file = await asyncio.to_thread(
+                        component_service_instance.client.files.upload,
+                        file=io.BytesIO(file_content),
+                        config={"display_name": file.filename, "mime_type": mime_type},
+                    )
                     if uploaded_file:
                         file_info["gemini_uri"] = uploaded_file.uri
                         file_info["id"] = uploaded_file.name # Use the Gemini file ID (e.g., files/xxxx)
                         gemini_sdk_file_objects.append(uploaded_file) # Keep the SDK object
                         logger.info(f"Successfully uploaded {file.filename} to Gemini Files API. URI: {uploaded_file.uri}")
                     else:
-                        logger.warning(f"Failed to upload {file.filename} to Gemini Files API, genai.upload_file returned None.")
+                        logger.warning(f"Failed to upload {file.filename} to Gemini Files API, files.upload returned None.")
                         # Fallback: only include basic metadata without URI/ID/object
                         pass
                 except Exception as e:
@@ -1391,7 +1505,8 @@ async def modify_full_code_with_files_endpoint(
                     #    except Exception as del_e:
                     #        logger.error(f"Error deleting Gemini file {sdk_file.name}: {del_e}")
 
-        return StreamingResponse(stream_generator(), media_type="text/html")
+        shaped_stream = shape_stream(stream_generator(), get_flush_policy("v2-modify-full-code-with-files"), name="v2-modify-full-code-with-files")
+        return StreamingResponse(shaped_stream, media_type="text/html")
 
     except Exception as e:
         logger.error(f"Error processing file uploads or calling modification service: {e}", exc_info=True)
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Keep test runs from appending to the checked-in request/generation logs
+# or filling the working-directory generation cache.
+_log_dir = tempfile.mkdtemp(prefix="morpheo-test-logs-")
+os.environ.setdefault("MORPHEO_REQUEST_LOG_PATH", os.path.join(_log_dir, "gemini_request_log.txt"))
+os.environ.setdefault("MORPHEO_GENERATION_LOG_PATH", os.path.join(_log_dir, "morpheo_generation_log.jsonl"))
+os.environ.setdefault("MORPHEO_ROUTING_LOG_PATH", os.path.join(_log_dir, "morpheo_routing_log.jsonl"))
+os.environ.setdefault("MORPHEO_GEN_CACHE_DIR", os.path.join(_log_dir, "generation_cache"))
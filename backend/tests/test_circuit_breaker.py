@@ -0,0 +1,151 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import time
+
+import pytest
+from google.genai import errors as genai_errors
+
+from backend.components.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+from backend.components.errors import CircuitOpenError
+from backend.components.model_backend import _make_text_chunk
+from backend.components.retry_policy import RetryPolicy
+from backend.components.service import ComponentService
+
+
+def _server_error():
+    return genai_errors.ServerError(503, {"error": {"code": 503, "message": "unavailable", "status": "UNAVAILABLE"}})
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker("m/chat", min_calls=4, failure_threshold=0.5, open_s=0.05)
+    for _ in range(2):
+        breaker.record_success(0.1)
+    breaker.record_outcome(genai_errors.ClientError(400, {"error": {"message": "bad"}}), None)  # Not the model's fault
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()  # One probe at a time
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()  # Re-opened with a doubled cool-down
+
+    time.sleep(0.06)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED and breaker.times_opened == 2
+
+
+def test_slow_first_chunks_open_the_breaker():
+    breaker = CircuitBreaker("m/generation", min_calls=5, slow_call_s=1.0, slow_threshold=0.8)
+    for _ in range(4):
+        breaker.record_success(2.5)
+    breaker.record_success(0.2)
+    assert breaker.state == OPEN
+
+
+class _RecordingModels:
+    def __init__(self, failing_model, text="ok"):
+        self.failing_model = failing_model
+        self.text = text
+        self.models = []
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.models.append(model)
+        if model == self.failing_model:
+            raise _server_error()
+        return self._stream()
+
+    async def _stream(self):
+        yield _make_text_chunk(self.text)
+
+
+class _Client:
+    def __init__(self, models):
+        self.aio = type("Aio", (), {"models": models})()
+
+
+def _collect(service, task="modification"):
+    async def run():
+        return "".join([chunk async for chunk in service._call_gemini_with_retry("hi", task=task)])
+    return asyncio.run(run())
+
+
+def test_open_circuit_fails_fast_then_fails_over():
+    models = _RecordingModels(failing_model="gemini-2.0-flash")
+    service = ComponentService(client=_Client(models))
+    service.retry_policy = RetryPolicy(max_retries=0)
+    service.breakers = CircuitBreakers(min_calls=3, open_s=60)
+
+    for _ in range(3):
+        assert "<!-- ERROR:" in _collect(service)
+    calls_before = len(models.models)
+    with pytest.raises(CircuitOpenError) as excinfo:
+        _collect(service)
+    assert len(models.models) == calls_before  # Refused without touching the upstream
+    assert excinfo.value.retry_after > 50
+    # Breakers are per task: generation still reaches the upstream
+    assert "<!-- ERROR:" in _collect(service, task="generation")
+    assert len(models.models) == calls_before + 1
+
+    service.breakers.fallback_model = "gemini-1.5-flash"
+    assert _collect(service) == "ok"
+    assert models.models[-1] == "gemini-1.5-flash"
+    assert service.breakers.snapshot()["breakers"]["gemini-2.0-flash/modification"]["state"] == OPEN
+
+
+def test_failed_over_generation_is_not_cached_as_the_primary_model(tmp_path):
+    from backend.components.generation_cache import GenerationCache
+
+    page = "<!DOCTYPE html><html><body>Fallback</body></html>"
+    models = _RecordingModels(failing_model="gemini-2.0-flash", text=page)
+    service = ComponentService(client=_Client(models))
+    service.generation_cache = GenerationCache(str(tmp_path))
+    service.breakers = CircuitBreakers(fallback_model="gemini-1.5-flash", min_calls=3, open_s=60)
+    for _ in range(3):
+        service.breakers.get("gemini-2.0-flash", "generation").record_failure()
+
+    async def generate():
+        return "".join([chunk async for chunk in service.generate_full_component_code("a todo app", user_id="u")])
+
+    assert asyncio.run(generate()) == page
+    assert models.models == ["gemini-1.5-flash"]
+    assert service.generation_cache.stats.stores == 0 and len(service.similarity_index) == 0
+    assert service._flight_models == {}
+
+    # Once the primary model answers again its pages are cached as usual
+    service.breakers = CircuitBreakers(min_calls=3, open_s=60)
+    models.failing_model = None
+    asyncio.run(generate())
+    assert service.generation_cache.stats.stores == 1
+
+
+def test_image_generation_holds_a_permit_and_trips_its_breaker():
+    class Models:
+        def __init__(self):
+            self.calls = 0
+
+        async def generate_content(self, model, contents, config=None):
+            self.calls += 1
+            raise _server_error()
+
+    models = Models()
+    service = ComponentService(client=_Client(models))
+    service.breakers = CircuitBreakers(min_calls=3, open_s=60)
+
+    for _ in range(3):
+        assert "error" in asyncio.run(service.generate_image("a red fox"))
+    assert service.limiter.in_flight == 0
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(service.generate_image("a red fox"))
+    assert models.calls == 3
@@ -0,0 +1,50 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.client_manager import ClientManager
+from backend.components.model_backend import SyntheticGeminiClient
+from backend.components.service import ComponentService
+
+
+def test_one_client_is_shared_and_warmed():
+    manager = ClientManager(backend="synthetic")
+    first = ComponentService(client_manager=manager)
+    second = ComponentService(client_manager=manager)
+    assert isinstance(first.client, SyntheticGeminiClient) and first.client is second.client is manager.get()
+
+    assert asyncio.run(manager.warm()) is True
+    snapshot = manager.snapshot()
+    assert snapshot["built"] and snapshot["warm_ms"] is not None and snapshot["pool"] is None
+
+
+def test_gemini_client_uses_the_managed_pool_and_closes_it(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    manager = ClientManager(backend="gemini", max_connections=8, max_keepalive_connections=4, keepalive_expiry_s=30)
+    client = manager.get()
+    pool = manager._async_http
+    assert client._api_client._async_httpx_client is pool and client._api_client._httpx_client is manager._http
+    assert manager.snapshot()["pool"] == {"max_connections": 8, "max_keepalive_connections": 4, "keepalive_expiry_s": 30}
+
+    async def unreachable(model):
+        raise ConnectionError("no route to host")
+
+    monkeypatch.setattr(client.aio.models, "get", unreachable)
+    assert asyncio.run(manager.warm()) is False  # Never raises; the first request connects instead
+    assert "no route" in manager.snapshot()["warm_error"]
+
+    asyncio.run(manager.aclose())
+    asyncio.run(manager.aclose())
+    assert pool.is_closed and manager.snapshot()["closed"]
+
+    never_built = ClientManager(backend="synthetic")
+    asyncio.run(never_built.aclose())
+    with pytest.raises(RuntimeError):
+        never_built.get()  # No client is built after shutdown
@@ -0,0 +1,151 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.concurrency import AdaptiveLimiter
+from backend.components.errors import OverloadedError
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+
+
+def test_queue_full_rejects_fast_and_queued_callers_get_freed_slots():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_size=1, queue_timeout_s=1.0)
+
+    async def run():
+        held = await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 1
+
+        with pytest.raises(OverloadedError) as exc_info:
+            limiter.check_admission()
+        assert int(exc_info.value.retry_after_header) >= 1
+        with pytest.raises(OverloadedError):
+            await limiter.acquire()
+
+        held.release()
+        permit = await waiting
+        assert limiter.in_flight == 1 and limiter.queue_depth == 0
+        permit.release()
+
+    asyncio.run(run())
+    assert limiter.rejected_full == 2
+
+
+def test_queued_caller_times_out():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_size=4)
+
+    async def run():
+        held = await limiter.acquire()
+        with pytest.raises(OverloadedError):
+            await limiter.acquire(timeout=0.01)
+        assert limiter.queue_depth == 0
+        held.release()
+
+    asyncio.run(run())
+    assert limiter.rejected_timeout == 1 and limiter.in_flight == 0
+
+
+def test_limit_grows_when_saturated_and_backs_off_on_rate_limit():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=10, backoff=0.5)
+
+    async def run():
+        for _ in range(20):
+            permits = [await limiter.acquire() for _ in range(limiter.limit)]
+            for permit in permits:
+                permit.mark_first_chunk()
+                permit.release()
+        grown = limiter.limit
+        assert grown > 2
+
+        permit = await limiter.acquire()
+        permit.release(rate_limited=True)
+        assert limiter.limit <= grown // 2 + 1
+        assert limiter.rate_limited == 1
+
+    asyncio.run(run())
+
+
+def test_service_propagates_overload_instead_of_error_marker():
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=50, seed=1)))
+    service.limiter = AdaptiveLimiter(initial_limit=1, queue_size=0)
+
+    async def run():
+        held = await service.limiter.acquire()
+        try:
+            return [chunk async for chunk in service._call_gemini_with_retry("Build a todo app")]
+        finally:
+            held.release()
+
+    with pytest.raises(OverloadedError):
+        asyncio.run(run())
+
+
+def _admission_order(limiter, requests):
+    """Queues `requests` [(task, user)] behind one held slot and returns the order they are admitted."""
+    order = []
+
+    async def waiter(label, task, user):
+        permit = await limiter.acquire(task=task, user=user)
+        order.append(label)
+        await asyncio.sleep(0)
+        permit.release()
+
+    async def run():
+        held = await limiter.acquire()
+        tasks = []
+        for index, (task, user) in enumerate(requests):
+            tasks.append(asyncio.create_task(waiter(f"{task}:{user}:{index}", task, user)))
+            await asyncio.sleep(0)
+        held.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    return order
+
+
+def test_priority_classes_are_served_in_order():
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=1, queue_size=10)
+    order = _admission_order(limiter, [("suggestion", "a"), ("generation", "a"), ("chat", "a")])
+    assert [label.split(":")[0] for label in order] == ["chat", "generation", "suggestion"]
+
+
+def test_heavy_user_does_not_starve_others():
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=1, queue_size=10)
+    requests = [("generation", "heavy")] * 5 + [("generation", "light")]
+    order = _admission_order(limiter, requests)
+    assert order.index("generation:light:5") <= 1
+
+
+def test_full_queue_sheds_lower_priority_work():
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=1, queue_size=2, queue_timeout_s=1.0)
+
+    async def run():
+        held = await limiter.acquire()
+        background = [asyncio.create_task(limiter.acquire(task="suggestion", user="a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError):
+            limiter.check_admission("suggestion")
+        limiter.check_admission("chat")  # Outranks queued work: admitted to the queue
+
+        interactive = asyncio.create_task(limiter.acquire(task="chat", user="b"))
+        await asyncio.sleep(0)
+        held.release()
+        permit = await interactive
+        permit.release()
+
+        results = await asyncio.gather(*background, return_exceptions=True)
+        assert sum(isinstance(r, OverloadedError) for r in results) == 1
+        for result in results:
+            if not isinstance(result, BaseException):
+                result.release()
+
+    asyncio.run(run())
+    assert limiter.shed == 1
@@ -0,0 +1,132 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+from backend.components.context_cache import ContextCache
+from backend.components.model_backend import SyntheticCaches, SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.prompt_store import WC_TEMPLATE, TemplateStore
+from backend.components.service import ComponentService
+
+TEMPLATE = "Build self-contained web components. " * 200
+
+
+def _client_with(caches):
+    return type("Client", (), {"aio": type("Aio", (), {"caches": caches})()})()
+
+
+def test_handles_are_created_once_refreshed_and_recreated():
+    caches = SyntheticCaches()
+    client = _client_with(caches)
+    cache = ContextCache(ttl_s=60, refresh_margin_s=10, min_tokens=100)
+
+    async def run():
+        return await asyncio.gather(*(cache.handle_for(client, "m", TEMPLATE) for _ in range(5)))
+
+    names = asyncio.run(run())
+    assert len(set(names)) == 1 and names[0].startswith("cachedContents/")
+    assert caches.created == 1 and cache.stats.hits == 5
+
+    # Near expiry the TTL is extended instead of creating a new handle
+    handle = next(iter(cache._handles.values()))
+    handle.expires_at -= 55
+    assert asyncio.run(cache.handle_for(client, "m", TEMPLATE)) == names[0]
+    assert cache.stats.refreshed == 1 and handle.expires_at - handle.created_at > 50
+
+    # Expired locally, or rejected upstream: a new handle is created
+    handle.expires_at = 0
+    second = asyncio.run(cache.handle_for(client, "m", TEMPLATE))
+    assert second != names[0] and cache.stats.expired == 1
+    cache.invalidate(second)
+    assert asyncio.run(cache.handle_for(client, "m", TEMPLATE)) not in (None, second)
+    assert caches.created == 3 and cache.stats.invalidated == 1
+
+    # Other templates and models get their own handles; short prefixes are sent inline
+    assert asyncio.run(cache.handle_for(client, "other", TEMPLATE)) is not None
+    assert asyncio.run(cache.handle_for(client, "m", "short")) is None
+    assert cache.snapshot()["inline"] == 1 and len(cache.snapshot()["handles"]) == 2
+
+
+def test_failed_creation_falls_back_inline_for_a_while():
+    class FailingCaches:
+        calls = 0
+
+        async def create(self, model, config=None):
+            FailingCaches.calls += 1
+            raise RuntimeError("caching not supported for this model")
+
+    cache = ContextCache(min_tokens=100, retry_after_failure_s=60)
+    client = _client_with(FailingCaches())
+    assert asyncio.run(cache.handle_for(client, "m", TEMPLATE)) is None
+    assert asyncio.run(cache.handle_for(client, "m", TEMPLATE)) is None
+    assert FailingCaches.calls == 1 and cache.stats.failures == 1 and cache.stats.inline == 2
+    assert asyncio.run(cache.handle_for(object(), "m", TEMPLATE)) is None  # Client without a caches API
+
+
+def test_generation_sends_only_the_suffix_and_recovers_from_a_lost_handle(tmp_path):
+    client = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=5, tokens_per_sec=50_000, response_tokens=200, seed=1))
+    service = ComponentService(client=client)
+    service.context_cache = ContextCache(min_tokens=100)
+    (tmp_path / WC_TEMPLATE).write_text(TEMPLATE, encoding="utf-8")
+    service.templates = TemplateStore(str(tmp_path))
+    requests = []
+    original = client.aio.models.generate_content_stream
+
+    async def recording(model, contents, config=None):
+        requests.append((contents, dict(config)))
+        return await original(model=model, contents=contents, config=config)
+
+    client.aio.models.generate_content_stream = recording
+
+    async def generate(request):
+        return "".join([chunk async for chunk in service.generate_full_component_code(request, use_cache=False)])
+
+    assert "</html>" in asyncio.run(generate("a todo app"))
+    contents, config = requests[-1]
+    assert config["cached_content"].startswith("cachedContents/")
+    assert contents[0].startswith("\n\n## User Request:") and TEMPLATE not in contents[0]
+
+    # Upstream expiry: the request is resent inline and the handle is dropped
+    client.aio.caches.expire(config["cached_content"])
+    assert "</html>" in asyncio.run(generate("a calculator"))
+    contents, config = requests[-1]
+    assert "cached_content" not in config and contents[0].startswith(TEMPLATE)
+    assert service.context_cache.stats.invalidated == 1
+
+    asyncio.run(generate("a timer"))
+    assert requests[-1][1]["cached_content"] and client.aio.caches.created == 2
+
+    # Grounded requests carry tools, which the API refuses alongside cached content: sent inline
+    async def grounded(request):
+        return "".join([chunk async for chunk in service.generate_full_component_code(request, enable_grounding=True, use_cache=False)])
+
+    assert "</html>" in asyncio.run(grounded("today's weather"))
+    contents, config = requests[-1]
+    assert config["tools"] and "cached_content" not in config and contents[0].startswith(TEMPLATE)
+
+
+def test_modifications_share_the_static_prefix_and_cached_tokens_are_tracked(tmp_path):
+    client = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=5, tokens_per_sec=50_000, response_tokens=200, seed=1, implicit_cache_min_tokens=100))
+    service = ComponentService(client=client)
+    service.context_cache = ContextCache(enabled=False)  # Implicit (upstream prefix) caching only
+    (tmp_path / WC_TEMPLATE).write_text(TEMPLATE, encoding="utf-8")
+    service.templates = TemplateStore(str(tmp_path))
+
+    first = service._create_modification_prompt("make it blue", "<html><body>App one</body></html>")
+    second = service._create_modification_prompt("add a title", "<html><body>Another app</body></html>")
+    shared = os.path.commonprefix([first, second])
+    assert TEMPLATE in shared and "EXISTING HTML CODE" in shared and "App one" not in shared
+
+    async def modify(request, html):
+        return "".join([chunk async for chunk in service.modify_full_component_code(request, html)])
+
+    asyncio.run(modify("make it blue", "<html><body>App one</body></html>"))
+    asyncio.run(modify("add a title", "<html><body>Another app</body></html>"))
+    stats = service.prompt_usage.snapshot()["tasks"]["modification"]
+    assert stats["requests"] == 2 and stats["cache_hit_rate"] == 0.5
+    assert 0.4 < stats["cached_share"] < 0.5 and stats["est_input_cost_saving"] > 0
+    assert stats["avg_first_chunk_s_cache_hit"] is not None and stats["avg_first_chunk_s_cache_miss"] is not None
@@ -0,0 +1,130 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.errors import OverloadedError
+from backend.components.edit_protocol import FULL, Edit, EditError, EditProtocol, apply_edits, apply_reply, parse_edits
+from backend.components.model_backend import _make_text_chunk
+from backend.components.security_scan import FULL as FULL_CORRECTION, SecurityScanning
+from backend.components.service import ComponentService
+
+ROWS = "".join(f"    <li>Item {i}</li>\n" for i in range(300))
+DOC = (
+    "<!DOCTYPE html>\n<html>\n<body>\n  <h1>Todo</h1>\n  <ul>\n" + ROWS + "  </ul>\n"
+    "  <button id=\"add\">Add</button>\n</body>\n</html>"
+)
+EDIT_REPLY = (
+    "<<<<<<< SEARCH\n  <h1>Todo</h1>\n=======\n  <h1>My Todo List</h1>\n>>>>>>> REPLACE\n"
+    "<<<<<<< SEARCH\n<button id=\"add\">Add</button>\n=======\n  <button id=\"add\" class=\"blue\">Add</button>\n>>>>>>> REPLACE\n"
+)
+
+
+class _Models:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.prompts.append(contents[0] if isinstance(contents, list) else contents)
+        return self._stream(self.responses.pop(0))
+
+    async def _stream(self, text):
+        for i in range(0, len(text), 50):
+            yield _make_text_chunk(text[i:i + 50])
+
+
+def _service(models):
+    service = ComponentService(client=type("Client", (), {"aio": type("Aio", (), {"models": models})()})())
+    service.edit_protocol = EditProtocol()
+    return service
+
+
+def _modify(service, request):
+    async def run():
+        return "".join([chunk async for chunk in service.modify_full_component_code(request, DOC)])
+    return asyncio.run(run())
+
+
+def test_edits_are_applied_exactly_or_by_line_and_rejected_when_ambiguous():
+    edits = parse_edits(EDIT_REPLY)
+    assert edits[0] == Edit("  <h1>Todo</h1>", "  <h1>My Todo List</h1>")
+    edited = apply_edits(DOC, edits)  # The second SEARCH lost its indentation: matched line by line
+    assert "<h1>My Todo List</h1>" in edited and '  <button id="add" class="blue">Add</button>\n</body>' in edited
+    assert edited.count("<li>") == 300
+
+    with pytest.raises(EditError, match="matches 300 places"):
+        apply_edits(DOC, [Edit("<li>", "<li class='x'>")])
+    with pytest.raises(EditError, match="not found"):
+        apply_edits(DOC, [Edit("<h2>Missing</h2>", "")])
+    with pytest.raises(EditError, match="removed the end"):
+        apply_reply(DOC, "<<<<<<< SEARCH\n</body>\n</html>\n=======\n>>>>>>> REPLACE")
+    with pytest.raises(EditError, match="no search/replace edits"):
+        apply_reply(DOC, "Sure! Here is the change you asked for.")
+    assert apply_reply(DOC, "<!DOCTYPE html><html></html>") == ("<!DOCTYPE html><html></html>", 0)
+    assert apply_reply(DOC, "```html\n<!DOCTYPE html><html></html>\n```\n") == ("<!DOCTYPE html><html></html>", 0)
+    with pytest.raises(EditError, match="ends before </html>"):
+        apply_reply(DOC, "<!DOCTYPE html><html><body>trunc")
+
+
+def test_modification_applies_edits_and_reports_savings():
+    models = _Models(DOC, EDIT_REPLY)
+    service = _service(models)
+    service.edit_protocol = EditProtocol(FULL)
+    assert _modify(service, "warm up") == DOC  # Full rewrite: the latency baseline
+    assert "FULL MODIFIED HTML CODE" in models.prompts[0]
+
+    service.edit_protocol.mode = "edits"
+    result = _modify(service, "rename the title and make the button blue")
+    assert "SEARCH/REPLACE EDITS" in models.prompts[1] and "<<<<<<< SEARCH" in models.prompts[1]
+    assert result == apply_reply(DOC, EDIT_REPLY)[0]
+
+    stats = service.edit_protocol.snapshot()
+    assert stats["applied"] == 1 and stats["avg_edits"] == 2 and stats["fallbacks"] == 0
+    assert stats["output_tokens_saved"] > 1000 and stats["avg_latency_saved_s"] is not None
+
+
+def test_modification_falls_back_to_a_full_rewrite_when_edits_do_not_apply():
+    rewritten = DOC.replace("Todo", "Tasks")
+    models = _Models("<<<<<<< SEARCH\n<h1>Done</h1>\n=======\n<h1>Tasks</h1>\n>>>>>>> REPLACE", rewritten)
+    service = _service(models)
+
+    assert _modify(service, "rename the title") == rewritten
+    assert len(models.prompts) == 2 and "FULL MODIFIED HTML CODE" in models.prompts[1]
+    stats = service.edit_protocol.snapshot()
+    assert stats["fallbacks"] == 1 and stats["fallback_rate"] == 1.0 and stats["applied"] == 0
+    assert service.prompt_modules.snapshot()["prompts"] == 1  # The rebuilt prompt is not counted twice
+
+
+def test_unsafe_edits_are_corrected_from_the_full_rewrite_prompt_and_refusals_do_not_fall_back():
+    unsafe_reply = "<<<<<<< SEARCH\n  <h1>Todo</h1>\n=======\n  <h1>Todo</h1><script>ev" + "al(x)</script>\n>>>>>>> REPLACE"
+    models = _Models(unsafe_reply, DOC)
+    service = _service(models)
+    service.security = SecurityScanning(correction_mode=FULL_CORRECTION)
+    user = type("User", (), {"username": "u"})()
+
+    async def modify(service):
+        return [chunk async for chunk in service.modify_ui_from_prompt_and_files("add a script", DOC, [], [], user)]
+
+    out = asyncio.run(modify(service))
+    assert "<!-- MORPHEO_CORRECTION_COMMIT -->" in out
+    correction_prompt = models.prompts[1]
+    assert "FULL MODIFIED HTML CODE" in correction_prompt and "SEARCH/REPLACE EDITS" not in correction_prompt
+    assert service.prompt_modules.snapshot()["prompts"] == 1
+
+    # A shed edit call is reported, not retried as a (heavier) full rewrite
+    models = _Models(EDIT_REPLY, DOC)
+    service = _service(models)
+
+    async def refuse(**kwargs):
+        raise OverloadedError("Timed out waiting for model capacity.")
+    service.limiter.acquire = refuse
+    assert asyncio.run(modify(service)) == ["<!-- ERROR: Timed out waiting for model capacity. -->"]
+    assert _modify(service, "rename the title") == "<!-- ERROR: Timed out waiting for model capacity. -->"
+    assert models.prompts == [] and service.edit_protocol.snapshot()["fallbacks"] == 0
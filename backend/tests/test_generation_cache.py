@@ -0,0 +1,94 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import time
+
+from backend.components.generation_cache import GenerationCache, make_cache_key, normalize_request
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+
+
+def test_key_normalizes_trivial_differences():
+    assert normalize_request('  A   Calculator. ') == "a calculator"
+    key = make_cache_key("a calculator", "t1", "gemini-2.0-flash", False)
+    assert make_cache_key("A calculator!", "t1", "gemini-2.0-flash", False) == key
+    assert make_cache_key("a calculator", "t2", "gemini-2.0-flash", False) != key
+    assert make_cache_key("a calculator", "t1", "gemini-2.0-flash", True) != key
+
+
+def test_memory_lru_disk_tier_and_ttl(tmp_path):
+    cache = GenerationCache(str(tmp_path), memory_entries=1, ttl_s=60, grounded_ttl_s=0)
+    cache.put("a", "<html>a</html>")
+    cache.put("b", "<html>b</html>")  # evicts "a" from memory, disk keeps it
+    cache.put("c", "<html>c</html>", grounding=True)  # grounded entries disabled by TTL 0
+
+    assert cache.get("a") == "<html>a</html>"
+    assert cache.stats.hits_disk == 1
+    assert cache.get("a") == "<html>a</html>"
+    assert cache.stats.hits_memory == 1
+    assert cache.get("c") is None
+
+    # A fresh instance still sees the disk tier; expired entries are dropped on read
+    reopened = GenerationCache(str(tmp_path), ttl_s=60)
+    assert reopened.get("b") == "<html>b</html>"
+    expired = GenerationCache(str(tmp_path), ttl_s=60)
+    expired._read_disk = lambda key: {"html": "x", "created_at": 0, "expires_at": time.time() - 1}
+    assert expired.get("b") is None
+
+    assert reopened.invalidate() >= 2
+    assert GenerationCache(str(tmp_path)).get("a") is None
+
+
+def test_disk_tier_evicts_oldest_past_size_cap(tmp_path):
+    cache = GenerationCache(str(tmp_path), memory_entries=1, disk_max_bytes=3000)
+    for index in range(5):
+        cache.put(f"k{index}", "x" * 1000)
+        os.utime(tmp_path / f"k{index}.json", (index, time.time() - 100 + index))
+    assert cache.stats.evictions >= 2
+    assert cache.get("k4") is not None
+    assert GenerationCache(str(tmp_path)).get("k0") is None
+
+
+def test_size_cap_is_kept_without_rescanning_the_directory(tmp_path, monkeypatch):
+    cache = GenerationCache(str(tmp_path), memory_entries=1, disk_max_bytes=3000)
+    cache.put("k0", "x" * 1000)  # The first store indexes the directory
+    scans = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda path: scans.append(path) or listdir(path))
+    for index in range(1, 20):
+        cache.put(f"k{index}", "x" * 1000)
+
+    assert scans == [] and cache.stats.evictions == 18
+    remaining = sorted(listdir(tmp_path))
+    assert remaining == ["k18.json", "k19.json"]
+    assert cache.snapshot()["disk_bytes"] == sum(os.path.getsize(tmp_path / name) for name in remaining)
+
+
+def test_service_replays_cached_generation(tmp_path):
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=200, seed=3)))
+    service.generation_cache = GenerationCache(str(tmp_path))
+    calls = []
+    original = service._call_gemini_api
+
+    def counting_call(contents, accumulator=None, **kwargs):
+        calls.append(contents)
+        return original(contents, accumulator, **kwargs)
+
+    service._call_gemini_api = counting_call
+
+    async def generate(prompt, use_cache=True):
+        return "".join([chunk async for chunk in service.generate_full_component_code(prompt, use_cache=use_cache)])
+
+    first = asyncio.run(generate("a calculator"))
+    second = asyncio.run(generate("A calculator."))
+    assert second == first
+    assert len(calls) == 1
+
+    asyncio.run(generate("a calculator", use_cache=False))
+    assert len(calls) == 2
+    assert service.generation_cache.stats.bypassed == 1
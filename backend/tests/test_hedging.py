@@ -0,0 +1,102 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.errors import ModelCallError
+from backend.components.hedging import HedgeBudget, Hedger, LatencyTracker
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+
+
+def _warmed_hedger(seconds=0.02, samples=20, budget_ratio=1.0):
+    hedger = Hedger(enabled=True, budget_ratio=budget_ratio, min_samples=samples)
+    for _ in range(samples):
+        hedger._stats("chat").tracker.record(seconds)
+    hedger.budget.tokens = hedger.budget.max_tokens
+    return hedger
+
+
+def test_tracker_quantile_and_budget_ratio():
+    tracker = LatencyTracker(min_samples=10)
+    assert tracker.threshold() is None
+    for ms in range(1, 101):
+        tracker.record(ms / 1000)
+    assert tracker.threshold() == pytest.approx(0.090)
+
+    budget = HedgeBudget(ratio=0.05, max_tokens=5)
+    granted = 0
+    for _ in range(1000):
+        budget.earn()
+        granted += budget.try_spend()
+    assert 45 <= granted <= 50
+
+
+def test_slow_primary_loses_to_hedge_and_is_cancelled():
+    hedger = _warmed_hedger()
+    cancelled = []
+
+    async def attempt(is_hedge):
+        try:
+            await asyncio.sleep(0.01 if is_hedge else 5)
+            return "hedge" if is_hedge else "primary"
+        except asyncio.CancelledError:
+            cancelled.append(is_hedge)
+            raise
+
+    result = asyncio.run(hedger.run("chat", attempt))
+
+    assert result == "hedge"
+    assert cancelled == [False]
+    stats = hedger.snapshot()["classes"]["chat"]
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1 and stats["hedge_win_rate"] == 1.0
+
+
+def test_failed_primary_is_covered_by_hedge_but_budget_limits_hedges():
+    hedger = _warmed_hedger()
+
+    async def attempt(is_hedge):
+        if is_hedge:
+            return "backup"
+        await asyncio.sleep(0.2)
+        raise ModelCallError("upstream failed")
+
+    assert asyncio.run(hedger.run("chat", attempt)) == "backup"
+
+    hedger.budget.tokens, hedger.budget.ratio = 0.0, 0.05
+    with pytest.raises(ModelCallError):
+        asyncio.run(hedger.run("chat", attempt))
+    assert hedger.snapshot()["classes"]["chat"]["budget_denied"] == 1
+
+
+def test_complete_text_collects_and_backup_bypasses_coalescing():
+    client = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=200, tokens_per_sec=1e6, response_tokens=50, seed=3))
+    service = ComponentService(client=client)
+    service.hedger = _warmed_hedger(seconds=0.0)  # Always hedge immediately
+
+    async def run():
+        return await service.complete_text("Describe this image.", task="chat", shared=True)
+
+    text = asyncio.run(run())
+
+    assert text.startswith("<!DOCTYPE html>") and text.rstrip().endswith("</html>")
+    # Only the primary went through single-flight; the backup was an independent request
+    assert service.single_flight.leaders == 1
+    assert service.hedger.snapshot()["classes"]["chat"]["hedged"] == 1
+
+
+def test_large_prompt_calls_opt_out_of_hedging():
+    client = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=50, tokens_per_sec=1e6, response_tokens=50, seed=3))
+    service = ComponentService(client=client)
+    service.hedger = _warmed_hedger(seconds=0.0)
+
+    text = asyncio.run(service.complete_text("Edit this page.", task="modification", hedge=False))
+
+    assert text.rstrip().endswith("</html>")
+    assert "modification" not in service.hedger.snapshot()["classes"]  # Never handed to the hedger
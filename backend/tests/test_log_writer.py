@@ -0,0 +1,52 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import json
+
+from google.genai.types import Blob, Part
+
+from backend.components.log_writer import LogWriter, sanitize
+
+
+def test_sanitize_redacts_binary_and_truncates():
+    payload = {
+        "contents": ["Describe this image.", Part(inline_data=Blob(mime_type="image/png", data=b"\x89PNG" * 1000))],
+        "raw": b"\x00" * 5000,
+        "prompt": "data:image/png;base64," + "A" * 4000 + " tail",
+        "response": "x" * 5000,
+    }
+    clean = sanitize(payload, max_chars=100)
+
+    assert clean["contents"][1] == "<inline image/png 4000 bytes redacted>"
+    assert clean["raw"] == "<binary 5000 bytes redacted>"
+    assert clean["prompt"] == "data:image/png;base64,<4000 chars redacted> tail"
+    assert clean["response"].startswith("x" * 100) and "truncated 4900 chars" in clean["response"]
+
+
+def test_writer_batches_and_rotates(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    writer = LogWriter(path, max_bytes=2000, backup_count=2, flush_interval_s=0.01, batch_size=5)
+    for i in range(60):
+        assert writer.write({"i": i, "payload": "y" * 100})
+        if i % 5 == 4:
+            writer.flush()
+    writer.close()
+
+    assert writer.rotations >= 1
+    assert os.path.exists(path + ".1")
+    assert not os.path.exists(path + ".3")
+    with open(path, encoding="utf-8") as f:
+        last = [json.loads(line) for line in f][-1]
+    assert last["i"] == 59
+
+
+def test_writer_sampling_and_queue_bound(tmp_path):
+    writer = LogWriter(str(tmp_path / "log.jsonl"), sample_rate=0.0, queue_size=1)
+    assert writer.write({"dropped": True}) is False
+    assert writer.write({"forced": True}, force=True) is True
+    assert writer.sampled_out == 1
+    writer.close()
@@ -0,0 +1,81 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import time
+
+import pytest
+from google.genai import errors as genai_errors
+
+from backend.components.model_backend import (
+    RecordingGeminiClient,
+    ReplayGeminiClient,
+    SyntheticGeminiClient,
+    SyntheticStreamConfig,
+)
+from backend.components.service import ComponentService
+
+
+async def _collect(client, contents="a calculator"):
+    stream = await client.aio.models.generate_content_stream(model="gemini-2.0-flash", contents=contents)
+    return [chunk.text async for chunk in stream]
+
+
+def test_synthetic_stream_honours_ttft_and_size():
+    config = SyntheticStreamConfig(ttft_ms=50, tokens_per_sec=10_000, response_tokens=400, chunk_sigma=0, chunk_tokens=40, seed=1)
+    client = SyntheticGeminiClient(config)
+
+    start = time.perf_counter()
+    chunks = asyncio.run(_collect(client))
+    elapsed = time.perf_counter() - start
+
+    assert len(chunks) == 10
+    assert "".join(chunks).startswith("<!DOCTYPE html>")
+    assert elapsed >= 0.05
+
+
+def test_synthetic_rate_limit_injection():
+    client = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, rate_limit_rate=1.0, seed=1))
+    with pytest.raises(genai_errors.ClientError) as exc_info:
+        asyncio.run(_collect(client))
+    assert exc_info.value.code == 429
+
+
+def test_record_then_replay_reproduces_chunks(tmp_path):
+    cassette = str(tmp_path / "cassette.jsonl")
+    upstream = SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=300, seed=7))
+    recorder = RecordingGeminiClient(upstream, cassette)
+    recorded = asyncio.run(_collect(recorder))
+
+    async def abandon():  # The consumer stops after the first chunk (e.g. a client disconnect)
+        stream = await recorder.aio.models.generate_content_stream(model="gemini-2.0-flash", contents="a calculator")
+        async for _ in stream:
+            break
+        await stream.aclose()
+
+    asyncio.run(abandon())
+    recorder.cassette.flush()
+    with open(cassette, encoding="utf-8") as f:
+        assert ['"incomplete": true' in line for line in f] == [False, True]
+
+    replay = ReplayGeminiClient(cassette, speed=0, synthetic_fallback=False)
+    assert len(replay.cassette) == 1  # The truncated take is on disk but never replayed
+    assert asyncio.run(_collect(replay)) == recorded and asyncio.run(_collect(replay)) == recorded
+
+    with pytest.raises(LookupError):
+        asyncio.run(_collect(replay, contents="something never recorded"))
+
+
+def test_service_streams_from_injected_client():
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=200, seed=3)))
+
+    async def run():
+        return "".join([chunk async for chunk in service._call_gemini_with_retry("Build a todo app")])
+
+    html = asyncio.run(run())
+    assert html.startswith("<!DOCTYPE html>")
+    assert "<!-- ERROR:" not in html
@@ -0,0 +1,86 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.model_backend import _make_text_chunk
+from backend.components.model_registry import DEFAULT_REGISTRY, ModelRegistry
+from backend.components.service import ComponentService
+
+
+class _Log:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record, force=False):
+        self.records.append(record)
+        return True
+
+
+def test_routes_by_prompt_size_capability_and_latency():
+    log = _Log()
+    registry = ModelRegistry.from_dict(DEFAULT_REGISTRY, routing_log=log)
+
+    assert registry.route("chat", "What does this button do?").model == "gemini-2.0-flash-lite"
+    assert registry.route("generation", "x" * 400).model == "gemini-2.0-flash"
+
+    large = registry.route("chat", [{"role": "user", "parts": [{"text": "x" * 80000}]}])
+    assert large.model == "gemini-2.0-flash" and large.prompt_tokens == 20000
+    assert "exceeds 16000" in large.skipped[0]
+
+    assert registry.route("chat", "hi", needs=("grounding",)).model == "gemini-2.0-flash"
+    assert registry.route("chat", "hi", available=lambda m: m != "gemini-2.0-flash-lite").model == "gemini-2.0-flash"
+
+    registry.observe("gemini-2.0-flash-lite", 4.0)
+    slow = registry.route("suggestion", "hi")
+    assert slow.model == "gemini-2.0-flash" and "over budget" in slow.skipped[0]
+
+    assert len(log.records) == 6 and log.records[-1]["model"] == "gemini-2.0-flash"
+    assert registry.snapshot()["decisions"]["chat"] == {"gemini-2.0-flash-lite": 1, "gemini-2.0-flash": 3}
+
+
+def test_slow_model_is_probed_once_its_sample_is_stale():
+    registry = ModelRegistry.from_dict(DEFAULT_REGISTRY)
+    registry.latency_probe_s = 0.0
+    registry.observe("gemini-2.0-flash-lite", 4.0)
+
+    assert registry.route("suggestion", "hi", log=False).model == "gemini-2.0-flash"
+    assert registry.route("suggestion", "hi").model == "gemini-2.0-flash-lite"
+    registry.latency_probe_s = 60.0
+    assert registry.route("suggestion", "hi").model == "gemini-2.0-flash"
+
+    registry.observe("gemini-2.0-flash-lite", 0.5)
+    assert registry.snapshot()["latency_s"]["gemini-2.0-flash-lite"] == 0.5
+    assert registry.route("suggestion", "hi").model == "gemini-2.0-flash-lite"
+
+
+def test_unknown_model_in_rule_is_rejected():
+    config = dict(DEFAULT_REGISTRY, rules=[{"task": "chat", "candidates": [{"model": "no-such-model"}]}])
+    with pytest.raises(ValueError):
+        ModelRegistry.from_dict(config)
+
+
+def test_service_calls_use_the_routed_model():
+    requested = []
+
+    class Models:
+        async def generate_content_stream(self, model, contents, config=None):
+            requested.append(model)
+            async def stream():
+                yield _make_text_chunk("1. Add a dark mode toggle")
+            return stream()
+
+    client = type("Client", (), {"aio": type("Aio", (), {"models": Models()})()})()
+    service = ComponentService(client=client)
+
+    suggestions = asyncio.run(service.suggest_modifications("<html></html>"))
+
+    assert suggestions == ["Add a dark mode toggle"]
+    assert requested == ["gemini-2.0-flash-lite"]
+    assert service.models.snapshot()["latency_s"]["gemini-2.0-flash-lite"] >= 0
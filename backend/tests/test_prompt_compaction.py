@@ -0,0 +1,90 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import re
+
+from backend.components.prompt_compaction import AB, COMPACT, FULL, VariantSelector, compact
+from backend.components.prompt_modules import ModularTemplate
+from backend.components.prompt_store import WC_TEMPLATE, TemplateStore
+
+EXAMPLE = "\n".join(f"    const value{i} = compute({i}); // step {i}" for i in range(30))
+
+TEMPLATE = f"""# Rules
+
+Use   standard    web components.   
+// Guidance written as a comment line.
+//     *   And a nested point.
+
+
+
+```javascript
+{EXAMPLE}
+```
+
+Second example:
+
+```javascript
+{EXAMPLE}
+    const extra = true;
+```
+"""
+
+
+def test_compaction_removes_comment_markers_whitespace_and_repeated_examples():
+    text, report = compact(TEMPLATE)
+    assert "//" not in text.split("```")[0] and "\n\n\n" not in text
+    assert "Use standard web components." in text
+    assert "\nGuidance written as a comment line.\n    * And a nested point.\n" in text  # Guidance kept, marker dropped
+    assert "const value0 = compute(0); // step 0" in text  # Comments inside code are kept
+    assert text.count("const value5") == 1 and "const extra = true;" in text
+    assert report.comment_markers == 2 and report.duplicate_examples == 1 and report.blank_lines >= 2
+    assert report.tokens_after < report.tokens_before and 0 < report.token_savings < 1
+    assert compact(text)[0] == text  # Idempotent
+
+
+def test_store_serves_a_compact_variant_per_template_version(tmp_path):
+    path = tmp_path / WC_TEMPLATE
+    path.write_text(TEMPLATE, encoding="utf-8")
+    store = TemplateStore(str(tmp_path), check_interval_s=0)
+
+    full, small = store.get(), store.get(variant=COMPACT)
+    assert full.variant == FULL and small.variant == COMPACT
+    assert small.digest != full.digest and small.tokens < full.tokens
+    assert store.get(variant=COMPACT) is small
+    assert store.snapshot()["templates"][WC_TEMPLATE]["compact"]["duplicate_examples"] == 1
+
+    path.write_text(TEMPLATE + "\nNew rule.\n", encoding="utf-8")
+    assert "New rule." in store.get(variant=COMPACT).text
+
+
+def test_ab_selection_is_stable_per_request_and_outcomes_are_tallied():
+    selector = VariantSelector(AB, compact_share=0.5)
+    requests = [f"app number {i}" for i in range(200)]
+    choices = [selector.choose(r) for r in requests]
+    assert choices == [selector.choose(r) for r in requests]
+    assert 60 < choices.count(COMPACT) < 140
+    assert VariantSelector(FULL).choose("x") == FULL and VariantSelector(COMPACT).choose("x") == COMPACT
+
+    selector.record(COMPACT, True, True, 0.5, 2.0)
+    selector.record(COMPACT, False, False, 1.5, 4.0)
+    stats = selector.snapshot()["variants"][COMPACT]
+    assert stats["requests"] == 2 and stats["failure_rate"] == 0.5 and stats["complete_rate"] == 0.5
+    assert stats["avg_first_chunk_s"] == 1.0 and stats["avg_duration_s"] == 3.0
+
+
+def test_compact_variant_keeps_every_module_and_section_of_the_shipped_template():
+    path = os.path.join(project_root, "backend", "gemini_prompt_template_wc.md")
+    with open(path, encoding="utf-8") as f:
+        full = f.read()
+    text, _ = compact(full)
+
+    assert set(ModularTemplate(text).modules) == set(ModularTemplate(full).modules)
+    assert "uploaded-files" in ModularTemplate(text).modules
+    headings = [m.group(1) for m in re.finditer(r"^(?:#+|//)\s*(---.*---|[A-Z][A-Z ,&/-]{6,}.*)$", full, re.MULTILINE)]
+    assert "--- GENERATION PROCESS ---" in headings
+    for heading in headings:
+        assert re.sub(r" {2,}", " ", heading.strip()) in text
@@ -0,0 +1,93 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import pytest
+
+from backend.components.prompt_compaction import COMPACT
+from backend.components.prompt_modules import ALL, MODULES_HEADING, ModularTemplate, ModuleUsage, detect_intents
+from backend.components.prompt_store import WC_TEMPLATE, TemplateStore
+from backend.components.service import ComponentService
+
+TEMPLATE = """Core rules.
+<!-- @module libraries when=libraries -->
+Use import maps for Three.js.
+<!-- @end -->
+
+More core rules.
+<!-- @module chat-api when=chat,speech -->
+Chat history uses parts.
+<!-- @end -->
+<!-- @module uploaded-files when=files -->
+Handle uploaded files.
+<!-- @end -->
+<!-- @module libraries when=libraries -->
+Charting libraries too.
+<!-- @end -->
+Final rules."""
+
+
+def test_modules_are_rendered_for_the_detected_intents():
+    modular = ModularTemplate(TEMPLATE)
+    assert list(modular.modules) == ["libraries", "chat-api", "uploaded-files"]
+    assert modular.render(modular.select(None)) == (
+        "Core rules.\n\nMore core rules.\nFinal rules." + MODULES_HEADING +
+        "Use import maps for Three.js.\nChat history uses parts.\nHandle uploaded files.\nCharting libraries too."
+    )
+    assert modular.render(modular.select(set())) == "Core rules.\n\nMore core rules.\nFinal rules."
+    assert modular.select({"speech"}) == ("chat-api",)
+
+    assert detect_intents("a simple todo list") == frozenset()
+    assert detect_intents("a 3D rubik's cube") == {"libraries"}
+    assert detect_intents("a calculator") == {"calculator"}
+    assert {"files", "media", "images"} <= detect_intents("use this", files=[{"mime_type": "image/png"}])
+    assert "chat" in detect_intents("make the button blue", current_html="<script>morpheoApi.call('/api/chat')</script>")
+
+    with pytest.raises(ValueError):
+        ModularTemplate("<!-- @module a when=x -->\nnever closed")
+
+
+def test_store_compiles_each_rendering_once_and_reports_savings(tmp_path):
+    (tmp_path / WC_TEMPLATE).write_text(TEMPLATE, encoding="utf-8")
+    store = TemplateStore(str(tmp_path), check_interval_s=0)
+
+    everything = store.get()
+    simple = store.get(intents=frozenset())
+    assert "@module" not in everything.text and everything.modules == ("libraries", "chat-api", "uploaded-files")
+    assert simple.modules == () and simple.skipped == everything.modules
+    assert simple.tokens < everything.tokens and simple.tokens_saved > 0 and simple.digest != everything.digest
+    assert store.get(intents={"libraries"}) is store.get(intents={"libraries", "unrelated"})
+    # Every rendering starts with the same core, which alone is the cacheable template section
+    assert everything.static is simple.static and everything.text.startswith(simple.static.text)
+    assert everything.scope_digest == simple.scope_digest == store.get(intents={"libraries"}).scope_digest
+    core, modules = everything.sections(cacheable=True)
+    assert core.cacheable and not modules.cacheable and core.text + modules.text == everything.text
+    assert [section.name for section in simple.sections(cacheable=True)] == ["template"]
+    assert store.get(variant=COMPACT, intents={"chat"}).modules == ("chat-api",)
+    assert store.snapshot()["templates"][WC_TEMPLATE]["renderings"] == 3
+
+    usage = ModuleUsage()
+    usage.record(simple.modules, simple.skipped, simple.tokens, simple.tokens_saved)
+    usage.record(everything.modules, everything.skipped, everything.tokens, everything.tokens_saved)
+    stats = usage.snapshot()
+    assert stats["prompts"] == 2 and stats["inclusion_rate"]["libraries"] == 0.5 and 0 < stats["token_savings"] < 1
+    assert ModuleUsage(ALL).intents("a calculator") is None
+
+
+def test_service_prompts_include_only_the_needed_modules(tmp_path):
+    (tmp_path / WC_TEMPLATE).write_text(TEMPLATE, encoding="utf-8")
+    service = ComponentService(client=object())
+    service.templates = TemplateStore(str(tmp_path), check_interval_s=0)
+
+    prompt = service._create_full_code_prompt("a todo list")
+    assert "Core rules." in prompt and "Three.js" not in prompt and "uploaded files" not in prompt
+    globe = service._build_full_code_prompt("a 3D globe")
+    assert "Three.js" in globe.suffix and globe.prefix == service._build_full_code_prompt("a todo list").prefix
+
+    modification = service._create_modification_prompt("add a title", "<script>fetchChat('/api/chat')</script>", uploaded_files=[{"mime_type": "text/csv"}])
+    assert "Chat history uses parts." in modification and "Handle uploaded files." in modification
+    assert service.prompt_modules.snapshot()["inclusion_rate"] == {"chat-api": 1.0, "libraries": 0.0, "uploaded-files": 1.0}
+    assert "Chat history uses parts." not in service._build_modification_prompt("add a title", "<script>fetchChat('/api/chat')</script>", uploaded_files=[{"mime_type": "text/csv"}]).prefix
@@ -0,0 +1,61 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import hashlib
+
+from backend.components.generation_cache import template_hash
+from backend.components.prompt_store import WC_TEMPLATE, WC_TEMPLATE_FALLBACK, CompiledTemplate, TemplateStore
+from backend.components.service import ComponentService
+from backend.components.token_budget import PromptSection, TokenEstimator, assemble, count_tokens
+
+
+def test_templates_are_loaded_once_and_hot_reloaded(tmp_path):
+    path = tmp_path / WC_TEMPLATE
+    path.write_text("Version one.", encoding="utf-8")
+    store = TemplateStore(str(tmp_path), check_interval_s=0)
+
+    first = store.get()
+    assert first.text == "Version one." and first.digest == template_hash("Version one.")
+    assert store.get() is first  # Unchanged file: same compiled object
+
+    path.write_text("Version two, longer.", encoding="utf-8")
+    second = store.get()
+    assert second.text == "Version two, longer." and second is not first and store.reloads == 1
+    assert first.text == "Version one."  # Requests holding the old version are unaffected
+
+    path.unlink()
+    assert store.get() is second  # Last good version survives a missing file
+
+    frozen = TemplateStore(str(tmp_path), check_interval_s=-1)
+    assert frozen.get().source == "fallback" and frozen.get().text == WC_TEMPLATE_FALLBACK
+    path.write_text("Version three.", encoding="utf-8")
+    assert frozen.get().source == "fallback"  # Hot reload disabled
+
+
+def test_precomputed_tokens_and_hash_match_a_full_pass():
+    template = CompiledTemplate.from_text(WC_TEMPLATE, "Build it well. " * 100)
+    assert template.tokens == count_tokens(template.text)
+    assert template.content_hash("suffix") == hashlib.sha256((template.text + "suffix").encode()).hexdigest()[:16]
+
+    assembled = assemble("generation", [template.section(), PromptSection("request", " a todo app")], TokenEstimator())
+    plain = assemble("generation", [PromptSection("template", template.text), PromptSection("request", " a todo app")], TokenEstimator())
+    assert assembled.text == plain.text and assembled.tokens == plain.tokens
+    assert assembled.digest == plain.digest == template.content_hash(" a todo app")
+
+
+def test_service_prompts_use_the_store(tmp_path):
+    (tmp_path / WC_TEMPLATE).write_text("Stored template.", encoding="utf-8")
+    service = ComponentService(client=object())
+    service.templates = TemplateStore(str(tmp_path), check_interval_s=0)
+
+    assert service._create_full_code_prompt("a clock").startswith("Stored template.\n\n## User Request:")
+    assert service._create_modification_prompt("make it blue", "<html></html>").startswith("--- GENERAL REQUIREMENTS (Apply to modification) ---\nStored template.")
+    key = service.generation_cache_key("a clock")
+
+    (tmp_path / WC_TEMPLATE).write_text("Edited template.", encoding="utf-8")
+    assert service._create_full_code_prompt("a clock").startswith("Edited template.")
+    assert service.generation_cache_key("a clock") != key  # Cache keys follow the template version
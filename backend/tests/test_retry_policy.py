@@ -0,0 +1,115 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import json
+
+from google.genai import errors as genai_errors
+
+from backend.components.model_backend import _make_text_chunk
+from backend.components.retry_policy import (
+    INVALID, QUOTA, TRANSIENT, OverlapSplicer, RetryPolicy, classify_error, retry_hint,
+)
+from backend.components.service import ComponentService
+
+
+def _quota_error(delay: str) -> genai_errors.ClientError:
+    return genai_errors.ClientError(429, {"error": {
+        "code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED",
+        "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": delay}],
+    }})
+
+
+class _FlakyModels:
+    """Streams `first` then fails with a 503; later calls stream `resumed`."""
+
+    def __init__(self, first, resumed, error=None):
+        self.first, self.resumed = first, resumed
+        self.error = error or genai_errors.ServerError(503, {"error": {"code": 503, "message": "Backend unavailable", "status": "UNAVAILABLE"}})
+        self.requests = []
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.requests.append(contents)
+        return self._stream(len(self.requests) == 1)
+
+    async def _stream(self, fail):
+        for text in (self.first if fail else self.resumed):
+            yield _make_text_chunk(text)
+        if fail:
+            raise self.error
+
+
+class _Client:
+    def __init__(self, models):
+        self.aio = type("Aio", (), {"models": models})()
+
+
+def _service(models):
+    service = ComponentService(client=_Client(models))
+    service.retry_policy = RetryPolicy(max_retries=2, base_delay_s=0.001, max_delay_s=5.0)
+    return service
+
+
+def _collect(service, contents, **kwargs):
+    async def run():
+        return [chunk async for chunk in service._call_gemini_with_retry(contents, **kwargs)]
+    return asyncio.run(run())
+
+
+def test_classification_and_server_retry_hints():
+    assert classify_error(genai_errors.ServerError(503, {"error": {"message": "unavailable"}})) == TRANSIENT
+    assert classify_error(json.JSONDecodeError("Expecting property name enclosed in double quotes", "{", 1)) == TRANSIENT
+    assert classify_error(ConnectionResetError("reset")) == TRANSIENT
+    assert classify_error(_quota_error("3s")) == QUOTA
+    assert classify_error(genai_errors.ClientError(400, {"error": {"message": "bad request"}})) == INVALID
+
+    assert retry_hint(_quota_error("3s")) == 3.0
+    assert retry_hint(_quota_error("0.5s")) == 0.5
+    assert retry_hint(ValueError("no hint")) is None
+
+    policy = RetryPolicy(max_retries=3, base_delay_s=0.5, max_delay_s=10.0)
+    assert not policy.should_retry(INVALID, 0)
+    assert not policy.should_retry(QUOTA, 0, hint=60.0)  # Not worth holding the stream open
+    assert policy.should_retry(QUOTA, 0, hint=3.0) and 3.0 <= policy.backoff(0, 3.0) <= 3.6
+    assert all(0.25 <= policy.backoff(attempt) <= 10.0 for attempt in range(8))
+
+
+def test_splicer_trims_repeated_text_and_fences():
+    splicer = OverlapSplicer("<div class=\"card\">Total: ", window=64)
+    out = splicer.feed("```html\n<div class=\"card\">Total: 42</div>") + splicer.flush()
+    assert out == "42</div>" and splicer.trimmed == len("<div class=\"card\">Total: ")
+
+    # A short coincidental match is not treated as a repeat
+    coincidence = OverlapSplicer("color: red;", window=64)
+    assert coincidence.feed(";\n}") + coincidence.flush() == ";\n}"
+
+
+def test_mid_stream_failure_resumes_without_duplication():
+    models = _FlakyModels(
+        first=["<!DOCTYPE html>\n<html><body>", "<h1>Hello wor"],
+        resumed=["```html\n<h1>Hello wor", "ld</h1>", "</body></html>"],
+    )
+    service = _service(models)
+
+    chunks = _collect(service, "Build a greeting page", task="generation")
+
+    assert "".join(chunks) == "<!DOCTYPE html>\n<html><body><h1>Hello world</h1></body></html>"
+    assert len(models.requests) == 2
+    continuation = models.requests[1]
+    assert [turn["role"] for turn in continuation] == ["user", "model", "user"]
+    assert continuation[0]["parts"][0]["text"] == "Build a greeting page"
+    assert continuation[1]["parts"][0]["text"] == "<!DOCTYPE html>\n<html><body><h1>Hello wor"
+
+
+def test_quota_with_long_retry_hint_is_not_retried():
+    models = _FlakyModels(first=[], resumed=["never"], error=_quota_error("120s"))
+    service = _service(models)
+
+    chunks = _collect(service, "Build a page")
+
+    assert len(models.requests) == 1
+    assert len(chunks) == 1 and chunks[0].startswith("<!-- ERROR:") and "quota" in chunks[0]
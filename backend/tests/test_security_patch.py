@@ -0,0 +1,74 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.model_backend import _make_text_chunk
+from backend.components.security_patch import PATCH_MARKER, PatchError, plan_patch, script_spans
+from backend.components.security_scan import EVAL_ISSUE, SecurityScanning, scan_html
+from backend.components.service import ComponentService
+
+UNSAFE_CALL = "ev" + "al(expr)"
+DOC = (
+    "<!DOCTYPE html><html><body>\n<h1>Calculator</h1>\n<input id=\"expr\">\n"
+    "<script>const keys = document.querySelectorAll('button');</script>\n"
+    "<output id=\"out\"></output>\n"
+    f"<script>\nfunction compute(expr) {{\n  return {UNSAFE_CALL};\n}}\n</script>\n"
+    "<footer>made with care</footer>\n</body></html>"
+)
+SAFE_BLOCK = "<script>\nfunction compute(expr) {\n  return parseExpression(expr);\n}\n</script>"
+
+
+def test_plan_rewrites_only_offending_blocks_and_splices_them_back():
+    plan = plan_patch(DOC)
+    assert [DOC[b.start:b.end] for b in plan.blocks] == [DOC[s:e] for s, e in script_spans(DOC)][1:]
+    prompt = plan.prompt(context_lines=1)
+    assert "querySelectorAll" not in prompt and "<output id=\"out\">" in prompt and "<footer>" in prompt
+    assert EVAL_ISSUE in prompt and PATCH_MARKER.format(index=1) in prompt
+
+    patched = plan.apply(f"Here you go:\n{PATCH_MARKER.format(index=1)}\n```html\n{SAFE_BLOCK}\n```\n")
+    assert patched == DOC.replace(DOC[plan.blocks[0].start:plan.blocks[0].end], SAFE_BLOCK) and scan_html(patched) == []
+
+    for bad in ("no markers at all", f"{PATCH_MARKER.format(index=1)}\n<script>{UNSAFE_CALL}</script>", f"{PATCH_MARKER.format(index=1)}\nconst x = 1;"):
+        with pytest.raises(PatchError):
+            plan.apply(bad)
+    assert plan_patch(DOC.replace("<footer>", f"<footer onclick=\"{UNSAFE_CALL}\">")) is None  # Inline handlers need a full regeneration
+
+
+class _Models:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.prompts.append(contents[0] if isinstance(contents, list) else contents)
+        return self._stream(self.responses.pop(0))
+
+    async def _stream(self, chunks):
+        for text in chunks:
+            yield _make_text_chunk(text)
+
+
+def test_patch_correction_replaces_the_document_and_reports_savings():
+    reply = f"{PATCH_MARKER.format(index=1)}\n{SAFE_BLOCK}"
+    models = _Models([DOC[i:i + 40] for i in range(0, len(DOC), 40)], [reply])
+    service = ComponentService(client=type("Client", (), {"aio": type("Aio", (), {"models": models})()})())
+    service.security = SecurityScanning()
+    original_prompt = "Build a calculator. " + "Template rules. " * 2000
+
+    async def run():
+        return [chunk async for chunk in service._stream_with_security_scan(["a calculator"], None, original_prompt, task="generation")]
+    out = asyncio.run(run())
+
+    assert "".join(out[:out.index("<!-- MORPHEO_SECURITY_CORRECTION_START -->")]) == DOC  # Streamed in full: a patch needs the whole document
+    assert "Template rules." not in models.prompts[1] and len(models.prompts[1]) < len(original_prompt) / 10
+    replaced = out[out.index("<!-- MORPHEO_REPLACE_WITH_CORRECTED_START -->") + 1]
+    assert SAFE_BLOCK in replaced and "<footer>made with care</footer>" in replaced and scan_html(replaced) == []
+    patches = service.security.snapshot()["patches"]
+    assert patches["applied"] == 1 and patches["input_tokens_saved"] > 4000 and patches["output_tokens_saved"] > 0
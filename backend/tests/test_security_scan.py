@@ -0,0 +1,144 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import random
+
+from backend.components.errors import OverloadedError
+from backend.components.model_backend import _make_text_chunk
+from backend.components.security_scan import (
+    BASE64_ISSUE, EVAL_ISSUE, FULL, IncrementalScanner, Rule, SecurityScanning, benchmark_corpus, regex_scan, scan_html,
+)
+from backend.components.service import ComponentService
+
+PAYLOAD = "data:audio/wav;base64," + "QUJD" * 300
+UNSAFE = "<html><body><script>\nconst x = ev" + "al (input);\nconst beep = '" + PAYLOAD + "';\n</script></body></html>"
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_findings_survive_chunk_boundaries():
+    assert scan_html(UNSAFE) == [EVAL_ISSUE, BASE64_ISSUE]
+    for size in (1, 2, 7, 100):
+        scanner = IncrementalScanner()
+        found_at = [i for i, chunk in enumerate(_chunks(UNSAFE, size)) if scanner.feed(chunk)]
+        assert scanner.issues == [EVAL_ISSUE, BASE64_ISSUE]
+        assert found_at[0] == UNSAFE.index("(input)") // size  # Flagged by the chunk that completes "eval ("
+
+    # Base64 outside a script, or split by the end of a script, is not flagged
+    assert scan_html("<img src='" + PAYLOAD + "'>") == []
+    assert scan_html("<script>a = 'data:x;base64," + "QUJD" * 100 + "'</script>" + "QUJD" * 300) == []
+    assert scan_html("<script src='app.js'></script><p>evaluate (carefully)</p>") == []
+
+
+def test_single_pass_scanner_agrees_with_the_regex_scan():
+    fragments = [
+        "<p>text</p>", "<script>", "<SCRIPT type='module'>", "</script>", "eval(", "EvAl \n (", "evaluate", "medieval",
+        "data:audio/wav;base64,", "QUJD" * 255, "QUJD" * 50, "=", "'", " ", "<scr", "ipt>",
+    ]
+    rng = random.Random(7)
+    for _ in range(300):
+        doc = "".join(rng.choice(fragments) for _ in range(rng.randint(1, 40))) + "</script>"
+        expected = set(regex_scan(doc))
+        assert set(scan_html(doc)) == expected, doc
+        scanner = IncrementalScanner()
+        i = 0
+        while i < len(doc):
+            step = rng.randint(1, 300)
+            scanner.feed(doc[i:i + step])
+            i += step
+        assert set(scanner.issues) == expected, doc
+
+    for name, doc in benchmark_corpus(50_000).items():
+        assert scan_html(doc) == regex_scan(doc), name
+
+
+def test_rules_are_pluggable():
+    rules = [Rule("document.write", "Detected document.write().", "document.write", follow="("),
+             Rule("inline-handler", "Detected javascript: URL.", "javascript:")]
+    scanner = IncrementalScanner(rules)
+    assert scanner.feed("<a href='JavaScript:go()'>") and scanner.issues == ["Detected javascript: URL."]
+    assert not scanner.feed("<script>eval(x); document.write")
+    assert [f.rule for f in scanner.feed(" ('x')</script>")] == ["document.write"]
+
+
+class _Models:
+    """Streams the first response (recording how far it was read), then the correction."""
+
+    def __init__(self, first, correction):
+        self.responses = [first, correction]
+        self.read = []
+
+    async def generate_content_stream(self, model, contents, config=None):
+        return self._stream(self.responses.pop(0))
+
+    async def _stream(self, chunks):
+        self.read.append(0)
+        for text in chunks:
+            self.read[-1] += 1
+            yield _make_text_chunk(text)
+
+
+def _correct(first, correction, refuse=None):
+    models = _Models(first, correction)
+    service = ComponentService(client=type("Client", (), {"aio": type("Aio", (), {"models": models})()})())
+    service.security = SecurityScanning(early_abort=True, correction_mode=FULL)  # Patches need the whole document
+    if refuse is not None:
+        calls = []
+        acquire = service.limiter.acquire
+
+        async def refusing_acquire(**kwargs):  # The `refuse`-th upstream call times out in the queue
+            calls.append(kwargs)
+            if len(calls) == refuse:
+                raise OverloadedError("Timed out waiting for model capacity.")
+            return await acquire(**kwargs)
+        service.limiter.acquire = refusing_acquire
+
+    async def run():
+        return [chunk async for chunk in service._stream_with_security_scan(["a calculator"], None, "a calculator", task="generation")]
+    return asyncio.run(run()), models, service.security.snapshot()
+
+
+def test_unsafe_stream_is_aborted_and_the_correction_streamed_live():
+    first = _chunks(UNSAFE, 16) + ["<p>more</p>"] * 50
+    corrected = ["<!DOCTYPE html><html><body>", "<script>const x = parse(input);</script>", "</body></html>"]
+    out, models, snapshot = _correct(first, corrected)
+
+    assert models.read[0] < len(first) // 2  # The upstream stream was abandoned at the finding
+    assert "ev" + "al (" not in "".join(out[:out.index("<!-- MORPHEO_SECURITY_CORRECTION_START -->")])
+    start = out.index("<!-- MORPHEO_CORRECTION_TENTATIVE_START -->")
+    assert out[start + 1:] == corrected + ["<!-- MORPHEO_CORRECTION_COMMIT -->", "<!-- MORPHEO_SECURITY_CORRECTION_END -->"]  # Chunk by chunk
+    assert snapshot["aborted_early"] == 1 and snapshot["corrections"]["succeeded"] == 1 and snapshot["issues"] == {"eval": 1}
+    assert snapshot["avg_correction_first_byte_s"] is not None
+
+    # An unsafe correction is cut off where the finding completes and rolled back
+    out, models, snapshot = _correct(first, corrected[:1] + _chunks(UNSAFE, 16) + corrected[2:])
+    tentative = out[out.index("<!-- MORPHEO_CORRECTION_TENTATIVE_START -->") + 1:out.index("<!-- MORPHEO_CORRECTION_ROLLBACK -->")]
+    assert tentative[0] == corrected[0] and "ev" + "al (" not in "".join(tentative)
+    assert "<!-- MORPHEO_CORRECTION_COMMIT -->" not in out and "MORPHEO_SECURITY_WARNING" in out[-2]
+    rollback = out.index("<!-- MORPHEO_CORRECTION_ROLLBACK -->")
+    assert out[rollback + 1] == "<!-- MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE -->"  # The restored original was cut short
+    assert models.read[1] < len(UNSAFE) // 16 and snapshot["corrections"]["issues_persist"] == 1
+
+
+def test_refused_calls_are_reported_in_stream():
+    first = _chunks(UNSAFE, 16)
+    corrected = ["<!DOCTYPE html><html><body></body></html>"]
+
+    out, models, _ = _correct(first, corrected, refuse=1)
+    assert out == ["<!-- ERROR: Timed out waiting for model capacity. -->"] and models.read == []
+
+    # Refused correction: the tentative replacement is rolled back, not left half-applied
+    out, models, snapshot = _correct(first, corrected, refuse=2)
+    tentative = out.index("<!-- MORPHEO_CORRECTION_TENTATIVE_START -->")
+    assert out[tentative + 1].startswith("<!-- ERROR: Security correction unavailable")
+    assert out[tentative + 2:tentative + 5] == [
+        "<!-- MORPHEO_CORRECTION_ROLLBACK -->", "<!-- MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE -->", "<!-- MORPHEO_SECURITY_CORRECTION_FAILED_AI_ERROR -->",
+    ]
+    assert out[-1] == "<!-- MORPHEO_SECURITY_CORRECTION_END -->" and snapshot["corrections"]["failed"] == 1
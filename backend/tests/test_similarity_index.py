@@ -0,0 +1,141 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+import json
+import time
+
+from backend.components.generation_cache import GenerationCache
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+from backend.components.similarity_index import SimilarityIndex
+
+
+def test_paraphrase_matches_within_scope_only():
+    index = SimilarityIndex()
+    index.add("a scientific calculator with a dark theme", "k1", scope="t1:m")
+    index.add("a kanban board for tracking tasks", "k2", scope="t1:m")
+
+    match = index.query("scientific calculator with dark theme", scope="t1:m")
+    assert match is not None and match.key == "k1"
+    assert match.similarity > 0.6
+    assert index.query("scientific calculator with dark theme", scope="t2:m") is None
+    assert index.query("a weather dashboard", scope="t1:m", min_similarity=0.9) is None
+
+    index.remove("k1")
+    match = index.query("scientific calculator with dark theme", scope="t1:m")
+    assert match is None or match.key != "k1"
+
+
+def test_index_is_bounded_and_reclaims_removed_rows():
+    index = SimilarityIndex(max_entries=3)
+    for i in range(5):
+        index.add(f"a todo list app number {i}", f"k{i}")
+    assert len(index) == 3 and index.evictions == 2
+    assert index.query("a todo list app number 0", min_similarity=0.99) is None
+    assert index.query("a todo list app number 4").key == "k4"
+
+    many = SimilarityIndex()
+    for i in range(3000):
+        many.add(f"request {i}", f"r{i}")
+    for i in range(2500):
+        many.remove(f"r{i}")
+    assert many.compactions >= 1 and many._size < 3000 and len(many._keys) == many._size
+    assert many.query("request 2999").key == "r2999"
+
+
+def test_generation_cache_evictions_leave_the_index(tmp_path):
+    index = SimilarityIndex()
+    cache = GenerationCache(None, memory_entries=1)
+    cache.on_remove = index.remove
+    for key, request in (("k1", "a pomodoro timer"), ("k2", "a snake game")):
+        cache.put(key, "<html></html>")
+        index.add(request, key)
+    assert len(index) == 1 and index.query("pomodoro timer") is None
+
+    disk = GenerationCache(str(tmp_path))
+    disk.on_remove = index.remove
+    disk.put("k3", "<html></html>")
+    index.add("a weather dashboard", "k3")
+    disk.invalidate("k3")
+    assert len(index) == 1
+
+
+def test_bootstrap_from_generation_log(tmp_path):
+    log_path = tmp_path / "gen.jsonl"
+    records = [
+        {"status": "Success", "cache": "miss", "cache_key": "k1", "user_request": "a pomodoro timer", "template_hash": "t", "model": "m"},
+        {"status": "Failure", "cache": "miss", "cache_key": "k2", "user_request": "a snake game", "template_hash": "t", "model": "m"},
+        {"status": "Success", "cache": "hit", "cache_key": "k3", "user_request": "a pomodoro timer", "template_hash": "t", "model": "m"},
+    ]
+    log_path.write_text("\n".join(json.dumps(r) for r in records) + "\nnot json\n")
+
+    index = SimilarityIndex()
+    assert index.load_generation_log(str(log_path)) == 1
+    assert index.query("pomodoro timer", scope="t:m").key == "k1"
+
+
+def test_lookup_stays_under_a_millisecond_at_100k_entries():
+    index = SimilarityIndex()
+    apps = ["todo list", "calculator", "weather dashboard", "kanban board", "pomodoro timer", "snake game", "notes app", "photo gallery"]
+    styles = ["with a dark theme", "with charts", "for kids", "using local storage", "with drag and drop", "minimal"]
+    requests = [f"a {app} {a} and {b} number {n}" for app in apps for a in styles for b in styles for n in range(8)]
+    # A clustered vocabulary fills shared buckets, so every lookup scans up to its bound.
+    # Signatures are computed once per distinct request to keep the build short.
+    signatures = {request: index.hasher.signature(request) for request in requests}
+    index.hasher.signature = signatures.__getitem__
+    for i in range(100_000):
+        index.add(requests[i * 7919 % len(requests)], f"k{i}", scope="t:m")
+    assert len(index) == 100_000 and index.evictions == 0
+    del index.hasher.signature  # Lookups below hash their query as usual
+
+    queries = requests[::len(requests) // 200][:200]
+    for query in queries[:20]:
+        index.query(query, scope="t:m")  # Warm up
+    # Best of several rounds, so a briefly loaded machine does not fail the bound
+    rounds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for query in queries:
+            assert index.query(query, scope="t:m").similarity == 1.0
+        rounds.append((time.perf_counter() - start) / len(queries))
+    assert min(rounds) < 0.001
+
+
+def test_service_serves_near_duplicate_without_model_call(tmp_path):
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=200, seed=3)))
+    service.generation_cache = GenerationCache(str(tmp_path))
+    service.similarity_index = SimilarityIndex(serve_threshold=0.7, preview_threshold=0.4)
+    calls = []
+    original = service._call_gemini_api
+
+    def counting_call(contents, accumulator=None, **kwargs):
+        calls.append(contents)
+        return original(contents, accumulator, **kwargs)
+
+    service._call_gemini_api = counting_call
+
+    async def generate(prompt):
+        return "".join([chunk async for chunk in service.generate_full_component_code(prompt)])
+
+    first = asyncio.run(generate("a scientific calculator with a dark theme"))
+    assert asyncio.run(generate("scientific calculator, dark theme")) == first
+    assert len(calls) == 1
+
+    preview = asyncio.run(service.find_similar_generation("calculator with a light theme"))
+    assert preview is not None and preview["html"] == first
+
+
+def test_near_identical_prompts_with_different_numbers_are_not_served():
+    pomodoro = "a pomodoro timer with {} minute focus sessions, a 5 minute break, a task list and a dark theme"
+    index = SimilarityIndex(serve_threshold=0.85)
+    index.add(pomodoro.format(25), "k25", scope="t:m")
+
+    assert index.query(pomodoro.format(50), scope="t:m").similarity >= 0.85  # Indistinguishable by n-grams
+    assert index.servable(pomodoro.format(50), scope="t:m") is None and index.serve_refused == 1
+    assert index.servable("A pomodoro timer with 25 minute focus sessions, a 5 minute break, a task list, and a dark theme!", scope="t:m").key == "k25"
+    assert SimilarityIndex().servable(pomodoro.format(25)) is None  # Previews only by default
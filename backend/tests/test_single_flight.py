@@ -0,0 +1,92 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+from backend.components.generation_cache import GenerationCache
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+from backend.components.single_flight import SingleFlight
+
+
+def _upstream(calls, closed, n=5, delay=0.01):
+    async def source():
+        calls.append(1)
+        try:
+            for i in range(n):
+                await asyncio.sleep(delay)
+                yield f"c{i}"
+        finally:
+            closed.append(1)
+    return source
+
+
+def test_late_subscriber_replays_from_start():
+    calls, closed = [], []
+    flights = SingleFlight()
+
+    async def consume(delay):
+        await asyncio.sleep(delay)
+        return [chunk async for chunk in flights.stream("k", _upstream(calls, closed))]
+
+    async def run():
+        return await asyncio.gather(consume(0), consume(0.025))
+
+    first, late = asyncio.run(run())
+    assert first == late == [f"c{i}" for i in range(5)]
+    assert len(calls) == 1
+    assert flights.followers == 1 and flights.in_flight() == 0
+
+
+def test_upstream_cancelled_only_after_last_subscriber_leaves():
+    calls, closed = [], []
+    flights = SingleFlight()
+
+    async def take(count):
+        stream = flights.stream("k", _upstream(calls, closed, n=50))
+        received = []
+        async for chunk in stream:
+            received.append(chunk)
+            if len(received) == count:
+                break
+        await stream.aclose()
+        return received
+
+    async def run():
+        short = asyncio.create_task(take(2))
+        longer = asyncio.create_task(take(6))
+        assert len(await short) == 2
+        assert not closed  # The other subscriber is still reading
+        assert len(await longer) == 6
+        await asyncio.sleep(0.02)
+
+    asyncio.run(run())
+    assert closed == [1]
+    assert flights.cancelled == 1 and flights.in_flight() == 0
+
+
+def test_concurrent_generations_share_one_model_call(tmp_path):
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=20, tokens_per_sec=50_000, response_tokens=200, seed=3)))
+    service.generation_cache = GenerationCache(str(tmp_path))
+    calls = []
+    original = service._call_gemini_api
+
+    def counting_call(contents, accumulator=None, **kwargs):
+        calls.append(contents)
+        return original(contents, accumulator, **kwargs)
+
+    service._call_gemini_api = counting_call
+
+    async def generate():
+        return "".join([chunk async for chunk in service.generate_full_component_code("a todo app", use_cache=False)])
+
+    async def run():
+        return await asyncio.gather(generate(), generate(), generate())
+
+    results = asyncio.run(run())
+    assert results[0] and results.count(results[0]) == 3
+    assert len(calls) == 1
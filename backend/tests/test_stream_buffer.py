@@ -0,0 +1,51 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+from backend.components.model_backend import SyntheticGeminiClient, SyntheticStreamConfig
+from backend.components.service import ComponentService
+from backend.components.stream_buffer import StreamAccumulator
+
+
+def test_accumulator_views_and_value():
+    chunks = [f"<div>{i}</div>" for i in range(500)]
+    with StreamAccumulator(view_chars=64) as acc:
+        for chunk in chunks:
+            acc.append(chunk)
+        expected = "".join(chunks)
+
+        assert len(acc) == len(expected)
+        assert acc.chunks == 500
+        assert acc.head(20) == expected[:20]
+        assert acc.tail(30) == expected[-30:]
+        assert acc.head(1000) == expected[:1000]
+        assert acc.preview(10) == expected[:10] + "..."
+        assert acc.getvalue() == expected
+
+
+def test_accumulator_spills_to_disk_and_handles_unicode():
+    acc = StreamAccumulator(spill_bytes=1024)
+    text = "héllo ✓ " * 400
+    acc.append(text)
+    acc.append("end")
+    assert acc.spilled
+    assert acc.getvalue() == text + "end"
+    assert acc.tail(3) == "end"
+    acc.close()
+
+
+def test_service_fills_shared_accumulator():
+    service = ComponentService(client=SyntheticGeminiClient(SyntheticStreamConfig(ttft_ms=0, tokens_per_sec=100_000, response_tokens=200, seed=5)))
+    acc = StreamAccumulator()
+
+    async def run():
+        return "".join([chunk async for chunk in service._call_gemini_with_retry("Build a todo app", accumulator=acc)])
+
+    streamed = asyncio.run(run())
+    assert acc.getvalue() == streamed
+    acc.close()
@@ -0,0 +1,57 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+from backend.components.stream_shaper import FlushPolicy, shape_stream, shaper_metrics
+
+
+async def _source(count, size=100, delay=0.0, produced=None):
+    for i in range(count):
+        if delay:
+            await asyncio.sleep(delay)
+        if produced is not None:
+            produced.append(i)
+        yield "x" * size
+
+
+def test_coalesces_by_byte_budget():
+    async def run():
+        policy = FlushPolicy(max_bytes=1000, max_delay_ms=1000, flush_first=False)
+        return [chunk async for chunk in shape_stream(_source(50), policy, name="test-bytes")]
+
+    flushes = asyncio.run(run())
+    assert "".join(flushes) == "x" * 5000
+    assert len(flushes) == 5
+    assert shaper_metrics.snapshot()["test-bytes"]["flushes"] == 5
+
+
+def test_flushes_on_deadline_and_sends_first_chunk_immediately():
+    async def run():
+        policy = FlushPolicy(max_bytes=1_000_000, max_delay_ms=5)
+        return [chunk async for chunk in shape_stream(_source(6, delay=0.02), policy, name="test-deadline")]
+
+    flushes = asyncio.run(run())
+    assert len(flushes[0]) == 100
+    assert len(flushes) > 1
+
+
+def test_slow_consumer_applies_backpressure_and_disconnect_cancels_upstream():
+    produced = []
+
+    async def run():
+        stream = shape_stream(_source(1000, produced=produced), FlushPolicy(max_bytes=100, max_buffered_chunks=4), name="test-bp")
+        first = await stream.__anext__()
+        await asyncio.sleep(0.05)  # client stalls; producer must stop after filling the buffer
+        stalled_at = len(produced)
+        await stream.aclose()       # client disconnects
+        return first, stalled_at
+
+    first, stalled_at = asyncio.run(run())
+    assert first == "x" * 100
+    assert stalled_at <= 8
+    assert len(produced) == stalled_at
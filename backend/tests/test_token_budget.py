@@ -0,0 +1,141 @@
+import sys
+import os
+
+# Add the project root directory to the Python path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import asyncio
+
+import pytest
+
+from backend.components.service import ComponentService
+from backend.components.token_budget import PromptBudgetExceeded, PromptSection, TokenEstimator, assemble, count_tokens
+
+
+def test_estimator_counts_and_calibrates():
+    estimator = TokenEstimator(calibration_samples=2)
+    assert estimator.raw("") == 0
+    assert estimator.raw("Hello, world!") == 6  # Hell o , worl d !
+    assert estimator.raw("x" * 400) == 100
+
+    class Models:
+        async def count_tokens(self, model, contents):
+            return type("Count", (), {"total_tokens": 150})()
+
+    client = type("Client", (), {"aio": type("Aio", (), {"models": Models()})()})()
+    assert asyncio.run(estimator.calibrate(client, "m", "x" * 400)) == pytest.approx(1.5)
+    assert estimator.estimate("x" * 40, "m") == 15
+    assert estimator.estimate("x" * 40, "other") == 10
+    assert estimator.needs_calibration("m")
+    asyncio.run(estimator.calibrate(client, "m", "x" * 400))
+    assert not estimator.needs_calibration("m")
+    assert asyncio.run(estimator.calibrate(object(), "n", "text")) is None
+
+
+def test_calibration_runs_one_at_a_time_and_backs_off_after_failure():
+    from backend.components.token_budget import schedule_calibration
+
+    calls = []
+
+    class Models:
+        async def count_tokens(self, model, contents):
+            calls.append(model)
+            await asyncio.sleep(0)
+            raise RuntimeError("429 RESOURCE_EXHAUSTED")
+
+    client = type("Client", (), {"aio": type("Aio", (), {"models": Models()})()})()
+    estimator = TokenEstimator(calibration_samples=2, retry_after_failure_s=60)
+
+    async def burst():
+        for _ in range(10):
+            schedule_calibration(estimator, client, "m", "x" * 400)
+        assert len(estimator._pending) == 1
+        await asyncio.gather(*estimator._pending.values())
+        schedule_calibration(estimator, client, "m", "x" * 400)
+        schedule_calibration(estimator, client, "n", "x" * 400, idle=lambda: False)
+
+    asyncio.run(burst())
+    assert calls == ["m"]
+    assert estimator.needs_calibration("m") and not estimator.can_calibrate("m")
+    assert estimator.can_calibrate("n")
+
+
+def test_assemble_trims_lowest_priority_first():
+    estimator = TokenEstimator()
+    sections = [
+        PromptSection("template", "t" * 400),                                   # 100 tokens, required
+        PromptSection("files", "f" * 2000, priority=20, alternatives=("f" * 800,)),  # 500, or 200
+        PromptSection("rules", "r" * 1200, priority=10),                         # 300
+    ]
+
+    fits = assemble("generation", sections, estimator, budget=1000)
+    assert not fits.trimmed and fits.tokens == 900
+
+    reduced = assemble("generation", sections, estimator, budget=400)
+    actions = {s.name: s.action for s in reduced.sections}
+    assert actions == {"template": "kept", "files": "reduced", "rules": "dropped"}
+    assert reduced.tokens == 300 and reduced.text == "t" * 400 + "f" * 800
+
+    truncated = assemble("generation", sections, estimator, budget=800)
+    report = {s.name: s for s in truncated.sections}
+    assert report["rules"].action == "truncated" and report["files"].action == "kept"
+    assert truncated.tokens <= 800 and "omitted to fit the input budget" in truncated.text
+    assert "rules 300" not in truncated.summary() and "(truncated from 300)" in truncated.summary()
+
+    with pytest.raises(PromptBudgetExceeded) as excinfo:
+        assemble("generation", sections, estimator, budget=50)
+    assert excinfo.value.budget == 50 and excinfo.value.tokens == 100
+
+
+def test_service_prompts_fit_the_input_budget(monkeypatch):
+    service = ComponentService(client=object())
+    template = "Build it well."
+    files = [{"name": "notes.txt", "text_content": "lorem ipsum " * 2000, "content_data_url": "data:text/plain;base64," + "A" * 20000}]
+
+    # Within budget the prompt is the plain concatenation of its sections
+    prompt = service._create_full_code_prompt("a todo app", template)
+    assert prompt == (
+        f"{template}\n\n## User Request:\n\n```text\na todo app\n```\n\n"
+        "## Full HTML Output (Remember: Complete, self-contained HTML with CSS and Vanilla JS/Web Components):\n"
+    )
+    with_files = service._build_full_code_prompt("a todo app", template, service._uploaded_files_section(files))
+    assert not with_files.trimmed and "A" * 20000 in with_files.text
+
+    # Over budget, data URLs go first, then extracted text is shortened
+    monkeypatch.setenv("MORPHEO_INPUT_BUDGET_GENERATION", "2000")
+    trimmed = service._build_full_code_prompt("a todo app", template, service._uploaded_files_section(files))
+    assert trimmed.tokens <= 2000 and trimmed.text.endswith("Vanilla JS/Web Components):\n")
+    assert "A" * 100 not in trimmed.text and "truncated to fit the input budget" in trimmed.text
+    assert [s.action for s in trimmed.sections if s.name == "uploaded_files"] == ["reduced"]
+
+    monkeypatch.setenv("MORPHEO_INPUT_BUDGET_GENERATION", "10")
+
+    async def collect():
+        return [chunk async for chunk in service.generate_full_component_code("a todo app", use_cache=False)]
+
+    chunks = asyncio.run(collect())
+    assert len(chunks) == 1 and chunks[0].startswith("<!-- ERROR: The generation request is too large")
+
+
+def test_suggestion_correction_and_chat_prompts_fit_their_budgets(monkeypatch):
+    service = ComponentService(client=object())
+    html = "<html><body>" + "<p>lorem ipsum dolor</p>" * 5000 + "</body></html>"
+
+    monkeypatch.setenv("MORPHEO_INPUT_BUDGET_SUGGESTION", "3000")
+    suggestion = service._create_suggestion_prompt(html)
+    assert count_tokens(suggestion) <= 3000 and "characters omitted" in suggestion
+    assert suggestion.startswith("<html><body>", suggestion.index("```html\n") + 8) and suggestion.rstrip().endswith("one sentence each):")
+
+    monkeypatch.setenv("MORPHEO_INPUT_BUDGET_CORRECTION", "4000")
+    correction = service._create_security_correction_prompt("x" * 40000, html, ["Inline event handler"])
+    assert count_tokens(correction) <= 4000 and "Inline event handler" in correction
+    assert "---END PREVIOUS HTML OUTPUT---" in correction and correction.endswith("ending with </html>.")
+
+    monkeypatch.setenv("MORPHEO_INPUT_BUDGET_CHAT", "100")
+    turns = [{"role": role, "parts": [{"text": "word " * 40}]} for role in ("user", "model", "user", "model")]
+    turns.append({"role": "user", "parts": [{"text": "and now?"}]})
+    fitted = service.fit_conversation("chat", turns)
+    assert fitted[0]["role"] == "user" and fitted[-1] is turns[-1] and len(fitted) < len(turns)
+    with pytest.raises(PromptBudgetExceeded):
+        service.fit_conversation("chat", [{"role": "user", "parts": [{"text": "word " * 400}]}])
@@ -33,6 +33,10 @@ export interface UIState {
   streamCompletedSuccessfully: boolean;
   isCorrectingSecurity: boolean;
   isReplacingForCorrection: boolean;
+  // Content shown before a tentative (streamed) correction; restored if the correction is rolled back
+  tentativeRollbackHtml: string | null;
+  // A rollback restored an original that was cut off at a security finding: it is not a usable page
+  originalIncomplete: boolean;
   securityCorrectionError: string | null;
   loadedGenerationHtml: string | null;
   loadedGenerationPrompt: string | null;
@@ -68,6 +72,8 @@ const initialState: UIState = {
   streamCompletedSuccessfully: false,
   isCorrectingSecurity: false,
   isReplacingForCorrection: false,
+  tentativeRollbackHtml: null,
+  originalIncomplete: false,
   securityCorrectionError: null,
   loadedGenerationHtml: null,
   loadedGenerationPrompt: null,
@@ -645,6 +651,26 @@ export interface ExtractedComponentProperties {
   values: Record<string, any>;
 }
 
+// Tentative correction channel: a streamed security correction replaces the preview live and is
+// then committed (it scanned clean) or rolled back (the previous content is restored)
+const CORRECTION_TENTATIVE_START = '<!-- MORPHEO_CORRECTION_TENTATIVE_START -->';
+const CORRECTION_COMMIT = '<!-- MORPHEO_CORRECTION_COMMIT -->';
+const CORRECTION_ROLLBACK = '<!-- MORPHEO_CORRECTION_ROLLBACK -->';
+// Follows a rollback when the original stream was aborted at the finding, so the restored content is truncated
+const CORRECTION_ORIGINAL_INCOMPLETE = '<!-- MORPHEO_CORRECTION_ORIGINAL_INCOMPLETE -->';
+const ORIGINAL_INCOMPLETE_MESSAGE = 'The output was stopped at unsafe code and could not be corrected, so it is incomplete. Please try again.';
+
+// Appends streamed text to the content, without markdown code fences; false if there was nothing to append
+const appendStreamText = (state: UIState, text: string): boolean => {
+  if (text.trim() === '') {
+    return false;
+  }
+  let cleanedChunk = text.replace(/^\s*```html\s*\n?/im, '');
+  cleanedChunk = cleanedChunk.replace(/\n?\s*```\s*$/im, '');
+  state.generatedHtmlContent = (state.generatedHtmlContent || '') + cleanedChunk.trim(); // Trim the cleaned chunk too
+  return true;
+};
+
 const uiSlice = createSlice({
   name: 'ui',
   initialState,
@@ -684,6 +710,8 @@ const uiSlice = createSlice({
         state.modificationError = null;
         state.streamCompletedSuccessfully = false;
         state.isCorrectingSecurity = false;
+        state.tentativeRollbackHtml = null;
+        state.originalIncomplete = false;
         state.securityCorrectionError = null;
     },
     streamChunkReceived: (state, action: PayloadAction<{ chunk: string }>) => {
@@ -737,23 +765,72 @@ const uiSlice = createSlice({
         processingChunk = processingChunk.substring(0, processingChunk.indexOf('<!-- MORPHEO_REPLACE_WITH_CORRECTED_END -->'));
       }
 
-      // --- Append actual content --- 
-      // Only append if processingChunk has non-whitespace characters left
-      if (processingChunk.trim() !== '') {
-        // Basic cleaning for markdown code fences before appending
-        let cleanedChunk = processingChunk.replace(/^\s*```html\s*\n?/im, '');
-        cleanedChunk = cleanedChunk.replace(/\n?\s*```\s*$/im, '');
-        
-        state.generatedHtmlContent = (state.generatedHtmlContent || '') + cleanedChunk.trim(); // Trim the cleaned chunk too
-      } else {
-        // If, after stripping signals, the chunk is empty, we might not need to do anything further with appending.
-        // This prevents appending empty strings, but state changes from signals above would have already occurred.
-        hasContentToAppend = false;
+      // A streamed correction starts: keep the current content for a rollback and show the correction live
+      const tentativeIndex = processingChunk.indexOf(CORRECTION_TENTATIVE_START);
+      if (tentativeIndex !== -1) {
+        appendStreamText(state, processingChunk.substring(0, tentativeIndex)); // Still part of the original stream
+        state.tentativeRollbackHtml = state.generatedHtmlContent || '';
+        state.generatedHtmlContent = '';
+        state.isReplacingForCorrection = true;
+        state.isCorrectingSecurity = true;
+        state.securityCorrectionError = null;
+        processingChunk = processingChunk.substring(tentativeIndex + CORRECTION_TENTATIVE_START.length);
+      }
+      // The correction scanned clean: it becomes the content
+      const commitIndex = processingChunk.indexOf(CORRECTION_COMMIT);
+      if (commitIndex !== -1) {
+        appendStreamText(state, processingChunk.substring(0, commitIndex)); // Last part of the correction
+        state.tentativeRollbackHtml = null;
+        state.isReplacingForCorrection = false;
+        processingChunk = processingChunk.substring(commitIndex + CORRECTION_COMMIT.length);
+      }
+      // The correction failed or is unsafe too: restore the content from before it
+      const rollbackIndex = processingChunk.indexOf(CORRECTION_ROLLBACK);
+      if (rollbackIndex !== -1) {
+        state.generatedHtmlContent = state.tentativeRollbackHtml ?? state.generatedHtmlContent;
+        state.tentativeRollbackHtml = null;
+        state.isReplacingForCorrection = false;
+        processingChunk = processingChunk.substring(rollbackIndex + CORRECTION_ROLLBACK.length);
+      }
+      // The content just restored was cut off at the finding: it is discarded when the stream completes
+      if (processingChunk.includes(CORRECTION_ORIGINAL_INCOMPLETE)) {
+        state.originalIncomplete = true;
+        state.securityCorrectionError = ORIGINAL_INCOMPLETE_MESSAGE;
+        processingChunk = processingChunk.replace(CORRECTION_ORIGINAL_INCOMPLETE, '');
       }
+
+      // --- Append actual content --- 
+      // Only append if processingChunk has non-whitespace characters left (markdown code fences are stripped).
+      // If, after stripping signals, the chunk is empty, state changes from signals above have already occurred.
+      hasContentToAppend = appendStreamText(state, processingChunk);
       // The original `return` statements for some signals are removed to allow content within the same chunk
       // (before/after a signal) to be processed and appended if it exists.
     },
     streamComplete: (state, action: PayloadAction<{ isGenerating?: boolean; isModifying?: boolean }>) => {
+      if (state.tentativeRollbackHtml !== null) {
+        // The stream ended before a streamed correction was committed: keep the original content
+        state.generatedHtmlContent = state.tentativeRollbackHtml;
+        state.tentativeRollbackHtml = null;
+      }
+      if (state.originalIncomplete) {
+        // Never keep or record a truncated document: a generation fails, a modification keeps the previous page
+        state.originalIncomplete = false;
+        if (action.payload.isGenerating) {
+          state.generatingFullCode = false;
+          state.error = ORIGINAL_INCOMPLETE_MESSAGE;
+          state.generatedHtmlContent = null;
+          state.htmlHistory = [];
+          state.historyIndex = -1;
+        } else if (action.payload.isModifying) {
+          state.modifyingCode = false;
+          state.modificationError = ORIGINAL_INCOMPLETE_MESSAGE;
+          state.generatedHtmlContent = state.historyIndex >= 0 ? state.htmlHistory[state.historyIndex] : null;
+        }
+        state.streamCompletedSuccessfully = false;
+        state.isCorrectingSecurity = false;
+        state.isReplacingForCorrection = false;
+        return;
+      }
       let finalHtml = state.generatedHtmlContent || '';
       // Basic cleaning for markdown code fences
       finalHtml = finalHtml.replace(/^\s*```html\s*\n?/im, ''); // Remove ```html at the beginning
@@ -794,6 +871,8 @@ const uiSlice = createSlice({
         state.generatedHtmlContent = null;
         state.isCorrectingSecurity = false;
         state.isReplacingForCorrection = false;
+        state.tentativeRollbackHtml = null;
+        state.originalIncomplete = false;
         state.securityCorrectionError = null;
     },
     setLoadedGeneration: (state, action: PayloadAction<GenerationDetail>) => {